@@ -1,3 +1,5 @@
+import itertools
+
 import numpy as np
 floating  = np.float32
 
@@ -22,6 +24,32 @@ DEBUG : print as much information as possible to isolate the cause of a bug.
 """
 
 
+def per_moving(value, n_moving=None):
+    """One value of an argument of a batch registration per moving image
 
+    Parameters
+    ----------
+    value : None, str, array, shape (dim+1, dim+1), or iterable
+        None, a string or a matrix is shared by all the moving images, other
+        values must be iterables with one element per moving image.
+    n_moving : int, optional
+        Number of moving images. If None, the moving images are not known in
+        advance and an iterator over the values is returned, endless for a
+        shared value.
 
-
+    Returns
+    -------
+    values : list or iterator
+        The value of each moving image.
+    """
+    shared = value is None or isinstance(value, str) or \
+        (isinstance(value, np.ndarray) and value.ndim == 2)
+    if n_moving is None:
+        return itertools.repeat(value) if shared else iter(value)
+    if shared:
+        return [value] * n_moving
+    value = list(value)
+    if len(value) != n_moving:
+        raise ValueError('Expected one value per moving image (%d), got %d'
+                         % (n_moving, len(value)))
+    return value
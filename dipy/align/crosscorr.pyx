@@ -1,7 +1,11 @@
 """ Utility functions used by the Cross Correlation (CC) metric """
 
 import numpy as np
+from cython.parallel import parallel, prange
+from libc.stdlib cimport malloc, free
 from dipy.align.fused_types cimport floating
+from dipy.utils.omp import default_threads
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 cimport cython
 cimport numpy as cnp
 
@@ -125,6 +129,153 @@ cdef inline void _update_factors(double[:, :, :, :] factors,
             factors[ss, rr, cc, SIJ] += sval*mval
 
 
+cdef inline void _add_cc_terms(double *sums, double sval, double mval,
+                               double weight) nogil:
+    r"""Adds `weight` times the CC terms of a pair of values to `sums`
+    """
+    sums[SI] += weight * sval
+    sums[SI2] += weight * sval * sval
+    sums[SJ] += weight * mval
+    sums[SJ2] += weight * mval * mval
+    sums[SIJ] += weight * sval * mval
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _box_sums_2d(floating[:, :, :] static, floating[:, :, :] moving,
+                       cnp.npy_intp s, cnp.npy_intp radius, double *rows,
+                       double *sums) nogil:
+    r"""Sums of the CC terms of a slice along square windows
+
+    Computes, at each voxel of slice `s`, the sums of the static and moving
+    values, of their squares and of their products along the window of
+    (2 * radius + 1)^2 voxels of the slice centered at the voxel (clipped to
+    the slice), in that order. The sums are computed with running sums along
+    the rows, then along the columns of the slice.
+
+    Parameters
+    ----------
+    static : array, shape (S, R, C)
+        the static volume
+    moving : array, shape (S, R, C)
+        the moving volume
+    s : int
+        the slice whose sums are computed
+    radius : int
+        the radius of the windows
+    rows : pointer to R * C * 5 doubles
+        buffer for the sums along the rows
+    sums : pointer to R * C * 5 doubles
+        on output, the sums along the windows of each voxel
+    """
+    cdef:
+        cnp.npy_intp nr = static.shape[1]
+        cnp.npy_intp nc = static.shape[2]
+        cnp.npy_intp r, c, it
+        double window[5]
+
+    for r in range(nr):
+        for it in range(5):
+            window[it] = 0
+        for c in range(_int_min(radius, nc - 1) + 1):
+            _add_cc_terms(window, static[s, r, c], moving[s, r, c], 1)
+        for c in range(nc):
+            for it in range(5):
+                rows[(r * nc + c) * 5 + it] = window[it]
+            if c + radius + 1 < nc:
+                _add_cc_terms(window, static[s, r, c + radius + 1],
+                              moving[s, r, c + radius + 1], 1)
+            if c >= radius:
+                _add_cc_terms(window, static[s, r, c - radius],
+                              moving[s, r, c - radius], -1)
+    for c in range(nc):
+        for it in range(5):
+            window[it] = 0
+        for r in range(_int_min(radius, nr - 1) + 1):
+            for it in range(5):
+                window[it] += rows[(r * nc + c) * 5 + it]
+        for r in range(nr):
+            for it in range(5):
+                sums[(r * nc + c) * 5 + it] = window[it]
+            if r + radius + 1 < nr:
+                for it in range(5):
+                    window[it] += rows[((r + radius + 1) * nc + c) * 5 + it]
+            if r >= radius:
+                for it in range(5):
+                    window[it] -= rows[((r - radius) * nc + c) * 5 + it]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _precompute_cc_factors_slab_3d(floating[:, :, :] static,
+                                         floating[:, :, :] moving,
+                                         cnp.npy_intp radius,
+                                         cnp.npy_intp first,
+                                         cnp.npy_intp last,
+                                         double *ring,
+                                         cnp.npy_intp ring_size,
+                                         double *rows,
+                                         floating[:, :, :, :] factors) nogil:
+    r"""Computes the CC factors of slices first, ..., last - 1
+
+    The sums along the windows of the slices (see `_box_sums_2d`) are kept
+    in `ring`, a circular buffer of `ring_size` slices, and the sums of each
+    slice of the neighborhood of a voxel are added in increasing order, so
+    that the factors of a voxel don't depend on the slab it belongs to.
+    """
+    cdef:
+        cnp.npy_intp ns = static.shape[0]
+        cnp.npy_intp nr = static.shape[1]
+        cnp.npy_intp nc = static.shape[2]
+        cnp.npy_intp plane = nr * nc * 5
+        cnp.npy_intp ss, rr, cc, s, it, next_s
+        cnp.npy_intp firsts, lasts, firstr, lastr, firstc, lastc
+        cnp.npy_intp sides, sider, sidec
+        double cnt, Imean, Jmean, IJprods, Isq, Jsq
+        double sums[5]
+        double *window
+
+    next_s = _int_max(0, first - radius)
+    for ss in range(first, last):
+        firsts = _int_max(0, ss - radius)
+        lasts = _int_min(ns - 1, ss + radius)
+        sides = (lasts - firsts + 1)
+        while next_s <= lasts:
+            _box_sums_2d(static, moving, next_s, radius, rows,
+                         ring + (next_s % ring_size) * plane)
+            next_s += 1
+        for rr in range(nr):
+            firstr = _int_max(0, rr - radius)
+            lastr = _int_min(nr - 1, rr + radius)
+            sider = (lastr - firstr + 1)
+            for cc in range(nc):
+                firstc = _int_max(0, cc - radius)
+                lastc = _int_min(nc - 1, cc + radius)
+                sidec = (lastc - firstc + 1)
+                for it in range(5):
+                    sums[it] = 0
+                for s in range(firsts, lasts + 1):
+                    window = ring + (s % ring_size) * plane + (rr * nc + cc) * 5
+                    for it in range(5):
+                        sums[it] += window[it]
+                cnt = sides*sider*sidec
+                Imean = sums[SI] / cnt
+                Jmean = sums[SJ] / cnt
+                IJprods = (sums[SIJ] - Jmean * sums[SI] -
+                           Imean * sums[SJ] + cnt * Jmean * Imean)
+                Isq = (sums[SI2] - Imean * sums[SI] -
+                       Imean * sums[SI] + cnt * Imean * Imean)
+                Jsq = (sums[SJ2] - Jmean * sums[SJ] -
+                       Jmean * sums[SJ] + cnt * Jmean * Jmean)
+                factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
+                factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
+                factors[ss, rr, cc, 2] = IJprods
+                factors[ss, rr, cc, 3] = Isq
+                factors[ss, rr, cc, 4] = Jsq
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
@@ -146,6 +297,11 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         the moving volume (notice that both images must already be in a common
         reference domain, i.e. the same S, R, C)
     radius : the radius of the neighborhood (cube of (2 * radius + 1)^3 voxels)
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores). The volume is split in slabs of slices
+        processed in parallel, and the result doesn't depend on the number
+        of threads.
 
     Returns
     -------
@@ -176,117 +332,32 @@ def precompute_cc_factors_3d(floating[:, :, :] static,
         cnp.npy_intp nr = static.shape[1]
         cnp.npy_intp nc = static.shape[2]
         cnp.npy_intp side = 2 * radius + 1
-        cnp.npy_intp firstc, lastc, firstr, lastr, firsts, lasts
-        cnp.npy_intp s, r, c, it, sides, sider, sidec
-        double cnt
-        cnp.npy_intp ssss, sss, ss, rr, cc, prev_ss, prev_rr, prev_cc
-        double Imean, Jmean, IJprods, Isq, Jsq
-        double[:, :, :, :] temp = np.zeros((2, nr, nc, 5), dtype=np.float64)
+        cnp.npy_intp ring_size = _int_min(side, ns)
+        cnp.npy_intp plane = nr * nc * 5
+        cnp.npy_intp slab, n_slabs, i
+        double *ring
+        double *rows
         floating[:, :, :, :] factors = np.zeros((ns, nr, nc, 5),
                                                 dtype=np.asarray(static).dtype)
 
-    with nogil:
-        sss = 1
-        for s in range(ns+radius):
-            ss = _wrap(s - radius, ns)
-            sss = 1 - sss
-            firsts = _int_max(0, ss - radius)
-            lasts = _int_min(ns - 1, ss + radius)
-            sides = (lasts - firsts + 1)
-            for r in range(nr+radius):
-                rr = _wrap(r - radius, nr)
-                firstr = _int_max(0, rr - radius)
-                lastr = _int_min(nr - 1, rr + radius)
-                sider = (lastr - firstr + 1)
-                for c in range(nc+radius):
-                    cc = _wrap(c - radius, nc)
-                    # New corner
-                    _update_factors(temp, moving, static,
-                                    sss, rr, cc, s, r, c, 0)
-
-                    # Add signed sub-volumes
-                    if s > 0:
-                        prev_ss = 1 - sss
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += temp[prev_ss, rr, cc, it]
-                        if r > 0:
-                            prev_rr = _wrap(rr-1, nr)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, prev_rr, cc, it]
-                            if c > 0:
-                                prev_cc = _wrap(cc-1, nc)
-                                for it in range(5):
-                                    temp[sss, rr, cc, it] += \
-                                        temp[prev_ss, prev_rr, prev_cc, it]
-                        if c > 0:
-                            prev_cc = _wrap(cc-1, nc)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[prev_ss, rr, prev_cc, it]
-                    if(r > 0):
-                        prev_rr = _wrap(rr-1, nr)
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += \
-                                temp[sss, prev_rr, cc, it]
-                        if(c > 0):
-                            prev_cc = _wrap(cc-1, nc)
-                            for it in range(5):
-                                temp[sss, rr, cc, it] -= \
-                                    temp[sss, prev_rr, prev_cc, it]
-                    if(c > 0):
-                        prev_cc = _wrap(cc-1, nc)
-                        for it in range(5):
-                            temp[sss, rr, cc, it] += temp[sss, rr, prev_cc, it]
-
-                    # Add signed corners
-                    if s >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s-side, r, c, -1)
-                        if r >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r-side, c, 1)
-                            if c >= side:
-                                _update_factors(temp, moving, static, sss, rr,
-                                                cc, s-side, r-side, c-side, -1)
-                        if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s-side, r, c-side, 1)
-                    if r >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r-side, c, -1)
-                        if c >= side:
-                            _update_factors(temp, moving, static,
-                                            sss, rr, cc, s, r-side, c-side, 1)
-
-                    if c >= side:
-                        _update_factors(temp, moving, static,
-                                        sss, rr, cc, s, r, c-side, -1)
-                    # Compute final factors
-                    if s >= radius and r >= radius and c >= radius:
-                        firstc = _int_max(0, cc - radius)
-                        lastc = _int_min(nc - 1, cc + radius)
-                        sidec = (lastc - firstc + 1)
-                        cnt = sides*sider*sidec
-                        Imean = temp[sss, rr, cc, SI] / cnt
-                        Jmean = temp[sss, rr, cc, SJ] / cnt
-                        IJprods = (temp[sss, rr, cc, SIJ] -
-                                   Jmean * temp[sss, rr, cc, SI] -
-                                   Imean * temp[sss, rr, cc, SJ] +
-                                   cnt * Jmean * Imean)
-                        Isq = (temp[sss, rr, cc, SI2] -
-                               Imean * temp[sss, rr, cc, SI] -
-                               Imean * temp[sss, rr, cc, SI] +
-                               cnt * Imean * Imean)
-                        Jsq = (temp[sss, rr, cc, SJ2] -
-                               Jmean * temp[sss, rr, cc, SJ] -
-                               Jmean * temp[sss, rr, cc, SJ] +
-                               cnt * Jmean * Jmean)
-                        factors[ss, rr, cc, 0] = static[ss, rr, cc] - Imean
-                        factors[ss, rr, cc, 1] = moving[ss, rr, cc] - Jmean
-                        factors[ss, rr, cc, 2] = IJprods
-                        factors[ss, rr, cc, 3] = Isq
-                        factors[ss, rr, cc, 4] = Jsq
+    if num_threads is not None:
+        num_threads = max(1, num_threads)
+    # One slab of slices per thread
+    threads = default_threads if num_threads is None else num_threads
+    slab = (ns + threads - 1) // threads
+    n_slabs = (ns + slab - 1) // slab
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        ring = <double *> malloc(ring_size * plane * sizeof(double))
+        rows = <double *> malloc(plane * sizeof(double))
+        for i in prange(n_slabs, schedule='static'):
+            _precompute_cc_factors_slab_3d(static, moving, radius, i * slab,
+                                           _int_min(ns, (i + 1) * slab), ring,
+                                           ring_size, rows, factors)
+        free(ring)
+        free(rows)
+    if num_threads is not None:
+        restore_default_num_threads()
     return factors
 
 
@@ -354,7 +425,7 @@ def precompute_cc_factors_3d_test(floating[:, :, :] static,
 @cython.cdivision(True)
 def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                                floating[:, :, :, :] factors,
-                               cnp.npy_intp radius):
+                               cnp.npy_intp radius, num_threads=None):
     r"""Gradient of the CC Metric w.r.t. the forward transformation
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -372,6 +443,9 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -396,10 +470,16 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
         double energy = 0
         cnp.npy_intp s, r, c
         double Ii, Ji, sfm, sff, smm, localCorrelation, temp
+        # The energy of each slice, added in order so that the energy doesn't
+        # depend on the number of threads
+        double[:] slice_energy = np.zeros((ns,), dtype=np.float64)
         floating[:, :, :, :] out =\
             np.zeros((ns, nr, nc, 3), dtype=np.asarray(grad_static).dtype)
+    if num_threads is not None:
+        num_threads = max(1, num_threads)
+    set_num_threads(num_threads)
     with nogil:
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, schedule='static'):
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -413,11 +493,15 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
                     if(sff * smm > 1e-5):
                         localCorrelation = sfm * sfm / (sff * smm)
                     if(localCorrelation < 1):  # avoid bad values...
-                        energy -= localCorrelation
+                        slice_energy[s] -= localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ji - sfm / sff * Ii)
                     out[s, r, c, 0] -= temp * grad_static[s, r, c, 0]
                     out[s, r, c, 1] -= temp * grad_static[s, r, c, 1]
                     out[s, r, c, 2] -= temp * grad_static[s, r, c, 2]
+        for s in range(radius, ns-radius):
+            energy += slice_energy[s]
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out), energy
 
 
@@ -426,7 +510,7 @@ def compute_cc_forward_step_3d(floating[:, :, :, :] grad_static,
 @cython.cdivision(True)
 def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                                 floating[:, :, :, :] factors,
-                                cnp.npy_intp radius):
+                                cnp.npy_intp radius, num_threads=None):
     r"""Gradient of the CC Metric w.r.t. the backward transformation
 
     Computes the gradient of the Cross Correlation metric for symmetric
@@ -444,6 +528,9 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         the radius of the neighborhood used for the CC metric when
         computing the factors. The returned vector field will be
         zero along a boundary of width radius voxels.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -469,11 +556,17 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
         cnp.npy_intp s, r, c
         double energy = 0
         double Ii, Ji, sfm, sff, smm, localCorrelation, temp
+        # The energy of each slice, added in order so that the energy doesn't
+        # depend on the number of threads
+        double[:] slice_energy = np.zeros((ns,), dtype=np.float64)
         floating[:, :, :, :] out = np.zeros((ns, nr, nc, 3), dtype=ftype)
 
+    if num_threads is not None:
+        num_threads = max(1, num_threads)
+    set_num_threads(num_threads)
     with nogil:
 
-        for s in range(radius, ns-radius):
+        for s in prange(radius, ns-radius, schedule='static'):
             for r in range(radius, nr-radius):
                 for c in range(radius, nc-radius):
                     Ii = factors[s, r, c, 0]
@@ -487,11 +580,15 @@ def compute_cc_backward_step_3d(floating[:, :, :, :] grad_moving,
                     if(sff * smm > 1e-5):
                         localCorrelation = sfm * sfm / (sff * smm)
                     if(localCorrelation < 1):  # avoid bad values...
-                        energy -= localCorrelation
+                        slice_energy[s] -= localCorrelation
                     temp = 2.0 * sfm / (sff * smm) * (Ii - sfm / smm * Ji)
                     out[s, r, c, 0] -= temp * grad_moving[s, r, c, 0]
                     out[s, r, c, 1] -= temp * grad_moving[s, r, c, 1]
                     out[s, r, c, 2] -= temp * grad_moving[s, r, c, 2]
+        for s in range(radius, ns-radius):
+            energy += slice_energy[s]
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out), energy
 
 
@@ -43,6 +43,10 @@
 
 """
 
+from contextlib import contextmanager
+import copy
+from time import time
+
 import numpy as np
 import numpy.linalg as npl
 import scipy.ndimage as ndimage
@@ -51,11 +55,14 @@ from dipy.core.interpolation import (interpolate_scalar_2d,
                                      interpolate_scalar_3d)
 from dipy.align import vector_fields as vf
 from dipy.align import VerbosityLevels
+from dipy.align import per_moving
 from dipy.align.parzenhist import (ParzenJointHistogram,
                                    sample_domain_regular,
                                    compute_parzen_mi)
 from dipy.align.imwarp import (get_direction_and_spacings, ScaleSpace)
 from dipy.align.scalespace import IsotropicScaleSpace
+from dipy.utils.omp import default_threads
+from dipy.utils.parallel import determine_num_jobs, paramap
 from warnings import warn
 
 _interp_options = ['nearest', 'linear']
@@ -137,6 +144,10 @@ class AffineMap(object):
         self.domain_grid2world = domain_grid2world
         self.codomain_shape = codomain_grid_shape
         self.codomain_grid2world = codomain_grid2world
+        # Number of iterations and time (in seconds) spent at each level of
+        # the AffineRegistration that produced this map, coarsest first
+        self.iterations = None
+        self.timings = None
 
     def get_affine(self):
         """Return the value of the transformation, not a reference.
@@ -460,7 +471,7 @@ class AffineMap(object):
 
 class MutualInformationMetric(object):
 
-    def __init__(self, nbins=32, sampling_proportion=None):
+    def __init__(self, nbins=32, sampling_proportion=None, num_threads=None):
         r"""Initialize an instance of the Mutual Information metric.
 
         This class implements the methods required by Optimizer to drive the
@@ -480,6 +491,11 @@ class MutualInformationMetric(object):
             then sparse sampling is used, where `sampling_proportion`
             specifies the proportion of voxels to be used. The default is
             None.
+        num_threads : int, optional
+            Number of threads used to compute the histograms and their
+            gradient, and the gradient of 3D moving images. If None (default)
+            then all available threads will be used (all CPU cores). The
+            metric doesn't depend on the number of threads.
 
         Notes
         -----
@@ -492,13 +508,15 @@ class MutualInformationMetric(object):
         not applied.
 
         """
-        self.histogram = ParzenJointHistogram(nbins)
+        self.histogram = ParzenJointHistogram(nbins, num_threads)
         self.sampling_proportion = sampling_proportion
+        self.num_threads = num_threads
         self.metric_val = None
         self.metric_grad = None
 
     def setup(self, transform, static, moving, static_grid2world=None,
-              moving_grid2world=None, starting_affine=None):
+              moving_grid2world=None, starting_affine=None,
+              static_samples=None):
         r"""Prepare the metric to compute intensity densities and gradients.
 
         The histograms will be setup to compute probability densities of
@@ -529,6 +547,11 @@ class MutualInformationMetric(object):
             instead of manually transforming the moving image to reduce
             interpolation artifacts. The default is None, implying no
             pre-alignment is performed.
+        static_samples : tuple, optional
+            the sampling points and the static intensities at these points,
+            as returned by `sample_static` for the same `static` image. They
+            are computed if None (default). Passing them avoids sampling the
+            static image again when it is registered with many moving images.
 
         """
         n = transform.get_number_of_parameters()
@@ -567,25 +590,61 @@ class MutualInformationMetric(object):
             self.samples = None
             self.ns = 0
         else:
-            k = int(np.ceil(1.0 / self.sampling_proportion))
-            shape = np.array(static.shape, dtype=np.int32)
-            self.samples = sample_domain_regular(k, shape, static_grid2world)
-            self.samples = np.array(self.samples)
+            if static_samples is None:
+                static_samples = self.sample_static(static, static_grid2world)
+            self.samples, self.static_vals = static_samples
             self.ns = self.samples.shape[0]
-            # Add a column of ones (homogeneous coordinates)
-            self.samples = np.hstack((self.samples, np.ones(self.ns)[:, None]))
             if self.starting_affine is None:
                 self.samples_prealigned = self.samples
             else:
                 self.samples_prealigned = \
                     self.starting_affine.dot(self.samples.T).T
-            # Sample the static image
-            static_p = self.static_world2grid.dot(self.samples.T).T
-            static_p = static_p[..., :self.dim]
-            self.static_vals, inside = self.interp_method(static, static_p)
-            self.static_vals = np.array(self.static_vals, dtype=np.float64)
         self.histogram.setup(self.static, self.moving)
 
+    def sample_static(self, static, static_grid2world=None):
+        r"""Sample the static image at the points used by the sparse metric.
+
+        The sampling points only depend on the static image, so that they can
+        be computed once and given to `setup` for each moving image
+        registered to `static`.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            static image
+        static_grid2world : array (dim+1, dim+1), optional
+            the grid-to-space transform of the static image. The default is
+            None, implying the transform is the identity.
+
+        Returns
+        -------
+        static_samples : tuple or None
+            the sampling points, array of shape (n, dim+1) in physical space
+            and homogeneous coordinates, and the intensities of `static` at
+            these points, array of shape (n,). None if all the voxels are used
+            (`sampling_proportion` is None).
+
+        """
+        if self.sampling_proportion is None:
+            return None
+        dim = len(static.shape)
+        if static_grid2world is None:
+            static_grid2world = np.eye(dim + 1)
+        k = int(np.ceil(1.0 / self.sampling_proportion))
+        shape = np.array(static.shape, dtype=np.int32)
+        samples = np.array(sample_domain_regular(k, shape, static_grid2world))
+        ns = samples.shape[0]
+        # Add a column of ones (homogeneous coordinates)
+        samples = np.hstack((samples, np.ones(ns)[:, None]))
+        # Sample the static image
+        static_p = npl.inv(static_grid2world).dot(samples.T).T
+        static_p = static_p[..., :dim]
+        if dim == 2:
+            static_vals, inside = interpolate_scalar_2d(static, static_p)
+        else:
+            static_vals, inside = interpolate_scalar_3d(static, static_p)
+        return samples, np.array(static_vals, dtype=np.float64)
+
     def _update_histogram(self):
         r"""Update the histogram according to the current affine transform.
 
@@ -677,7 +736,8 @@ class MutualInformationMetric(object):
                                             self.moving_world2grid,
                                             self.moving_spacing,
                                             self.static.shape,
-                                            grid_to_world)
+                                            grid_to_world,
+                                            self.num_threads)
                 # The Jacobian must be evaluated at the pre-aligned points
                 H.update_gradient_dense(
                     params,
@@ -790,7 +850,11 @@ class AffineRegistration(object):
                  method='L-BFGS-B',
                  ss_sigma_factor=None,
                  options=None,
-                 verbosity=VerbosityLevels.STATUS):
+                 verbosity=VerbosityLevels.STATUS,
+                 sampling_proportions=None,
+                 opt_tol=None,
+                 patience=5,
+                 skip_finest=False):
         """Initialize an instance of the AffineRegistration class.
 
         Parameters
@@ -831,6 +895,35 @@ class AffineRegistration(object):
         options : dict, optional
             extra optimization options. The default is None, implying
             no extra options are passed to the optimizer.
+        sampling_proportions : sequence of floats or None, optional
+            the proportion of voxels sampled by the metric at each scale,
+            `sampling_proportions[0]` corresponding to the coarsest scale as
+            in `level_iters`. None at a scale means that all the voxels are
+            used. It overrides the `sampling_proportion` of the metric at each
+            scale, e.g. [None, 0.5, 0.1] uses all the voxels of the small
+            coarse images and a few voxels of the full resolution images.
+            The default is None, implying the metric's sampling proportion
+            is used at all scales.
+        opt_tol : float, optional
+            the optimization of a scale stops when the value of the metric
+            decreased by less than `opt_tol` during the last `patience`
+            iterations, even if `level_iters` are not done. The default is
+            None, implying each scale runs until the optimizer converges or
+            reaches its maximum number of iterations.
+        patience : int, optional
+            the number of iterations over which the decrease of the metric is
+            compared to `opt_tol`. The default is 5.
+        skip_finest : boolean, optional
+            if True, the finest scale is not optimized when the optimization
+            of the previous scale decreased the metric by less than `opt_tol`,
+            that is, when the transform already converged at the coarser
+            scales. Only used if `opt_tol` is not None. The default is False.
+
+        Notes
+        -----
+        The number of iterations and the time (in seconds) spent at each
+        scale are recorded in the `iterations` and `timings` attributes of
+        the returned AffineMap, coarsest scale first.
 
         """
         self.metric = metric
@@ -859,6 +952,14 @@ class AffineRegistration(object):
             self.factors = factors
             self.sigmas = sigmas
 
+        if sampling_proportions is not None and \
+                len(sampling_proportions) != self.levels:
+            raise ValueError('There must be one sampling proportion per '
+                             'level of the scale space')
+        self.sampling_proportions = sampling_proportions
+        self.opt_tol = opt_tol
+        self.patience = patience
+        self.skip_finest = skip_finest
         self.verbosity = verbosity
 
     # Separately add a string that tells about the verbosity kwarg. This needs
@@ -916,7 +1017,20 @@ class AffineRegistration(object):
                 Start from identity
 
         """
-        self.dim = len(static.shape)
+        self._init_static(static, static_grid2world)
+        self._init_moving(static, moving, transform, params0,
+                          static_grid2world, moving_grid2world,
+                          starting_affine)
+
+    def _init_moving(self, static, moving, transform, params0,
+                     static_grid2world, moving_grid2world, starting_affine):
+        r"""Initialize the registration of a moving image.
+
+        Computes the starting affine and the scale space of the moving image.
+        The scale space of the static image must have been built by
+        `_init_static`. The parameters are the same as `_init_optimizer`.
+
+        """
         self.transform = transform
         n = transform.get_number_of_parameters()
         self.nparams = n
@@ -951,36 +1065,81 @@ class AffineRegistration(object):
         else:
             raise ValueError('Invalid starting_affine matrix')
         # Extract information from affine matrices to create the scale space
-        static_direction, static_spacing = \
-            get_direction_and_spacings(static_grid2world, self.dim)
         moving_direction, moving_spacing = \
             get_direction_and_spacings(moving_grid2world, self.dim)
 
-        static = ((static.astype(np.float64) - static.min()) /
-                  (static.max() - static.min()))
         moving = ((moving.astype(np.float64) - moving.min()) /
                   (moving.max() - moving.min()))
 
-        # Build the scale space of the input images
+        # Build the scale space of the moving image
         if self.use_isotropic:
             self.moving_ss = IsotropicScaleSpace(moving, self.factors,
                                                  self.sigmas,
                                                  moving_grid2world,
                                                  moving_spacing, False)
+        else:
+            self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
+                                        moving_spacing, self.ss_sigma_factor,
+                                        False)
+
+    def _init_static(self, static, static_grid2world):
+        r"""Build the scale space of the static image.
 
+        The smoothed static image is resampled to the grid of each level of
+        the scale space, and the part of the metric depending only on the
+        static image is precomputed at each level, so that they can be shared
+        by the registrations of many moving images.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            the image to be used as reference during optimization.
+        static_grid2world : array, shape (dim+1, dim+1)
+            the voxel-to-space transformation associated with the static image
+
+        """
+        self.dim = len(static.shape)
+        static_direction, static_spacing = \
+            get_direction_and_spacings(static_grid2world, self.dim)
+
+        static = ((static.astype(np.float64) - static.min()) /
+                  (static.max() - static.min()))
+
+        if self.use_isotropic:
             self.static_ss = IsotropicScaleSpace(static, self.factors,
                                                  self.sigmas,
                                                  static_grid2world,
                                                  static_spacing, False)
         else:
-            self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
-                                        moving_spacing, self.ss_sigma_factor,
-                                        False)
-
             self.static_ss = ScaleSpace(static, self.levels, static_grid2world,
                                         static_spacing, self.ss_sigma_factor,
                                         False)
 
+        original_static_shape = self.static_ss.get_image(0).shape
+        original_static_grid2world = self.static_ss.get_affine(0)
+        sample_static = getattr(self.metric, 'sample_static', None)
+        self.static_levels = []
+        with self._restored_sampling():
+            for level in range(self.levels):
+                # Resample the smooth static image to the shape of this level
+                smooth_static = self.static_ss.get_image(level)
+                current_static_shape = self.static_ss.get_domain_shape(level)
+                current_static_grid2world = self.static_ss.get_affine(level)
+                current_affine_map = AffineMap(None,
+                                               current_static_shape,
+                                               current_static_grid2world,
+                                               original_static_shape,
+                                               original_static_grid2world)
+                current_static = current_affine_map.transform(smooth_static)
+                static_samples = None
+                self._set_level_sampling(level)
+                if sample_static is not None:
+                    static_samples = sample_static(current_static,
+                                                   current_static_grid2world)
+                self.static_levels.append((current_static,
+                                           current_static_grid2world,
+                                           static_samples))
+
     def optimize(self, static, moving, transform, params0,
                  static_grid2world=None, moving_grid2world=None,
                  starting_affine=None, ret_metric=False):
@@ -1042,7 +1201,36 @@ class AffineRegistration(object):
                              static_grid2world, moving_grid2world,
                              starting_affine)
         del starting_affine  # Now we must refer to self.starting_affine
+        return self._optimize(ret_metric)
+
+    def _set_level_sampling(self, level):
+        r"""Set the sampling proportion of the metric at a level.
+        """
+        if self.sampling_proportions is not None:
+            self.metric.sampling_proportion = \
+                self.sampling_proportions[-1 - level]
+
+    @contextmanager
+    def _restored_sampling(self):
+        r"""Restore the sampling proportion of the metric on exit, after it
+        was set at each level by `_set_level_sampling`.
+        """
+        if self.sampling_proportions is None:
+            yield
+            return
+        sampling_proportion = self.metric.sampling_proportion
+        try:
+            yield
+        finally:
+            self.metric.sampling_proportion = sampling_proportion
+
+    def _optimize(self, ret_metric):
+        r"""Run the multi-resolution iterations of an initialized optimizer.
+        """
+        with self._restored_sampling():
+            return self._optimize_levels(ret_metric)
 
+    def _optimize_levels(self, ret_metric):
         # Multi-resolution iterations
         original_static_shape = self.static_ss.get_image(0).shape
         original_static_grid2world = self.static_ss.get_affine(0)
@@ -1054,31 +1242,43 @@ class AffineRegistration(object):
                                original_moving_shape,
                                original_moving_grid2world)
 
+        iterations = [0] * self.levels
+        timings = [0.0] * self.levels
+        level_decrease = None
         for level in range(self.levels - 1, -1, -1):
             self.current_level = level
             max_iter = self.level_iters[-1 - level]
+            if (level == 0 and self.skip_finest and level_decrease is not None
+                    and level_decrease < self.opt_tol):
+                if self.verbosity >= VerbosityLevels.STATUS:
+                    print('Skipping level 0: the metric decreased by %g at '
+                          'level 1' % (level_decrease,))
+                break
             if self.verbosity >= VerbosityLevels.STATUS:
                 print('Optimizing level %d [max iter: %d]' % (level, max_iter))
+            start = time()
 
-            # Resample the smooth static image to the shape of this level
-            smooth_static = self.static_ss.get_image(level)
-            current_static_shape = self.static_ss.get_domain_shape(level)
-            current_static_grid2world = self.static_ss.get_affine(level)
-            current_affine_map = AffineMap(None,
-                                           current_static_shape,
-                                           current_static_grid2world,
-                                           original_static_shape,
-                                           original_static_grid2world)
-            current_static = current_affine_map.transform(smooth_static)
+            # The smooth static image resampled to the shape of this level
+            current_static, current_static_grid2world, static_samples = \
+                self.static_levels[level]
 
             # The moving image is full resolution
             current_moving_grid2world = original_moving_grid2world
 
             current_moving = self.moving_ss.get_image(level)
             # Prepare the metric for iterations at this resolution
-            self.metric.setup(transform, current_static, current_moving,
-                              current_static_grid2world,
-                              current_moving_grid2world, self.starting_affine)
+            self._set_level_sampling(level)
+            if static_samples is None:
+                self.metric.setup(self.transform, current_static,
+                                  current_moving, current_static_grid2world,
+                                  current_moving_grid2world,
+                                  self.starting_affine)
+            else:
+                self.metric.setup(self.transform, current_static,
+                                  current_moving, current_static_grid2world,
+                                  current_moving_grid2world,
+                                  self.starting_affine,
+                                  static_samples=static_samples)
 
             # Optimize this level
             if self.options is None:
@@ -1090,11 +1290,32 @@ class AffineRegistration(object):
             else:
                 self.options['maxiter'] = max_iter
 
-            opt = Optimizer(self.metric.distance_and_gradient,
-                            self.params0,
-                            method=self.method, jac=True,
-                            options=self.options)
-            params = opt.xopt
+            level_decrease = None
+            if self.opt_tol is None:
+                opt = Optimizer(self.metric.distance_and_gradient,
+                                self.params0,
+                                method=self.method, jac=True,
+                                options=self.options)
+                xopt, fopt, nit = opt.xopt, opt.fopt, opt.nit
+            else:
+                monitor = _ConvergenceMonitor(
+                    self.metric.distance_and_gradient, self.opt_tol,
+                    self.patience)
+                try:
+                    opt = Optimizer(monitor, self.params0,
+                                    method=self.method, jac=True,
+                                    callback=monitor.callback,
+                                    options=self.options)
+                    xopt, fopt, nit = opt.xopt, opt.fopt, opt.nit
+                except _MetricConverged:
+                    xopt, fopt, nit = monitor.xopt, monitor.fopt, monitor.nit
+                    if self.verbosity >= VerbosityLevels.STATUS:
+                        print('Level %d converged after %d iterations' %
+                              (level, nit))
+                level_decrease = monitor.values[0] - fopt
+            params = xopt
+            iterations[-1 - level] = nit
+            timings[-1 - level] = time() - start
 
             # Update starting_affine matrix with optimal parameters
             T = self.transform.param_to_matrix(params)
@@ -1104,10 +1325,232 @@ class AffineRegistration(object):
             self.params0 = self.transform.get_identity_parameters()
 
         affine_map.set_affine(self.starting_affine)
+        affine_map.iterations = iterations
+        affine_map.timings = timings
         if ret_metric:
-            return affine_map, opt.xopt, opt.fopt
+            return affine_map, xopt, fopt
         return affine_map
 
+    def optimize_batch(self, static, movings, transform, params0=None,
+                       static_grid2world=None, moving_grid2world=None,
+                       starting_affine=None, ret_metric=False,
+                       engine='thread', n_jobs=None):
+        r""" Register many moving images towards the same static image.
+
+        The scale space of the static image, its resampling to each level and
+        the static part of the metric (e.g. the sampling points of the Mutual
+        Information) are computed once and shared by all the registrations,
+        which run concurrently. Each registration gives the same result as
+        `optimize` with the same arguments.
+
+        Parameters
+        ----------
+        static : 2D or 3D array
+            the image to be used as reference during optimization.
+        movings : sequence of 2D or 3D arrays
+            the images to be registered towards `static`.
+        transform : instance of Transform, or sequence
+            the transformation with respect to whose parameters the gradient
+            must be computed, or a sequence of them. Each moving image is then
+            registered with each transformation in turn, starting from the
+            result of the previous one (e.g. translation, rigid and affine).
+        params0 : array, shape (n,), optional
+            parameters from which to start the optimization of each moving
+            image with the first transformation. If None (default), the
+            optimization will start at the identity transform, as it does for
+            the next transformations.
+        static_grid2world : array, shape (dim+1, dim+1), optional
+            the voxel-to-space transformation associated with the static
+            image. The default is None, implying the transform is the
+            identity.
+        moving_grid2world : array, shape (dim+1, dim+1), or sequence, optional
+            the voxel-to-space transformation associated with the moving
+            images, or a sequence of them, one per moving image. The default
+            is None, implying the transform is the identity.
+        starting_affine : string, or matrix, or None, or sequence, optional
+            the starting affine of all the moving images (see `optimize`) or
+            a sequence of them, one per moving image. The default is None.
+        ret_metric : boolean, optional
+            if True, the optimal parameters and the value of the metric are
+            returned with each affine map, as in `optimize`
+            (default 'False').
+        engine : {'serial', 'thread', 'process'}, optional
+            how the registrations run concurrently, see
+            ``dipy.utils.parallel.paramap``. Default 'thread'.
+        n_jobs : int, optional
+            Number of registrations running concurrently. If None (default),
+            the number of cpus. When registrations run concurrently, each one
+            uses its share of the `num_threads` of the metric (all available
+            threads if None).
+
+        Returns
+        -------
+        affine_maps : list
+            the AffineMap registering each moving image, or the tuples
+            ``(affine_map, xopt, fopt)`` if `ret_metric` is True.
+
+        See Also
+        --------
+        iter_optimize_batch : the same registrations, with the moving images
+            loaded and the results returned one at a time.
+
+        """
+        movings = list(movings)
+        n_moving = len(movings)
+        items = zip(movings,
+                    per_moving(moving_grid2world, n_moving),
+                    per_moving(starting_affine, n_moving))
+        return list(self._iter_batch(static, items, n_moving, transform,
+                                     params0, static_grid2world, ret_metric,
+                                     engine, n_jobs))
+
+    def iter_optimize_batch(self, static, movings, transform, params0=None,
+                            static_grid2world=None, moving_grid2world=None,
+                            starting_affine=None, ret_metric=False,
+                            engine='thread', n_jobs=None):
+        r""" Register many moving images towards the same static image, one
+        at a time.
+
+        Same as `optimize_batch`, except that `movings` (and the values of
+        `moving_grid2world` and `starting_affine` given per moving image)
+        can be iterables consumed lazily, e.g. generators loading the images
+        from files. Only a few moving images per job are in memory at once,
+        and the results are returned as a generator, in the order of
+        `movings`, as soon as they are available. The parameters are the
+        same as `optimize_batch`.
+
+        Returns
+        -------
+        affine_maps : generator
+            the AffineMap registering each moving image, or the tuples
+            ``(affine_map, xopt, fopt)`` if `ret_metric` is True.
+
+        """
+        items = zip(movings, per_moving(moving_grid2world),
+                    per_moving(starting_affine))
+        return self._iter_batch(static, items, None, transform, params0,
+                                static_grid2world, ret_metric, engine,
+                                n_jobs)
+
+    def _iter_batch(self, static, items, n_moving, transform, params0,
+                    static_grid2world, ret_metric, engine, n_jobs):
+        r"""Register the (moving, moving_grid2world, starting_affine) items
+        of `optimize_batch` and `iter_optimize_batch`.
+        """
+        if isinstance(transform, (list, tuple)):
+            transforms = list(transform)
+        else:
+            transforms = [transform]
+        # The scale space of the static image is built once in a copy, so
+        # that the state of this instance is left untouched
+        batch = copy.copy(self)
+        n_jobs = determine_num_jobs(n_jobs)
+        n_concurrent = n_jobs if n_moving is None else min(n_jobs, n_moving)
+        if (engine != 'serial' and n_concurrent > 1 and
+                isinstance(self.metric, MutualInformationMetric)):
+            # Each registration runs its kernels with a share of the threads
+            total_threads = default_threads \
+                if self.metric.num_threads is None else \
+                self.metric.num_threads
+            num_threads = max(1, total_threads // n_concurrent)
+            batch.metric = copy.deepcopy(self.metric)
+            batch.metric.num_threads = num_threads
+            batch.metric.histogram.num_threads = num_threads
+        batch._init_static(static, static_grid2world)
+        shared = {'registration': batch, 'static': static,
+                  'static_grid2world': static_grid2world}
+        if engine == 'process' and n_jobs > 1:
+            # The scale space is inherited by the forked workers, not pickled
+            func_args = [None]
+            initializer, initargs = _init_batch_worker, (shared,)
+        else:
+            func_args = [shared]
+            initializer, initargs = None, ()
+        func_args += [transforms, params0, ret_metric]
+        return paramap(_optimize_batch_item, items, engine=engine,
+                       n_jobs=n_jobs, func_args=func_args,
+                       initializer=initializer, initargs=initargs)
+
+
+class _MetricConverged(Exception):
+    pass
+
+
+class _ConvergenceMonitor(object):
+    r"""Stops the optimization of a level when the metric stops decreasing.
+
+    It is given to `Optimizer` as the function to minimize, to record the
+    value of the metric at each point, and as the callback checking after
+    each iteration whether the metric decreased by more than `tol` during
+    the last `patience` iterations. Otherwise `_MetricConverged` is raised
+    and the last iterate is kept in `xopt` and `fopt`.
+    """
+
+    def __init__(self, fun, tol, patience):
+        self.fun = fun
+        self.tol = tol
+        self.patience = patience
+        # Values of the metric at the starting point and at each iterate
+        self.values = []
+        self.nit = 0
+        self.xopt = None
+        self.fopt = None
+        self._last_params = None
+        self._last_value = None
+
+    def __call__(self, params):
+        value = self.fun(params)
+        self._last_params = np.array(params)
+        self._last_value = value[0]
+        if not self.values:
+            self.values.append(value[0])
+        return value
+
+    def callback(self, xk):
+        self.nit += 1
+        if np.array_equal(xk, self._last_params):
+            value = self._last_value
+        else:
+            value = self.fun(xk)[0]
+        self.values.append(value)
+        self.xopt = np.array(xk)
+        self.fopt = value
+        if (len(self.values) > self.patience and
+                self.values[-1 - self.patience] - value < self.tol):
+            raise _MetricConverged()
+
+
+# State shared with the batch registration worker processes, set by
+# _init_batch_worker
+_batch_shared = None
+
+
+def _init_batch_worker(shared):
+    global _batch_shared
+    _batch_shared = shared
+
+
+def _optimize_batch_item(item, shared, transforms, params0, ret_metric):
+    """Register one moving image of `AffineRegistration.optimize_batch`"""
+    if shared is None:
+        shared = _batch_shared
+    moving, moving_grid2world, starting_affine = item
+    for transform in transforms:
+        # Each registration has its own metric, optimizer options and state,
+        # the static scale space is shared
+        registration = copy.copy(shared['registration'])
+        registration.metric = copy.deepcopy(registration.metric)
+        if registration.options is not None:
+            registration.options = dict(registration.options)
+        registration._init_moving(shared['static'], moving, transform,
+                                  params0, shared['static_grid2world'],
+                                  moving_grid2world, starting_affine)
+        result = registration._optimize(ret_metric)
+        # The next transformation starts from this one, at identity
+        params0 = None
+        starting_affine = result[0].affine if ret_metric else result.affine
+    return result
+
 
 def transform_centers_of_mass(static, static_grid2world,
                               moving, moving_grid2world):
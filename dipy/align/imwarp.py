@@ -1,7 +1,9 @@
 """  Classes and functions for Symmetric Diffeomorphic Registration """
 
+import copy
 import logging
 import abc
+from functools import partial
 
 import numpy as np
 import numpy.linalg as npl
@@ -11,7 +13,10 @@ from dipy.align import vector_fields as vfu
 from dipy.align import floating
 from dipy.align import VerbosityLevels
 from dipy.align import Bunch
+from dipy.align import per_moving
 from dipy.align.scalespace import ScaleSpace
+from dipy.utils.omp import default_threads
+from dipy.utils.parallel import determine_num_jobs, paramap
 
 RegistrationStages = Bunch(INIT_START=0,
                            INIT_END=1,
@@ -258,11 +263,12 @@ class DiffeomorphicMap(object):
         self.backward = np.zeros(tuple(self.disp_shape) + (self.dim,),
                                  dtype=floating)
 
-    def _get_warping_function(self, interpolation):
+    def _get_warping_function(self, interpolation, num_threads=None):
         """Appropriate warping function for the given interpolation type
 
         Returns the right warping function from vector_fields that must be
-        called for the specified data dimension and interpolation type
+        called for the specified data dimension and interpolation type. The
+        3D warping functions use `num_threads` threads.
         """
         if self.dim == 2:
             if interpolation == 'linear':
@@ -271,13 +277,13 @@ class DiffeomorphicMap(object):
                 return vfu.warp_2d_nn
         else:
             if interpolation == 'linear':
-                return vfu.warp_3d
+                return partial(vfu.warp_3d, num_threads=num_threads)
             else:
-                return vfu.warp_3d_nn
+                return partial(vfu.warp_3d_nn, num_threads=num_threads)
 
     def _warp_forward(self, image, interpolation='linear',
                       image_world2grid=None, out_shape=None,
-                      out_grid2world=None):
+                      out_grid2world=None, num_threads=None):
         """Warps an image in the forward direction
 
         Deforms the input image under this diffeomorphic map in the forward
@@ -301,6 +307,9 @@ class DiffeomorphicMap(object):
             the number of slices, rows, and columns of the desired warped image
         out_grid2world : the transformation bringing voxel coordinates of the
             warped image to physical space
+        num_threads : int, optional
+            Number of threads used to warp 3D images. If None (default) then
+            all available threads will be used (all CPU cores).
 
         Returns
         -------
@@ -380,7 +389,7 @@ class DiffeomorphicMap(object):
         else:
             image = np.asarray(image, dtype=floating)
 
-        warp_f = self._get_warping_function(interpolation)
+        warp_f = self._get_warping_function(interpolation, num_threads)
 
         warped = warp_f(image, self.forward, affine_idx_in, affine_idx_out,
                         affine_disp, out_shape)
@@ -388,7 +397,7 @@ class DiffeomorphicMap(object):
 
     def _warp_backward(self, image, interpolation='linear',
                        image_world2grid=None, out_shape=None,
-                       out_grid2world=None):
+                       out_grid2world=None, num_threads=None):
         """Warps an image in the backward direction
 
         Deforms the input image under this diffeomorphic map in the backward
@@ -412,6 +421,9 @@ class DiffeomorphicMap(object):
             the number of slices, rows and columns of the desired warped image
         out_grid2world : the transformation bringing voxel coordinates of the
             warped image to physical space
+        num_threads : int, optional
+            Number of threads used to warp 3D images. If None (default) then
+            all available threads will be used (all CPU cores).
 
         Returns
         -------
@@ -491,7 +503,7 @@ class DiffeomorphicMap(object):
         else:
             image = np.asarray(image, dtype=floating)
 
-        warp_f = self._get_warping_function(interpolation)
+        warp_f = self._get_warping_function(interpolation, num_threads)
 
         warped = warp_f(image, self.backward, affine_idx_in, affine_idx_out,
                         affine_disp, out_shape)
@@ -499,7 +511,7 @@ class DiffeomorphicMap(object):
         return warped
 
     def transform(self, image, interpolation='linear', image_world2grid=None,
-                  out_shape=None, out_grid2world=None):
+                  out_shape=None, out_grid2world=None, num_threads=None):
         """Warps an image in the forward direction
 
         Transforms the input image under this transformation in the forward
@@ -522,6 +534,9 @@ class DiffeomorphicMap(object):
             the number of slices, rows and columns of the desired warped image
         out_grid2world : the transformation bringing voxel coordinates of the
             warped image to physical space
+        num_threads : int, optional
+            Number of threads used to warp 3D images. If None (default) then
+            all available threads will be used (all CPU cores).
 
         Returns
         -------
@@ -538,15 +553,16 @@ class DiffeomorphicMap(object):
         if self.is_inverse:
             warped = self._warp_backward(image, interpolation,
                                          image_world2grid, out_shape,
-                                         out_grid2world)
+                                         out_grid2world, num_threads)
         else:
             warped = self._warp_forward(image, interpolation, image_world2grid,
-                                        out_shape, out_grid2world)
+                                        out_shape, out_grid2world,
+                                        num_threads)
         return np.asarray(warped)
 
     def transform_inverse(self, image, interpolation='linear',
                           image_world2grid=None, out_shape=None,
-                          out_grid2world=None):
+                          out_grid2world=None, num_threads=None):
         """Warps an image in the backward direction
 
         Transforms the input image under this transformation in the backward
@@ -569,6 +585,9 @@ class DiffeomorphicMap(object):
             the number of slices, rows, and columns of the desired warped image
         out_grid2world : the transformation bringing voxel coordinates of the
             warped image to physical space
+        num_threads : int, optional
+            Number of threads used to warp 3D images. If None (default) then
+            all available threads will be used (all CPU cores).
 
         Returns
         -------
@@ -582,11 +601,12 @@ class DiffeomorphicMap(object):
         """
         if self.is_inverse:
             warped = self._warp_forward(image, interpolation, image_world2grid,
-                                        out_shape, out_grid2world)
+                                        out_shape, out_grid2world,
+                                        num_threads)
         else:
             warped = self._warp_backward(image, interpolation,
                                          image_world2grid, out_shape,
-                                         out_grid2world)
+                                         out_grid2world, num_threads)
         return np.asarray(warped)
 
     def inverse(self):
@@ -890,7 +910,8 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                  opt_tol=1e-5,
                  inv_iter=20,
                  inv_tol=1e-3,
-                 callback=None):
+                 callback=None,
+                 num_threads=None):
         """ Symmetric Diffeomorphic Registration (SyN) Algorithm
 
         Performs the multi-resolution optimization algorithm for non-linear
@@ -924,6 +945,12 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             a function receiving a SymmetricDiffeomorphicRegistration object
             to be called after each iteration (this optimizer will call this
             function passing self as parameter)
+        num_threads : int, optional
+            Number of threads used to warp the images and to compose and
+            invert the displacement fields of 3D images. If None (default)
+            then all available threads will be used (all CPU cores). The
+            threads used by the metric are set when it is created, e.g.
+            ``CCMetric(3, num_threads=num_threads)``.
         """
         super(SymmetricDiffeomorphicRegistration, self).__init__(metric)
         if level_iters is None:
@@ -943,6 +970,7 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         self.full_energy_profile = []
         self.verbosity = VerbosityLevels.STATUS
         self.callback = callback
+        self.num_threads = num_threads
         self.moving_ss = None
         self.static_ss = None
         self.static_direction = None
@@ -1010,8 +1038,11 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             self.invert_vector_field = vfu.invert_vector_field_fixed_point_2d
             self.compose = vfu.compose_vector_fields_2d
         else:
-            self.invert_vector_field = vfu.invert_vector_field_fixed_point_3d
-            self.compose = vfu.compose_vector_fields_3d
+            self.invert_vector_field = partial(
+                vfu.invert_vector_field_fixed_point_3d,
+                num_threads=self.num_threads)
+            self.compose = partial(vfu.compose_vector_fields_3d,
+                                   num_threads=self.num_threads)
 
     def _init_optimizer(self, static, moving,
                         static_grid2world, moving_grid2world, prealign):
@@ -1043,40 +1074,72 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             the affine transformation (operating on the physical space)
             pre-aligning the moving image towards the static
 
+        """
+        self._init_static(static, static_grid2world)
+        self._init_moving(static, moving, static_grid2world,
+                          moving_grid2world, prealign)
+
+    def _init_static(self, static, static_grid2world):
+        """Builds the scale space of the static image
+
+        The scale space only depends on the static image, so that it can be
+        shared by the registrations of many moving images.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            the image to be used as reference during optimization.
+        static_grid2world : array, shape (dim+1, dim+1)
+            the voxel-to-space transformation associated to the static image
+
         """
         self._connect_functions()
         # Extract information from affine matrices to create the scale space
         static_direction, static_spacing = \
             get_direction_and_spacings(static_grid2world, self.dim)
-        moving_direction, moving_spacing = \
-            get_direction_and_spacings(moving_grid2world, self.dim)
 
         # the images' directions don't change with scale
         self.static_direction = np.eye(self.dim + 1)
-        self.moving_direction = np.eye(self.dim + 1)
         self.static_direction[:self.dim, :self.dim] = static_direction
-        self.moving_direction[:self.dim, :self.dim] = moving_direction
 
-        # Build the scale space of the input images
         if self.verbosity >= VerbosityLevels.DIAGNOSE:
             logger.info('Applying zero mask: ' + str(self.mask0))
 
         if self.verbosity >= VerbosityLevels.STATUS:
-            logger.info('Creating scale space from the moving image.' +
+            logger.info('Creating scale space from the static image.' +
                         ' Levels: %d. Sigma factor: %f.' %
                         (self.levels, self.ss_sigma_factor))
 
-        self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
-                                    moving_spacing, self.ss_sigma_factor,
+        self.static_ss = ScaleSpace(static, self.levels, static_grid2world,
+                                    static_spacing, self.ss_sigma_factor,
                                     self.mask0)
 
+        if self.verbosity >= VerbosityLevels.DEBUG:
+            logger.info('Static scale space:')
+            for level in range(self.levels):
+                self.static_ss.print_level(level)
+
+    def _init_moving(self, static, moving, static_grid2world,
+                     moving_grid2world, prealign):
+        """Initializes the registration of a moving image
+
+        Builds the scale space of the moving image and allocates the
+        transformation models at the coarsest scale. The scale space of the
+        static image must have been built by `_init_static`. The parameters
+        are the same as `_init_optimizer`.
+        """
+        moving_direction, moving_spacing = \
+            get_direction_and_spacings(moving_grid2world, self.dim)
+        self.moving_direction = np.eye(self.dim + 1)
+        self.moving_direction[:self.dim, :self.dim] = moving_direction
+
         if self.verbosity >= VerbosityLevels.STATUS:
-            logger.info('Creating scale space from the static image.' +
+            logger.info('Creating scale space from the moving image.' +
                         ' Levels: %d. Sigma factor: %f.' %
                         (self.levels, self.ss_sigma_factor))
 
-        self.static_ss = ScaleSpace(static, self.levels, static_grid2world,
-                                    static_spacing, self.ss_sigma_factor,
+        self.moving_ss = ScaleSpace(moving, self.levels, moving_grid2world,
+                                    moving_spacing, self.ss_sigma_factor,
                                     self.mask0)
 
         if self.verbosity >= VerbosityLevels.DEBUG:
@@ -1084,10 +1147,6 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
             for level in range(self.levels):
                 self.moving_ss.print_level(level)
 
-            logger.info('Static scale space:')
-            for level in range(self.levels):
-                self.static_ss.print_level(level)
-
         # Get the properties of the coarsest level from the static image. These
         # properties will be taken as the reference discretization.
         disp_shape = self.static_ss.get_domain_shape(self.levels-1)
@@ -1180,12 +1239,14 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
                                                        'linear',
                                                        None,
                                                        current_disp_shape,
-                                                       current_disp_grid2world)
+                                                       current_disp_grid2world,
+                                                       self.num_threads)
         wmoving = self.moving_to_ref.transform_inverse(current_moving,
                                                        'linear',
                                                        None,
                                                        current_disp_shape,
-                                                       current_disp_grid2world)
+                                                       current_disp_grid2world,
+                                                       self.num_threads)
         # Pass both images to the metric. Now both images are sampled on the
         # reference grid (equal to the static image's grid) and the direction
         # doesn't change across scales
@@ -1496,3 +1557,158 @@ class SymmetricDiffeomorphicRegistration(DiffeomorphicRegistration):
         self.static_to_ref.forward = np.array(self.static_to_ref.forward)
         self.static_to_ref.backward = np.array(self.static_to_ref.backward)
         return self.static_to_ref
+
+    def optimize_batch(self, static, movings, static_grid2world=None,
+                       moving_grid2world=None, prealign=None,
+                       engine='thread', n_jobs=None):
+        """Registers many moving images towards the same static image
+
+        The scale space of the static image is built once and shared by all
+        the registrations, which run concurrently. Each registration gives
+        the same result as `optimize` with the same arguments.
+
+        Parameters
+        ----------
+        static : array, shape (S, R, C) or (R, C)
+            the image to be used as reference during optimization. The
+            displacement fields will have the same discretization as the static
+            image.
+        movings : sequence of arrays, shape (S, R, C) or (R, C)
+            the images to be registered towards `static`, pre-aligned by
+            `prealign` (see `optimize`).
+        static_grid2world : array, shape (dim+1, dim+1)
+            the voxel-to-space transformation associated to the static image
+        moving_grid2world : array, shape (dim+1, dim+1), or sequence
+            the voxel-to-space transformation associated to the moving images,
+            or a sequence of them, one per moving image
+        prealign : array, shape (dim+1, dim+1), or sequence
+            the affine transformation (operating on the physical space)
+            pre-aligning the moving images towards the static, or a sequence
+            of them, one per moving image
+        engine : {'serial', 'thread', 'process'}, optional
+            how the registrations run concurrently, see
+            ``dipy.utils.parallel.paramap``. Default 'thread'.
+        n_jobs : int, optional
+            Number of registrations running concurrently. If None (default),
+            the number of cpus. When registrations run concurrently, each one
+            uses its share of `num_threads` and of the threads of the metric
+            (all available threads if None).
+
+        Returns
+        -------
+        maps : list of DiffeomorphicMap
+            the diffeomorphic map of each moving image, as returned by
+            `optimize`.
+
+        See Also
+        --------
+        iter_optimize_batch : the same registrations, with the moving images
+            loaded and the results returned one at a time.
+
+        """
+        movings = list(movings)
+        n_moving = len(movings)
+        items = zip(movings,
+                    per_moving(moving_grid2world, n_moving),
+                    per_moving(prealign, n_moving))
+        return list(self._iter_batch(static, items, n_moving,
+                                     static_grid2world, engine, n_jobs))
+
+    def iter_optimize_batch(self, static, movings, static_grid2world=None,
+                            moving_grid2world=None, prealign=None,
+                            engine='thread', n_jobs=None):
+        """Registers many moving images towards the same static image, one at
+        a time
+
+        Same as `optimize_batch`, except that `movings` (and the values of
+        `moving_grid2world` and `prealign` given per moving image) can be
+        iterables consumed lazily, e.g. generators loading the images from
+        files. Only a few moving images per job are in memory at once, and
+        the results are returned as a generator, in the order of `movings`,
+        as soon as they are available. The parameters are the same as
+        `optimize_batch`.
+
+        Returns
+        -------
+        maps : generator of DiffeomorphicMap
+            the diffeomorphic map of each moving image, as returned by
+            `optimize`.
+
+        """
+        items = zip(movings, per_moving(moving_grid2world),
+                    per_moving(prealign))
+        return self._iter_batch(static, items, None, static_grid2world,
+                                engine, n_jobs)
+
+    def _iter_batch(self, static, items, n_moving, static_grid2world, engine,
+                    n_jobs):
+        """Registers the (moving, moving_grid2world, prealign) items of
+        `optimize_batch` and `iter_optimize_batch`
+        """
+        # The scale space of the static image is built once in a copy, so
+        # that the state of this instance is left untouched
+        static = static.astype(floating)
+        batch = copy.copy(self)
+        n_jobs = determine_num_jobs(n_jobs)
+        n_concurrent = n_jobs if n_moving is None else min(n_jobs, n_moving)
+        if engine != 'serial' and n_concurrent > 1:
+            # Each registration runs its kernels with a share of the threads
+            total_threads = default_threads if self.num_threads is None \
+                else self.num_threads
+            batch.num_threads = max(1, total_threads // n_concurrent)
+            if hasattr(self.metric, 'num_threads'):
+                total_threads = default_threads \
+                    if self.metric.num_threads is None else \
+                    self.metric.num_threads
+                batch.metric = copy.deepcopy(self.metric)
+                batch.metric.num_threads = max(
+                    1, total_threads // n_concurrent)
+        batch._init_static(static, static_grid2world)
+        shared = {'registration': batch, 'static': static,
+                  'static_grid2world': static_grid2world}
+        if engine == 'process' and n_jobs > 1:
+            # The scale space is inherited by the forked workers, not pickled
+            func_args = [None]
+            initializer, initargs = _init_batch_worker, (shared,)
+        else:
+            func_args = [shared]
+            initializer, initargs = None, ()
+        return paramap(_optimize_batch_item, items, engine=engine,
+                       n_jobs=n_jobs, func_args=func_args,
+                       initializer=initializer, initargs=initargs)
+
+
+# State shared with the batch registration worker processes, set by
+# _init_batch_worker
+_batch_shared = None
+
+
+def _init_batch_worker(shared):
+    global _batch_shared
+    _batch_shared = shared
+
+
+def _optimize_batch_item(item, shared):
+    """Registers one moving image of
+    `SymmetricDiffeomorphicRegistration.optimize_batch`"""
+    if shared is None:
+        shared = _batch_shared
+    moving, moving_grid2world, prealign = item
+    # Each registration has its own metric and state, the static scale space
+    # is shared
+    registration = copy.copy(shared['registration'])
+    registration.metric = copy.deepcopy(registration.metric)
+    registration.energy_list = []
+    registration.full_energy_profile = []
+    if registration.verbosity >= VerbosityLevels.DEBUG:
+        if prealign is not None:
+            logger.info("Pre-align: " + str(prealign))
+    registration._init_moving(shared['static'], moving.astype(floating),
+                              shared['static_grid2world'], moving_grid2world,
+                              prealign)
+    registration._optimize()
+    registration._end_optimizer()
+    static_to_ref = registration.static_to_ref
+    static_to_ref.forward = np.array(static_to_ref.forward)
+    static_to_ref.backward = np.array(static_to_ref.backward)
+    return static_to_ref
@@ -1,6 +1,7 @@
 """  Metrics for Symmetric Diffeomorphic Registration """
 
 import abc
+from functools import partial
 import numpy as np
 import scipy as sp
 from numpy import gradient
@@ -196,7 +197,7 @@ class SimilarityMetric(object, metaclass=abc.ABCMeta):
 
 class CCMetric(SimilarityMetric):
 
-    def __init__(self, dim, sigma_diff=2.0, radius=4):
+    def __init__(self, dim, sigma_diff=2.0, radius=4, num_threads=None):
         r"""Normalized Cross-Correlation Similarity metric.
 
         Parameters
@@ -208,10 +209,26 @@ class CCMetric(SimilarityMetric):
         radius : int
             the radius of the squared (cubic) neighborhood at each voxel to be
             considered to compute the cross correlation
+        num_threads : int, optional
+            Number of threads used to compute the cross correlation of 3D
+            images. If None (default) then all available threads will be
+            used (all CPU cores). The result doesn't depend on the number of
+            threads.
         """
         super(CCMetric, self).__init__(dim)
         self.sigma_diff = sigma_diff
         self.radius = radius
+        self.num_threads = num_threads
+
+    @property
+    def num_threads(self):
+        """Number of threads used to compute the cross correlation"""
+        return self._num_threads
+
+    @num_threads.setter
+    def num_threads(self, num_threads):
+        # The functions are bound to the number of threads
+        self._num_threads = num_threads
         self._connect_functions()
 
     def _connect_functions(self):
@@ -227,9 +244,12 @@ class CCMetric(SimilarityMetric):
             self.compute_backward_step = cc.compute_cc_backward_step_2d
             self.reorient_vector_field = vfu.reorient_vector_field_2d
         elif self.dim == 3:
-            self.precompute_factors = cc.precompute_cc_factors_3d
-            self.compute_forward_step = cc.compute_cc_forward_step_3d
-            self.compute_backward_step = cc.compute_cc_backward_step_3d
+            self.precompute_factors = partial(cc.precompute_cc_factors_3d,
+                                              num_threads=self.num_threads)
+            self.compute_forward_step = partial(
+                cc.compute_cc_forward_step_3d, num_threads=self.num_threads)
+            self.compute_backward_step = partial(
+                cc.compute_cc_backward_step_3d, num_threads=self.num_threads)
             self.reorient_vector_field = vfu.reorient_vector_field_3d
         else:
             raise ValueError('CC Metric not defined for dim. %d' % (self.dim))
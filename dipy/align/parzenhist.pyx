@@ -7,8 +7,10 @@ import numpy as np
 cimport numpy as cnp
 cimport cython
 import numpy.random as random
+from cython.parallel import prange
 from dipy.align.fused_types cimport floating
 from dipy.align import vector_fields as vf
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 from dipy.align.vector_fields cimport(_apply_affine_3d_x0,
                                       _apply_affine_3d_x1,
@@ -24,7 +26,7 @@ cdef extern from "dpy_math.h" nogil:
     double log(double)
 
 class ParzenJointHistogram(object):
-    def __init__(self, nbins):
+    def __init__(self, nbins, num_threads=None):
         r""" Computes joint histogram and derivatives with Parzen windows
 
         Base class to compute joint and marginal probability density
@@ -45,6 +47,12 @@ class ParzenJointHistogram(object):
         nbins : int
             the number of bins of the joint and marginal probability density
             functions (the actual number of bins of the joint PDF is nbins**2)
+        num_threads : int, optional
+            the number of threads used to compute the PDFs and their
+            gradient. If None (default) then all available threads will be
+            used (at most 32). The voxels or samples are split in chunks
+            whose partial histograms are added in order, so the result
+            doesn't depend on the number of threads.
 
         References
         ----------
@@ -76,6 +84,7 @@ class ParzenJointHistogram(object):
         # support of the cubic spline is 5 bins (the center plus 2 bins at each
         # side) we need a padding of 2, in the case of cubic splines.
         self.padding = 2
+        self.num_threads = num_threads
         self.setup_called = False
 
     def setup(self, static, moving, smask=None, mmask=None):
@@ -210,12 +219,14 @@ class ParzenJointHistogram(object):
             _compute_pdfs_dense_2d(static, moving, smask, mmask, self.smin,
                                    self.sdelta, self.mmin, self.mdelta,
                                    self.nbins, self.padding, self.joint,
-                                   self.smarginal, self.mmarginal)
+                                   self.smarginal, self.mmarginal,
+                                   self.num_threads)
         elif dim == 3:
             _compute_pdfs_dense_3d(static, moving, smask, mmask, self.smin,
                                    self.sdelta, self.mmin, self.mdelta,
                                    self.nbins, self.padding, self.joint,
-                                   self.smarginal, self.mmarginal)
+                                   self.smarginal, self.mmarginal,
+                                   self.num_threads)
 
     def update_pdfs_sparse(self, sval, mval):
         r""" Computes the Probability Density Functions from a set of samples
@@ -244,7 +255,8 @@ class ParzenJointHistogram(object):
         energy = _compute_pdfs_sparse(sval, mval, self.smin, self.sdelta,
                                       self.mmin, self.mdelta, self.nbins,
                                       self.padding, self.joint,
-                                      self.smarginal, self.mmarginal)
+                                      self.smarginal, self.mmarginal,
+                                      self.num_threads)
 
     def update_gradient_dense(self, theta, transform, static, moving,
                               grid2world, mgradient, smask=None, mmask=None):
@@ -314,12 +326,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_dense_2d[cython.double](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    self.num_threads)
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_dense_2d[cython.float](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    self.num_threads)
             else:
                 raise ValueError('Grad. field dtype must be floating point')
 
@@ -328,12 +342,14 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_dense_3d[cython.double](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    self.num_threads)
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_dense_3d[cython.float](theta, transform,
                     static, moving, grid2world, mgradient, smask, mmask,
                     self.smin, self.sdelta, self.mmin, self.mdelta,
-                    self.nbins, self.padding, self.joint_grad)
+                    self.nbins, self.padding, self.joint_grad,
+                    self.num_threads)
             else:
                 raise ValueError('Grad. field dtype must be floating point')
 
@@ -393,12 +409,12 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_sparse_2d[cython.double](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, self.num_threads)
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_sparse_2d[cython.float](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, self.num_threads)
             else:
                 raise ValueError('Gradients dtype must be floating point')
 
@@ -407,12 +423,12 @@ class ParzenJointHistogram(object):
                 _joint_pdf_gradient_sparse_3d[cython.double](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, self.num_threads)
             elif mgradient.dtype == np.float32:
                 _joint_pdf_gradient_sparse_3d[cython.float](theta, transform,
                     sval, mval, sample_points, mgradient, self.smin,
                     self.sdelta, self.mmin, self.mdelta, self.nbins,
-                    self.padding, self.joint_grad)
+                    self.padding, self.joint_grad, self.num_threads)
             else:
                 raise ValueError('Gradients dtype must be floating point')
         else:
@@ -571,12 +587,75 @@ cdef inline double _cubic_spline_derivative(double x) nogil:
     return 0.0
 
 
+cdef enum:
+    # Maximum number of partial histograms, hence of threads, of the PDFs
+    # and gradient computations
+    MAX_PARTIALS = 32
+
+
+cdef inline cnp.npy_intp _num_partials(cnp.npy_intp n) nogil:
+    r""" Number of partial histograms to accumulate `n` items (rows, samples)
+    """
+    return n if n < MAX_PARTIALS else MAX_PARTIALS
+
+
+cdef void _add_partial_pdfs(double[:, :, :] joints, double[:, :] smarginals,
+                            double[:, :] joint, double[:] smarginal) nogil:
+    r""" Adds the partial joint and static marginal histograms in order
+    """
+    cdef:
+        cnp.npy_intp nbins = joint.shape[0]
+        cnp.npy_intp p, i, j
+
+    for i in range(nbins):
+        smarginal[i] = 0
+        for j in range(nbins):
+            joint[i, j] = 0
+    for p in range(joints.shape[0]):
+        for i in range(nbins):
+            smarginal[i] += smarginals[p, i]
+            for j in range(nbins):
+                joint[i, j] += joints[p, i, j]
+
+
+cdef void _add_partial_gradients(double[:, :, :, :] grad_pdfs,
+                                 cnp.npy_intp[:] counts, double mdelta,
+                                 double[:, :, :] grad_pdf) nogil:
+    r""" Adds the partial gradients of the joint PDF in order and normalizes
+    """
+    cdef:
+        cnp.npy_intp nbins = grad_pdf.shape[0]
+        cnp.npy_intp n = grad_pdf.shape[2]
+        cnp.npy_intp valid_points = 0
+        cnp.npy_intp p, i, j, k
+        double norm_factor
+
+    for i in range(nbins):
+        for j in range(nbins):
+            for k in range(n):
+                grad_pdf[i, j, k] = 0
+    for p in range(grad_pdfs.shape[0]):
+        valid_points += counts[p]
+        for i in range(nbins):
+            for j in range(nbins):
+                for k in range(n):
+                    grad_pdf[i, j, k] += grad_pdfs[p, i, j, k]
+
+    norm_factor = valid_points * mdelta
+    if norm_factor > 0:
+        for i in range(nbins):
+            for j in range(nbins):
+                for k in range(n):
+                    grad_pdf[i, j, k] /= norm_factor
+
+
 cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
                             int[:, :] smask, int[:, :] mmask,
                             double smin, double sdelta,
                             double mmin, double mdelta,
                             int nbins, int padding, double[:, :] joint,
-                            double[:] smarginal, double[:] mmarginal):
+                            double[:] smarginal, double[:] mmarginal,
+                            num_threads=None):
     r""" Joint Probability Density Function of intensities of two 2D images
 
     Parameters
@@ -612,39 +691,58 @@ cdef _compute_pdfs_dense_2d(double[:, :] static, double[:, :] moving,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
         cnp.npy_intp nrows = static.shape[0]
         cnp.npy_intp ncols = static.shape[1]
-        cnp.npy_intp offset, valid_points
+        cnp.npy_intp n_partials = _num_partials(nrows)
+        cnp.npy_intp offset, valid_points, p
         cnp.npy_intp i, j, r, c
         double rn, cn
         double val, spline_arg, sum
-
-    joint[...] = 0
-    sum = 0
-    valid_points = 0
+        # Partial histograms of consecutive chunks of the rows, added in order
+        # so that the PDFs don't depend on the number of threads
+        double[:, :, :] joints = np.zeros((n_partials, nbins, nbins))
+        double[:, :] smarginals = np.zeros((n_partials, nbins))
+        double[:] sums = np.zeros((n_partials,))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+
+    set_num_threads(num_threads)
     with nogil:
-        smarginal[:] = 0
-        for i in range(nrows):
-            for j in range(ncols):
-                if smask is not None and smask[i, j] == 0:
-                    continue
-                if mmask is not None and mmask[i, j] == 0:
-                    continue
-                valid_points += 1
-                rn = _bin_normalize(static[i, j], smin, sdelta)
-                r = _bin_index(rn, nbins, padding)
-                cn = _bin_normalize(moving[i, j], mmin, mdelta)
-                c = _bin_index(cn, nbins, padding)
-                spline_arg = (c - 2) - cn
+        for p in prange(n_partials, schedule='dynamic'):
+            for i in range(nrows * p // n_partials,
+                           nrows * (p + 1) // n_partials):
+                for j in range(ncols):
+                    if smask is not None and smask[i, j] == 0:
+                        continue
+                    if mmask is not None and mmask[i, j] == 0:
+                        continue
+                    counts[p] += 1
+                    rn = _bin_normalize(static[i, j], smin, sdelta)
+                    r = _bin_index(rn, nbins, padding)
+                    cn = _bin_normalize(moving[i, j], mmin, mdelta)
+                    c = _bin_index(cn, nbins, padding)
+                    spline_arg = (c - 2) - cn
 
-                smarginal[r] += 1
-                for offset in range(-2, 3):
-                    val = _cubic_spline(spline_arg)
-                    joint[r, c + offset] += val
-                    sum += val
-                    spline_arg += 1.0
+                    smarginals[p, r] += 1
+                    for offset in range(-2, 3):
+                        val = _cubic_spline(spline_arg)
+                        joints[p, r, c + offset] += val
+                        sums[p] += val
+                        spline_arg = spline_arg + 1.0
+
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    with nogil:
+        _add_partial_pdfs(joints, smarginals, joint, smarginal)
+        valid_points = 0
+        sum = 0
+        for p in range(n_partials):
+            valid_points += counts[p]
+            sum += sums[p]
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -664,7 +762,8 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
                             double smin, double sdelta,
                             double mmin, double mdelta,
                             int nbins, int padding, double[:, :] joint,
-                            double[:] smarginal, double[:] mmarginal):
+                            double[:] smarginal, double[:] mmarginal,
+                            num_threads=None):
     r""" Joint Probability Density Function of intensities of two 3D images
 
     Parameters
@@ -700,42 +799,60 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
         cnp.npy_intp nslices = static.shape[0]
         cnp.npy_intp nrows = static.shape[1]
         cnp.npy_intp ncols = static.shape[2]
-        cnp.npy_intp offset, valid_points
+        cnp.npy_intp n_partials = _num_partials(nslices)
+        cnp.npy_intp offset, valid_points, p
         cnp.npy_intp k, i, j, r, c
         double rn, cn
         double val, spline_arg, sum
+        # Partial histograms of consecutive chunks of the slices, added in order
+        # so that the PDFs don't depend on the number of threads
+        double[:, :, :] joints = np.zeros((n_partials, nbins, nbins))
+        double[:, :] smarginals = np.zeros((n_partials, nbins))
+        double[:] sums = np.zeros((n_partials,))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+
+    set_num_threads(num_threads)
+    with nogil:
+        for p in prange(n_partials, schedule='dynamic'):
+            for k in range(nslices * p // n_partials,
+                           nslices * (p + 1) // n_partials):
+                for i in range(nrows):
+                    for j in range(ncols):
+                        if smask is not None and smask[k, i, j] == 0:
+                            continue
+                        if mmask is not None and mmask[k, i, j] == 0:
+                            continue
+                        counts[p] += 1
+                        rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                        r = _bin_index(rn, nbins, padding)
+                        cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                        c = _bin_index(cn, nbins, padding)
+                        spline_arg = (c - 2) - cn
+
+                        smarginals[p, r] += 1
+                        for offset in range(-2, 3):
+                            val = _cubic_spline(spline_arg)
+                            joints[p, r, c + offset] += val
+                            sums[p] += val
+                            spline_arg = spline_arg + 1.0
+
+    if num_threads is not None:
+        restore_default_num_threads()
 
-    joint[...] = 0
-    sum = 0
     with nogil:
+        _add_partial_pdfs(joints, smarginals, joint, smarginal)
         valid_points = 0
-        smarginal[:] = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
-
-                    smarginal[r] += 1
-                    for offset in range(-2, 3):
-                        val = _cubic_spline(spline_arg)
-                        joint[r, c + offset] += val
-                        sum += val
-                        spline_arg += 1.0
-
+        sum = 0
+        for p in range(n_partials):
+            valid_points += counts[p]
+            sum += sums[p]
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -753,7 +870,8 @@ cdef _compute_pdfs_dense_3d(double[:, :, :] static, double[:, :, :] moving,
 cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
                           double sdelta, double mmin, double mdelta,
                           int nbins, int padding, double[:, :] joint,
-                          double[:] smarginal, double[:] mmarginal):
+                          double[:] smarginal, double[:] mmarginal,
+                          num_threads=None):
     r""" Probability Density Functions of paired intensities
 
     Parameters
@@ -783,35 +901,51 @@ cdef _compute_pdfs_sparse(double[:] sval, double[:] mval, double smin,
         the array to write the marginal PDF associated with the static image
     mmarginal : array, shape (nbins,)
         the array to write the marginal PDF associated with the moving image
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
         cnp.npy_intp n = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        cnp.npy_intp i, r, c
+        cnp.npy_intp n_partials = _num_partials(n)
+        cnp.npy_intp offset, valid_points, p
+        cnp.npy_intp i, j, r, c
         double rn, cn
         double val, spline_arg, sum
+        # Partial histograms of consecutive chunks of the samples, added in order
+        # so that the PDFs don't depend on the number of threads
+        double[:, :, :] joints = np.zeros((n_partials, nbins, nbins))
+        double[:, :] smarginals = np.zeros((n_partials, nbins))
+        double[:] sums = np.zeros((n_partials,))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+
+    set_num_threads(num_threads)
+    with nogil:
+        for p in prange(n_partials, schedule='dynamic'):
+            for i in range(n * p // n_partials, n * (p + 1) // n_partials):
+                counts[p] += 1
+                rn = _bin_normalize(sval[i], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(mval[i], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
 
-    joint[...] = 0
-    sum = 0
+                smarginals[p, r] += 1
+                for offset in range(-2, 3):
+                    val = _cubic_spline(spline_arg)
+                    joints[p, r, c + offset] += val
+                    sums[p] += val
+                    spline_arg = spline_arg + 1.0
+
+    if num_threads is not None:
+        restore_default_num_threads()
 
     with nogil:
+        _add_partial_pdfs(joints, smarginals, joint, smarginal)
         valid_points = 0
-        smarginal[:] = 0
-        for i in range(n):
-            valid_points += 1
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            smarginal[r] += 1
-            for offset in range(-2, 3):
-                val = _cubic_spline(spline_arg)
-                joint[r, c + offset] += val
-                sum += val
-                spline_arg += 1.0
-
+        sum = 0
+        for p in range(n_partials):
+            valid_points += counts[p]
+            sum += sums[p]
         if sum > 0:
             for i in range(nbins):
                 for j in range(nbins):
@@ -832,7 +966,8 @@ cdef _joint_pdf_gradient_dense_2d(double[:] theta, Transform transform,
                                   floating[:, :, :] mgradient, int[:, :] smask,
                                   int[:, :] mmask, double smin, double sdelta,
                                   double mmin, double mdelta, int nbins,
-                                  int padding, double[:, :, :] grad_pdf):
+                                  int padding, double[:, :, :] grad_pdf,
+                                  num_threads=None):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -878,59 +1013,69 @@ cdef _joint_pdf_gradient_dense_2d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
         cnp.npy_intp nrows = static.shape[0]
         cnp.npy_intp ncols = static.shape[1]
         cnp.npy_intp n = theta.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
+        cnp.npy_intp n_partials = _num_partials(nrows)
+        cnp.npy_intp offset, p
         cnp.npy_intp k, i, j, r, c
         double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(2, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-        double[:] x = np.empty(shape=(2,), dtype=np.float64)
-
-    grad_pdf[...] = 0
+        double val, spline_arg
+        # Partial gradients of consecutive chunks of the rows, added in order
+        # so that the gradient doesn't depend on the number of threads. Each
+        # chunk has its own Jacobian buffers.
+        double[:, :, :, :] grad_pdfs = np.zeros((n_partials, nbins, nbins, n))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+        int[:] constant_jacobian = np.zeros((n_partials,), dtype=np.int32)
+        double[:, :, :] J = np.empty(shape=(n_partials, 2, n),
+                                     dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(n_partials, n), dtype=np.float64)
+        double[:, :] x = np.empty(shape=(n_partials, 2), dtype=np.float64)
+
+    set_num_threads(num_threads)
     with nogil:
-        valid_points = 0
-        for i in range(nrows):
-            for j in range(ncols):
-                if smask is not None and smask[i, j] == 0:
-                    continue
-                if mmask is not None and mmask[i, j] == 0:
-                    continue
+        for p in prange(n_partials, schedule='dynamic'):
+            for i in range(nrows * p // n_partials,
+                           nrows * (p + 1) // n_partials):
+                for j in range(ncols):
+                    if smask is not None and smask[i, j] == 0:
+                        continue
+                    if mmask is not None and mmask[i, j] == 0:
+                        continue
 
-                valid_points += 1
-                x[0] = _apply_affine_2d_x0(i, j, 1, grid2world)
-                x[1] = _apply_affine_2d_x1(i, j, 1, grid2world)
+                    counts[p] += 1
+                    x[p, 0] = _apply_affine_2d_x0(i, j, 1, grid2world)
+                    x[p, 1] = _apply_affine_2d_x1(i, j, 1, grid2world)
 
-                if constant_jacobian == 0:
-                    constant_jacobian = transform._jacobian(theta, x, J)
+                    if constant_jacobian[p] == 0:
+                        constant_jacobian[p] = transform._jacobian(theta,
+                                                                   x[p], J[p])
 
-                for k in range(n):
-                    prod[k] = (J[0, k] * mgradient[i, j, 0] +
-                               J[1, k] * mgradient[i, j, 1])
+                    for k in range(n):
+                        prod[p, k] = (J[p, 0, k] * mgradient[i, j, 0] +
+                                      J[p, 1, k] * mgradient[i, j, 1])
 
-                rn = _bin_normalize(static[i, j], smin, sdelta)
-                r = _bin_index(rn, nbins, padding)
-                cn = _bin_normalize(moving[i, j], mmin, mdelta)
-                c = _bin_index(cn, nbins, padding)
-                spline_arg = (c - 2) - cn
+                    rn = _bin_normalize(static[i, j], smin, sdelta)
+                    r = _bin_index(rn, nbins, padding)
+                    cn = _bin_normalize(moving[i, j], mmin, mdelta)
+                    c = _bin_index(cn, nbins, padding)
+                    spline_arg = (c - 2) - cn
 
-                for offset in range(-2, 3):
-                    val = _cubic_spline_derivative(spline_arg)
-                    for k in range(n):
-                        grad_pdf[r, c + offset, k] -= val * prod[k]
-                    spline_arg += 1.0
+                    for offset in range(-2, 3):
+                        val = _cubic_spline_derivative(spline_arg)
+                        for k in range(n):
+                            grad_pdfs[p, r, c + offset, k] -= val * prod[p, k]
+                        spline_arg = spline_arg + 1.0
 
-        norm_factor = valid_points * mdelta
-        if norm_factor > 0:
-            for i in range(nbins):
-                for j in range(nbins):
-                    for k in range(n):
-                        grad_pdf[i, j, k] /= norm_factor
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    with nogil:
+        _add_partial_gradients(grad_pdfs, counts, mdelta, grad_pdf)
 
 
 cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
@@ -942,7 +1087,8 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
                                   int[:, :, :] mmask, double smin,
                                   double sdelta, double mmin, double mdelta,
                                   int nbins, int padding,
-                                  double[:, :, :] grad_pdf):
+                                  double[:, :, :] grad_pdf,
+                                  num_threads=None):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -988,62 +1134,72 @@ cdef _joint_pdf_gradient_dense_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
         cnp.npy_intp nslices = static.shape[0]
         cnp.npy_intp nrows = static.shape[1]
         cnp.npy_intp ncols = static.shape[2]
         cnp.npy_intp n = theta.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
+        cnp.npy_intp n_partials = _num_partials(nslices)
+        cnp.npy_intp offset, p
         cnp.npy_intp l, k, i, j, r, c
         double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-        double[:] x = np.empty(shape=(3,), dtype=np.float64)
-
-    grad_pdf[...] = 0
+        double val, spline_arg
+        # Partial gradients of consecutive chunks of the slices, added in order
+        # so that the gradient doesn't depend on the number of threads. Each
+        # chunk has its own Jacobian buffers.
+        double[:, :, :, :] grad_pdfs = np.zeros((n_partials, nbins, nbins, n))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+        int[:] constant_jacobian = np.zeros((n_partials,), dtype=np.int32)
+        double[:, :, :] J = np.empty(shape=(n_partials, 3, n),
+                                     dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(n_partials, n), dtype=np.float64)
+        double[:, :] x = np.empty(shape=(n_partials, 3), dtype=np.float64)
+
+    set_num_threads(num_threads)
     with nogil:
-        valid_points = 0
-        for k in range(nslices):
-            for i in range(nrows):
-                for j in range(ncols):
-                    if smask is not None and smask[k, i, j] == 0:
-                        continue
-                    if mmask is not None and mmask[k, i, j] == 0:
-                        continue
-                    valid_points += 1
-                    x[0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
-                    x[1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
-                    x[2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
+        for p in prange(n_partials, schedule='dynamic'):
+            for k in range(nslices * p // n_partials,
+                           nslices * (p + 1) // n_partials):
+                for i in range(nrows):
+                    for j in range(ncols):
+                        if smask is not None and smask[k, i, j] == 0:
+                            continue
+                        if mmask is not None and mmask[k, i, j] == 0:
+                            continue
+                        counts[p] += 1
+                        x[p, 0] = _apply_affine_3d_x0(k, i, j, 1, grid2world)
+                        x[p, 1] = _apply_affine_3d_x1(k, i, j, 1, grid2world)
+                        x[p, 2] = _apply_affine_3d_x2(k, i, j, 1, grid2world)
+
+                        if constant_jacobian[p] == 0:
+                            constant_jacobian[p] = transform._jacobian(
+                                theta, x[p], J[p])
 
-                    if constant_jacobian == 0:
-                        constant_jacobian = transform._jacobian(theta, x, J)
+                        for l in range(n):
+                            prod[p, l] = (J[p, 0, l] * mgradient[k, i, j, 0] +
+                                          J[p, 1, l] * mgradient[k, i, j, 1] +
+                                          J[p, 2, l] * mgradient[k, i, j, 2])
 
-                    for l in range(n):
-                        prod[l] = (J[0, l] * mgradient[k, i, j, 0] +
-                                   J[1, l] * mgradient[k, i, j, 1] +
-                                   J[2, l] * mgradient[k, i, j, 2])
+                        rn = _bin_normalize(static[k, i, j], smin, sdelta)
+                        r = _bin_index(rn, nbins, padding)
+                        cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
+                        c = _bin_index(cn, nbins, padding)
+                        spline_arg = (c - 2) - cn
 
-                    rn = _bin_normalize(static[k, i, j], smin, sdelta)
-                    r = _bin_index(rn, nbins, padding)
-                    cn = _bin_normalize(moving[k, i, j], mmin, mdelta)
-                    c = _bin_index(cn, nbins, padding)
-                    spline_arg = (c - 2) - cn
+                        for offset in range(-2, 3):
+                            val = _cubic_spline_derivative(spline_arg)
+                            for l in range(n):
+                                grad_pdfs[p, r, c + offset, l] -= val * prod[p, l]
+                            spline_arg = spline_arg + 1.0
 
-                    for offset in range(-2, 3):
-                        val = _cubic_spline_derivative(spline_arg)
-                        for l in range(n):
-                            grad_pdf[r, c + offset, l] -= val * prod[l]
-                        spline_arg += 1.0
+    if num_threads is not None:
+        restore_default_num_threads()
 
-        norm_factor = valid_points * mdelta
-        if norm_factor > 0:
-            for i in range(nbins):
-                for j in range(nbins):
-                    for k in range(n):
-                        grad_pdf[i, j, k] /= norm_factor
+    with nogil:
+        _add_partial_gradients(grad_pdfs, counts, mdelta, grad_pdf)
 
 
 cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
@@ -1052,7 +1208,8 @@ cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
                                    floating[:, :] mgradient, double smin,
                                    double sdelta, double mmin,
                                    double mdelta, int nbins, int padding,
-                                   double[:, :, :] grad_pdf):
+                                   double[:, :, :] grad_pdf,
+                                   num_threads=None):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -1091,49 +1248,57 @@ cdef _joint_pdf_gradient_sparse_2d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
-        cnp.npy_intp n = theta.shape[0]
         cnp.npy_intp m = sval.shape[0]
-        cnp.npy_intp offset
-        int constant_jacobian = 0
-        cnp.npy_intp i, j, r, c, valid_points
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp n_partials = _num_partials(m)
+        cnp.npy_intp offset, p
+        cnp.npy_intp i, j, r, c
         double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(2, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-
-    grad_pdf[...] = 0
+        double val, spline_arg
+        # Partial gradients of consecutive chunks of the samples, added in order
+        # so that the gradient doesn't depend on the number of threads. Each
+        # chunk has its own Jacobian buffers.
+        double[:, :, :, :] grad_pdfs = np.zeros((n_partials, nbins, nbins, n))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+        int[:] constant_jacobian = np.zeros((n_partials,), dtype=np.int32)
+        double[:, :, :] J = np.empty(shape=(n_partials, 2, n),
+                                     dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(n_partials, n), dtype=np.float64)
+
+    set_num_threads(num_threads)
     with nogil:
-        valid_points = 0
-        for i in range(m):
-            valid_points += 1
-            if constant_jacobian == 0:
-                constant_jacobian = transform._jacobian(theta,
-                                                        sample_points[i], J)
-
-            for j in range(n):
-                prod[j] = (J[0, j] * mgradient[i, 0] +
-                           J[1, j] * mgradient[i, 1])
-
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            for offset in range(-2, 3):
-                val = _cubic_spline_derivative(spline_arg)
+        for p in prange(n_partials, schedule='dynamic'):
+            for i in range(m * p // n_partials, m * (p + 1) // n_partials):
+                counts[p] += 1
+                if constant_jacobian[p] == 0:
+                    constant_jacobian[p] = transform._jacobian(
+                        theta, sample_points[i], J[p])
+
                 for j in range(n):
-                    grad_pdf[r, c + offset, j] -= val * prod[j]
-                spline_arg += 1.0
+                    prod[p, j] = (J[p, 0, j] * mgradient[i, 0] +
+                                  J[p, 1, j] * mgradient[i, 1])
 
-        norm_factor = valid_points * mdelta
-        if norm_factor > 0:
-            for i in range(nbins):
-                for j in range(nbins):
-                    for k in range(n):
-                        grad_pdf[i, j, k] /= norm_factor
+                rn = _bin_normalize(sval[i], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(mval[i], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                for offset in range(-2, 3):
+                    val = _cubic_spline_derivative(spline_arg)
+                    for j in range(n):
+                        grad_pdfs[p, r, c + offset, j] -= val * prod[p, j]
+                    spline_arg = spline_arg + 1.0
+
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    with nogil:
+        _add_partial_gradients(grad_pdfs, counts, mdelta, grad_pdf)
 
 
 cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
@@ -1142,7 +1307,8 @@ cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
                                    floating[:, :] mgradient, double smin,
                                    double sdelta, double mmin,
                                    double mdelta, int nbins, int padding,
-                                   double[:, :, :] grad_pdf):
+                                   double[:, :, :] grad_pdf,
+                                   num_threads=None):
     r""" Gradient of the joint PDF w.r.t. transform parameters theta
 
     Computes the vector of partial derivatives of the joint histogram w.r.t.
@@ -1181,51 +1347,58 @@ cdef _joint_pdf_gradient_sparse_3d(double[:] theta, Transform transform,
         sides of the histogram is actually 2*padding)
     grad_pdf : array, shape (nbins, nbins, len(theta))
         the array to write the gradient to
+    num_threads : int
+        number of threads. If None, all available threads are used
     """
     cdef:
-        cnp.npy_intp n = theta.shape[0]
         cnp.npy_intp m = sval.shape[0]
-        cnp.npy_intp offset, valid_points
-        int constant_jacobian = 0
+        cnp.npy_intp n = theta.shape[0]
+        cnp.npy_intp n_partials = _num_partials(m)
+        cnp.npy_intp offset, p
         cnp.npy_intp i, j, r, c
         double rn, cn
-        double val, spline_arg, norm_factor
-        double[:, :] J = np.empty(shape=(3, n), dtype=np.float64)
-        double[:] prod = np.empty(shape=(n,), dtype=np.float64)
-
-    grad_pdf[...] = 0
+        double val, spline_arg
+        # Partial gradients of consecutive chunks of the samples, added in order
+        # so that the gradient doesn't depend on the number of threads. Each
+        # chunk has its own Jacobian buffers.
+        double[:, :, :, :] grad_pdfs = np.zeros((n_partials, nbins, nbins, n))
+        cnp.npy_intp[:] counts = np.zeros((n_partials,), dtype=np.intp)
+        int[:] constant_jacobian = np.zeros((n_partials,), dtype=np.int32)
+        double[:, :, :] J = np.empty(shape=(n_partials, 3, n),
+                                     dtype=np.float64)
+        double[:, :] prod = np.empty(shape=(n_partials, n), dtype=np.float64)
+
+    set_num_threads(num_threads)
     with nogil:
-        valid_points = 0
-        for i in range(m):
-            valid_points += 1
-
-            if constant_jacobian == 0:
-                constant_jacobian = transform._jacobian(theta,
-                                                        sample_points[i], J)
-
-            for j in range(n):
-                prod[j] = (J[0, j] * mgradient[i, 0] +
-                           J[1, j] * mgradient[i, 1] +
-                           J[2, j] * mgradient[i, 2])
-
-            rn = _bin_normalize(sval[i], smin, sdelta)
-            r = _bin_index(rn, nbins, padding)
-            cn = _bin_normalize(mval[i], mmin, mdelta)
-            c = _bin_index(cn, nbins, padding)
-            spline_arg = (c - 2) - cn
-
-            for offset in range(-2, 3):
-                val = _cubic_spline_derivative(spline_arg)
+        for p in prange(n_partials, schedule='dynamic'):
+            for i in range(m * p // n_partials, m * (p + 1) // n_partials):
+                counts[p] += 1
+                if constant_jacobian[p] == 0:
+                    constant_jacobian[p] = transform._jacobian(
+                        theta, sample_points[i], J[p])
+
                 for j in range(n):
-                    grad_pdf[r, c + offset, j] -= val * prod[j]
-                spline_arg += 1.0
+                    prod[p, j] = (J[p, 0, j] * mgradient[i, 0] +
+                                  J[p, 1, j] * mgradient[i, 1] +
+                                  J[p, 2, j] * mgradient[i, 2])
 
-        norm_factor = valid_points * mdelta
-        if norm_factor > 0:
-            for i in range(nbins):
-                for j in range(nbins):
-                    for k in range(n):
-                        grad_pdf[i, j, k] /= norm_factor
+                rn = _bin_normalize(sval[i], smin, sdelta)
+                r = _bin_index(rn, nbins, padding)
+                cn = _bin_normalize(mval[i], mmin, mdelta)
+                c = _bin_index(cn, nbins, padding)
+                spline_arg = (c - 2) - cn
+
+                for offset in range(-2, 3):
+                    val = _cubic_spline_derivative(spline_arg)
+                    for j in range(n):
+                        grad_pdfs[p, r, c + offset, j] -= val * prod[p, j]
+                    spline_arg = spline_arg + 1.0
+
+    if num_threads is not None:
+        restore_default_num_threads()
+
+    with nogil:
+        _add_partial_gradients(grad_pdfs, counts, mdelta, grad_pdf)
 
 
 def compute_parzen_mi(double[:, :] joint,
@@ -1,5 +1,6 @@
 import numpy as np
-from numpy.testing import assert_array_almost_equal
+from numpy.testing import (assert_array_almost_equal, assert_array_equal,
+                           assert_equal)
 from dipy.align import floating
 from dipy.align import crosscorr as cc
 
@@ -214,8 +215,39 @@ def test_compute_cc_steps_3d():
         assert_array_almost_equal(actual, expected)
 
 
+def test_cc_3d_num_threads():
+    np.random.seed(2817343)
+    sh = (23, 16, 12)
+    F = np.random.rand(*sh).astype(floating)
+    G = (F + 0.5 * np.random.rand(*sh)).astype(floating)
+    grad = np.random.randn(*sh + (3,)).astype(floating)
+    for radius in [1, 4]:
+        expected = np.asarray(cc.precompute_cc_factors_3d_test(F, G, radius))
+        fw_expected = cc.compute_cc_forward_step_3d(grad, expected, radius,
+                                                    num_threads=1)
+        bw_expected = cc.compute_cc_backward_step_3d(grad, expected, radius,
+                                                     num_threads=1)
+        factors_1 = np.asarray(cc.precompute_cc_factors_3d(F, G, radius,
+                                                           num_threads=1))
+        assert_array_almost_equal(factors_1, expected, decimal=4)
+        # The results don't depend on the number of threads, and invalid
+        # numbers of threads use a single thread
+        for num_threads in [2, 3, 5, None, 0, -2]:
+            factors = np.asarray(cc.precompute_cc_factors_3d(
+                F, G, radius, num_threads=num_threads))
+            assert_array_equal(factors, factors_1)
+            for step, step_expected in [
+                    (cc.compute_cc_forward_step_3d, fw_expected),
+                    (cc.compute_cc_backward_step_3d, bw_expected)]:
+                actual, energy = step(grad, expected, radius,
+                                      num_threads=num_threads)
+                assert_array_equal(actual, step_expected[0])
+                assert_equal(energy, step_expected[1])
+
+
 if __name__ == '__main__':
     test_cc_factors_2d()
     test_cc_factors_3d()
     test_compute_cc_steps_2d()
     test_compute_cc_steps_3d()
+    test_cc_3d_num_threads()
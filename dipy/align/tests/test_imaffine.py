@@ -284,6 +284,116 @@ def test_affreg_defaults():
             assert(reduction > 0.9)
 
 
+def test_affreg_batch():
+    # Registering a batch of moving images sharing the static scale space
+    # must give the same results as registering them one at a time
+    transform = regtransforms[('RIGID', 2)]
+    static, moving, static_g2w, moving_g2w, smask, mmask, T = \
+        setup_random_transform(transform, 0.1, 1, 1.0)
+    movings = [moving, np.roll(moving, 3, axis=0), 2 * moving + 1]
+    for sampling_pc in [None, 0.35]:
+        metric = imaffine.MutualInformationMetric(32, sampling_pc)
+        affreg = imaffine.AffineRegistration(metric, [100, 50, 25],
+                                             verbosity=0)
+        expected = [affreg.optimize(static, m, transform, None, static_g2w,
+                                    moving_g2w, 'mass', ret_metric=True)
+                    for m in movings]
+        for engine in ['serial', 'thread', 'process']:
+            actual = affreg.optimize_batch(static, movings, transform, None,
+                                           static_g2w, moving_g2w, 'mass',
+                                           ret_metric=True, engine=engine,
+                                           n_jobs=2)
+            assert_equal(len(actual), len(movings))
+            for (affine_map, xopt, fopt), (exp_map, exp_xopt, exp_fopt) \
+                    in zip(actual, expected):
+                assert_array_equal(affine_map.affine, exp_map.affine)
+                assert_array_equal(xopt, exp_xopt)
+                assert_equal(fopt, exp_fopt)
+
+    # One starting affine per moving image
+    affine_maps = affreg.optimize_batch(static, [moving, moving], transform,
+                                        starting_affine=[None, np.eye(3)],
+                                        engine='serial')
+    assert_array_equal(affine_maps[0].affine, affine_maps[1].affine)
+    assert_raises(ValueError, affreg.optimize_batch, static, movings,
+                  transform, starting_affine=[None, None])
+
+    # The moving images can be loaded lazily, and registered through a
+    # sequence of transforms, each starting from the result of the previous
+    affine = regtransforms[('AFFINE', 2)]
+    rigid_maps = [affreg.optimize(static, m, transform, None, static_g2w,
+                                  moving_g2w, 'mass') for m in movings]
+    expected = [affreg.optimize(static, m, affine, None, static_g2w,
+                                moving_g2w, rigid_map.affine)
+                for m, rigid_map in zip(movings, rigid_maps)]
+    loaded = []
+
+    def load_movings():
+        for m in movings:
+            loaded.append(m)
+            yield m
+
+    results = affreg.iter_optimize_batch(static, load_movings(),
+                                         [transform, affine], None,
+                                         static_g2w, moving_g2w, 'mass',
+                                         n_jobs=2)
+    assert_equal(loaded, [])
+    for affine_map, exp_map in zip(results, expected):
+        assert_array_equal(affine_map.affine, exp_map.affine)
+    assert_equal(len(loaded), len(movings))
+
+
+def test_affreg_early_stopping():
+    # Test the convergence monitoring and the sampling schedule
+    transform = regtransforms[('RIGID', 2)]
+    static, moving, static_g2w, moving_g2w, smask, mmask, T = \
+        setup_random_transform(transform, 0.1, 1, 1.0)
+    start_sad = np.abs(static - moving).sum()
+    level_iters = [1000, 100, 50]
+
+    def register(**kwargs):
+        metric = imaffine.MutualInformationMetric(32)
+        affreg = imaffine.AffineRegistration(metric, level_iters,
+                                             verbosity=0, **kwargs)
+        affine_map = affreg.optimize(static, moving, transform, None,
+                                     static_g2w, moving_g2w)
+        end_sad = np.abs(static - affine_map.transform(moving)).sum()
+        assert(1 - end_sad / start_sad > 0.9)
+        assert_equal(len(affine_map.iterations), len(level_iters))
+        assert_equal(len(affine_map.timings), len(level_iters))
+        return affine_map
+
+    expected = register()
+    assert(all(n > 0 for n in expected.iterations))
+
+    affine_map = register(opt_tol=1e-4, patience=3)
+    assert(all(0 < n <= m for n, m in zip(affine_map.iterations,
+                                          expected.iterations)))
+
+    # The finest level is skipped when the previous one barely improved
+    affine_map = register(opt_tol=1e6, skip_finest=True)
+    assert_equal(affine_map.iterations[-1], 0)
+    assert_equal(affine_map.timings[-1], 0)
+
+    affine_map = register(sampling_proportions=[None, 0.5, 0.2])
+    assert(affine_map.iterations[0] > 0)
+
+    # The sampling proportion of the metric is restored after registering
+    metric = imaffine.MutualInformationMetric(32, sampling_proportion=0.3)
+    affreg = imaffine.AffineRegistration(
+        metric, level_iters, verbosity=0,
+        sampling_proportions=[None, 0.5, 0.2])
+    affreg.optimize(static, moving, transform, None, static_g2w, moving_g2w)
+    assert_equal(metric.sampling_proportion, 0.3)
+    affreg.optimize_batch(static, [moving], transform, None, static_g2w,
+                          moving_g2w, engine='serial')
+    assert_equal(metric.sampling_proportion, 0.3)
+
+    metric = imaffine.MutualInformationMetric(32)
+    assert_raises(ValueError, imaffine.AffineRegistration, metric,
+                  level_iters, sampling_proportions=[None, 0.5])
+
+
 def test_mi_gradient():
     np.random.seed(2022966)
     # Test the gradient of mutual information
@@ -773,6 +773,76 @@ def test_cc_3d():
     assert(reduced > 0.9)
 
 
+def test_cc_3d_num_threads():
+    r""" Test that 3D SyN with CC metric doesn't depend on the threads """
+    fname = get_fnames('t1_coronal_slice')
+    image = np.load(fname)
+    moving, static = get_warped_stacked_image(image, 11, 0.1, 4)
+
+    def register(num_threads):
+        metric = metrics.CCMetric(3, 2.0, 2, num_threads=num_threads)
+        optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+            metric, [4, 2], num_threads=num_threads)
+        return optimizer.optimize(static, moving)
+
+    expected = register(1)
+    for num_threads in [3, None]:
+        mapping = register(num_threads)
+        assert_array_equal(mapping.forward, expected.forward)
+        assert_array_equal(mapping.backward, expected.backward)
+
+
+def test_syn_batch():
+    r""" Test that a batch of SyN registrations gives the same maps """
+    fname = get_fnames('t1_coronal_slice')
+    image = np.load(fname)
+    moving, static = get_warped_stacked_image(image, 11, 0.1, 4)
+    movings = [moving, np.roll(moving, 2, axis=1)]
+
+    metric = metrics.CCMetric(3, 2.0, 2)
+    optimizer = imwarp.SymmetricDiffeomorphicRegistration(metric, [4, 2])
+    optimizer.verbosity = VerbosityLevels.NONE
+    expected = [optimizer.optimize(static, m) for m in movings]
+    for engine in ['thread', 'process']:
+        mappings = optimizer.optimize_batch(static, movings, engine=engine,
+                                            n_jobs=2)
+        assert_equal(len(mappings), len(movings))
+        for mapping, exp_mapping in zip(mappings, expected):
+            assert_array_equal(mapping.forward, exp_mapping.forward)
+            assert_array_equal(mapping.backward, exp_mapping.backward)
+
+    # The moving images can be loaded lazily
+    mappings = optimizer.iter_optimize_batch(static, iter(movings), n_jobs=2)
+    for mapping, exp_mapping in zip(mappings, expected):
+        assert_array_equal(mapping.forward, exp_mapping.forward)
+        assert_array_equal(mapping.backward, exp_mapping.backward)
+
+    # Concurrent registrations run the CC kernels with a share of the threads
+    optimizer = imwarp.SymmetricDiffeomorphicRegistration(
+        metrics.CCMetric(3, 2.0, 2, num_threads=4), [4, 2], num_threads=4)
+    optimizer.verbosity = VerbosityLevels.NONE
+    shares = []
+    optimize_item = imwarp._optimize_batch_item
+
+    def record_share(item, shared):
+        metric = shared['registration'].metric
+        shares.append([shared['registration'].num_threads] +
+                      [f.keywords['num_threads'] for f in
+                       [metric.precompute_factors,
+                        metric.compute_forward_step,
+                        metric.compute_backward_step]])
+        return optimize_item(item, shared)
+
+    imwarp._optimize_batch_item = record_share
+    try:
+        optimizer.optimize_batch(static, movings, engine='thread', n_jobs=2)
+    finally:
+        imwarp._optimize_batch_item = optimize_item
+    assert_equal(shares, [[2, 2, 2, 2]] * len(movings))
+    assert_equal(optimizer.metric.precompute_factors.keywords,
+                 {'num_threads': 4})
+
+
 def test_em_3d_gauss_newton():
     r""" Test 3D SyN with EM metric, Gauss-Newton optimizer
 
@@ -514,6 +514,42 @@ def test_joint_pdf_gradients_sparse():
         assert(std_cosine < 0.15)
 
 
+def test_parzen_num_threads():
+    np.random.seed(7315286)
+    for dim, shape in [(2, (43, 31)), (3, (37, 11, 9))]:
+        static = np.random.rand(*shape)
+        moving = np.random.rand(*shape)
+        smask = (np.random.rand(*shape) > 0.3).astype(np.int32)
+        mgradient = np.random.randn(*shape + (dim,))
+        sval = np.random.rand(100)
+        mval = np.random.rand(100)
+        points = np.random.randn(100, dim)
+        pgradient = np.random.randn(100, dim)
+        transform = regtransforms[('AFFINE', dim)]
+        theta = transform.get_identity_parameters()
+        grid2world = np.eye(dim + 1)
+
+        def histograms(num_threads):
+            H = ParzenJointHistogram(32, num_threads=num_threads)
+            H.setup(static, moving)
+            H.update_pdfs_dense(static, moving, smask, None)
+            H.update_gradient_dense(theta, transform, static, moving,
+                                    grid2world, mgradient, smask, None)
+            dense = (H.joint.copy(), H.smarginal.copy(), H.mmarginal.copy(),
+                     H.joint_grad.copy())
+            H.update_pdfs_sparse(sval, mval)
+            H.update_gradient_sparse(theta, transform, sval, mval, points,
+                                     pgradient)
+            return dense + (H.joint, H.smarginal, H.mmarginal, H.joint_grad)
+
+        # The partial histograms don't depend on the number of threads
+        expected = histograms(1)
+        assert_almost_equal(expected[0].sum(), 1)
+        for num_threads in [2, 3, None]:
+            for actual, desired in zip(histograms(num_threads), expected):
+                assert_array_equal(actual, desired)
+
+
 def test_sample_domain_regular():
     # Test 2D sampling
     shape = np.array((10, 10), dtype=np.int32)
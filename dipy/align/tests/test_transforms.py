@@ -1,3 +1,5 @@
+import pickle
+
 from dipy.align.transforms import regtransforms, Transform
 import numpy as np
 from numpy.testing import (assert_array_equal,
@@ -248,6 +250,17 @@ def test_invalid_transform():
     assert_equal(actual, expected)
 
 
+def test_pickle_transform():
+    rng = np.random.RandomState(1234)
+    for transform in regtransforms.values():
+        copied = pickle.loads(pickle.dumps(transform))
+        assert_equal(type(copied), type(transform))
+        assert_equal(copied.get_dim(), transform.get_dim())
+        theta = rng.uniform(size=(transform.get_number_of_parameters(),))
+        assert_array_equal(copied.param_to_matrix(theta),
+                           transform.param_to_matrix(theta))
+
+
 if __name__ == '__main__':
     test_number_of_parameters()
     test_jacobian_functions()
@@ -255,3 +268,4 @@ if __name__ == '__main__':
     test_param_to_matrix_3d()
     test_identity_parameters()
     test_invalid_transform()
+    test_pickle_transform()
@@ -1487,3 +1487,51 @@ def test_gradient_3d():
                   shape, invalid_affine)
     assert_raises(ValueError, vfu.gradient, img, sp_to_grid, invalid_spacings,
                   shape, T)
+
+
+def test_3d_kernels_num_threads():
+    np.random.seed(5324989)
+    shape = (15, 12, 10)
+    d1 = np.random.randn(*shape + (3,)).astype(floating)
+    d2 = np.random.randn(*shape + (3,)).astype(floating)
+    volume = np.random.rand(*shape).astype(floating)
+    labels = np.random.randint(0, 5, shape).astype(np.int32)
+    out_shape = np.array(shape, dtype=np.int32)
+    A = from_matvec(np.eye(3) + 0.05 * np.random.randn(3, 3),
+                    np.random.randn(3))
+    B = from_matvec(np.eye(3), np.random.randn(3))
+
+    def run(num_threads):
+        comp, stats = vfu.compose_vector_fields_3d(
+            d1, d2, A, B, 0.5, None, num_threads=num_threads)
+        inv = vfu.invert_vector_field_fixed_point_3d(
+            0.3 * d1, np.eye(4), np.ones(3), 10, 1e-3,
+            num_threads=num_threads)
+        warped = vfu.warp_3d(volume, d1, A, B, A, out_shape,
+                             num_threads=num_threads)
+        warped_nn = vfu.warp_3d_nn(labels, d1, A, B, A, out_shape,
+                                   num_threads=num_threads)
+        transformed = vfu.transform_3d_affine(volume, out_shape, A,
+                                              num_threads=num_threads)
+        grad, inside = vfu.gradient(volume, A, np.ones(3), shape,
+                                    np.linalg.inv(A), num_threads=num_threads)
+        return (comp, stats, inv, warped, warped_nn, transformed, grad,
+                inside)
+
+    # The results don't depend on the number of threads
+    expected = run(1)
+    for num_threads in (2, 3, None):
+        for actual, desired in zip(run(num_threads), expected):
+            assert_array_equal(actual, desired)
+
+    # The warping functions of a DiffeomorphicMap use the given threads
+    mapping = imwarp.DiffeomorphicMap(3, shape)
+    mapping.forward = d1
+    mapping.backward = d2
+    for interpolation in ('linear', 'nearest'):
+        assert_array_equal(
+            mapping.transform(volume, interpolation, num_threads=2),
+            mapping.transform(volume, interpolation, num_threads=1))
+        assert_array_equal(
+            mapping.transform_inverse(volume, interpolation, num_threads=2),
+            mapping.transform_inverse(volume, interpolation))
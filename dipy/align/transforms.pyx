@@ -114,6 +114,11 @@ cdef class Transform:
     def get_dim(self):
         return self.dim
 
+    def __reduce__(self):
+        r""" Transforms have no state, they are pickled by their type
+        """
+        return (type(self), ())
+
 
 cdef class TranslationTransform2D(Transform):
     def __init__(self):
@@ -6,7 +6,10 @@
 import numpy as np
 cimport numpy as cnp
 cimport cython
+from cython.parallel import parallel, prange
+from libc.stdlib cimport calloc, malloc, free
 from dipy.align.fused_types cimport floating, number
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 from dipy.core.interpolation cimport (_interpolate_scalar_2d,
                                       _interpolate_scalar_3d,
                                       _interpolate_vector_2d,
@@ -312,7 +315,11 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
         double nn
         cnp.npy_intp i, j, k
         double di, dj, dk, dii, djj, dkk, diii, djjj, dkkk
-    for k in range(ns1):
+        # Count, sum, sum of squares and maximum of the squared norms of each
+        # slice, added in order so that the statistics don't depend on the
+        # number of threads
+        double *slice_stats = <double *> calloc(4 * ns1, sizeof(double))
+    for k in prange(ns1, schedule='static'):
         for i in range(nr1):
             for j in range(nc1):
 
@@ -339,9 +346,9 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                     diii = _apply_affine_3d_x1(k, i, j, 1, premult_index)
                     djjj = _apply_affine_3d_x2(k, i, j, 1, premult_index)
 
-                dkkk += dk
-                diii += di
-                djjj += dj
+                dkkk = dkkk + dk
+                diii = diii + di
+                djjj = djjj + dj
 
                 # If d1 and comp are the same array, this will correctly update
                 # d1[k,i,j], which will never be accessed again
@@ -357,15 +364,22 @@ cdef void _compose_vector_fields_3d(floating[:, :, :, :] d1,
                     comp[k, i, j, 2] = t * comp[k, i, j, 2] + djj
                     nn = (comp[k, i, j, 0] ** 2 + comp[k, i, j, 1] ** 2 +
                           comp[k, i, j, 2]**2)
-                    meanNorm += nn
-                    stdNorm += nn * nn
-                    cnt += 1
-                    if(maxNorm < nn):
-                        maxNorm = nn
+                    slice_stats[4 * k] += 1
+                    slice_stats[4 * k + 1] += nn
+                    slice_stats[4 * k + 2] += nn * nn
+                    if(slice_stats[4 * k + 3] < nn):
+                        slice_stats[4 * k + 3] = nn
                 else:
                     comp[k, i, j, 0] = 0
                     comp[k, i, j, 1] = 0
                     comp[k, i, j, 2] = 0
+    for k in range(ns1):
+        cnt += <int> slice_stats[4 * k]
+        meanNorm += slice_stats[4 * k + 1]
+        stdNorm += slice_stats[4 * k + 2]
+        if(maxNorm < slice_stats[4 * k + 3]):
+            maxNorm = slice_stats[4 * k + 3]
+    free(slice_stats)
     meanNorm /= cnt
     stats[0] = sqrt(maxNorm)
     stats[1] = sqrt(meanNorm)
@@ -376,7 +390,7 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
                              double[:, :] premult_index,
                              double[:, :] premult_disp,
                              double time_scaling,
-                             floating[:, :, :, :] comp):
+                             floating[:, :, :, :] comp, num_threads=None):
     r"""Computes the composition of two 3D displacement fields
 
     Computes the composition of the two 3-D displacements d1 and d2. The
@@ -415,6 +429,9 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     comp : array, shape (S, R, C, 3), same dimension as d1
         the buffer to write the composition to. If None, the buffer will be
         created internally
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -440,8 +457,13 @@ def compose_vector_fields_3d(floating[:, :, :, :] d1, floating[:, :, :, :] d2,
     if not is_valid_affine(premult_disp, 3):
         raise ValueError("Invalid displacement pre-multiplication matrix")
 
-    _compose_vector_fields_3d[floating](d1, d2, premult_index, premult_disp,
-                                        time_scaling, comp, stats)
+    set_num_threads(num_threads)
+    with nogil:
+        _compose_vector_fields_3d[floating](d1, d2, premult_index,
+                                            premult_disp, time_scaling, comp,
+                                            stats)
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(comp), np.asarray(stats)
 
 
@@ -553,7 +575,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
                                        double[:, :] d_world2grid,
                                        double[:] spacing,
                                        int max_iter, double tol,
-                                       floating[:, :, :, :] start=None):
+                                       floating[:, :, :, :] start=None,
+                                       num_threads=None):
     r"""Computes the inverse of a 3D displacement fields
 
     Computes the inverse of the given 3-D displacement field d using the
@@ -581,6 +604,9 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         an approximation to the inverse displacement field (if no approximation
         is available, None can be provided and the start displacement field
         will be zero)
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -599,6 +625,7 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         cnp.npy_intp ns = d.shape[0]
         cnp.npy_intp nr = d.shape[1]
         cnp.npy_intp nc = d.shape[2]
+        cnp.npy_intp i, j, k
         int iter_count, current
         double dkk, dii, djj, dk, di, dj
         double difmag, mag, maxlen, step_factor
@@ -611,6 +638,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
         double[:] stats = np.zeros(shape=(2,), dtype=np.float64)
         double[:] substats = np.zeros(shape=(3,), dtype=np.float64)
         double[:, :, :] norms = np.zeros(shape=(ns, nr, nc), dtype=np.float64)
+        # Sum and maximum of the norms of each slice
+        double[:, :] slice_norms = np.zeros(shape=(ns, 2), dtype=np.float64)
         floating[:, :, :, :] p = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
         floating[:, :, :, :] q = np.zeros(shape=(ns, nr, nc, 3), dtype=ftype)
 
@@ -620,6 +649,7 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
     if start is not None:
         p[...] = start
 
+    set_num_threads(num_threads)
     with nogil:
         iter_count = 0
         difmag = 1
@@ -632,18 +662,24 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
                                                 1.0, q, substats)
             difmag = 0
             error = 0
-            for k in range(ns):
+            for k in prange(ns, schedule='static'):
+                slice_norms[k, 0] = 0
+                slice_norms[k, 1] = 0
                 for i in range(nr):
                     for j in range(nc):
                         mag = sqrt((q[k, i, j, 0]/ss) ** 2 +
                                    (q[k, i, j, 1]/sr) ** 2 +
                                    (q[k, i, j, 2]/sc) ** 2)
                         norms[k, i, j] = mag
-                        error += mag
-                        if(difmag < mag):
-                            difmag = mag
-            maxlen = difmag*epsilon
+                        slice_norms[k, 0] += mag
+                        if(slice_norms[k, 1] < mag):
+                            slice_norms[k, 1] = mag
             for k in range(ns):
+                error += slice_norms[k, 0]
+                if(difmag < slice_norms[k, 1]):
+                    difmag = slice_norms[k, 1]
+            maxlen = difmag*epsilon
+            for k in prange(ns, schedule='static'):
                 for i in range(nr):
                     for j in range(nc):
                         if norms[k, i, j] > maxlen:
@@ -660,6 +696,8 @@ def invert_vector_field_fixed_point_3d(floating[:, :, :, :] d,
             iter_count += 1
         stats[0] = error
         stats[1] = iter_count
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(p)
 
 
@@ -1182,7 +1220,7 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
             double[:, :] affine_idx_in=None,
             double[:, :] affine_idx_out=None,
             double[:, :] affine_disp=None,
-            int[:] out_shape=None):
+            int[:] out_shape=None, num_threads=None):
     r"""Warps a 3D volume using trilinear interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -1208,6 +1246,9 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -1258,11 +1299,13 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef floating[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                              dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype = np.asarray(d1).dtype)
-
-    with nogil:
+    cdef floating *tmp
 
-        for k in range(nslices):
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        # Each thread interpolates the displacements in its own buffer
+        tmp = <floating *> malloc(3 * sizeof(floating))
+        for k in prange(nslices, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -1277,7 +1320,7 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
                         inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
+                                                                  dj, tmp)
                         dkk = tmp[0]
                         dii = tmp[1]
                         djj = tmp[2]
@@ -1309,11 +1352,14 @@ def warp_3d(floating[:, :, :] volume, floating[:, :, :, :] d1,
                     inside = _interpolate_scalar_3d[floating](volume, dkk,
                                                               dii, djj,
                                                               &warped[k,i,j])
+        free(tmp)
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(warped)
 
 
 def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
-                        double[:, :] affine):
+                        double[:, :] affine, num_threads=None):
     r"""Transforms a 3D volume by an affine transform with trilinear interp.
 
     Deforms the input volume under the given affine transformation using
@@ -1329,6 +1375,9 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
         the shape of the resulting volume
     affine : array, shape (4, 4)
         the affine transform to be applied
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -1360,9 +1409,10 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
     if not is_valid_affine(affine, 3):
         raise ValueError("Invalid affine transform matrix")
 
+    set_num_threads(num_threads)
     with nogil:
 
-        for k in range(nslices):
+        for k in prange(nslices, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine is not None:
@@ -1375,6 +1425,8 @@ def transform_3d_affine(floating[:, :, :] volume, int[:] ref_shape,
                         djj = j
                     inside = _interpolate_scalar_3d[floating](volume, dkk,
                         dii, djj, &out[k,i,j])
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(out)
 
 
@@ -1382,7 +1434,7 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                double[:, :] affine_idx_in=None,
                double[:, :] affine_idx_out=None,
                double[:, :] affine_disp=None,
-               int[:] out_shape=None):
+               int[:] out_shape=None, num_threads=None):
     r"""Warps a 3D volume using using nearest-neighbor interpolation
 
     Deforms the input volume under the given transformation. The warped volume
@@ -1408,6 +1460,9 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
         the matrix C in eq. (1) above
     out_shape : array, shape (3,)
         the number of slices, rows and columns of the sampling grid
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -1458,11 +1513,13 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
 
     cdef number[:, :, :] warped = np.zeros(shape=(nslices, nrows, ncols),
                                            dtype=np.asarray(volume).dtype)
-    cdef floating[:] tmp = np.zeros(shape=(3,), dtype = np.asarray(d1).dtype)
-
-    with nogil:
+    cdef floating *tmp
 
-        for k in range(nslices):
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        # Each thread interpolates the displacements in its own buffer
+        tmp = <floating *> malloc(3 * sizeof(floating))
+        for k in prange(nslices, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     if affine_idx_in is None:
@@ -1477,7 +1534,7 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
                         dj = _apply_affine_3d_x2(
                             k, i, j, 1, affine_idx_in)
                         inside = _interpolate_vector_3d[floating](d1, dk, di,
-                                                                  dj, &tmp[0])
+                                                                  dj, tmp)
                         dkk = tmp[0]
                         dii = tmp[1]
                         djj = tmp[2]
@@ -1508,6 +1565,9 @@ def warp_3d_nn(number[:, :, :] volume, floating[:, :, :, :] d1,
 
                     inside = _interpolate_scalar_nn_3d[number](volume, dkk, dii, djj,
                                                        &warped[k,i,j])
+        free(tmp)
+    if num_threads is not None:
+        restore_default_num_threads()
     return np.asarray(warped)
 
 
@@ -2377,7 +2437,8 @@ def create_sphere(cnp.npy_intp nslices, cnp.npy_intp nrows,
 
 def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
                  double[:] img_spacing, double[:, :] out_grid2world,
-                 floating[:, :, :, :] out, int[:, :, :] inside):
+                 floating[:, :, :, :] out, int[:, :, :] inside,
+                 num_threads=None):
     r""" Gradient of a 3D image in physical space coordinates
 
     Each grid cell (i, j, k) in the sampling grid (determined by
@@ -2411,22 +2472,30 @@ def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
     inside : array, shape (S', R', C')
         the buffer in which to store the flags indicating whether the sample
         point lies inside (=1) or outside (=0) the image grid
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
     """
     cdef:
         int nslices = out.shape[0]
         int nrows = out.shape[1]
         int ncols = out.shape[2]
-        int i, j, k, in_flag
+        int i, j, k, p, in_flag
         double tmp
-        double[:] x = np.empty(shape=(3,), dtype=np.float64)
-        double[:] dx = np.empty(shape=(3,), dtype=np.float64)
+        double *x
+        double *dx
+        double *q
         double[:] h = np.empty(shape=(3,), dtype=np.float64)
-        double[:] q = np.empty(shape=(3,), dtype=np.float64)
-    with nogil:
-        h[0] = 0.5 * img_spacing[0]
-        h[1] = 0.5 * img_spacing[1]
-        h[2] = 0.5 * img_spacing[2]
-        for k in range(nslices):
+    h[0] = 0.5 * img_spacing[0]
+    h[1] = 0.5 * img_spacing[1]
+    h[2] = 0.5 * img_spacing[2]
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        # Each thread keeps its sample points in its own buffer
+        x = <double *> malloc(9 * sizeof(double))
+        dx = x + 3
+        q = x + 6
+        for k in prange(nslices, schedule='static'):
             for i in range(nrows):
                 for j in range(ncols):
                     inside[k, i, j] = 1
@@ -2434,7 +2503,9 @@ def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
                     x[0] = _apply_affine_3d_x0(k, i, j, 1, out_grid2world)
                     x[1] = _apply_affine_3d_x1(k, i, j, 1, out_grid2world)
                     x[2] = _apply_affine_3d_x2(k, i, j, 1, out_grid2world)
-                    dx[:] = x[:]
+                    dx[0] = x[0]
+                    dx[1] = x[1]
+                    dx[2] = x[2]
                     for p in range(3):
                         # Compute coordinates of point dx on img's grid
                         dx[p] = x[p] - h[p]
@@ -2469,6 +2540,9 @@ def _gradient_3d(floating[:, :, :] img, double[:, :] img_world2grid,
                             continue
                         out[k, i, j, p] = (out[k, i, j, p] - tmp) / img_spacing[p]
                         dx[p] = x[p]
+        free(x)
+    if num_threads is not None:
+        restore_default_num_threads()
 
 
 def _sparse_gradient_3d(floating[:, :, :] img,
@@ -2716,7 +2790,7 @@ def _sparse_gradient_2d(floating[:, :] img, double[:, :] img_world2grid,
 
 
 def gradient(img, img_world2grid, img_spacing, out_shape,
-             out_grid2world):
+             out_grid2world, num_threads=None):
     r""" Gradient of an image in physical space
 
     Parameters
@@ -2732,6 +2806,9 @@ def gradient(img, img_world2grid, img_spacing, out_shape,
         the number of (slices), rows and columns of the sampling grid
     out_grid2world : array, shape (dim+1, dim+1)
         the grid-to-space transform associated to the sampling grid
+    num_threads : int, optional
+        Number of threads used for 3D images. If None (default) then all
+        available threads will be used (all CPU cores).
 
     Returns
     -------
@@ -2749,12 +2826,7 @@ def gradient(img, img_world2grid, img_spacing, out_shape,
     ftype = img.dtype.type
     out = np.empty(tuple(out_shape)+(dim,), dtype=ftype)
     inside = np.empty(tuple(out_shape), dtype=np.int32)
-    # Select joint density gradient 2D or 3D
-    if dim == 2:
-        jd_grad = _gradient_2d
-    elif dim == 3:
-        jd_grad = _gradient_3d
-    else:
+    if dim not in (2, 3):
         raise ValueError('Undefined gradient for image dimension %d' % (dim,))
     if img_world2grid.dtype != np.float64:
         img_world2grid = img_world2grid.astype(np.float64)
@@ -2762,7 +2834,12 @@ def gradient(img, img_world2grid, img_spacing, out_shape,
         img_spacing = img_spacing.astype(np.float64)
     if out_grid2world.dtype != np.float64:
         out_grid2world = out_grid2world.astype(np.float64)
-    jd_grad(img, img_world2grid, img_spacing, out_grid2world, out, inside)
+    if dim == 2:
+        _gradient_2d(img, img_world2grid, img_spacing, out_grid2world, out,
+                     inside)
+    else:
+        _gradient_3d(img, img_world2grid, img_spacing, out_grid2world, out,
+                     inside, num_threads)
     return np.asarray(out), np.asarray(inside)
 
 
@@ -1,6 +1,13 @@
+from functools import lru_cache
 
 import numpy as np
 
+from dipy.utils.parallel import chunk_slices, determine_num_jobs, paramap
+
+
+# Number of slices corrected together with batched FFTs
+_SLICES_PER_BATCH = 16
+
 
 def _image_tv(x, axis=0, n_points=3):
     """ Computes total variation (TV) of matrix x across a given axis and
@@ -9,8 +16,8 @@ def _image_tv(x, axis=0, n_points=3):
     Parameters
     ----------
     x : 2D ndarray
-        matrix x
-    axis : int (0 or 1)
+        matrix x. Stacks of matrices (ND arrays) are also supported.
+    axis : int
         Axis which TV will be calculated. Default a is set to 0.
     n_points : int
         Number of points to be included in TV calculation.
@@ -23,26 +30,23 @@ def _image_tv(x, axis=0, n_points=3):
         Total variation calculated from the left neighbours of each point.
 
     """
-    xs = x.copy() if axis else x.T.copy()
+    xs = np.moveaxis(x, axis, -1)
+    N = xs.shape[-1]
 
     # Add copies of the data so that data extreme points are also analysed
-    xs = np.concatenate((xs[:, (-n_points-1):], xs, xs[:, 0:(n_points+1)]),
-                        axis=1)
-
-    ptv = np.absolute(xs[:, (n_points+1):(-n_points-1)] -
-                      xs[:, (n_points+2):(-n_points)])
-    ntv = np.absolute(xs[:, (n_points+1):(-n_points-1)] -
-                      xs[:, (n_points):(-n_points-2)])
+    xs = np.concatenate((xs[..., -n_points:], xs, xs[..., :n_points]),
+                        axis=-1)
+
+    # Absolute differences between each point and its right neighbour, which
+    # are shared by the TVs of n_points consecutive points
+    diff = np.absolute(xs[..., :-1] - xs[..., 1:])
+    ptv = diff[..., n_points:n_points+N].copy()
+    ntv = diff[..., n_points-1:n_points-1+N].copy()
     for n in range(1, n_points):
-        ptv = ptv + np.absolute(xs[:, (n_points+1+n):(-n_points-1+n)] -
-                                xs[:, (n_points+2+n):(-n_points+n)])
-        ntv = ntv + np.absolute(xs[:, (n_points+1-n):(-n_points-1-n)] -
-                                xs[:, (n_points-n):(-n_points-2-n)])
+        ptv += diff[..., n_points+n:n_points+n+N]
+        ntv += diff[..., n_points-1-n:n_points-1-n+N]
 
-    if axis:
-        return ptv, ntv
-    else:
-        return ptv.T, ntv.T
+    return np.moveaxis(ptv, -1, axis), np.moveaxis(ntv, -1, axis)
 
 
 def _gibbs_removal_1d(x, axis=0, n_points=3):
@@ -51,8 +55,8 @@ def _gibbs_removal_1d(x, axis=0, n_points=3):
     Parameters
     ----------
     x : 2D ndarray
-        Matrix x.
-    axis : int (0 or 1)
+        Matrix x. Stacks of matrices (ND arrays) are corrected at once.
+    axis : int
         Axis in which Gibbs oscillations will be suppressed.
         Default is set to 0.
     n_points : int, optional
@@ -72,13 +76,16 @@ def _gibbs_removal_1d(x, axis=0, n_points=3):
     accessed in a larger range of neighbours. The number of neighbours to be
     considered in TV calculation can be adjusted using the parameter n_points.
 
+    The sub-voxel shifts only act along `axis`, so that they are computed
+    with FFTs along this axis only.
+
     """
     ssamp = np.linspace(0.02, 0.9, num=45)
 
-    xs = x.copy() if axis else x.T.copy()
+    xs = np.moveaxis(x, axis, -1).copy()
 
     # TV for shift zero (baseline)
-    tvr, tvl = _image_tv(xs, axis=1, n_points=n_points)
+    tvr, tvl = _image_tv(xs, axis=-1, n_points=n_points)
     tvp = np.minimum(tvr, tvl)
     tvn = tvp.copy()
 
@@ -87,30 +94,36 @@ def _gibbs_removal_1d(x, axis=0, n_points=3):
     isn = xs.copy()
     sp = np.zeros(xs.shape)
     sn = np.zeros(xs.shape)
-    N = xs.shape[1]
-    c = np.fft.fftshift(np.fft.fft2(xs))
+    N = xs.shape[-1]
+    c = np.fft.fftshift(np.fft.fft(xs, axis=-1), axes=-1)
     k = np.linspace(-N/2, N/2-1, num=N)
     k = (2.0j * np.pi * k) / N
+    # The spectrum is shifted back before the inverse FFT: shift it, and the
+    # phases, once for all shifts
+    c = np.fft.fftshift(c, axes=-1)
+    k = np.fft.fftshift(k)
     for s in ssamp:
         # Access positive shift for given s
-        img_p = abs(np.fft.ifft2(np.fft.fftshift(c * np.exp(k*s))))
-        tvsr, tvsl = _image_tv(img_p, axis=1, n_points=n_points)
+        img_p = abs(np.fft.ifft(c * np.exp(k*s), axis=-1))
+        tvsr, tvsl = _image_tv(img_p, axis=-1, n_points=n_points)
         tvs_p = np.minimum(tvsr, tvsl)
 
         # Access negative shift for given s
-        img_n = abs(np.fft.ifft2(np.fft.fftshift(c * np.exp(-k*s))))
-        tvsr, tvsl = _image_tv(img_n, axis=1, n_points=n_points)
+        img_n = abs(np.fft.ifft(c * np.exp(-k*s), axis=-1))
+        tvsr, tvsl = _image_tv(img_n, axis=-1, n_points=n_points)
         tvs_n = np.minimum(tvsr, tvsl)
 
         # Update positive shift params
-        isp[tvp > tvs_p] = img_p[tvp > tvs_p]
-        sp[tvp > tvs_p] = s
-        tvp[tvp > tvs_p] = tvs_p[tvp > tvs_p]
+        better = tvp > tvs_p
+        np.copyto(isp, img_p, where=better)
+        np.copyto(sp, s, where=better)
+        np.copyto(tvp, tvs_p, where=better)
 
         # Update negative shift params
-        isn[tvn > tvs_n] = img_n[tvn > tvs_n]
-        sn[tvn > tvs_n] = s
-        tvn[tvn > tvs_n] = tvs_n[tvn > tvs_n]
+        better = tvn > tvs_n
+        np.copyto(isn, img_n, where=better)
+        np.copyto(sn, s, where=better)
+        np.copyto(tvn, tvs_n, where=better)
 
     # check non-zero sub-voxel shifts
     idx = np.nonzero(sp + sn)
@@ -119,9 +132,10 @@ def _gibbs_removal_1d(x, axis=0, n_points=3):
     # original grid points
     xs[idx] = (isp[idx] - isn[idx])/(sp[idx] + sn[idx])*sn[idx] + isn[idx]
 
-    return xs if axis else xs.T
+    return np.moveaxis(xs, -1, axis)
 
 
+@lru_cache(maxsize=8)
 def _weights(shape):
     """ Computes the weights necessary to combine two images processed by
     the 1D Gibbs removal procedure along two different axes [1]_.
@@ -138,6 +152,10 @@ def _weights(shape):
     G1 : 2D ndarray
         Weights for the image corrected along axis 1.
 
+    Notes
+    -----
+    The weights are cached for the last few shapes, and are read-only.
+
     References
     ----------
     .. [1] Kellner E, Dhital B, Kiselev VG, Reisert M. Gibbs-ringing artifact
@@ -163,6 +181,8 @@ def _weights(shape):
     G0[0, 1:-1] = G0[-1, 1:-1] = 1
     G0[0, 0] = G0[-1, -1] = G0[0, -1] = G0[-1, 0] = 1/2
 
+    G0.setflags(write=False)
+    G1.setflags(write=False)
     return G0, G1
 
 
@@ -172,7 +192,8 @@ def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None):
     Parameters
     ----------
     image : 2D ndarray
-        Matrix containing the 2D image.
+        Matrix containing the 2D image. Stacks of images along the first
+        axes (ND arrays) are corrected at once.
     n_points : int, optional
         Number of neighbours to access local TV (see note). Default is
         set to 3.
@@ -207,20 +228,21 @@ def _gibbs_removal_2d(image, n_points=3, G0=None, G1=None):
            doi: 10.1002/mrm.26054.
 
     """
-    if np.any(G0) is None or np.any(G1) is None:
-        G0, G1 = _weights(image.shape)
+    if G0 is None or G1 is None:
+        G0, G1 = _weights(image.shape[-2:])
 
-    img_c1 = _gibbs_removal_1d(image, axis=1, n_points=n_points)
-    img_c0 = _gibbs_removal_1d(image, axis=0, n_points=n_points)
+    img_c1 = _gibbs_removal_1d(image, axis=-1, n_points=n_points)
+    img_c0 = _gibbs_removal_1d(image, axis=-2, n_points=n_points)
 
     C1 = np.fft.fft2(img_c1)
     C0 = np.fft.fft2(img_c0)
-    imagec = abs(np.fft.ifft2(np.fft.fftshift(C1)*G1 + np.fft.fftshift(C0)*G0))
+    imagec = abs(np.fft.ifft2(np.fft.fftshift(C1, axes=(-2, -1))*G1 +
+                              np.fft.fftshift(C0, axes=(-2, -1))*G0))
 
     return imagec
 
 
-def gibbs_removal(vol, slice_axis=2, n_points=3):
+def gibbs_removal(vol, slice_axis=2, n_points=3, num_threads=1):
     """Suppresses Gibbs ringing artefacts of images volumes.
 
     Parameters
@@ -233,6 +255,10 @@ def gibbs_removal(vol, slice_axis=2, n_points=3):
     n_points : int, optional
         Number of neighbour points to access local TV (see note).
         Default is set to 3.
+    num_threads : int, optional
+        Number of threads correcting batches of slices concurrently. If
+        None, all cpus are used. See
+        ``dipy.utils.parallel.determine_num_jobs``. Default is set to 1.
 
     Returns
     -------
@@ -287,9 +313,19 @@ def gibbs_removal(vol, slice_axis=2, n_points=3):
     if nd == 2:
         vol = _gibbs_removal_2d(vol, n_points=n_points, G0=G0, G1=G1)
     else:
-        for vi in range(shap[2]):
-            vol[:, :, vi] = _gibbs_removal_2d(vol[:, :, vi], n_points=n_points,
-                                              G0=G0, G1=G1)
+        # Batches of slices are corrected at once, with FFTs along their
+        # last two axes. numpy releases the GIL in FFTs and array operations,
+        # so that the batches are corrected in parallel by threads
+        num_threads = determine_num_jobs(num_threads)
+        batches = chunk_slices(shap[2], num_threads,
+                               chunk_size=min(_SLICES_PER_BATCH,
+                                              -(-shap[2] // num_threads)))
+        results = paramap(_gibbs_removal_batch, batches, engine='thread',
+                          n_jobs=num_threads, func_args=[vol],
+                          func_kwargs={'n_points': n_points, 'G0': G0,
+                                       'G1': G1})
+        for batch, corrected in zip(batches, results):
+            vol[:, :, batch] = corrected
 
     # Reshape data to original format
     if nd == 4:
@@ -298,3 +334,10 @@ def gibbs_removal(vol, slice_axis=2, n_points=3):
         vol = np.swapaxes(vol, slice_axis, 2)
 
     return vol
+
+
+def _gibbs_removal_batch(batch, vol, n_points, G0, G1):
+    """Gibbs removal of the slices ``vol[:, :, batch]``"""
+    images = np.moveaxis(vol[:, :, batch], -1, 0)
+    corrected = _gibbs_removal_2d(images, n_points=n_points, G0=G0, G1=G1)
+    return np.moveaxis(corrected, 0, -1)
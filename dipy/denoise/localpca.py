@@ -1,13 +1,9 @@
 import numpy as np
-try:
-    from scipy.linalg.lapack import dgesvd as svd
-    svd_args = [1, 0]
-    # If you have an older version of scipy, we fall back
-    # on the standard scipy SVD API:
-except ImportError:
-    from scipy.linalg import svd
-    svd_args = [False]
-from scipy.linalg import eigh
+
+from dipy.utils.parallel import determine_num_jobs, paramap
+
+# Arrays shared with the genpca worker processes, set by _genpca_init
+_genpca_shared = None
 
 
 def _pca_classifier(L, nvoxels):
@@ -39,19 +35,289 @@ def _pca_classifier(L, nvoxels):
            theory. Neuroimage 142:394-406.
            doi: 10.1016/j.neuroimage.2016.08.016
     """
-    var = np.mean(L)
-    c = L.size - 1
-    r = L[c] - L[0] - 4 * np.sqrt((c + 1.0) / nvoxels) * var
-    while r > 0:
-        var = np.mean(L[:c])
-        c = c - 1
-        r = L[c] - L[0] - 4 * np.sqrt((c + 1.0) / nvoxels) * var
-    ncomps = c + 1
+    var, ncomps = _pca_classifier_batch(np.asarray(L)[None], nvoxels)
+    return var[0], ncomps[0]
+
+
+def _pca_classifier_batch(L, nvoxels):
+    """ Classifies the PCA eigenvalues of many patches at once
+
+    Parameters
+    ----------
+    L : array (m, n)
+        Array containing the PCA eigenvalues of m patches in ascending order.
+    nvoxels : int
+        Number of voxels used to compute L
+
+    Returns
+    -------
+    var : array (m,)
+        Estimation of the noise variance of each patch
+    ncomps : array (m,)
+        Number of eigenvalues related to noise in each patch
+
+    Notes
+    -----
+    Equivalent to ``_pca_classifier`` on each row of `L`: the noise
+    components are the ``c + 1`` smallest eigenvalues, for the largest ``c``
+    such that ``L[c] - L[0] <= 4 * sqrt((c + 1) / nvoxels) * mean(L[:c + 1])``.
+    """
+    n = L.shape[-1]
+    c = np.arange(1, n + 1)
+    cummean = np.cumsum(L, axis=-1) / c
+    r = L - L[:, :1] - 4 * np.sqrt(c / nvoxels) * cummean
+    ncomps = n - np.argmax((r <= 0)[:, ::-1], axis=-1)
+    var = cummean[np.arange(len(L)), ncomps - 1]
     return var, ncomps
 
 
+def _row_covariances(row, centers, radius):
+    """ Means and covariances of the patches centered on a row of voxels
+
+    The patches of neighbouring voxels of the row share all but one plane,
+    so the sums over their voxels are taken as differences of cumulative
+    sums over the planes of the row, instead of from each patch.
+
+    Parameters
+    ----------
+    row : array (n_x, p_y, p_z, dim)
+        The voxels of the planes covered by the patches of the row.
+    centers : array (n,)
+        Indices, along the first axis of `row`, of the centers of the
+        patches.
+    radius : int
+        Radius of the patches along the first axis.
+
+    Returns
+    -------
+    C : array (n, dim, dim)
+        Covariance matrix of each patch.
+    M : array (n, dim)
+        Mean of each patch.
+    """
+    first = centers[0] - radius
+    planes = row[first:centers[-1] + radius + 1]
+    planes = planes.reshape(len(planes), -1, row.shape[-1]).astype(np.float64)
+    # Shift the data by the mean of the row, to limit the cancellation when
+    # the means of the patches are removed from their sums
+    shift = planes.mean(axis=(0, 1))
+    planes -= shift
+    sums = np.zeros((len(planes) + 1,) + planes.shape[-1:])
+    np.cumsum(planes.sum(axis=1), axis=0, out=sums[1:])
+    grams = np.zeros((len(planes) + 1,) + planes.shape[-1:] * 2)
+    np.cumsum(np.matmul(np.swapaxes(planes, 1, 2), planes), axis=0,
+              out=grams[1:])
+    lo = centers - radius - first
+    hi = centers + radius + 1 - first
+    n_voxels = (2 * radius + 1) * planes.shape[1]
+    M = (sums[hi] - sums[lo]) / n_voxels
+    C = (grams[hi] - grams[lo]) / n_voxels - M[:, :, None] * M[:, None, :]
+    return C, M + shift
+
+
+def _orthonormalize(Y):
+    """ Orthonormal bases of the columns of a stack of matrices
+
+    Classical Gram-Schmidt with reorthogonalization, one column at a time
+    for all the matrices. Columns that are linearly dependent on the
+    previous ones are set to zero.
+    """
+    Q = np.zeros_like(Y)
+    for j in range(Y.shape[-1]):
+        v = Y[..., j]
+        for _ in range(2):
+            coefs = np.matmul(v[:, None, :], Q[..., :j])
+            v = v - np.matmul(coefs, np.swapaxes(Q[..., :j], 1, 2))[:, 0]
+        norm = np.sqrt(np.sum(v ** 2, axis=-1))
+        scale = np.linalg.norm(Y[..., j], axis=-1)
+        independent = norm > 1e-10 * scale
+        v[independent] /= norm[independent, None]
+        v[~independent] = 0
+        Q[..., j] = v
+    return Q
+
+
+def _top_eigenvectors(C, n_vectors, omega, n_iter=2):
+    """ Eigenvectors of the largest eigenvalues of a stack of covariances
+
+    Randomized subspace iteration [1]_ followed by a Rayleigh-Ritz
+    projection, for all the matrices at once.
+
+    Parameters
+    ----------
+    C : array (n, dim, dim)
+        Covariance matrices.
+    n_vectors : int
+        Number of eigenvectors to compute.
+    omega : array (dim, dim)
+        Random gaussian matrix, whose first columns start the iteration.
+    n_iter : int, optional
+        Number of power iterations.
+
+    Returns
+    -------
+    W : array (n, dim, m)
+        The eigenvectors in ascending order of eigenvalue, in columns. When
+        the subspace would not be much smaller than `dim`, all ``m = dim``
+        eigenvectors are computed exactly. Otherwise ``m = n_vectors``.
+
+    References
+    ----------
+    .. [1] Halko N, Martinsson PG, Tropp JA, 2011. Finding structure with
+           randomness: probabilistic algorithms for constructing approximate
+           matrix decompositions. SIAM Review 53(2):217-288.
+    """
+    dim = C.shape[-1]
+    # A few more vectors than needed make the iteration converge faster
+    n_subspace = n_vectors + 5
+    if n_subspace >= dim // 2:
+        return np.linalg.eigh(C)[1]
+    if n_vectors == 0:
+        return np.zeros(C.shape[:-1] + (0,))
+    Q = _orthonormalize(np.matmul(C, omega[:, :n_subspace]))
+    for _ in range(n_iter):
+        Q = _orthonormalize(np.matmul(C, Q))
+    B = np.matmul(np.swapaxes(Q, 1, 2), np.matmul(C, Q))
+    V = np.linalg.eigh(B)[1]
+    return np.matmul(Q, V[..., -n_vectors:])
+
+
+def _genpca_init(shared):
+    global _genpca_shared
+    _genpca_shared = shared
+
+
+def _genpca_slab(k_range, shared, patch_radius, pca_method, tau_factor,
+                 calc_dtype, sigma_given, return_var):
+    """Denoises the patches centered on a slab of planes of the volume
+
+    Parameters
+    ----------
+    k_range : tuple
+        First and last (excluded) index, along the third axis, of the planes
+        of patch centers of the slab.
+    shared : dict or None
+        The 'arr', 'mask' and 'var' arrays of ``genpca``. When None, they
+        are read from the arrays given to ``_genpca_init`` in this worker.
+
+    Returns
+    -------
+    z_start : int
+        Index, along the third axis, of the first plane of the returned
+        arrays.
+    theta, thetax, var, thetavar : arrays
+        Contributions of the patches of the slab to the accumulators of
+        ``genpca`` on the planes they cover. var and thetavar are None
+        unless `return_var` is True.
+    """
+    if shared is None:
+        shared = _genpca_shared
+    arr = shared['arr']
+    mask = shared['mask']
+    var = shared['var']
+    k_start, k_stop = k_range
+    patch_size = 2 * patch_radius + 1
+    n_patch = np.prod(patch_size)
+    dim = arr.shape[-1]
+
+    z_start = k_start - patch_radius[2]
+    z_stop = k_stop + patch_radius[2]
+    slab_shape = arr.shape[:2] + (z_stop - z_start,)
+    theta = np.zeros(slab_shape, dtype=calc_dtype)
+    thetax = np.zeros(slab_shape + (dim,), dtype=calc_dtype)
+    if return_var:
+        slab_var = np.zeros(slab_shape, dtype=calc_dtype)
+        thetavar = np.zeros(slab_shape, dtype=calc_dtype)
+    else:
+        slab_var = thetavar = None
+
+    if pca_method == 'rand':
+        omega = np.random.RandomState(0).standard_normal((dim, dim))
+    offsets = np.arange(-patch_radius[0], patch_radius[0] + 1)
+    all_centers = np.arange(patch_radius[0], arr.shape[0] - patch_radius[0])
+    for k in range(k_start, k_stop):
+        kx1 = k - patch_radius[2]
+        kx2 = k + patch_radius[2] + 1
+        for j in range(patch_radius[1], arr.shape[1] - patch_radius[1]):
+            centers = all_centers[mask[all_centers, j, k]]
+            if len(centers) == 0:
+                continue
+            jx1 = j - patch_radius[1]
+            jx2 = j + patch_radius[1] + 1
+
+            # The patches of the voxels of the row, one after the other
+            row = arr[:, jx1:jx2, kx1:kx2]
+            X = row[centers[:, None] + offsets].reshape(len(centers),
+                                                        n_patch, dim)
+            if pca_method == 'rand':
+                # Eigenvalues of the covariances of all the patches of the
+                # row, which are updated from one patch to the next
+                C, M = _row_covariances(row, centers, patch_radius[0])
+                X = X - M[:, None]
+                d = np.linalg.eigvalsh(C)
+            else:
+                # compute the mean and normalize
+                M = np.mean(X, axis=1)
+                X = X - M[:, None]
+
+            if pca_method == 'svd':
+                # PCA using an SVD of all the patches of the row at once
+                S, Vt = np.linalg.svd(X, full_matrices=False)[1:]
+                # Items in S are the singular values in descending order.
+                # We invert the order (=> ascending), square and normalize
+                # \lambda_i = s_i^2 / n
+                d = S[:, ::-1] ** 2 / n_patch
+                # Rows of Vt are eigenvectors, in the same order as S:
+                W = np.swapaxes(Vt[:, ::-1], 1, 2)
+            elif pca_method == 'eig':
+                # PCA using an eigenvalue decomposition of all the
+                # covariance matrices of the row at once
+                C = np.matmul(np.swapaxes(X, 1, 2), X) / n_patch
+                d, W = np.linalg.eigh(C)
+
+            if sigma_given:
+                # Predefined variance
+                this_var = var[centers, j, k]
+            else:
+                # Random matrix theory
+                this_var = _pca_classifier_batch(d, n_patch)[0]
+
+            # Threshold by tau:
+            tau = tau_factor ** 2 * this_var
+
+            # Update ncomps according to tau_factor
+            ncomps = np.sum(d < tau[:, None], axis=1)
+            if pca_method == 'rand':
+                # Only the eigenvectors that are kept
+                W = _top_eigenvectors(C, dim - ncomps.min(), omega)
+            # Null the eigenvectors of the ncomps smallest eigenvalues
+            first_kept = W.shape[-1] - dim + ncomps
+            W = W * (np.arange(W.shape[-1]) >= first_kept[:, None])[:, None, :]
+
+            # This is equations 1 and 2 in Manjon 2013:
+            Xest = np.matmul(np.matmul(X, W), np.swapaxes(W, 1, 2))
+            Xest += M[:, None]
+            Xest = Xest.reshape((len(centers),) + tuple(patch_size) + (dim,))
+            # This is equation 3 in Manjon 2013:
+            this_theta = 1.0 / (1.0 + dim - ncomps)
+            Xest *= this_theta[:, None, None, None, None]
+            # Patches of the row overlap along the first axis, add them one
+            # offset at a time so that each voxel is indexed once
+            ksl = slice(kx1 - z_start, kx2 - z_start)
+            for o in range(patch_size[0]):
+                isl = centers - patch_radius[0] + o
+                theta[isl, jx1:jx2, ksl] += this_theta[:, None, None]
+                thetax[isl, jx1:jx2, ksl] += Xest[:, o]
+                if return_var:
+                    slab_var[isl, jx1:jx2, ksl] += \
+                        (this_var * this_theta)[:, None, None]
+                    thetavar[isl, jx1:jx2, ksl] += this_theta[:, None, None]
+    return z_start, theta, thetax, slab_var, thetavar
+
+
 def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
-           tau_factor=None, return_sigma=False, out_dtype=None):
+           tau_factor=None, return_sigma=False, out_dtype=None,
+           engine='serial', n_jobs=None):
     r"""General function to perform PCA-based denoising of diffusion datasets.
 
     Parameters
@@ -70,11 +336,16 @@ def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
     patch_radius : int or 1D array (optional)
         The radius of the local patch to be taken around each voxel (in
         voxels). Default: 2 (denoise in blocks of 5x5x5 voxels).
-    pca_method : 'eig' or 'svd' (optional)
-        Use either eigenvalue decomposition (eig) or singular value
-        decomposition (svd) for principal component analysis. The default
-        method is 'eig' which is faster. However, occasionally 'svd' might be
-        more accurate.
+    pca_method : 'eig', 'svd' or 'rand' (optional)
+        Use either eigenvalue decomposition (eig), singular value
+        decomposition (svd) or a randomized decomposition (rand) for principal
+        component analysis. The default method is 'eig' which is faster than
+        'svd'. However, occasionally 'svd' might be more accurate. 'rand'
+        updates the covariance of each patch from the previous one along the
+        first axis, and only approximates the eigenvectors that are kept.
+        All eigenvalues are still computed for each patch, so the gain is
+        moderate, e.g. 17 s instead of 25 s with 'eig' for mppca on
+        24x24x16 voxels with 120 directions.
     tau_factor : float (optional)
         Thresholding of PCA eigenvalues is done by nulling out eigenvalues that
         are smaller than:
@@ -93,6 +364,12 @@ def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
     out_dtype : str or dtype (optional)
         The dtype for the output array. Default: output has the same dtype as
         the input.
+    engine : {'serial', 'thread', 'process'} (optional)
+        How the slabs of the volume are denoised. 'thread' and 'process'
+        use a pool of `n_jobs` threads or processes. Default: 'serial'.
+    n_jobs : int (optional)
+        Number of workers of the pool. See
+        ``dipy.utils.parallel.determine_num_jobs``. Default: all cpus.
 
     Returns
     -------
@@ -100,6 +377,13 @@ def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
         This is the denoised array of the same size as that of the input data,
         clipped to non-negative values
 
+    Notes
+    -----
+    The patches centered on each slab of ``2 * patch_radius[2] + 1`` planes
+    of the volume are denoised together, a row of patches at a time with
+    stacked decompositions. The contributions of each slab are then added
+    in order, so that the result does not depend on `engine` nor `n_jobs`.
+
     References
     ----------
     .. [1] Veraart J, Novikov DS, Christiaens D, Ades-aron B, Sijbers,
@@ -132,12 +416,9 @@ def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
         raise ValueError("PCA denoising can only be performed on 4D arrays.",
                          arr.shape)
 
-    if pca_method.lower() == 'svd':
-        is_svd = True
-    elif pca_method.lower() == 'eig':
-        is_svd = False
-    else:
-        raise ValueError("pca_method should be either 'eig' or 'svd'")
+    pca_method = pca_method.lower()
+    if pca_method not in ('eig', 'svd', 'rand'):
+        raise ValueError("pca_method should be either 'eig', 'svd' or 'rand'")
 
     if isinstance(patch_radius, int):
         patch_radius = np.ones(3, dtype=int) * patch_radius
@@ -171,94 +452,61 @@ def genpca(arr, sigma=None, mask=None, patch_radius=2, pca_method='eig',
     if tau_factor is None:
         tau_factor = 1 + np.sqrt(dim / np.prod(patch_size))
 
-    theta = np.zeros(arr.shape, dtype=calc_dtype)
+    return_var = return_sigma is True and sigma is None
+    theta = np.zeros(arr.shape[:-1], dtype=calc_dtype)
     thetax = np.zeros(arr.shape, dtype=calc_dtype)
 
-    if return_sigma is True and sigma is None:
+    if return_var:
         var = np.zeros(arr.shape[:-1], dtype=calc_dtype)
         thetavar = np.zeros(arr.shape[:-1], dtype=calc_dtype)
 
-    # loop around and find the 3D patch for each direction at each pixel
-    for k in range(patch_radius[2], arr.shape[2] - patch_radius[2]):
-        for j in range(patch_radius[1], arr.shape[1] - patch_radius[1]):
-            for i in range(patch_radius[0], arr.shape[0] - patch_radius[0]):
-                # Shorthand for indexing variables:
-                if not mask[i, j, k]:
-                    continue
-                ix1 = i - patch_radius[0]
-                ix2 = i + patch_radius[0] + 1
-                jx1 = j - patch_radius[1]
-                jx2 = j + patch_radius[1] + 1
-                kx1 = k - patch_radius[2]
-                kx2 = k + patch_radius[2] + 1
-
-                X = arr[ix1:ix2, jx1:jx2, kx1:kx2].reshape(
-                                np.prod(patch_size), dim)
-                # compute the mean and normalize
-                M = np.mean(X, axis=0)
-                # Upcast the dtype for precision in the SVD
-                X = X - M
-
-                if is_svd:
-                    # PCA using an SVD
-                    U, S, Vt = svd(X, *svd_args)[:3]
-                    # Items in S are the eigenvalues, but in ascending order
-                    # We invert the order (=> descending), square and normalize
-                    # \lambda_i = s_i^2 / n
-                    d = S[::-1] ** 2 / X.shape[0]
-                    # Rows of Vt are eigenvectors, but also in ascending
-                    # eigenvalue order:
-                    W = Vt[::-1].T
-
-                else:
-                    # PCA using an Eigenvalue decomposition
-                    C = np.transpose(X).dot(X)
-                    C = C / X.shape[0]
-                    [d, W] = eigh(C, turbo=True)
-
-                if sigma is None:
-                    # Random matrix theory
-                    this_var, ncomps = _pca_classifier(d, np.prod(patch_size))
-                else:
-                    # Predefined variance
-                    this_var = var[i, j, k]
-
-                # Threshold by tau:
-                tau = tau_factor ** 2 * this_var
-
-                # Update ncomps according to tau_factor
-                ncomps = np.sum(d < tau)
-                W[:, :ncomps] = 0
-
-                # This is equations 1 and 2 in Manjon 2013:
-                Xest = X.dot(W).dot(W.T) + M
-                Xest = Xest.reshape(patch_size[0],
-                                    patch_size[1],
-                                    patch_size[2], dim)
-                # This is equation 3 in Manjon 2013:
-                this_theta = 1.0 / (1.0 + dim - ncomps)
-                theta[ix1:ix2, jx1:jx2, kx1:kx2] += this_theta
-                thetax[ix1:ix2, jx1:jx2, kx1:kx2] += Xest * this_theta
-                if return_sigma is True and sigma is None:
-                    var[ix1:ix2, jx1:jx2, kx1:kx2] += this_var * this_theta
-                    thetavar[ix1:ix2, jx1:jx2, kx1:kx2] += this_theta
-
-    denoised_arr = thetax / theta
+    # Slabs of planes of patch centers along the last spatial axis
+    k_stop = arr.shape[2] - patch_radius[2]
+    slabs = [(k, min(k + patch_size[2], k_stop))
+             for k in range(patch_radius[2], k_stop, patch_size[2])]
+    slabs = [(k1, k2) for k1, k2 in slabs if np.any(mask[:, :, k1:k2])]
+
+    shared = {'arr': arr, 'mask': mask,
+              'var': var if sigma is not None else None}
+    if engine == 'process' and determine_num_jobs(n_jobs) > 1:
+        # The arrays are inherited by the forked workers, not pickled
+        func_args = [None]
+        initializer, initargs = _genpca_init, (shared,)
+    else:
+        func_args = [shared]
+        initializer, initargs = None, ()
+    func_args += [patch_radius, pca_method, tau_factor, calc_dtype,
+                  sigma is not None, return_var]
+    results = paramap(_genpca_slab, slabs, engine=engine, n_jobs=n_jobs,
+                      func_args=func_args, initializer=initializer,
+                      initargs=initargs)
+    for z_start, s_theta, s_thetax, s_var, s_thetavar in results:
+        zsl = slice(z_start, z_start + s_theta.shape[2])
+        theta[:, :, zsl] += s_theta
+        thetax[:, :, zsl] += s_thetax
+        if return_var:
+            var[:, :, zsl] += s_var
+            thetavar[:, :, zsl] += s_thetavar
+
+    # Normalize the accumulator in place, rather than allocating another
+    # array of the size of the data
+    denoised_arr = thetax
+    denoised_arr /= theta[..., None]
     denoised_arr.clip(min=0, out=denoised_arr)
     denoised_arr[mask == 0] = 0
     if return_sigma is True:
         if sigma is None:
             var = var / thetavar
             var[mask == 0] = 0
-            return denoised_arr.astype(out_dtype), np.sqrt(var)
+            return denoised_arr.astype(out_dtype, copy=False), np.sqrt(var)
         else:
-            return denoised_arr.astype(out_dtype), sigma
+            return denoised_arr.astype(out_dtype, copy=False), sigma
     else:
-        return denoised_arr.astype(out_dtype)
+        return denoised_arr.astype(out_dtype, copy=False)
 
 
 def localpca(arr, sigma, mask=None, patch_radius=2, pca_method='eig',
-             tau_factor=2.3, out_dtype=None):
+             tau_factor=2.3, out_dtype=None, engine='serial', n_jobs=None):
     r""" Performs local PCA denoising according to Manjon et al. [1]_.
 
     Parameters
@@ -275,11 +523,16 @@ def localpca(arr, sigma, mask=None, patch_radius=2, pca_method='eig',
     patch_radius : int or 1D array (optional)
         The radius of the local patch to be taken around each voxel (in
         voxels). Default: 2 (denoise in blocks of 5x5x5 voxels).
-    pca_method : 'eig' or 'svd' (optional)
-        Use either eigenvalue decomposition (eig) or singular value
-        decomposition (svd) for principal component analysis. The default
-        method is 'eig' which is faster. However, occasionally 'svd' might be
-        more accurate.
+    pca_method : 'eig', 'svd' or 'rand' (optional)
+        Use either eigenvalue decomposition (eig), singular value
+        decomposition (svd) or a randomized decomposition (rand) for principal
+        component analysis. The default method is 'eig' which is faster than
+        'svd'. However, occasionally 'svd' might be more accurate. 'rand'
+        updates the covariance of each patch from the previous one along the
+        first axis, and only approximates the eigenvectors that are kept.
+        All eigenvalues are still computed for each patch, so the gain is
+        moderate, e.g. 17 s instead of 25 s with 'eig' for mppca on
+        24x24x16 voxels with 120 directions.
     tau_factor : float (optional)
         Thresholding of PCA eigenvalues is done by nulling out eigenvalues that
         are smaller than:
@@ -296,6 +549,11 @@ def localpca(arr, sigma, mask=None, patch_radius=2, pca_method='eig',
     out_dtype : str or dtype (optional)
         The dtype for the output array. Default: output has the same dtype as
         the input.
+    engine : {'serial', 'thread', 'process'} (optional)
+        How the slabs of the volume are denoised. See ``genpca``.
+        Default: 'serial'.
+    n_jobs : int (optional)
+        Number of workers of the pool. Default: all cpus.
 
     Returns
     -------
@@ -316,11 +574,12 @@ def localpca(arr, sigma, mask=None, patch_radius=2, pca_method='eig',
     """
     return genpca(arr, sigma=sigma, mask=mask, patch_radius=patch_radius,
                   pca_method=pca_method, tau_factor=2.3,
-                  return_sigma=False, out_dtype=out_dtype)
+                  return_sigma=False, out_dtype=out_dtype, engine=engine,
+                  n_jobs=n_jobs)
 
 
 def mppca(arr, mask=None, patch_radius=2, pca_method='eig',
-          return_sigma=False, out_dtype=None):
+          return_sigma=False, out_dtype=None, engine='serial', n_jobs=None):
     r"""Performs PCA-based denoising using the Marcenko-Pastur
     distribution [1]_.
 
@@ -336,11 +595,16 @@ def mppca(arr, mask=None, patch_radius=2, pca_method='eig',
     patch_radius : int or 1D array (optional)
         The radius of the local patch to be taken around each voxel (in
         voxels). Default: 2 (denoise in blocks of 5x5x5 voxels).
-    pca_method : 'eig' or 'svd' (optional)
-        Use either eigenvalue decomposition (eig) or singular value
-        decomposition (svd) for principal component analysis. The default
-        method is 'eig' which is faster. However, occasionally 'svd' might be
-        more accurate.
+    pca_method : 'eig', 'svd' or 'rand' (optional)
+        Use either eigenvalue decomposition (eig), singular value
+        decomposition (svd) or a randomized decomposition (rand) for principal
+        component analysis. The default method is 'eig' which is faster than
+        'svd'. However, occasionally 'svd' might be more accurate. 'rand'
+        updates the covariance of each patch from the previous one along the
+        first axis, and only approximates the eigenvectors that are kept.
+        All eigenvalues are still computed for each patch, so the gain is
+        moderate, e.g. 17 s instead of 25 s with 'eig' for mppca on
+        24x24x16 voxels with 120 directions.
     return_sigma : bool (optional)
         If true, a noise standard deviation estimate based on the
         Marcenko-Pastur distribution is returned [2]_.
@@ -348,6 +612,11 @@ def mppca(arr, mask=None, patch_radius=2, pca_method='eig',
     out_dtype : str or dtype (optional)
         The dtype for the output array. Default: output has the same dtype as
         the input.
+    engine : {'serial', 'thread', 'process'} (optional)
+        How the slabs of the volume are denoised. See ``genpca``.
+        Default: 'serial'.
+    n_jobs : int (optional)
+        Number of workers of the pool. Default: all cpus.
 
     Returns
     -------
@@ -369,4 +638,5 @@ def mppca(arr, mask=None, patch_radius=2, pca_method='eig',
     """
     return genpca(arr, sigma=None, mask=mask, patch_radius=patch_radius,
                   pca_method=pca_method, tau_factor=None,
-                  return_sigma=return_sigma, out_dtype=out_dtype)
+                  return_sigma=return_sigma, out_dtype=out_dtype,
+                  engine=engine, n_jobs=n_jobs)
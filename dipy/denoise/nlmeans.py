@@ -1,6 +1,10 @@
+from itertools import product
 
 import numpy as np
-from dipy.denoise.denspeed import nlmeans_3d
+from dipy.denoise.denspeed import (_nlmeans_3d, correspond_indices,
+                                   remove_padding)
+from dipy.utils.omp import default_threads
+from dipy.utils.parallel import determine_num_jobs, paramap
 # from warnings import warn
 # import warnings
 
@@ -10,16 +14,19 @@ from dipy.denoise.denspeed import nlmeans_3d
 
 
 def nlmeans(arr, sigma, mask=None, patch_radius=1, block_radius=5,
-            rician=True, num_threads=None):
+            rician=True, num_threads=None, out=None, max_memory=None,
+            n_jobs=1, tile_size=None):
     r""" Non-local means for denoising 3D and 4D images
 
     Parameters
     ----------
-    arr : 3D or 4D ndarray
-        The array to be denoised
+    arr : 3D or 4D array-like
+        The array to be denoised. It is read one slab at a time, so that it
+        can be a memory-mapped array or a nibabel proxy.
     mask : 3D ndarray
-    sigma : float or 3D array
-        standard deviation of the noise estimated from the data
+    sigma : float, 1D, 3D or 4D array
+        standard deviation of the noise estimated from the data. A 1D array
+        gives the standard deviation of each volume of 4D data.
     patch_radius : int
         patch size is ``2 x patch_radius + 1``. Default is 1.
     block_radius : int
@@ -30,6 +37,25 @@ def nlmeans(arr, sigma, mask=None, patch_radius=1, block_radius=5,
     num_threads : int
         Number of threads. If None (default) then all available threads
         will be used (all CPU cores).
+    out : array-like, optional
+        Array, possibly memory-mapped, in which the denoised data is written.
+        Default: a new array with the shape and dtype of ``arr``.
+    max_memory : float, optional
+        Approximate memory, in megabytes, used by the temporary arrays while
+        denoising. The volumes are denoised by slabs of planes along their
+        third axis to fit in this budget, with the same result. If None
+        (default), whole volumes are denoised at once.
+    n_jobs : int, optional
+        Number of slabs, or tiles, denoised concurrently, each with a share
+        of the `num_threads` threads. Several jobs keep all the threads busy
+        when the volumes are small, or when many slabs have few voxels in the
+        mask. See ``dipy.utils.parallel.determine_num_jobs``. Default 1.
+    tile_size : int or tuple of 3 ints, optional
+        Denoise the volumes by tiles of this size instead of slabs of whole
+        planes. Tiles without voxels in `mask` are skipped and the others are
+        scheduled from the one with the most voxels to denoise, which
+        balances the load of the jobs on masked data. The result does not
+        depend on the tiles.
 
     Returns
     -------
@@ -50,31 +76,193 @@ def nlmeans(arr, sigma, mask=None, patch_radius=1, block_radius=5,
     #                        "'dipy.denoise.non_local_means'"
     #                        " instead"))
 
+    if arr.ndim not in (3, 4):
+        raise ValueError("Only 3D or 4D array are supported!", arr.shape)
+    n_jobs = determine_num_jobs(n_jobs)
+    if max_memory is not None:
+        max_memory = max_memory / n_jobs
+    tiles = _nlmeans_tiles(arr.shape[:3], block_radius, max_memory,
+                           tile_size)
+    if out is None:
+        out = np.zeros(arr.shape, dtype=_data_dtype(arr))
+    for index, denoised in _nlmeans_blocks(arr, sigma, mask, patch_radius,
+                                           block_radius, rician, num_threads,
+                                           tiles, n_jobs, ordered=False):
+        out[index] = denoised
+    return out
+
+
+def nlmeans_slabs(arr, sigma, mask=None, patch_radius=1, block_radius=5,
+                  rician=True, num_threads=None, max_memory=None, n_jobs=1):
+    r""" Non-local means denoising of 3D and 4D images, one slab at a time
+
+    Each volume is denoised by slabs of planes along its third axis. Only
+    the planes of a slab and its reflection padding are read from `arr` and
+    converted to float64, so that `arr` can be a memory-mapped array or a
+    nibabel proxy of a file larger than the available memory. The slabs are
+    generated in the order of the voxels in a nifti file, volume by volume,
+    which allows to write them to a file as they come (see
+    ``dipy.io.image.save_nifti_streaming``).
+
+    Parameters
+    ----------
+    arr : 3D or 4D array-like
+        The array to be denoised.
+    sigma : float, 1D, 3D or 4D array
+        Standard deviation of the noise estimated from the data. A 1D array
+        gives the standard deviation of each volume of 4D data.
+    mask : 3D ndarray, optional
+    patch_radius : int
+        patch size is ``2 x patch_radius + 1``. Default is 1.
+    block_radius : int
+        block size is ``2 x block_radius + 1``. Default is 5.
+    rician : boolean
+        If True the noise is estimated as Rician, otherwise Gaussian noise
+        is assumed.
+    num_threads : int
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
+    max_memory : float, optional
+        Approximate memory, in megabytes, used by the temporary arrays of the
+        slabs. If None (default), whole volumes are denoised at once.
+    n_jobs : int, optional
+        Number of slabs denoised concurrently. See ``nlmeans``. Default 1.
+
+    Returns
+    -------
+    slabs : generator
+        Generator of ``(index, denoised)`` tuples, where ``denoised`` is the
+        denoised ``arr[index]``, in the dtype of ``arr``.
+    """
+    if arr.ndim not in (3, 4):
+        raise ValueError("Only 3D or 4D array are supported!", arr.shape)
+    n_jobs = determine_num_jobs(n_jobs)
+    if max_memory is not None:
+        max_memory = max_memory / n_jobs
+    tiles = _nlmeans_tiles(arr.shape[:3], block_radius, max_memory)
+    return _nlmeans_blocks(arr, sigma, mask, patch_radius, block_radius,
+                           rician, num_threads, tiles, n_jobs, ordered=True)
+
+
+# Approximate number of bytes of the temporary arrays of ``_nlmeans_3d`` for
+# each voxel of a padded slab: the data, mask, sigma and a few float64 copies
+_SLAB_BYTES_PER_VOXEL = 64
+
+
+def _nlmeans_blocks(arr, sigma, mask, patch_radius, block_radius, rician,
+                    num_threads, tiles, n_jobs, ordered):
+    """Denoise each tile of each volume of `arr`
+
+    With ``ordered=False``, the tiles with the most voxels in the mask are
+    scheduled first, so that the jobs finish at about the same time.
+    """
+    shape = arr.shape[:3]
+    if mask is None:
+        mask = np.ones((1, 1, 1))
+    mask = np.broadcast_to(np.asarray(mask, dtype=np.float64), shape)
+
+    sigma = np.asarray(sigma, dtype=np.float64)
     if arr.ndim == 3:
-        sigma = np.ones(arr.shape, dtype=np.float64) * sigma
-        return nlmeans_3d(arr, mask, sigma,
-                          patch_radius, block_radius,
-                          rician, num_threads).astype(arr.dtype)
-
-    elif arr.ndim == 4:
-        denoised_arr = np.zeros_like(arr)
-
-        if isinstance(sigma, np.ndarray) and sigma.ndim == 3:
-            sigma = (np.ones(arr.shape, dtype=np.float64) *
-                     sigma[..., np.newaxis])
-        else:
-            sigma = np.ones(arr.shape, dtype=np.float64) * sigma
-
-        for i in range(arr.shape[-1]):
-            denoised_arr[..., i] = nlmeans_3d(arr[..., i],
-                                              mask,
-                                              sigma[..., i],
-                                              patch_radius,
-                                              block_radius,
-                                              rician,
-                                              num_threads).astype(arr.dtype)
-
-        return denoised_arr
+        volumes = [()]
+        sigma = np.broadcast_to(sigma, shape)[..., None]
+    else:
+        volumes = [(i,) for i in range(arr.shape[-1])]
+        if sigma.ndim == 3:
+            sigma = sigma[..., None]
+        sigma = np.broadcast_to(sigma, arr.shape)
 
+    loads = [np.count_nonzero(mask[tile]) for tile in tiles]
+    if not ordered:
+        order = np.argsort(loads, kind='stable')[::-1]
+        tiles = [tiles[i] for i in order]
+        loads = [loads[i] for i in order]
+
+    # Each job denoises its tiles with a share of the threads
+    if n_jobs > 1:
+        total_threads = default_threads if num_threads is None else \
+            num_threads
+        num_threads = max(1, total_threads // n_jobs)
+
+    if ordered:
+        items = [(volume, tile, load) for volume in volumes
+                 for tile, load in zip(tiles, loads)]
     else:
-        raise ValueError("Only 3D or 4D array are supported!", arr.shape)
+        items = [(volume, tile, load) for tile, load in zip(tiles, loads)
+                 for volume in volumes]
+    shared = {'arr': arr, 'sigma': sigma, 'mask': mask,
+              'indices': [correspond_indices(dim, block_radius)
+                          for dim in shape],
+              'dtype': _data_dtype(arr)}
+    # _nlmeans_3d releases the GIL, so that the jobs run in threads
+    return paramap(_nlmeans_tile, items, engine='thread', n_jobs=n_jobs,
+                   ordered=ordered,
+                   func_args=[shared, patch_radius, block_radius, rician,
+                              num_threads])
+
+
+def _nlmeans_tile(item, shared, patch_radius, block_radius, rician,
+                  num_threads):
+    volume, tile, load = item
+    index = tile + volume
+    if load == 0:
+        # No voxel of the tile is denoised
+        return index, np.zeros([s.stop - s.start for s in tile],
+                               dtype=shared['dtype'])
+    sigma = shared['sigma'][..., volume[0] if volume else 0]
+    padded = [_padded_tile(a, tail, shared['indices'], tile, block_radius)
+              for a, tail in ((shared['arr'], volume),
+                              (shared['mask'], ()), (sigma, ()))]
+    denoised = _nlmeans_3d(*padded, patch_radius=patch_radius,
+                           block_radius=block_radius, rician=rician,
+                           num_threads=num_threads)
+    return index, remove_padding(denoised,
+                                 block_radius).astype(shared['dtype'])
+
+
+def _data_dtype(arr):
+    if isinstance(arr, np.ndarray):
+        return arr.dtype
+    # The dtype of a proxy is the dtype on disk, before scaling
+    return np.asarray(arr[(slice(0, 1),) * arr.ndim]).dtype
+
+
+def _slab_planes(shape, block_radius, max_memory):
+    """Number of planes of the slabs fitting in `max_memory` megabytes"""
+    if max_memory is None:
+        return shape[2]
+    plane_size = ((shape[0] + 2 * block_radius) *
+                  (shape[1] + 2 * block_radius) * _SLAB_BYTES_PER_VOXEL)
+    n_planes = int(max_memory * 2 ** 20 // plane_size) - 2 * block_radius
+    return int(np.clip(n_planes, 1, shape[2]))
+
+
+def _nlmeans_tiles(shape, block_radius, max_memory, tile_size=None):
+    """Split a volume in tiles, as tuples of slices
+
+    By default, the tiles are slabs of whole planes along the third axis
+    fitting in `max_memory` megabytes, in increasing order.
+    """
+    if tile_size is None:
+        tile_size = shape[:2] + (_slab_planes(shape, block_radius,
+                                              max_memory),)
+    tile_size = np.broadcast_to(tile_size, (3,))
+    starts = [range(0, dim, size) for dim, size in zip(shape, tile_size)]
+    return [tuple(slice(start, min(start + size, dim))
+                  for start, size, dim in zip(corner, tile_size, shape))
+            for corner in product(*starts)]
+
+
+def _padded_tile(arr, tail, indices, tile, padding):
+    """Read a tile of `arr` with a reflection padding
+
+    The result is the same as the corresponding part of
+    ``add_padding_reflection(arr, padding)``, but only the voxels needed are
+    read from `arr`.
+    """
+    tile_indices = [ind[s.start:s.stop + 2 * padding]
+                    for ind, s in zip(indices, tile)]
+    bounds = tuple(slice(ind.min(), ind.max() + 1) for ind in tile_indices)
+    block = np.asarray(arr[bounds + tail], dtype=np.float64)
+    return np.ascontiguousarray(
+        block[np.ix_(*[ind - b.start
+                       for ind, b in zip(tile_indices, bounds)])])
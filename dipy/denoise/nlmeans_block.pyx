@@ -1,8 +1,13 @@
 cimport cython
-from cython.view cimport array as cvarray
+from cython cimport floating
+from cython.parallel import parallel, prange
 from libc.math cimport sqrt, exp
+from libc.stdlib cimport malloc, free
+from libc.string cimport memset
 import numpy as np
 
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
+
 __all__ = ['firdn', 'upfir', 'nlmeans_block']
 
 cdef inline int _int_max(int a, int b):
@@ -71,14 +76,14 @@ def _upfir_matrix(double[:, :] F, double[:] h, double[:, :] out):
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void _average_block(double[:, :, :] ima, int x, int y, int z,
-                         double[:, :, :] average, double weight) nogil:
+cdef void _average_block(floating[:, :, :] ima, int x, int y, int z,
+                         double * average, int size, double weight) nogil:
     """
     Computes the weighted average of the patches in a blockwise manner
 
     Parameters
     ----------
-    ima : 3D array of doubles
+    ima : 3D array of floats or doubles
         input image
     x : integer
         x coordinate of the center voxel
@@ -86,19 +91,21 @@ cdef void _average_block(double[:, :, :] ima, int x, int y, int z,
         y coordinate of the center voxel
     z : integer
         z coordinate of the center voxel
-    average : 3D array of doubles
-        the image where averages are stored
+    average : pointer to doubles
+        the ``size x size x size`` block, in C order, where averages are
+        stored
+    size : integer
+        the size of the block
     weight : double
         weight for the weighted averaging
     """
 
     cdef int a, b, c, x_pos, y_pos, z_pos
     cdef int is_outside
-    cdef int count = 0
-    cdef int neighborhoodsize = average.shape[0] // 2
-    for a in range(average.shape[0]):
-        for b in range(average.shape[1]):
-            for c in range(average.shape[2]):
+    cdef int neighborhoodsize = size // 2
+    for a in range(size):
+        for b in range(size):
+            for c in range(size):
                 x_pos = x + a - neighborhoodsize
                 y_pos = y + b - neighborhoodsize
                 z_pos = z + c - neighborhoodsize
@@ -110,25 +117,28 @@ cdef void _average_block(double[:, :, :] ima, int x, int y, int z,
                 if ((z_pos < 0) or (z_pos >= ima.shape[2])):
                     is_outside = 1
                 if (is_outside == 1):
-                    average[a, b, c] += weight * (ima[y, x, z]**2)
+                    average[(a * size + b) * size + c] += \
+                        weight * (<double> ima[y, x, z])**2
                 else:
-                    average[a, b, c] += weight * (ima[y_pos, x_pos, z_pos]**2)
+                    average[(a * size + b) * size + c] += \
+                        weight * (<double> ima[y_pos, x_pos, z_pos])**2
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void _value_block(double[:, :, :] estimate, double[:, :, :] Label, int x, int y,
-                       int z, double[:, :, :] average, double global_sum, double hh, int rician_int) nogil:
+cdef void _value_block(floating[:, :, :] estimate, floating[:, :, :] Label,
+                       int x, int y, int z, double * average, int size,
+                       double global_sum, double hh, int rician_int) nogil:
 
     """
     Computes the final estimate of the denoised image
 
     Parameters
     ----------
-    estimate : 3D array of doubles
+    estimate : 3D array of floats or doubles
         The denoised estimate array
-    Label : 3D array of doubles
+    Label : 3D array of floats or doubles
         The label map for block wise weighted averaging
     x : integer
         x coordinate of the center voxel
@@ -136,8 +146,10 @@ cdef void _value_block(double[:, :, :] estimate, double[:, :, :] Label, int x, i
         y coordinate of the center voxel
     z : integer
         z coordinate of the center voxel
-    average : 3D array of doubles
-        weighted average image
+    average : pointer to doubles
+        weighted average block, in C order
+    size : integer
+        the size of the block
     global_sum : double
         total weight sum
     hh : double
@@ -146,14 +158,14 @@ cdef void _value_block(double[:, :, :] estimate, double[:, :, :] Label, int x, i
         0 or 1 as per the boolean value
     """
 
-    cdef int is_outside, a, b, c, x_pos, y_pos, z_pos, count = 0
+    cdef int is_outside, a, b, c, x_pos, y_pos, z_pos
     cdef double value = 0.0
     cdef double denoised_value = 0.0
     cdef double label = 0.0
-    cdef int neighborhoodsize = average.shape[0] // 2
-    for a in range(average.shape[0]):
-        for b in range(average.shape[1]):
-            for c in range(average.shape[2]):
+    cdef int neighborhoodsize = size // 2
+    for a in range(size):
+        for b in range(size):
+            for c in range(size):
                 is_outside = 0
                 x_pos = x + a - neighborhoodsize
                 y_pos = y + b - neighborhoodsize
@@ -167,9 +179,11 @@ cdef void _value_block(double[:, :, :] estimate, double[:, :, :] Label, int x, i
                 if (is_outside == 0):
                     value = estimate[y_pos, x_pos, z_pos]
                     if (rician_int):
-                        denoised_value = (average[a, b, c] / global_sum) - hh
+                        denoised_value = (average[(a * size + b) * size + c] /
+                                          global_sum) - hh
                     else:
-                        denoised_value = (average[a, b, c] / global_sum)
+                        denoised_value = (average[(a * size + b) * size + c] /
+                                          global_sum)
                     if (denoised_value > 0):
                         denoised_value = sqrt(denoised_value)
                     else:
@@ -183,7 +197,7 @@ cdef void _value_block(double[:, :, :] estimate, double[:, :, :] Label, int x, i
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef double _distance(double[:, :, :] image, int x, int y, int z,
+cdef double _distance(floating[:, :, :] image, int x, int y, int z,
                       int nx, int ny, int nz, int block_radius) nogil:
     """
     Computes the distance between two square subpatches of image located at
@@ -192,7 +206,7 @@ cdef double _distance(double[:, :, :] image, int x, int y, int z,
 
     Parameters
     ----------
-    image : 3D array of doubles
+    image : 3D array of floats or doubles
         the image whose voxels are taken
     x : integer
         x coordinate of first patch's center
@@ -248,7 +262,7 @@ cdef double _distance(double[:, :, :] image, int x, int y, int z,
                     nj2 = 2 * sy - nj2 - 1
                 if(nk2 >= sz):
                     nk2 = 2 * sz - nk2 - 1
-                distancetotal += (image[nj1, ni1, nk1] -
+                distancetotal += (<double> image[nj1, ni1, nk1] -
                                   image[nj2, ni2, nk2])**2
                 acu = acu + 1
     return distancetotal / acu
@@ -257,7 +271,7 @@ cdef double _distance(double[:, :, :] image, int x, int y, int z,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef double _local_mean(double[:, :, :]ima, int x, int y, int z) nogil:
+cdef double _local_mean(floating[:, :, :] ima, int x, int y, int z) nogil:
     """
     local mean of a 3x3x3 patch centered at x,y,z
     """
@@ -283,7 +297,8 @@ cdef double _local_mean(double[:, :, :]ima, int x, int y, int z) nogil:
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef double _local_variance(double[:, :, :] ima, double mean, int x, int y, int z) nogil:
+cdef double _local_variance(floating[:, :, :] ima, double mean, int x,
+                            int y, int z) nogil:
     """
     local variance of a 3x3x3 patch centered at x,y,z
     """
@@ -343,17 +358,18 @@ cpdef upfir(double[:, :] image, double[:] h):
     return filtered
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-@cython.cdivision(True)
-def nlmeans_block(double[:, :, :]image, double[:, :, :] mask, int patch_radius, int block_radius, double h, int rician):
+def nlmeans_block(image, mask, int patch_radius, int block_radius, h,
+                  int rician, num_threads=None):
     """Non-Local Means Denoising Using Blockwise Averaging
 
     Parameters
     ----------
-    image : 3D array of doubles
-        the input image, corrupted with rician noise
-    mask : 3D array of doubles
+    image : 3D or 4D array
+        the input image, corrupted with rician noise. Images of float32 are
+        denoised in single precision, which halves the memory used, and
+        other images in double precision. The volumes of a 4D image are
+        denoised one after the other.
+    mask : 3D array
         the input mask
     patch_radius :  int
         similar patches in the non-local means are searched for locally,
@@ -361,20 +377,25 @@ def nlmeans_block(double[:, :, :]image, double[:, :, :] mask, int patch_radius,
     block_radius :  int
         the size of the block to be used (2*f+1)x(2*f+1)x(2*f+1) in the
         blockwise non-local means implementation (the Coupe's proposal).
-    h :  double
+    h :  double or 1D array
         the estimated amount of rician noise in the input image: in P.
         Coupe et al. the rician noise was simulated as
         sqrt((f+x)^2 + (y)^2) where f is the pixel value and x and y are
         independent realizations of a random variable with Normal
-        distribution, with mean=0 and standard deviation=h
+        distribution, with mean=0 and standard deviation=h. A 1D array gives
+        the noise of each volume of a 4D image.
     rician : boolean
         If True the noise is estimated as Rician, otherwise Gaussian noise
         is assumed.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
-    fima: 3D double array
-        the denoised output which has the same shape as input image.
+    fima: 3D or 4D array
+        the denoised output which has the same shape as input image, in
+        float32 for an image of float32 and in float64 otherwise.
 
     References
     ----------
@@ -388,90 +409,194 @@ def nlmeans_block(double[:, :, :]image, double[:, :, :] mask, int patch_radius,
         IET Image Processing, Institution of Engineering and Technology, 2011
 
     """
+    image = np.asarray(image)
+    dtype = np.float32 if image.dtype == np.float32 else np.float64
+    # Read-only images are copied, as the memoryviews need writable buffers
+    image = np.require(image, dtype, 'W')
+    if image.ndim == 3:
+        return nlmeans_block(image[..., None], mask, patch_radius,
+                             block_radius, h, rician, num_threads)[..., 0]
+    if image.ndim != 4:
+        raise ValueError('image needs to be a 3D or 4D array', image.shape)
+    mask = np.asarray(mask, dtype=np.float64)
+    if mask.shape != image.shape[:3]:
+        raise ValueError('mask needs to be a 3D array of the shape of the '
+                         'volumes', mask.shape)
+    h = np.ascontiguousarray(np.broadcast_to(h, image.shape[3:]),
+                             dtype=np.float64)
+
+    fima = np.zeros(image.shape, dtype=image.dtype)
+    # Local means, local variances, estimates and labels of a volume
+    work = np.zeros((4,) + image.shape[:3], dtype=image.dtype)
+    set_num_threads(num_threads)
+    try:
+        _nlmeans_block_volumes(image, mask, patch_radius, block_radius, h,
+                               rician, fima, work)
+    finally:
+        if num_threads is not None:
+            restore_default_num_threads()
+    return fima
 
-    cdef int[:] dims = cvarray((3,), itemsize=sizeof(int), format="i")
-    dims[0] = image.shape[0]
-    dims[1] = image.shape[1]
-    dims[2] = image.shape[2]
-    cdef double hh = 2 * h * h
-    cdef int Ndims = (2 * block_radius + 1)**3
-    cdef int nvox = dims[0] * dims[1] * dims[2]
-    cdef double[:, :, :] average = np.zeros((2 * block_radius + 1, 2 * block_radius + 1, 2 * block_radius + 1), dtype=np.float64)
-    cdef double[:, :, :] fima = np.zeros_like(image)
-    cdef double[:, :, :] means = np.zeros_like(image)
-    cdef double[:, :, :] variances = np.zeros_like(image)
-    cdef double[:, :, :] Estimate = np.zeros_like(image)
-    cdef double[:, :, :] Label = np.zeros_like(image)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _nlmeans_block_volumes(floating[:, :, :, :] image,
+                           const double[:, :, :] mask, int patch_radius,
+                           int block_radius, const double[:] h,
+                           int rician, floating[:, :, :, :] fima,
+                           floating[:, :, :, :] work):
+    cdef:
+        int v
+        floating[:, :, :] volume, denoised
+        floating[:, :, :] means = work[0]
+        floating[:, :, :] variances = work[1]
+        floating[:, :, :] Estimate = work[2]
+        floating[:, :, :] Label = work[3]
+
+    for v in range(image.shape[3]):
+        volume = image[:, :, :, v]
+        denoised = fima[:, :, :, v]
+        Estimate[...] = 0
+        Label[...] = 0
+        with nogil:
+            _nlmeans_block_3d(volume, mask, patch_radius, block_radius, h[v],
+                              rician, denoised, means, variances, Estimate,
+                              Label)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _nlmeans_block_3d(floating[:, :, :] image,
+                            const double[:, :, :] mask,
+                            int patch_radius, int block_radius, double h,
+                            int rician, floating[:, :, :] fima,
+                            floating[:, :, :] means,
+                            floating[:, :, :] variances,
+                            floating[:, :, :] Estimate,
+                            floating[:, :, :] Label) nogil:
+    """Denoise a volume, see ``nlmeans_block``
+
+    The blocks centered on every other voxel are averaged by tiles of
+    ``tile x tile`` voxels along the second and third axes. A block only
+    reaches the tiles next to the tile of its center, so that the tiles of
+    each of the four combinations of odd and even tile indices are averaged
+    in parallel, without concurrent writes to ``Estimate`` and ``Label``.
+    """
+    cdef:
+        int dims0 = image.shape[0]
+        int dims1 = image.shape[1]
+        int dims2 = image.shape[2]
+        int size = 2 * block_radius + 1
+        int tile = 2 * block_radius + 2
+        int n_tiles1 = (dims1 + tile - 1) // tile
+        int n_tiles2 = (dims2 + tile - 1) // tile
+        int color, n_color1, n_color2, t, i_start, k_start
+        int i, j, k
+        double * average
+
+    for k in prange(dims2, schedule='static'):
+        for i in range(dims1):
+            for j in range(dims0):
+                means[j, i, k] = _local_mean(image, j, i, k)
+                variances[j, i, k] = _local_variance(
+                    image, means[j, i, k], j, i, k)
+
+    for color in range(4):
+        n_color1 = (n_tiles1 - color % 2 + 1) // 2
+        n_color2 = (n_tiles2 - color // 2 + 1) // 2
+        if n_color1 * n_color2 == 0:
+            continue
+        with parallel():
+            average = <double *> malloc(size * size * size * sizeof(double))
+            for t in prange(n_color1 * n_color2, schedule='dynamic'):
+                i_start = (color % 2 + 2 * (t % n_color1)) * tile
+                k_start = (color // 2 + 2 * (t // n_color1)) * tile
+                _average_tile(image, means, variances, Estimate, Label,
+                              average, size, i_start,
+                              min(i_start + tile, dims1), k_start,
+                              min(k_start + tile, dims2), patch_radius,
+                              block_radius, h, rician)
+            free(average)
+
+    for k in prange(dims2, schedule='static'):
+        for i in range(dims1):
+            for j in range(dims0):
+
+                if mask[j, i, k] == 0:
+                    fima[j, i, k] = 0
+
+                else:
+                    if(Label[j, i, k] == 0.0):
+                        fima[j, i, k] = image[j, i, k]
+                    else:
+                        fima[j, i, k] = Estimate[j, i, k] / Label[j, i, k]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _average_tile(floating[:, :, :] image, floating[:, :, :] means,
+                        floating[:, :, :] variances,
+                        floating[:, :, :] Estimate, floating[:, :, :] Label,
+                        double * average, int size, int i_start, int i_stop,
+                        int k_start, int k_stop, int patch_radius,
+                        int block_radius, double h, int rician) nogil:
+    """Average the blocks centered on every other voxel of a tile"""
     cdef int i, j, k, ni, nj, nk
+    cdef int dims0 = image.shape[0]
+    cdef int dims1 = image.shape[1]
+    cdef int dims2 = image.shape[2]
     cdef double t1, t2
     cdef double epsilon = 0.00001
     cdef double mu1 = 0.95
     cdef double var1 = 0.5 + 1e-7
+    cdef double hh = 2 * h * h
     cdef double d
     cdef double totalWeight, wmax, w
 
-    with nogil:
-        for k in range(dims[2]):
-            for i in range(dims[1]):
-                for j in range(dims[0]):
-                    means[j, i, k] = _local_mean(image, j, i, k)
-                    variances[j, i, k] = _local_variance(
-                        image, means[j, i, k], j, i, k)
-        for k in range(0, dims[2], 2):
-            for i in range(0, dims[1], 2):
-                for j in range(0, dims[0], 2):
-                    with gil:
-                        average[...] = 0
-                    totalWeight = 0
-                    if (means[j, i, k] <= epsilon) or (
-                            variances[j, i, k] <= epsilon):
-                        wmax = 1.0
-                        _average_block(image, i, j, k, average, wmax)
-                        totalWeight += wmax
+    for k in range(k_start, k_stop, 2):
+        for i in range(i_start, i_stop, 2):
+            for j in range(0, dims0, 2):
+                memset(average, 0, size * size * size * sizeof(double))
+                totalWeight = 0
+                if (means[j, i, k] <= epsilon) or (
+                        variances[j, i, k] <= epsilon):
+                    wmax = 1.0
+                    _average_block(image, i, j, k, average, size, wmax)
+                    totalWeight += wmax
+                    _value_block(Estimate, Label, i, j, k,
+                                 average, size, totalWeight, hh, rician)
+                else:
+                    wmax = 0
+                    for nk in range(k - patch_radius, k + patch_radius + 1):
+                        for ni in range(i - patch_radius,
+                                        i + patch_radius + 1):
+                            for nj in range(j - patch_radius,
+                                            j + patch_radius + 1):
+                                if((ni == i)and(nj == j)and(nk == k)):
+                                    continue
+                                if ((ni < 0) or (nj < 0) or (nk < 0) or (
+                                        nj >= dims0) or (ni >= dims1) or
+                                        (nk >= dims2)):
+                                    continue
+                                if ((means[nj, ni, nk] <= epsilon) or (
+                                        variances[nj, ni, nk] <= epsilon)):
+                                    continue
+                                t1 = (means[j, i, k]) / (means[nj, ni, nk])
+                                t2 = (variances[j, i, k]) / \
+                                    (variances[nj, ni, nk])
+                                if ((t1 > mu1) and (t1 < (1 / mu1)) and
+                                        (t2 > var1) and (t2 < (1 / var1))):
+                                    d = _distance(image, i, j, k, ni, nj, nk,
+                                                  block_radius)
+                                    w = exp(-d / (h * h))
+                                    if(w > wmax):
+                                        wmax = w
+                                    _average_block(image, ni, nj, nk,
+                                                   average, size, w)
+                                    totalWeight += w
+
+                    if(totalWeight != 0.0):
                         _value_block(Estimate, Label, i, j, k,
-                                     average, totalWeight, hh, rician)
-                    else:
-                        wmax = 0
-                        for nk in range(k - patch_radius, k + patch_radius + 1):
-                            for ni in range(i - patch_radius, i + patch_radius + 1):
-                                for nj in range(j - patch_radius, j + patch_radius + 1):
-                                    if((ni == i)and(nj == j)and(nk == k)):
-                                        continue
-                                    if ((ni < 0) or (nj < 0) or (nk < 0) or (
-                                            nj >= dims[0]) or (ni >= dims[1]) or (nk >= dims[2])):
-                                        continue
-                                    if ((means[nj, ni, nk] <= epsilon) or (
-                                            variances[nj, ni, nk] <= epsilon)):
-                                        continue
-                                    t1 = (means[j, i, k]) / (means[nj, ni, nk])
-                                    t2 = (variances[j, i, k]) / \
-                                        (variances[nj, ni, nk])
-                                    if ((t1 > mu1) and (t1 < (1 / mu1)) and
-                                            (t2 > var1) and (t2 < (1 / var1))):
-                                        d = _distance(
-                                            image, i, j, k, ni, nj, nk, block_radius)
-                                        w = exp(-d / (h * h))
-                                        if(w > wmax):
-                                            wmax = w
-                                        _average_block(
-                                            image, ni, nj, nk, average, w)
-                                        totalWeight += w
-
-                        if(totalWeight != 0.0):
-                            _value_block(Estimate, Label, i, j, k,
-                                         average, totalWeight, hh, rician)
-
-        for k in range(0, dims[2]):
-            for i in range(0, dims[1]):
-                for j in range(0, dims[0]):
-
-                    if mask[j, i, k] == 0:
-                        fima[j, i, k] = 0
-
-                    else:
-                        if(Label[j, i, k] == 0.0):
-                            fima[j, i, k] = image[j, i, k]
-                        else:
-                            fima[j, i, k] = Estimate[j, i, k] / Label[j, i, k]
-
-    return fima
+                                     average, size, totalWeight, hh, rician)
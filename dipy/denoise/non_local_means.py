@@ -4,17 +4,19 @@ from dipy.denoise.nlmeans_block import nlmeans_block
 
 
 def non_local_means(arr, sigma, mask=None, patch_radius=1, block_radius=5,
-                    rician=True):
+                    rician=True, num_threads=None):
     r""" Non-local means for denoising 3D and 4D images, using
         blockwise averaging approach
 
     Parameters
     ----------
     arr : 3D or 4D ndarray
-        The array to be denoised
+        The array to be denoised. Arrays of float32 are denoised in single
+        precision.
     mask : 3D ndarray
-    sigma : float
-        standard deviation of the noise estimated from the data
+    sigma : float or 1D array
+        standard deviation of the noise estimated from the data. A 1D array
+        gives the standard deviation of each volume of 4D data.
     patch_radius : int
         patch size is ``2 x patch_radius + 1``. Default is 1.
     block_radius : int
@@ -22,6 +24,9 @@ def non_local_means(arr, sigma, mask=None, patch_radius=1, block_radius=5,
     rician : boolean
         If True the noise is estimated as Rician, otherwise Gaussian noise
         is assumed.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
 
     Returns
     -------
@@ -42,8 +47,12 @@ def non_local_means(arr, sigma, mask=None, patch_radius=1, block_radius=5,
                 Technology, 2011
 
     """
-    if not np.isscalar(sigma) and not sigma.shape == (1, ):
-        raise ValueError("Sigma input needs to be of type float", sigma)
+    if arr.ndim not in (3, 4):
+        raise ValueError("Only 3D or 4D array are supported!", arr.shape)
+    if not np.isscalar(sigma) and not sigma.shape == (1, ) and not (
+            arr.ndim == 4 and sigma.shape == arr.shape[3:]):
+        raise ValueError("Sigma input needs to be of type float, or an array "
+                         "of the sigma of each volume", sigma)
     if mask is None and arr.ndim > 2:
         mask = np.ones((arr.shape[0], arr.shape[1], arr.shape[2]), dtype='f8')
     else:
@@ -52,22 +61,6 @@ def non_local_means(arr, sigma, mask=None, patch_radius=1, block_radius=5,
     if mask.ndim != 3:
         raise ValueError('mask needs to be a 3D ndarray', mask.shape)
 
-    if arr.ndim == 3:
-        return np.array(nlmeans_block(
-            np.double(arr),
-            mask,
-            patch_radius,
-            block_radius,
-            sigma,
-            np.int(rician))).astype(arr.dtype)
-    elif arr.ndim == 4:
-        denoised_arr = np.zeros_like(arr)
-        for i in range(arr.shape[-1]):
-            denoised_arr[..., i] = np.array(nlmeans_block(np.double(
-                arr[..., i]), mask, patch_radius, block_radius, sigma,
-                np.int(rician))).astype(arr.dtype)
-
-        return denoised_arr
-
-    else:
-        raise ValueError("Only 3D or 4D array are supported!", arr.shape)
+    return nlmeans_block(arr, mask, patch_radius, block_radius, sigma,
+                         int(rician), num_threads).astype(arr.dtype,
+                                                          copy=False)
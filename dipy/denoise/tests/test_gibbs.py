@@ -76,6 +76,23 @@ def test_gibbs_4d():
     assert_array_almost_equal(image4d_cor[:, :, 1, 1], image_cor)
 
 
+def test_gibbs_batches_and_threads():
+    # More slices than a batch, corrected by several threads
+    image3d = np.zeros((6 * Nre, 6 * Nre, 37))
+    image3d[..., :] = image_gibbs[..., None]
+    image3d *= np.linspace(1, 2, 37)
+    expected = np.stack([_gibbs_removal_2d(image3d[..., i])
+                         for i in range(37)], axis=-1)
+    for num_threads in [1, 3, None]:
+        image3d_cor = gibbs_removal(image3d.copy(), num_threads=num_threads)
+        assert_array_almost_equal(image3d_cor, expected)
+
+    # Stacks of images are corrected at once along their last two axes
+    images = np.moveaxis(image3d[..., :4], -1, 0)
+    assert_array_almost_equal(_gibbs_removal_2d(images),
+                              np.moveaxis(expected[..., :4], -1, 0))
+
+
 def test_swapped_gibbs_2d():
     # 2D case: In this case slice_axis is a dummy variable. Since data is
     # already a single 2D image, to axis swapping is required
@@ -5,7 +5,8 @@ from numpy.testing import (run_module_suite,
                            assert_equal,
                            assert_raises,
                            assert_array_almost_equal)
-from dipy.denoise.localpca import (localpca, mppca, genpca, _pca_classifier)
+from dipy.denoise.localpca import (localpca, mppca, genpca, _pca_classifier,
+                                   _pca_classifier_batch, _row_covariances)
 from dipy.sims.voxel import multi_tensor
 from dipy.core.gradients import gradient_table, generate_bvecs
 
@@ -297,6 +298,66 @@ def test_pca_classifier():
     assert_(std_error < 5)
 
 
+def test_pca_classifier_batch():
+    rng = np.random.RandomState(0)
+    X = rng.standard_normal((10, 125, 20))
+    X[:5, :, :3] *= 10
+    X = X - X.mean(axis=1)[:, None]
+    L = np.linalg.eigh(np.matmul(np.swapaxes(X, 1, 2), X) / 125)[0]
+    var, ncomps = _pca_classifier_batch(L, 125)
+    for i in range(len(L)):
+        this_var, this_ncomps = _pca_classifier(L[i], 125)
+        assert_array_almost_equal(var[i], this_var)
+        assert_equal(ncomps[i], this_ncomps)
+
+
+def test_mppca_engines():
+    DWIgt = rfiw_phantom(gtab, snr=None)
+    rng = np.random.RandomState(0)
+    DWInoise = DWIgt + 0.02 * rng.standard_normal(DWIgt.shape)
+    mask = np.zeros(DWIgt.shape[:-1], dtype=bool)
+    mask[:, 1:-1, 2:] = True
+    DWIden, sigma = mppca(DWInoise, mask=mask, patch_radius=2,
+                          return_sigma=True)
+    for engine in ['thread', 'process']:
+        # The result does not depend on how the slabs are processed
+        DWIden_par, sigma_par = mppca(DWInoise, mask=mask, patch_radius=2,
+                                      return_sigma=True, engine=engine,
+                                      n_jobs=2)
+        assert_equal(DWIden_par, DWIden)
+        assert_equal(sigma_par, sigma)
+
+
+def test_row_covariances():
+    rng = np.random.RandomState(0)
+    row = 100 + rng.standard_normal((12, 3, 5, 8))
+    centers = np.array([1, 2, 5, 10])
+    C, M = _row_covariances(row, centers, 1)
+    for n, i in enumerate(centers):
+        X = row[i - 1:i + 2].reshape(-1, 8)
+        assert_array_almost_equal(M[n], X.mean(axis=0))
+        X = X - X.mean(axis=0)
+        assert_array_almost_equal(C[n], np.dot(X.T, X) / X.shape[0])
+
+
+def test_lpca_rand():
+    DWIgt = rfiw_phantom(gtab, snr=None)
+    std_gt = 0.02
+    rng = np.random.RandomState(0)
+    DWInoise = DWIgt + std_gt * rng.standard_normal(DWIgt.shape)
+    # The components above the threshold are well separated from the noise
+    DWIden = localpca(DWInoise, std_gt, patch_radius=2)
+    DWIden_rand = localpca(DWInoise, std_gt, patch_radius=2,
+                           pca_method='rand')
+    assert_array_almost_equal(DWIden_rand, DWIden)
+
+    DWIden = mppca(DWInoise, patch_radius=2)
+    DWIden_rand = mppca(DWInoise, patch_radius=2, pca_method='rand')
+    rmse_den = np.sum(np.abs(DWIgt - DWIden)) / np.sum(np.abs(DWIgt))
+    rmse_rand = np.sum(np.abs(DWIgt - DWIden_rand)) / np.sum(np.abs(DWIgt))
+    assert_(abs(rmse_rand - rmse_den) < 0.05 * rmse_den)
+
+
 def test_mppca_in_phantom():
     DWIgt = rfiw_phantom(gtab, snr=None)
     std_gt = 0.02
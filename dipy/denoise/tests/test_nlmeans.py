@@ -5,7 +5,7 @@ from numpy.testing import (run_module_suite,
                            assert_array_almost_equal,
                            assert_raises)
 import pytest
-from dipy.denoise.nlmeans import nlmeans
+from dipy.denoise.nlmeans import nlmeans, nlmeans_slabs
 from dipy.denoise.denspeed import (add_padding_reflection, remove_padding)
 from dipy.utils.omp import cpu_count, have_openmp
 from time import time
@@ -90,6 +90,61 @@ def test_nlmeans_dtype():
     S0n = nlmeans(S0, sigma=np.ones((20, 20, 20)), mask=mask, rician=True)
     assert_equal(S0.dtype, S0n.dtype)
 
+
+def test_nlmeans_slabs():
+    rng = np.random.RandomState(0)
+    S0 = (100 + 5 * rng.standard_normal((20, 21, 22, 3))).astype('f4')
+    mask = rng.rand(20, 21, 22) > 0.3
+    sigma = np.array([3., 4., 5.])
+    expected = nlmeans(S0, sigma, mask, block_radius=3)
+
+    # Slabs of one plane, a few planes and the whole volume give the same
+    # result as the denoising of whole volumes
+    for max_memory in [1e-3, 0.5, 1e3]:
+        S0n = nlmeans(S0, sigma, mask, block_radius=3, max_memory=max_memory)
+        assert_equal(S0n, expected)
+
+    out = np.zeros(S0.shape)
+    assert_(nlmeans(S0, sigma, mask, block_radius=3, out=out,
+                    max_memory=0.5) is out)
+    assert_array_almost_equal(out, expected)
+
+    # Slabs come volume after volume, in increasing order along the third
+    # axis
+    slabs = list(nlmeans_slabs(S0, sigma, mask, block_radius=3,
+                               max_memory=0.3))
+    assert_(len(slabs) > 3)
+    for (index, denoised), volume in zip(slabs, np.concatenate(
+            [[i] * (len(slabs) // 3) for i in range(3)])):
+        assert_equal(index[3], volume)
+        assert_equal(denoised, expected[index])
+    assert_raises(ValueError, nlmeans_slabs, S0[None], 1.0)
+
+
+def test_nlmeans_tiles_and_jobs():
+    rng = np.random.RandomState(1)
+    S0 = (100 + 5 * rng.standard_normal((20, 21, 22, 4))).astype('f4')
+    mask = np.zeros(S0.shape[:3], dtype=bool)
+    mask[3:9, 5:15, 2:18] = True
+    expected = nlmeans(S0, 4., mask, block_radius=3)
+
+    # The result does not depend on the tiles nor on the number of jobs
+    for kwargs in [{'n_jobs': 3}, {'tile_size': 7},
+                   {'n_jobs': 2, 'tile_size': (5, 30, 4), 'max_memory': 0.1},
+                   {'n_jobs': -1, 'num_threads': 1, 'tile_size': 6}]:
+        S0n = nlmeans(S0, 4., mask, block_radius=3, **kwargs)
+        assert_equal(S0n, expected)
+
+    # Slabs are still generated in order with several jobs
+    slabs = list(nlmeans_slabs(S0, 4., mask, block_radius=3, max_memory=0.2,
+                               n_jobs=3))
+    for (index, denoised), (expected_index, _) in zip(
+            slabs, nlmeans_slabs(S0, 4., mask, block_radius=3,
+                                 max_memory=0.2)):
+        assert_equal(index, expected_index)
+        assert_equal(denoised, expected[index])
+
+
 @pytest.mark.skipif(not have_openmp,
                     reason='OpenMP does not appear to be available')
 def test_nlmeans_4d_3dsigma_and_threads():
@@ -85,5 +85,34 @@ def test_nlmeans_dtype():
     assert_equal(S0.dtype, S0n.dtype)
 
 
+def test_nlmeans_float32_4D_and_threads():
+    rng = np.random.RandomState(0)
+    S0 = 100 + 5 * rng.standard_normal((23, 26, 29, 3))
+    S0[:10, :10, :10] += 200
+    mask = np.zeros(S0.shape[:3])
+    mask[2:20, 3:22, 1:27] = 1
+    sigma = np.array([4., 5., 6.])
+
+    # 4D data with a sigma per volume is denoised like each of its volumes
+    S0n = non_local_means(S0, sigma, mask, block_radius=2, rician=True)
+    for i in range(S0.shape[-1]):
+        assert_array_almost_equal(
+            S0n[..., i], non_local_means(S0[..., i], sigma[i], mask,
+                                         block_radius=2, rician=True))
+
+    # The result does not depend on the number of threads
+    for num_threads in [1, 2]:
+        assert_equal(non_local_means(S0, sigma, mask, block_radius=2,
+                                     rician=True, num_threads=num_threads),
+                     S0n)
+
+    # float32 data is denoised in single precision
+    S0n32 = non_local_means(S0.astype(np.float32), sigma, mask,
+                            block_radius=2, rician=True)
+    assert_equal(S0n32.dtype, np.float32)
+    assert_array_almost_equal(S0n32, S0n, decimal=3)
+    assert_raises(ValueError, non_local_means, S0, sigma[:2], mask)
+
+
 if __name__ == '__main__':
     run_module_suite()
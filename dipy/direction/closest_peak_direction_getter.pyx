@@ -167,7 +167,8 @@ cdef class PmfGenDirectionGetter(BasePmfDirectionGetter):
 
     @classmethod
     def from_shcoeff(klass, shcoeff, max_angle, sphere=default_sphere,
-                     pmf_threshold=0.1, basis_type=None, **kwargs):
+                     pmf_threshold=0.1, basis_type=None, pmf_mode='sh',
+                     **kwargs):
         """Probabilistic direction getter from a distribution of directions
         on the sphere
 
@@ -191,6 +192,13 @@ cdef class PmfGenDirectionGetter(BasePmfDirectionGetter):
         basis_type : name of basis
             The basis that ``shcoeff`` are associated with.
             ``dipy.reconst.shm.real_sym_sh_basis`` is used by default.
+        pmf_mode : str
+            How the distribution is evaluated while tracking, one of 'sh',
+            'float64', 'float32', 'uint8' or 'cache'. By default ('sh') the
+            coefficients are evaluated at each tracking step. The other modes
+            precompute or cache the distribution of each voxel, using more
+            memory for faster tracking (see
+            ``dipy.direction.pmf.SHCoeffPmfGen``).
         relative_peak_threshold : float in [0., 1.]
             Used for extracting initial tracking directions. Passed to
             peak_directions.
@@ -201,10 +209,11 @@ cdef class PmfGenDirectionGetter(BasePmfDirectionGetter):
         See also
         --------
         dipy.direction.peaks.peak_directions
+        dipy.direction.pmf.shcoeff_pmf_nbytes
 
         """
         pmf_gen = SHCoeffPmfGen(np.asarray(shcoeff,dtype=float), sphere,
-                                basis_type)
+                                basis_type, pmf_mode)
         return klass(pmf_gen, max_angle, sphere, pmf_threshold, **kwargs)
 
 
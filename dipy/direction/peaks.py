@@ -1,6 +1,7 @@
 
-from multiprocessing import cpu_count, Pool
-from itertools import repeat
+import mmap
+import multiprocessing
+from multiprocessing import cpu_count
 from os import path
 from warnings import warn
 
@@ -9,6 +10,12 @@ from nibabel.tmpdirs import InTemporaryDirectory
 import numpy as np
 import scipy.optimize as opt
 
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8, shared arrays are memory-mapped files
+    shared_memory = None
+
 from dipy.reconst.odf import gfa
 from dipy.reconst.recspeed import (local_maxima, remove_similar_vertices,
                                    search_descending)
@@ -218,6 +225,101 @@ class PeaksAndMetrics(EuDXDirectionGetter):
                                                    self.odf)
 
 
+# Context of the worker processes, the default one if None
+_mp_context = None
+
+
+class _SharedArrays(object):
+    """Arrays shared with the worker processes.
+
+    When the workers are forked, they inherit the arrays: the input data is
+    used as is, and the output arrays are allocated in anonymous shared
+    memory, so that nothing is copied. Otherwise, arrays are allocated in
+    shared memory, or in memory-mapped files of `tmpdir` when
+    ``multiprocessing.shared_memory`` is not available, and memory-mapped
+    input data is opened again by the workers from its file. Workers attach
+    to the arrays from their descriptions, see :func:`_attach_array`.
+    """
+
+    def __init__(self, tmpdir, inherit):
+        self.tmpdir = tmpdir
+        self.inherit = inherit
+        self.arrays = {}
+        self.descriptions = {}
+        self._segments = []
+
+    def create(self, name, shape, dtype, fill=None):
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        nbytes = max(1, int(np.prod(shape)) * dtype.itemsize)
+        if self.inherit:
+            # Anonymous mappings are shared with forked processes, and freed
+            # with the last array using them
+            array = np.ndarray(shape, dtype, buffer=mmap.mmap(-1, nbytes))
+            self.descriptions[name] = ('inherit', array)
+        elif shared_memory is not None:
+            segment = shared_memory.SharedMemory(create=True, size=nbytes)
+            self._segments.append(segment)
+            array = np.ndarray(shape, dtype, buffer=segment.buf)
+            self.descriptions[name] = ('shm', segment.name, shape, dtype.str)
+        else:
+            file_name = path.join(self.tmpdir, name + '.npy')
+            array = np.lib.format.open_memmap(file_name, 'w+', dtype, shape)
+            self.descriptions[name] = ('mmap', file_name, shape, dtype.str)
+        if fill is not None:
+            array.fill(fill)
+        self.arrays[name] = array
+        return array
+
+    def share(self, name, array, shape):
+        """Share an input array with the workers as an array of `shape`
+
+        The array is only copied when the workers can't inherit it or map
+        its file.
+        """
+        if self.inherit:
+            self.descriptions[name] = ('inherit', np.reshape(array, shape))
+        elif (isinstance(array, np.memmap) and
+                isinstance(array.base, mmap.mmap) and
+                array.flags.c_contiguous):
+            # The whole memory-mapped file, not a view of it
+            self.descriptions[name] = ('memmap', array.filename,
+                                       array.offset, shape, array.dtype.str)
+        else:
+            self.create(name, shape, array.dtype)[:] = np.reshape(array,
+                                                                  shape)
+            del self.arrays[name]
+
+    def outputs(self):
+        """The output arrays, copied out of the shared memory segments"""
+        if self.inherit:
+            return dict(self.arrays)
+        return dict((name, np.array(array)) for name, array in
+                    self.arrays.items())
+
+    def close(self):
+        self.arrays.clear()
+        for segment in self._segments:
+            segment.close()
+            segment.unlink()
+        self._segments = []
+
+
+def _attach_array(description):
+    """Array shared by the main process and the segment backing it"""
+    kind = description[0]
+    if kind == 'inherit':
+        return description[1], None
+    if kind == 'shm':
+        _, name, shape, dtype = description
+        segment = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shape, dtype, buffer=segment.buf), segment
+    if kind == 'memmap':
+        _, name, offset, shape, dtype = description
+        return np.memmap(name, dtype, 'r', offset, shape), None
+    return np.load(description[1], mmap_mode='r+'), None
+
+
 def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                min_separation_angle, mask, return_odf,
                                return_sh, gfa_thr, normalize_peaks, sh_order,
@@ -245,146 +347,158 @@ def _peaks_from_model_parallel(model, data, sphere, relative_peak_threshold,
                                 sh_order, sh_basis_type, npeaks,
                                 parallel=False)
 
-    shape = list(data.shape)
-    data = np.reshape(data, (-1, shape[-1]))
-    n = data.shape[0]
+    shape = data.shape[:-1]
+    if mask is None:
+        mask = np.ones(shape, dtype='bool')
+    elif mask.shape != shape:
+        raise ValueError("Mask is not the same shape as data.")
+    mask = np.asarray(mask, dtype=bool).ravel()
+    n = mask.shape[0]
     nbr_chunks = nbr_processes ** 2
-    chunk_size = int(np.ceil(n / nbr_chunks))
-    indices = list(zip(np.arange(0, n, chunk_size),
-                       np.arange(0, n, chunk_size) + chunk_size))
+    chunk_size = max(1, int(np.ceil(n / nbr_chunks)))
 
+    context = _mp_context or multiprocessing.get_context()
+    inherit = context.get_start_method() == 'fork'
     with InTemporaryDirectory() as tmpdir:
-
-        data_file_name = path.join(tmpdir, 'data.npy')
-        np.save(data_file_name, data)
-        if mask is not None:
-            mask = mask.flatten()
-            mask_file_name = path.join(tmpdir, 'mask.npy')
-            np.save(mask_file_name, mask)
-        else:
-            mask_file_name = None
-
-        pool = Pool(nbr_processes)
-
-        pam_res = pool.map(_peaks_from_model_parallel_sub,
-                           zip(repeat((data_file_name, mask_file_name)),
-                               indices,
-                               repeat(model),
-                               repeat(sphere),
-                               repeat(relative_peak_threshold),
-                               repeat(min_separation_angle),
-                               repeat(return_odf),
-                               repeat(return_sh),
-                               repeat(gfa_thr),
-                               repeat(normalize_peaks),
-                               repeat(sh_order),
-                               repeat(sh_basis_type),
-                               repeat(npeaks),
-                               repeat(B),
-                               repeat(invB)))
-        pool.close()
-
-        pam = PeaksAndMetrics()
-        pam.sphere = sphere
-        # use memmap to reduce the memory usage
-        pam.gfa = np.memmap(path.join(tmpdir, 'gfa.npy'),
-                            dtype=pam_res[0].gfa.dtype,
-                            mode='w+',
-                            shape=(data.shape[0]))
-
-        pam.peak_dirs = np.memmap(path.join(tmpdir, 'peak_dirs.npy'),
-                                  dtype=pam_res[0].peak_dirs.dtype,
-                                  mode='w+',
-                                  shape=(data.shape[0], npeaks, 3))
-        pam.peak_values = np.memmap(path.join(tmpdir, 'peak_values.npy'),
-                                    dtype=pam_res[0].peak_values.dtype,
-                                    mode='w+',
-                                    shape=(data.shape[0], npeaks))
-        pam.peak_indices = np.memmap(path.join(tmpdir, 'peak_indices.npy'),
-                                     dtype=pam_res[0].peak_indices.dtype,
-                                     mode='w+',
-                                     shape=(data.shape[0], npeaks))
-        pam.qa = np.memmap(path.join(tmpdir, 'qa.npy'),
-                           dtype=pam_res[0].qa.dtype,
-                           mode='w+',
-                           shape=(data.shape[0], npeaks))
-        if return_sh:
-            nbr_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
-            pam.shm_coeff = np.memmap(path.join(tmpdir, 'shm.npy'),
-                                      dtype=pam_res[0].shm_coeff.dtype,
-                                      mode='w+',
-                                      shape=(data.shape[0], nbr_shm_coeff))
-            pam.B = pam_res[0].B
-        else:
-            pam.shm_coeff = None
-            pam.invB = None
-        if return_odf:
-            pam.odf = np.memmap(path.join(tmpdir, 'odf.npy'),
-                                dtype=pam_res[0].odf.dtype,
-                                mode='w+',
-                                shape=(data.shape[0], len(sphere.vertices)))
-        else:
-            pam.odf = None
-
-        # copy subprocesses pam to a single pam (memmaps)
-        for i, (start_pos, end_pos) in enumerate(indices):
-            pam.gfa[start_pos: end_pos] = pam_res[i].gfa
-            pam.peak_dirs[start_pos: end_pos] = pam_res[i].peak_dirs
-            pam.peak_values[start_pos: end_pos] = pam_res[i].peak_values
-            pam.peak_indices[start_pos: end_pos] = pam_res[i].peak_indices
-            pam.qa[start_pos: end_pos] = pam_res[i].qa
+        shared = _SharedArrays(tmpdir, inherit)
+        try:
+            # Workers only read the voxels of their chunk and write their
+            # results in the output arrays
+            shared.share('data', data, (n, data.shape[-1]))
+            shared.create('gfa', (n,), float, 0)
+            shared.create('qa', (n, npeaks), float, 0)
+            shared.create('peak_dirs', (n, npeaks, 3), float, 0)
+            shared.create('peak_values', (n, npeaks), float, 0)
+            shared.create('peak_indices', (n, npeaks), int, -1)
             if return_sh:
-                pam.shm_coeff[start_pos: end_pos] = pam_res[i].shm_coeff
+                n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
+                shared.create('shm_coeff', (n, n_shm_coeff), float, 0)
             if return_odf:
-                pam.odf[start_pos: end_pos] = pam_res[i].odf
+                shared.create('odf', (n, len(sphere.vertices)), float, 0)
+
+            # Workers attach the arrays and get the model once, when they
+            # start
+            params = (model, sphere, relative_peak_threshold,
+                      min_separation_angle, gfa_thr, normalize_peaks, invB)
+            # Chunks without voxels in the mask are skipped
+            tasks = [(start, start + chunk_size,
+                      mask[start:start + chunk_size])
+                     for start in range(0, n, chunk_size)
+                     if mask[start:start + chunk_size].any()]
+            global_max = -np.inf
+            pool = context.Pool(min(nbr_processes, max(1, len(tasks))),
+                                initializer=_init_peaks_worker,
+                                initargs=(shared.descriptions, params))
+            try:
+                for chunk_max in pool.imap_unordered(
+                        _peaks_from_model_parallel_sub, tasks):
+                    global_max = max(global_max, chunk_max)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+            arrays = shared.outputs()
+        finally:
+            shared.close()
+
+    arrays['qa'] /= global_max
+    shape = list(shape)
+    return _pam_from_attrs(PeaksAndMetrics,
+                           sphere,
+                           arrays['peak_indices'].reshape(shape + [npeaks]),
+                           arrays['peak_values'].reshape(shape + [npeaks]),
+                           arrays['peak_dirs'].reshape(shape + [npeaks, 3]),
+                           arrays['gfa'].reshape(shape),
+                           arrays['qa'].reshape(shape + [npeaks]),
+                           arrays['shm_coeff'].reshape(shape + [-1])
+                           if return_sh else None,
+                           B if return_sh else None,
+                           arrays['odf'].reshape(shape + [-1])
+                           if return_odf else None)
 
-        # load memmaps to arrays and reshape the metric
-        shape[-1] = -1
-        pam.gfa = np.reshape(np.array(pam.gfa), shape[:-1])
-        pam.peak_dirs = np.reshape(np.array(pam.peak_dirs), shape + [3])
-        pam.peak_values = np.reshape(np.array(pam.peak_values), shape)
-        pam.peak_indices = np.reshape(np.array(pam.peak_indices), shape)
-        pam.qa = np.reshape(np.array(pam.qa), shape)
-        if return_sh:
-            pam.shm_coeff = np.reshape(np.array(pam.shm_coeff), shape)
-        if return_odf:
-            pam.odf = np.reshape(np.array(pam.odf), shape)
 
-        # Make sure all worker processes have exited before leaving context
-        # manager in order to prevent temporary file deletion errors in windows
-        pool.join()
+# Arrays and parameters of the worker process, see _init_peaks_worker
+_worker_state = None
 
-    return pam
+
+def _init_peaks_worker(descriptions, params):
+    """Attach the shared arrays once, when the worker process starts"""
+    global _worker_state
+    arrays = {}
+    segments = []
+    for name, description in descriptions.items():
+        arrays[name], segment = _attach_array(description)
+        if segment is not None:
+            segments.append(segment)
+    # The segments are closed when the worker exits
+    _worker_state = (arrays, segments, params)
 
 
 def _peaks_from_model_parallel_sub(args):
-    (data_file_name, mask_file_name) = args[0]
-    (start_pos, end_pos) = args[1]
-    model = args[2]
-    sphere = args[3]
-    relative_peak_threshold = args[4]
-    min_separation_angle = args[5]
-    return_odf = args[6]
-    return_sh = args[7]
-    gfa_thr = args[8]
-    normalize_peaks = args[9]
-    sh_order = args[10]
-    sh_basis_type = args[11]
-    npeaks = args[12]
-    B = args[13]
-    invB = args[14]
-
-    data = np.load(data_file_name, mmap_mode='r')[start_pos:end_pos]
-    if mask_file_name is not None:
-        mask = np.load(mask_file_name, mmap_mode='r')[start_pos:end_pos]
-    else:
-        mask = None
+    start_pos, end_pos, mask = args
+    arrays, _, params = _worker_state
+    (model, sphere, relative_peak_threshold, min_separation_angle, gfa_thr,
+     normalize_peaks, invB) = params
+    chunk = dict((name, array[start_pos:end_pos])
+                 for name, array in arrays.items())
+    return _peaks_from_model_voxels(
+        model, chunk['data'], mask, sphere, relative_peak_threshold,
+        min_separation_angle, gfa_thr, normalize_peaks, invB,
+        chunk['gfa'], chunk['qa'], chunk['peak_dirs'], chunk['peak_values'],
+        chunk['peak_indices'], chunk.get('shm_coeff'), chunk.get('odf'))
+
+
+def _peaks_from_model_voxels(model, data, mask, sphere,
+                             relative_peak_threshold, min_separation_angle,
+                             gfa_thr, normalize_peaks, invB, gfa_array,
+                             qa_array, peak_dirs, peak_values, peak_indices,
+                             shm_coeff, odf_array):
+    """Fit the model in the voxels of the mask and write peaks and metrics
+    in the output arrays.
+
+    `shm_coeff` and `odf_array` are None if they are not returned. The
+    quantitative anisotropy is not normalized, the maximum value used to
+    normalize it is returned.
+    """
+    npeaks = peak_values.shape[-1]
+    global_max = -np.inf
+    for idx in ndindex(mask.shape):
+        if not mask[idx]:
+            continue
+
+        odf = model.fit(data[idx]).odf(sphere)
 
-    return peaks_from_model(model, data, sphere, relative_peak_threshold,
-                            min_separation_angle, mask, return_odf,
-                            return_sh, gfa_thr, normalize_peaks,
-                            sh_order, sh_basis_type, npeaks, B, invB,
-                            parallel=False, nbr_processes=None)
+        if shm_coeff is not None:
+            shm_coeff[idx] = np.dot(odf, invB)
+
+        if odf_array is not None:
+            odf_array[idx] = odf
+
+        gfa_array[idx] = gfa(odf)
+        if gfa_array[idx] < gfa_thr:
+            global_max = max(global_max, odf.max())
+            continue
+
+        # Get peaks of odf
+        direction, pk, ind = peak_directions(odf, sphere,
+                                             relative_peak_threshold,
+                                             min_separation_angle)
+
+        # Calculate peak metrics
+        if pk.shape[0] != 0:
+            global_max = max(global_max, pk[0])
+
+            n = min(npeaks, pk.shape[0])
+            qa_array[idx][:n] = pk[:n] - odf.min()
+
+            peak_dirs[idx][:n] = direction[:n]
+            peak_indices[idx][:n] = ind[:n]
+            peak_values[idx][:n] = pk[:n]
+
+            if normalize_peaks:
+                peak_values[idx][:n] /= pk[0]
+                peak_dirs[idx] *= peak_values[idx][:, None]
+    return global_max
 
 
 def peaks_from_model(model, data, sphere, relative_peak_threshold,
@@ -436,9 +550,12 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
         Inverse of B.
     parallel: bool
         If True, use multiprocessing to compute peaks and metric
-        (default False). Temporary files are saved in the default temporary
+        (default False). The data and the results are shared with the
+        worker processes in shared memory, or in temporary files on Python
+        < 3.8. Temporary files are saved in the default temporary
         directory of the system. It can be changed using ``import tempfile``
-        and ``tempfile.tempdir = '/path/to/tempdir'``.
+        and ``tempfile.tempdir = '/path/to/tempdir'``. The worker processes
+        are started for each call.
     nbr_processes: int
         If `parallel` is True, the number of subprocesses to use
         (default multiprocessing.cpu_count()).
@@ -499,50 +616,19 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
     peak_indices = np.zeros((shape + (npeaks,)), dtype='int')
     peak_indices.fill(-1)
 
+    shm_coeff = None
     if return_sh:
         n_shm_coeff = (sh_order + 2) * (sh_order + 1) // 2
         shm_coeff = np.zeros((shape + (n_shm_coeff,)))
 
+    odf_array = None
     if return_odf:
         odf_array = np.zeros((shape + (len(sphere.vertices),)))
 
-    global_max = -np.inf
-    for idx in ndindex(shape):
-        if not mask[idx]:
-            continue
-
-        odf = model.fit(data[idx]).odf(sphere)
-
-        if return_sh:
-            shm_coeff[idx] = np.dot(odf, invB)
-
-        if return_odf:
-            odf_array[idx] = odf
-
-        gfa_array[idx] = gfa(odf)
-        if gfa_array[idx] < gfa_thr:
-            global_max = max(global_max, odf.max())
-            continue
-
-        # Get peaks of odf
-        direction, pk, ind = peak_directions(odf, sphere,
-                                             relative_peak_threshold,
-                                             min_separation_angle)
-
-        # Calculate peak metrics
-        if pk.shape[0] != 0:
-            global_max = max(global_max, pk[0])
-
-            n = min(npeaks, pk.shape[0])
-            qa_array[idx][:n] = pk[:n] - odf.min()
-
-            peak_dirs[idx][:n] = direction[:n]
-            peak_indices[idx][:n] = ind[:n]
-            peak_values[idx][:n] = pk[:n]
-
-            if normalize_peaks:
-                peak_values[idx][:n] /= pk[0]
-                peak_dirs[idx] *= peak_values[idx][:, None]
+    global_max = _peaks_from_model_voxels(
+        model, data, mask, sphere, relative_peak_threshold,
+        min_separation_angle, gfa_thr, normalize_peaks, invB, gfa_array,
+        qa_array, peak_dirs, peak_values, peak_indices, shm_coeff, odf_array)
 
     qa_array /= global_max
 
@@ -553,9 +639,9 @@ def peaks_from_model(model, data, sphere, relative_peak_threshold,
                            peak_dirs,
                            gfa_array,
                            qa_array,
-                           shm_coeff if return_sh else None,
+                           shm_coeff,
                            B if return_sh else None,
-                           odf_array if return_odf else None)
+                           odf_array)
 
 
 def reshape_peaks_for_visualization(peaks):
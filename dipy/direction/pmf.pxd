@@ -20,7 +20,22 @@ cdef class SHCoeffPmfGen(PmfGen):
         double[:, :] B
         object sphere
         double[:] coeff
-    pass
+        readonly object pmf_mode
+        readonly np.npy_intp cache_max_nbytes
+        int mode
+        np.npy_intp shape[3]
+        float[:, :, :, :] sf_float
+        unsigned char[:, :, :, :] sf_uint8
+        float[:, :, :, :] sf_range
+        int[:, :, :] cache_slot
+        double[:, :] cache_sf
+        np.npy_intp[:] cache_voxel
+        np.npy_intp cache_next
+
+    cdef void _add_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                             np.npy_intp k, double weight)
+    cdef np.npy_intp _cache_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                      np.npy_intp k)
 
 
 cdef class BootPmfGen(PmfGen):
@@ -9,6 +9,7 @@ from dipy.core.geometry import cart2sphere
 from dipy.reconst import shm
 
 from dipy.core.interpolation cimport trilinear_interpolate4d_c
+from libc.math cimport floor
 
 
 cdef class PmfGen:
@@ -47,15 +48,100 @@ cdef class SimplePmfGen(PmfGen):
         return self.pmf
 
 
+# Modes of evaluation of the pmf of SHCoeffPmfGen
+cdef enum:
+    SH_MODE
+    FLOAT64_MODE
+    FLOAT32_MODE
+    UINT8_MODE
+    CACHE_MODE
+
+PMF_MODES = {'sh': SH_MODE, 'float64': FLOAT64_MODE,
+             'float32': FLOAT32_MODE, 'uint8': UINT8_MODE,
+             'cache': CACHE_MODE}
+
+
+def shcoeff_pmf_nbytes(shcoeff_shape, n_vertices, pmf_mode='sh',
+                       cache_max_nbytes=2 ** 28):
+    """Memory used by ``SHCoeffPmfGen`` to evaluate the pmf.
+
+    Parameters
+    ----------
+    shcoeff_shape : tuple
+        Shape of the 4D array of spherical harmonic coefficients.
+    n_vertices : int
+        Number of vertices of the sphere the pmf is evaluated on.
+    pmf_mode : str
+        Mode of evaluation of the pmf, see ``SHCoeffPmfGen``.
+    cache_max_nbytes : int
+        Memory budget of the cached sphere functions in the 'cache' mode.
+
+    Returns
+    -------
+    nbytes : int
+        Number of bytes of the arrays used to evaluate the pmf. In the 'sh'
+        and 'cache' modes, this includes the coefficients in float64. The
+        other modes do not keep the coefficients once the sphere functions
+        are computed.
+    """
+    n_voxels = int(np.prod(shcoeff_shape[:3]))
+    n_coeffs = shcoeff_shape[3]
+    if pmf_mode not in PMF_MODES:
+        raise ValueError("pmf_mode should be one of %s, got %r" %
+                         (", ".join(PMF_MODES), pmf_mode))
+    if pmf_mode == 'sh':
+        return 8 * n_voxels * n_coeffs
+    if pmf_mode == 'float64':
+        return 8 * n_voxels * n_vertices
+    if pmf_mode == 'float32':
+        return 4 * n_voxels * n_vertices
+    if pmf_mode == 'uint8':
+        # quantized values, with an offset and a scale per voxel
+        return n_voxels * n_vertices + 8 * n_voxels
+    n_slots = _cache_size(n_voxels, n_vertices, cache_max_nbytes)
+    return (8 * n_voxels * n_coeffs + 4 * n_voxels +
+            n_slots * (8 * n_vertices + 8))
+
+
+def _cache_size(n_voxels, n_vertices, cache_max_nbytes):
+    """Number of sphere functions cached within `cache_max_nbytes`"""
+    return int(min(n_voxels, max(8, cache_max_nbytes // (8 * n_vertices))))
+
+
 cdef class SHCoeffPmfGen(PmfGen):
+    """Pmf from spherical harmonic coefficients.
+
+    The pmf can be evaluated in several modes, trading memory for speed:
+
+    - 'sh': the coefficients are interpolated at each point and then
+      evaluated on the sphere (least memory).
+    - 'float64', 'float32': the sphere functions of all voxels are computed
+      once, in double or single precision, and are interpolated at each
+      point (fastest).
+    - 'uint8': as 'float32', but the sphere function of each voxel is
+      quantized to 256 levels between its minimum and maximum.
+    - 'cache': the sphere functions are computed when first needed, and kept
+      within `cache_max_nbytes` bytes. When the cache is full, the function
+      computed first is replaced (first in, first out), however recently it
+      was used.
+
+    Use ``shcoeff_pmf_nbytes`` or ``memory_usage`` to get the memory used by
+    each mode.
+    """
 
     def __init__(self,
                  double[:, :, :, :] shcoeff_array,
                  object sphere,
-                 object basis_type):
+                 object basis_type,
+                 object pmf_mode='sh',
+                 np.npy_intp cache_max_nbytes=2 ** 28):
         cdef:
             int sh_order
+            np.npy_intp n_voxels, n_vertices
 
+        if pmf_mode not in PMF_MODES:
+            raise ValueError("pmf_mode should be one of %s, got %r" %
+                             (", ".join(PMF_MODES), pmf_mode))
         PmfGen.__init__(self, shcoeff_array)
 
         self.sphere = sphere
@@ -68,22 +154,163 @@ cdef class SHCoeffPmfGen(PmfGen):
         self.coeff = np.empty(shcoeff_array.shape[3])
         self.pmf = np.empty(self.B.shape[0])
 
+        self.pmf_mode = pmf_mode
+        self.mode = PMF_MODES[pmf_mode]
+        self.cache_max_nbytes = cache_max_nbytes
+        for i in range(3):
+            self.shape[i] = shcoeff_array.shape[i]
+        n_voxels = self.shape[0] * self.shape[1] * self.shape[2]
+        n_vertices = self.B.shape[0]
+
+        if self.mode == FLOAT64_MODE:
+            self.data = self._sphere_functions(np.float64)
+        elif self.mode == FLOAT32_MODE:
+            self.sf_float = self._sphere_functions(np.float32)
+            # The coefficients are not needed anymore
+            self.data = None
+        elif self.mode == UINT8_MODE:
+            self._quantize_sphere_functions()
+            self.data = None
+        elif self.mode == CACHE_MODE:
+            self.cache_slot = np.full((self.shape[0], self.shape[1],
+                                       self.shape[2]), -1, dtype=np.intc)
+            n_slots = _cache_size(n_voxels, n_vertices, cache_max_nbytes)
+            self.cache_sf = np.empty((n_slots, n_vertices))
+            self.cache_voxel = np.full(n_slots, -1, dtype=np.intp)
+            self.cache_next = 0
+
+    def memory_usage(self):
+        """Number of bytes used to evaluate the pmf, see
+        ``shcoeff_pmf_nbytes``."""
+        shape = (self.shape[0], self.shape[1], self.shape[2], self.B.shape[1])
+        return shcoeff_pmf_nbytes(shape,
+                                  self.B.shape[0], self.pmf_mode,
+                                  self.cache_max_nbytes)
+
+    def _sphere_functions(self, dtype):
+        """Sphere functions of all voxels, computed one slab at a time"""
+        B = np.asarray(self.B)
+        coeffs = np.asarray(self.data)
+        sf = np.empty(coeffs.shape[:3] + (B.shape[0],), dtype=dtype)
+        for x in range(coeffs.shape[0]):
+            sf[x] = np.dot(coeffs[x], B.T)
+        return sf
+
+    def _quantize_sphere_functions(self):
+        B = np.asarray(self.B)
+        coeffs = np.asarray(self.data)
+        sf_uint8 = np.empty(coeffs.shape[:3] + (B.shape[0],), dtype=np.uint8)
+        sf_range = np.empty(coeffs.shape[:3] + (2,), dtype=np.float32)
+        for x in range(coeffs.shape[0]):
+            sf = np.dot(coeffs[x], B.T)
+            sf_min = sf.min(axis=-1)
+            scale = (sf.max(axis=-1) - sf_min) / 255.
+            scale[scale == 0] = 1
+            sf_uint8[x] = np.rint((sf - sf_min[..., None]) /
+                                  scale[..., None])
+            sf_range[x, ..., 0] = sf_min
+            sf_range[x, ..., 1] = scale
+        self.sf_uint8 = sf_uint8
+        self.sf_range = sf_range
+
     cdef double[:] get_pmf_c(self, double* point):
         cdef:
             size_t i, j
             size_t len_pmf = self.pmf.shape[0]
             size_t len_B = self.B.shape[1]
             double _sum
+            np.npy_intp flr
+            double rem
+            np.npy_intp index[3][2]
+            double weight[3][2]
+            double w
+
+        if self.mode == SH_MODE:
+            if trilinear_interpolate4d_c(self.data, point, self.coeff) != 0:
+                self.__clear_pmf()
+            else:
+                for i in range(len_pmf):
+                    _sum = 0
+                    for j in range(len_B):
+                        _sum += self.B[i, j] * self.coeff[j]
+                    self.pmf[i] = _sum
+            return self.pmf
+
+        if self.mode == FLOAT64_MODE:
+            if trilinear_interpolate4d_c(self.data, point, self.pmf) != 0:
+                self.__clear_pmf()
+            return self.pmf
+
+        # Same interpolation as trilinear_interpolate4d_c, one voxel at a time
+        for i in range(3):
+            if point[i] < -.5 or point[i] >= (self.shape[i] - .5):
+                self.__clear_pmf()
+                return self.pmf
+            flr = <np.npy_intp> floor(point[i])
+            rem = point[i] - flr
+            index[i][0] = flr + (flr == -1)
+            index[i][1] = flr + (flr != (self.shape[i] - 1))
+            weight[i][0] = 1 - rem
+            weight[i][1] = rem
+
+        self.__clear_pmf()
+        for i in range(2):
+            for j in range(2):
+                for k in range(2):
+                    w = weight[0][i] * weight[1][j] * weight[2][k]
+                    if w != 0:
+                        self._add_voxel_pmf(index[0][i], index[1][j],
+                                            index[2][k], w)
+        return self.pmf
 
-        if trilinear_interpolate4d_c(self.data, point, self.coeff) != 0:
-            self.__clear_pmf()
+    cdef void _add_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                             np.npy_intp k, double weight):
+        """Add the weighted sphere function of a voxel to the pmf"""
+        cdef:
+            np.npy_intp L, slot
+            np.npy_intp len_pmf = self.pmf.shape[0]
+            double offset, scale
+
+        if self.mode == FLOAT32_MODE:
+            for L in range(len_pmf):
+                self.pmf[L] += weight * self.sf_float[i, j, k, L]
+        elif self.mode == UINT8_MODE:
+            offset = self.sf_range[i, j, k, 0]
+            scale = self.sf_range[i, j, k, 1]
+            for L in range(len_pmf):
+                self.pmf[L] += weight * (offset +
+                                         scale * self.sf_uint8[i, j, k, L])
         else:
-            for i in range(len_pmf):
-                _sum = 0
-                for j in range(len_B):
-                    _sum += self.B[i, j] * self.coeff[j]
-                self.pmf[i] = _sum
-        return self.pmf
+            slot = self.cache_slot[i, j, k]
+            if slot < 0:
+                slot = self._cache_voxel_pmf(i, j, k)
+            for L in range(len_pmf):
+                self.pmf[L] += weight * self.cache_sf[slot, L]
+
+    cdef np.npy_intp _cache_voxel_pmf(self, np.npy_intp i, np.npy_intp j,
+                                      np.npy_intp k):
+        """Compute the sphere function of a voxel in the oldest cache slot"""
+        cdef:
+            np.npy_intp slot, old, L, c
+            np.npy_intp len_pmf = self.pmf.shape[0]
+            np.npy_intp len_B = self.B.shape[1]
+            double _sum
+
+        slot = self.cache_next
+        self.cache_next = (slot + 1) % self.cache_sf.shape[0]
+        old = self.cache_voxel[slot]
+        if old >= 0:
+            self.cache_slot[old // (self.shape[1] * self.shape[2]),
+                            (old // self.shape[2]) % self.shape[1],
+                            old % self.shape[2]] = -1
+        for L in range(len_pmf):
+            _sum = 0
+            for c in range(len_B):
+                _sum += self.B[L, c] * self.data[i, j, k, c]
+            self.cache_sf[slot, L] = _sum
+        self.cache_slot[i, j, k] = slot
+        self.cache_voxel[slot] = (i * self.shape[1] + j) * self.shape[2] + k
+        return slot
 
 
 cdef class BootPmfGen(PmfGen):
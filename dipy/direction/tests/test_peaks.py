@@ -1,13 +1,17 @@
+import multiprocessing
+import os
 import numpy as np
 import warnings
 import pickle
 from io import BytesIO
+from nibabel.tmpdirs import InTemporaryDirectory
 
 from numpy.testing import (assert_array_equal, assert_array_almost_equal,
                            assert_almost_equal, run_module_suite,
                            assert_equal, assert_)
 from dipy.reconst.odf import (OdfFit, OdfModel, gfa)
 
+from dipy.direction import peaks
 from dipy.direction.peaks import (peaks_from_model,
                                   peak_directions,
                                   peak_directions_nl,
@@ -597,6 +601,60 @@ def test_peaksFromModelParallel():
                 assert_array_almost_equal(pam.odf, pam_single.odf)
 
 
+def test_peaks_from_model_parallel_volume():
+    _, fbvals, fbvecs = get_fnames('small_64D')
+    bvals, bvecs = read_bvals_bvecs(fbvals, fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+    mevals = np.array(([0.0015, 0.0003, 0.0003],
+                       [0.0015, 0.0003, 0.0003]))
+    np.random.seed(0)
+    data = np.empty((4, 5, 6, len(bvals)))
+    for idx in np.ndindex(data.shape[:3]):
+        data[idx], _ = multi_tensor(gtab, mevals, 100,
+                                    angles=[(0, 0), (np.random.rand() * 90,
+                                                     0)],
+                                    fractions=[50, 50], snr=50)
+    # Most chunks don't have any voxels in the mask
+    mask = np.zeros(data.shape[:3], dtype=bool)
+    mask[1, 2:4] = True
+    mask[3, 0, :2] = True
+    model = SimpleOdfModel(gtab)
+
+    pam_single = peaks_from_model(model, data, default_sphere, .5, 45,
+                                  mask=mask, return_odf=True, parallel=False)
+    shared_memory = peaks.shared_memory
+    with InTemporaryDirectory() as tmpdir:
+        data_file = np.memmap(os.path.join(tmpdir, 'data.dat'), data.dtype,
+                              'w+', shape=data.shape)
+        data_file[:] = data
+        data_file.flush()
+        # Forked workers inherit the arrays. Spawned workers map the data
+        # file, or get copies in shared memory or memory-mapped temporary
+        # files
+        for start_method, use_shared_memory, in_data in [
+                ('fork', True, data), ('spawn', True, data),
+                ('spawn', False, data), ('spawn', True, data_file)]:
+            peaks._mp_context = multiprocessing.get_context(start_method)
+            if not use_shared_memory:
+                peaks.shared_memory = None
+            try:
+                pam_multi = peaks_from_model(model, in_data, default_sphere,
+                                             .5, 45, mask=mask,
+                                             return_odf=True, parallel=True,
+                                             nbr_processes=2)
+            finally:
+                peaks._mp_context = None
+                peaks.shared_memory = shared_memory
+            for attr in ['peak_dirs', 'peak_values', 'peak_indices', 'gfa',
+                         'qa', 'shm_coeff', 'odf']:
+                assert_equal(getattr(pam_multi, attr).dtype,
+                             getattr(pam_single, attr).dtype)
+                assert_array_almost_equal(getattr(pam_multi, attr),
+                                          getattr(pam_single, attr))
+            assert_array_equal(pam_multi.B, pam_single.B)
+        del data_file
+
+
 def test_peaks_shm_coeff():
 
     SNR = 100
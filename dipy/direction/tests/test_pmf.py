@@ -1,10 +1,13 @@
+import sys
 import warnings
 import numpy as np
 import numpy.testing as npt
 
 from dipy.core.gradients import gradient_table
 from dipy.core.sphere import HemiSphere, unit_octahedron
-from dipy.direction.pmf import SimplePmfGen, SHCoeffPmfGen, BootPmfGen
+from dipy.data import default_sphere
+from dipy.direction.pmf import (SimplePmfGen, SHCoeffPmfGen, BootPmfGen,
+                                shcoeff_pmf_nbytes)
 from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
 from dipy.reconst.dti import TensorModel
 from dipy.sims.voxel import single_tensor
@@ -27,6 +30,59 @@ def test_pmf_from_sh():
                            np.zeros(len(sphere.vertices)))
 
 
+def test_pmf_from_sh_modes():
+    np.random.seed(1234)
+    shcoeff = np.random.random([4, 5, 3, 45])
+    sphere = default_sphere
+    n_vertices = len(sphere.vertices)
+    points = np.random.uniform(-0.5, 2.5, (50, 3))
+    pmfgen = SHCoeffPmfGen(shcoeff, sphere, None)
+    expected = [np.array(pmfgen.get_pmf(p)) for p in points]
+    sf_range = np.ptp(expected)
+
+    for pmf_mode, decimal in [('float64', 10), ('float32', 4),
+                              ('uint8', 1), ('cache', 10)]:
+        for cache_max_nbytes in [2 ** 28, 10 * 8 * n_vertices]:
+            pmfgen = SHCoeffPmfGen(shcoeff, sphere, None, pmf_mode,
+                                   cache_max_nbytes)
+            npt.assert_equal(pmfgen.pmf_mode, pmf_mode)
+            for point, pmf in zip(points, expected):
+                npt.assert_array_almost_equal(
+                    np.array(pmfgen.get_pmf(point)) / sf_range,
+                    pmf / sf_range, decimal=decimal)
+            # the pmf is 0 for invalid points
+            npt.assert_array_equal(pmfgen.get_pmf(np.array([-1., 0, 0])),
+                                   np.zeros(n_vertices))
+            npt.assert_equal(pmfgen.memory_usage(),
+                             shcoeff_pmf_nbytes(shcoeff.shape, n_vertices,
+                                                pmf_mode, cache_max_nbytes))
+
+    # The memory of each mode
+    n_voxels = 4 * 5 * 3
+    npt.assert_equal(shcoeff_pmf_nbytes(shcoeff.shape, n_vertices),
+                     8 * n_voxels * 45)
+    npt.assert_equal(shcoeff_pmf_nbytes(shcoeff.shape, n_vertices, 'float32'),
+                     4 * n_voxels * n_vertices)
+    npt.assert_(shcoeff_pmf_nbytes(shcoeff.shape, n_vertices, 'uint8') <
+                shcoeff_pmf_nbytes(shcoeff.shape, n_vertices, 'float32'))
+    npt.assert_(shcoeff_pmf_nbytes(shcoeff.shape, n_vertices, 'cache',
+                                   10 * 8 * n_vertices) <
+                shcoeff_pmf_nbytes(shcoeff.shape, n_vertices, 'cache'))
+    npt.assert_raises(ValueError, SHCoeffPmfGen, shcoeff, sphere, None,
+                      'float16')
+
+    # Only the 'sh' and 'cache' modes keep a reference to the coefficients
+    del pmfgen
+    refcount = sys.getrefcount(shcoeff)
+    for pmf_mode in ['sh', 'float64', 'float32', 'uint8', 'cache']:
+        pmfgen = SHCoeffPmfGen(shcoeff, sphere, None, pmf_mode)
+        npt.assert_equal(sys.getrefcount(shcoeff) > refcount,
+                         pmf_mode in ['sh', 'cache'])
+        del pmfgen
+    npt.assert_raises(ValueError, shcoeff_pmf_nbytes, shcoeff.shape,
+                      n_vertices, 'float16')
+
+
 def test_pmf_from_array():
     sphere = HemiSphere.from_sphere(unit_octahedron)
     pmfgen = SimplePmfGen(np.ones([2, 2, 2, len(sphere.vertices)]))
@@ -16,9 +16,15 @@ from nibabel.streamlines import ArraySequence as Streamlines
 # Make sure not to carry across setup module from * import
 __all__ = ['Dpy']
 
+#: Versions of the Dpy format: 0.0.1 stores the points and cumulative
+#: offsets of the tracks, 0.0.2 adds chunked writes, an index of offsets
+#: and lengths, and optional reduced precision and compression.
+VERSIONS = (u'0.0.1', u'0.0.2')
+
 
 class Dpy(object):
-    def __init__(self, fname, mode='r', compression=0):
+    def __init__(self, fname, mode='r', compression=0, version=u'0.0.1',
+                 dtype='f4', quantization_step=None, chunk_size=2 ** 16):
         """ Advanced storage system for tractography based on HDF5
 
         Parameters
@@ -27,7 +33,17 @@ class Dpy(object):
         mode : 'r' read
          'w' write
          'r+' read and write only if file already exists
-        compression : 0 no compression to 9 maximum compression
+        compression : 0 no compression to 9 maximum compression (gzip level),
+            or 'lzf'. Only used to write version 0.0.2.
+        version : '0.0.1' or '0.0.2', version of the format to write, files
+            are read whatever their version.
+        dtype : 'f4' or 'f2', precision of the points stored in version
+            0.0.2.
+        quantization_step : float, optional, if given the points are stored
+            in version 0.0.2 as int16 multiples of this step (e.g. 0.01 mm),
+            which must cover their range.
+        chunk_size : int, number of points written at once in version 0.0.2,
+            also the size of the HDF5 chunks of the points.
 
         Examples
         ----------
@@ -59,11 +75,19 @@ class Dpy(object):
         self.compression = compression
 
         if self.mode == 'w':
+            if version not in VERSIONS:
+                raise ValueError('version should be one of %s, got %r' %
+                                 (', '.join(VERSIONS), version))
 
-            self.f.attrs['version'] = u'0.0.1'
+            self.f.attrs['version'] = version
+            self._version = version
 
             self.streamlines = self.f.create_group('streamlines')
 
+            if version == u'0.0.2':
+                self._create_v2(dtype, quantization_step, chunk_size)
+                return
+
             self.tracks = self.streamlines.create_dataset(
                     'tracks',
                     shape=(0, 3),
@@ -82,18 +106,114 @@ class Dpy(object):
         if self.mode == 'r':
             self.tracks = self.f['streamlines']['tracks']
             self.offsets = self.f['streamlines']['offsets']
-            self.track_no = len(self.offsets) - 1
+            self._version = self.version()
+            if self._version == u'0.0.2':
+                self.lengths = self.f['streamlines']['lengths']
+                # The index is small enough to be kept in memory
+                self._index_offsets = self.offsets[:]
+                self._index_lengths = self.lengths[:]
+            else:
+                offsets = self.offsets[:]
+                self._index_offsets = offsets[:-1]
+                self._index_lengths = np.diff(offsets)
+            self.track_no = len(self._index_offsets)
             self.offs_pos = 0
 
+    def _create_v2(self, dtype, quantization_step, chunk_size):
+        """ Create the datasets of version 0.0.2, filled by chunks """
+        if quantization_step is not None:
+            dtype = 'i2'
+        elif np.dtype(dtype) not in (np.float32, np.float16):
+            raise ValueError("dtype should be 'f4' or 'f2', got %r" % dtype)
+        options = {}
+        if self.compression:
+            options['compression'] = (self.compression
+                                      if self.compression == 'lzf'
+                                      else 'gzip')
+            if self.compression != 'lzf':
+                options['compression_opts'] = int(self.compression)
+            options['shuffle'] = True
+
+        self.chunk_size = int(chunk_size)
+        self.tracks = self.streamlines.create_dataset(
+                'tracks', shape=(0, 3), dtype=dtype, maxshape=(None, 3),
+                chunks=(self.chunk_size, 3), **options)
+        if quantization_step is not None:
+            self.tracks.attrs['quantization_step'] = quantization_step
+        self.offsets = self.streamlines.create_dataset(
+                'offsets', shape=(0,), dtype='i8', maxshape=(None,),
+                chunks=True, **options)
+        self.lengths = self.streamlines.create_dataset(
+                'lengths', shape=(0,), dtype='i8', maxshape=(None,),
+                chunks=True, **options)
+
+        self.curr_pos = 0
+        self._buffer = []
+        self._buffer_lengths = []
+        self._buffer_size = 0
+
     def version(self):
 
         return self.f.attrs['version']
 
+    def _encode(self, points):
+        """ Points in the type stored in the file """
+        step = self.tracks.attrs.get('quantization_step')
+        if step is None:
+            return points.astype(self.tracks.dtype)
+        quantized = np.round(points / step)
+        if quantized.size and (quantized.min() < np.iinfo(np.int16).min or
+                               quantized.max() > np.iinfo(np.int16).max):
+            raise ValueError('Points out of the range of the quantization '
+                             'step %s' % step)
+        return quantized.astype(np.int16)
+
+    def _decode(self, points):
+        """ Points stored in the file as float32 """
+        step = self.tracks.attrs.get('quantization_step')
+        if step is None:
+            return points.astype(np.float32, copy=False)
+        return (points * step).astype(np.float32)
+
+    def _flush(self):
+        """ Write the buffered tracks of version 0.0.2 at once """
+        if not self._buffer:
+            return
+        points = self._encode(np.concatenate(self._buffer))
+        lengths = np.asarray(self._buffer_lengths, dtype=np.int64)
+        n_points = self.tracks.shape[0]
+        n_tracks = self.lengths.shape[0]
+
+        self.tracks.resize(n_points + len(points), axis=0)
+        self.tracks[n_points:] = points
+        self.offsets.resize(n_tracks + len(lengths), axis=0)
+        self.offsets[n_tracks:] = n_points + np.concatenate(
+            ([0], np.cumsum(lengths)[:-1]))
+        self.lengths.resize(n_tracks + len(lengths), axis=0)
+        self.lengths[n_tracks:] = lengths
+
+        self._buffer = []
+        self._buffer_lengths = []
+        self._buffer_size = 0
+
+    def _buffer_tracks(self, points, lengths):
+        """ Buffer the points of tracks of version 0.0.2 """
+        self._buffer.append(np.asarray(points))
+        self._buffer_lengths.extend(lengths)
+        self._buffer_size += len(points)
+        self.curr_pos += len(points)
+        if self._buffer_size >= self.chunk_size:
+            self._flush()
+
     def write_track(self, track):
         """ write on track each time
         """
-        self.tracks.resize(self.tracks.shape[0] + track.shape[0], axis=0)
-        self.tracks[-track.shape[0]:] = track.astype(np.float32)
+        if self._version == u'0.0.2':
+            self._buffer_tracks(track, [track.shape[0]])
+            return
+
+        self.tracks.resize(self.curr_pos + track.shape[0], axis=0)
+        self.tracks[self.curr_pos:] = track.astype(np.float32)
         self.curr_pos += track.shape[0]
 
         self.offsets.resize(self.offsets.shape[0] + 1, axis=0)
@@ -102,6 +222,12 @@ class Dpy(object):
     def write_tracks(self, tracks):
         """ write many tracks together
         """
+        if self._version == u'0.0.2':
+            if not isinstance(tracks, Streamlines):
+                tracks = Streamlines(tracks)
+            if len(tracks):
+                self._buffer_tracks(tracks.get_data(), tracks._lengths)
+            return
 
         self.tracks.resize(self.tracks.shape[0] + tracks._data.shape[0],
                            axis=0)
@@ -116,32 +242,81 @@ class Dpy(object):
     def read_track(self):
         """ read one track each time
         """
-        off0, off1 = self.offsets[self.offs_pos:self.offs_pos + 2]
+        off0 = self._index_offsets[self.offs_pos]
+        off1 = off0 + self._index_lengths[self.offs_pos]
         self.offs_pos += 1
-        return self.tracks[off0:off1]
+        return self._decode(self.tracks[off0:off1])
 
     def read_tracksi(self, indices):
         """ read tracks with specific indices
+
+        The indices can be a slice, which is read at once, or any sequence of
+        indices, read with a few large reads of the ranges of nearby tracks.
         """
+        if isinstance(indices, slice):
+            offsets = self._index_offsets[indices]
+            lengths = self._index_lengths[indices]
+            if len(offsets) and np.all(offsets[1:] ==
+                                       offsets[:-1] + lengths[:-1]):
+                start = offsets[0]
+                stop = offsets[-1] + lengths[-1]
+                return self._make_tracks(
+                    self._decode(self.tracks[start:stop]), lengths)
+            indices = np.arange(self.track_no)[indices]
+
+        indices = np.asarray(indices, dtype=np.intp).ravel()
+        offsets = self._index_offsets[indices]
+        lengths = self._index_lengths[indices]
+        if len(indices) == 0:
+            return Streamlines()
+
+        # Ranges of points to read, merging those of tracks close to each
+        # other in the file (e.g. in the same chunk)
+        max_gap = self.tracks.chunks[0] if self.tracks.chunks else 0
+        order = np.argsort(offsets, kind='mergesort')
+        starts = offsets[order]
+        ends = starts + lengths[order]
+        ends = np.maximum.accumulate(ends)
+        new_range = np.ones(len(order), dtype=bool)
+        new_range[1:] = starts[1:] > ends[:-1] + max_gap
+        range_ids = np.cumsum(new_range) - 1
+        range_starts = starts[new_range]
+        range_ends = np.append(ends[np.flatnonzero(new_range)[1:] - 1],
+                               ends[-1])
+
+        # Read each range and locate the points of each track in the buffer
+        buffer_starts = np.concatenate(
+            ([0], np.cumsum(range_ends - range_starts)[:-1]))
+        buffer = np.concatenate([self.tracks[start:end] for start, end
+                                 in zip(range_starts, range_ends)])
+        track_starts = np.empty(len(indices), dtype=np.int64)
+        track_starts[order] = (buffer_starts[range_ids] +
+                               starts - range_starts[range_ids])
+
+        points = np.repeat(track_starts - np.concatenate(
+            ([0], np.cumsum(lengths)[:-1])), lengths)
+        points += np.arange(np.sum(lengths))
+        return self._make_tracks(self._decode(buffer[points]), lengths)
+
+    def _make_tracks(self, data, lengths):
         tracks = Streamlines()
-        for i in indices:
-            off0, off1 = self.offsets[i:i + 2]
-            tracks.append(self.tracks[off0:off1])
+        tracks._data = data
+        tracks._lengths = np.asarray(lengths, dtype=np.int64)
+        tracks._offsets = np.concatenate(
+            ([0], np.cumsum(tracks._lengths)[:-1])).astype(np.int64)
         return tracks
 
     def read_tracks(self):
         """ read the entire tractography
         """
-        I = self.offsets[:]
-        TR = self.tracks[:]
-        tracks = Streamlines()
-        for i in range(len(I) - 1):
-            off0, off1 = I[i:i + 2]
-            tracks.append(TR[off0:off1])
-        return tracks
+        return self.read_tracksi(slice(None))
 
     def close(self):
-        self.f.close()
+        try:
+            if self.mode == 'w' and self._version == u'0.0.2':
+                self._flush()
+        finally:
+            self.f.close()
 
 
 if __name__ == '__main__':
@@ -1,5 +1,7 @@
+from itertools import chain
 
 import nibabel as nib
+from nibabel.volumeutils import seek_tell
 import numpy as np
 
 
@@ -103,6 +105,80 @@ def save_nifti(fname, data, affine, hdr=None):
     result_img.to_filename(fname)
 
 
+def save_nifti_streaming(fname, slabs, shape, affine, hdr=None, dtype=None):
+    """Save data into a nifti file as it is generated.
+
+    Only one slab of the data is held in memory at a time, which allows to
+    save the result of a processing larger than the available memory.
+
+    Parameters
+    ----------
+    fname : str
+        The full path to the file to be saved.
+
+    slabs : iterable of ndarray
+        The data to save, in the order of the voxels in the file (Fortran
+        order), e.g. consecutive slabs of planes along the third axis of
+        each volume, one volume after the other.
+
+    shape : tuple
+        The shape of the whole data.
+
+    affine : 4x4 array
+        The affine transform associated with the file.
+
+    hdr : nifti header, optional
+        May contain additional information to store in the file header.
+
+    dtype : dtype, optional
+        The data type stored in the file. Default: the data type of the first
+        slab.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    Unlike ``save_nifti``, the data is not scaled to the range of `dtype`:
+    the slabs are cast to `dtype` and written as they are.
+
+    See also
+    --------
+    save_nifti
+
+    """
+    slabs = iter(slabs)
+    first = next(slabs, None)
+    if dtype is None:
+        if first is None:
+            raise ValueError("dtype is needed to save an empty image")
+        dtype = first.dtype
+    # The header is built from an image of the right shape and dtype, without
+    # allocating its data
+    img = nib.Nifti1Image(np.broadcast_to(np.zeros((), dtype), shape),
+                          affine, header=hdr)
+    img.update_header()
+    hdr = img.header
+    hdr.set_data_dtype(dtype)
+    hdr.set_slope_inter(1, 0)
+    dtype = hdr.get_data_dtype()
+
+    n_written = 0
+    with nib.openers.ImageOpener(fname, 'wb') as fobj:
+        hdr.write_to(fobj)
+        seek_tell(fobj, hdr.get_data_offset(), write0=True)
+        if first is not None:
+            slabs = chain([first], slabs)
+        for slab in slabs:
+            slab = np.asarray(slab).astype(dtype, copy=False)
+            fobj.write(slab.tobytes(order='F'))
+            n_written += slab.size
+    if n_written != np.prod(shape):
+        raise ValueError("%d voxels written for an image of shape %s" %
+                         (n_written, shape))
+
+
 def save_qa_metric(fname, xopt, fopt):
     """Save Quality Assurance metrics.
 
@@ -44,6 +44,97 @@ class Origin(enum.Enum):
     TRACKVIS = 'corner'
 
 
+class LazyStreamlines(Streamlines):
+    """ Read-only streamlines whose points are transformed on access
+
+    The points are typically a memory-mapped array of a file on disk. They
+    are never modified, changes of space or origin only update the affine
+    applied to the points returned by indexing or iteration. Slicing returns
+    a view, without reading the points.
+    """
+
+    def __init__(self, iterable=None, buffer_size=4, affine=None):
+        super(LazyStreamlines, self).__init__(iterable, buffer_size)
+        if affine is None and isinstance(iterable, LazyStreamlines):
+            affine = iterable.affine
+        self._affine = np.eye(4) if affine is None else np.array(affine,
+                                                                 dtype=float)
+
+    @property
+    def affine(self):
+        """ Affine applied to the stored points on access """
+        return self._affine
+
+    def _transform(self, points):
+        if np.array_equal(self._affine, np.eye(4)):
+            return points
+        return apply_affine(self._affine, points).astype(points.dtype,
+                                                         copy=False)
+
+    def __getitem__(self, idx):
+        seq = super(LazyStreamlines, self).__getitem__(idx)
+        if isinstance(seq, LazyStreamlines):
+            seq._affine = self._affine
+            return seq
+        return self._transform(seq)
+
+    def __iter__(self):
+        for points in super(LazyStreamlines, self).__iter__():
+            yield self._transform(points)
+
+    def copy(self):
+        """ Load the transformed streamlines in memory
+
+        Returns
+        -------
+        output : Streamlines
+            In-memory copy of the streamlines, with the affine applied.
+        """
+        seq = super(LazyStreamlines, self).copy()
+        streamlines = Streamlines()
+        streamlines._data = self._transform(seq._data)
+        streamlines._offsets = seq._offsets
+        streamlines._lengths = seq._lengths
+        return streamlines
+
+    def iter_points(self, max_points=2 ** 20):
+        """ Transformed points of whole streamlines, a block at a time
+
+        Parameters
+        ----------
+        max_points : int, optional
+            Approximate number of points per block, a streamline is never
+            split between blocks.
+
+        Returns
+        -------
+        output : generator
+            Generator of tuples (indices, lengths, points) of the indices
+            of the streamlines of each block, their number of points and
+            their points one after the other.
+        """
+        offsets = np.asarray(self._offsets)
+        lengths = np.asarray(self._lengths)
+        if len(lengths) == 0:
+            return
+        ends = np.cumsum(lengths)
+        splits = np.searchsorted(ends, np.arange(max_points, ends[-1],
+                                                 max_points))
+        contiguous = np.all(offsets[1:] == offsets[:-1] + lengths[:-1])
+        for indices in np.split(np.arange(len(lengths)), np.unique(splits)):
+            if len(indices) == 0:
+                continue
+            if contiguous:
+                start = offsets[indices[0]]
+                stop = offsets[indices[-1]] + lengths[indices[-1]]
+                points = self._data[start:stop]
+            else:
+                points = np.concatenate(
+                    [self._data[offsets[i]:offsets[i] + lengths[i]]
+                     for i in indices])
+            yield indices, lengths[indices], self._transform(points)
+
+
 class StatefulTractogram(object):
     """ Class for stateful representation of collections of streamlines
     Object designed to be identical no matter the file format
@@ -90,6 +181,10 @@ class StatefulTractogram(object):
 
         In a case of manipulation not allowed by this object, use Nibabel
         directly and be careful.
+
+        If `streamlines` are LazyStreamlines (see ``load_tractogram`` with
+        ``lazy=True``), they are not copied nor loaded in memory. Changes of
+        space and origin are then applied to the points on access.
         """
         if data_per_point is None:
             data_per_point = {}
@@ -97,11 +192,16 @@ class StatefulTractogram(object):
         if data_per_streamline is None:
             data_per_streamline = {}
 
-        if isinstance(streamlines, Streamlines):
+        self._is_lazy = isinstance(streamlines, LazyStreamlines)
+        if self._is_lazy:
+            streamlines = LazyStreamlines(streamlines)
+        elif isinstance(streamlines, Streamlines):
             streamlines = streamlines.copy()
         self._tractogram = Tractogram(streamlines,
                                       data_per_point=data_per_point,
                                       data_per_streamline=data_per_streamline)
+        if self._is_lazy:
+            self._tractogram._streamlines = streamlines
 
         if isinstance(reference, type(self)):
             logger.warning('Using a StatefulTractogram as reference, this '
@@ -277,7 +377,10 @@ class StatefulTractogram(object):
                              'the same.')
 
         streamlines = self.streamlines.copy()
-        streamlines.extend(other_sft.streamlines)
+        if other_sft.is_lazy:
+            streamlines.extend(other_sft.streamlines.copy())
+        else:
+            streamlines.extend(other_sft.streamlines)
 
         data_per_point = deepcopy(self.data_per_point)
         data_per_point.extend(other_sft.data_per_point)
@@ -293,6 +396,11 @@ class StatefulTractogram(object):
         self.value = self + other
         return self.value
 
+    @property
+    def is_lazy(self):
+        """ True if the points are transformed on access, not in memory """
+        return self._is_lazy
+
     @property
     def space_attributes(self):
         """ Getter for spatial attribute """
@@ -350,6 +458,7 @@ class StatefulTractogram(object):
         if isinstance(streamlines, Streamlines):
             streamlines = streamlines.copy()
         self._tractogram._streamlines = Streamlines(streamlines)
+        self._is_lazy = False
         self.data_per_point = self.data_per_point
         self.data_per_streamline = self.data_per_streamline
         logger.warning('Streamlines has been modified')
@@ -464,6 +573,17 @@ class StatefulTractogram(object):
         output : ndarray
             8 corners of the XYZ aligned box, all zeros if no streamlines
         """
+        if self._is_lazy:
+            bbox_min = np.full(3, np.inf)
+            bbox_max = np.full(3, -np.inf)
+            for _, _, points in self.streamlines.iter_points():
+                if points.size > 0:
+                    bbox_min = np.minimum(bbox_min, np.min(points, axis=0))
+                    bbox_max = np.maximum(bbox_max, np.max(points, axis=0))
+            if np.all(np.isfinite(bbox_min)):
+                return np.asarray(list(product(*zip(bbox_min, bbox_max))))
+            return np.zeros((8, 3))
+
         if self._tractogram.streamlines._data.size > 0:
             bbox_min = np.min(self._tractogram.streamlines._data, axis=0)
             bbox_max = np.max(self._tractogram.streamlines._data, axis=0)
@@ -536,6 +656,23 @@ class StatefulTractogram(object):
         self.to_vox()
         self.to_corner()
 
+        if self._is_lazy:
+            indices_to_remove, indices_to_keep = \
+                self._lazy_invalid_streamlines(epsilon)
+            tmp_dpp = self._tractogram.data_per_point[indices_to_keep]
+            tmp_dps = self._tractogram.data_per_streamline[indices_to_keep]
+            tmp_streamlines = self.streamlines[indices_to_keep]
+            self._tractogram = Tractogram(tmp_streamlines,
+                                          data_per_point=tmp_dpp,
+                                          data_per_streamline=tmp_dps,
+                                          affine_to_rasmm=np.eye(4))
+            self._tractogram._streamlines = tmp_streamlines
+
+            self.to_space(old_space)
+            self.to_origin(old_origin)
+
+            return indices_to_remove, indices_to_keep
+
         min_condition = np.min(self._tractogram.streamlines._data,
                                axis=1) < epsilon
         max_condition = np.any(self._tractogram.streamlines._data >
@@ -565,6 +702,28 @@ class StatefulTractogram(object):
 
         return indices_to_remove, indices_to_keep
 
+    def _lazy_invalid_streamlines(self, epsilon):
+        """ Indices of the streamlines with points outside of the volume,
+        one block of points at a time (in vox space, corner origin) """
+        invalid = np.zeros(len(self.streamlines), dtype=bool)
+        for indices, lengths, points in self.streamlines.iter_points():
+            invalid_points = np.logical_or(
+                np.min(points, axis=1) < epsilon,
+                np.any(points > self._dimensions - epsilon, axis=1))
+            non_empty = lengths > 0
+            starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+            invalid[indices[non_empty]] = np.logical_or.reduceat(
+                invalid_points, starts[non_empty])
+        indices_to_remove = np.where(invalid)[0].tolist()
+        indices_to_keep = np.where(~invalid)[0].astype(int)
+        return indices_to_remove, indices_to_keep
+
+    def _transform_lazy(self, affine):
+        """ Unsafe function to compose an affine with the one applied to the
+        points of lazy streamlines """
+        streamlines = self._tractogram.streamlines
+        streamlines._affine = np.dot(affine, streamlines.affine)
+
     def _get_streamline_count(self):
         """ Safe getter for the number of streamlines """
         return len(self._tractogram)
@@ -577,8 +736,12 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.VOX:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.streamlines._data *= np.asarray(
-                    self._voxel_sizes)
+                if self._is_lazy:
+                    self._transform_lazy(
+                        np.diag(np.append(self._voxel_sizes, 1)))
+                else:
+                    self._tractogram.streamlines._data *= np.asarray(
+                        self._voxel_sizes)
                 self._space = Space.VOXMM
                 logger.debug('Moved streamlines from vox to voxmm')
         else:
@@ -589,8 +752,12 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.VOXMM:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.streamlines._data /= np.asarray(
-                    self._voxel_sizes)
+                if self._is_lazy:
+                    self._transform_lazy(
+                        np.diag(np.append(1. / self._voxel_sizes, 1)))
+                else:
+                    self._tractogram.streamlines._data /= np.asarray(
+                        self._voxel_sizes)
                 self._space = Space.VOX
                 logger.debug('Moved streamlines from voxmm to vox')
         else:
@@ -601,7 +768,10 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.VOX:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.apply_affine(self._affine)
+                if self._is_lazy:
+                    self._transform_lazy(self._affine)
+                else:
+                    self._tractogram.apply_affine(self._affine)
                 self._space = Space.RASMM
                 logger.debug('Moved streamlines from vox to rasmm')
         else:
@@ -612,7 +782,10 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.RASMM:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.apply_affine(self._inv_affine)
+                if self._is_lazy:
+                    self._transform_lazy(self._inv_affine)
+                else:
+                    self._tractogram.apply_affine(self._inv_affine)
                 self._space = Space.VOX
                 logger.debug('Moved streamlines from rasmm to vox')
         else:
@@ -623,9 +796,14 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.VOXMM:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.streamlines._data /= np.asarray(
-                    self._voxel_sizes)
-                self._tractogram.apply_affine(self._affine)
+                if self._is_lazy:
+                    self._transform_lazy(np.dot(
+                        self._affine,
+                        np.diag(np.append(1. / self._voxel_sizes, 1))))
+                else:
+                    self._tractogram.streamlines._data /= np.asarray(
+                        self._voxel_sizes)
+                    self._tractogram.apply_affine(self._affine)
                 self._space = Space.RASMM
                 logger.debug('Moved streamlines from voxmm to rasmm')
         else:
@@ -636,9 +814,14 @@ class StatefulTractogram(object):
         """ Unsafe function to transform streamlines """
         if self._space == Space.RASMM:
             if self._tractogram.streamlines._data.size > 0:
-                self._tractogram.apply_affine(self._inv_affine)
-                self._tractogram.streamlines._data *= np.asarray(
-                    self._voxel_sizes)
+                if self._is_lazy:
+                    self._transform_lazy(np.dot(
+                        np.diag(np.append(self._voxel_sizes, 1)),
+                        self._inv_affine))
+                else:
+                    self._tractogram.apply_affine(self._inv_affine)
+                    self._tractogram.streamlines._data *= np.asarray(
+                        self._voxel_sizes)
                 self._space = Space.VOXMM
                 logger.debug('Moved streamlines from rasmm to voxmm')
         else:
@@ -661,7 +844,12 @@ class StatefulTractogram(object):
         if self._origin == Origin.TRACKVIS:
             shift *= -1
 
-        self._tractogram.streamlines._data += shift
+        if self._is_lazy:
+            translation = np.eye(4)
+            translation[:3, 3] = shift
+            self._transform_lazy(translation)
+        else:
+            self._tractogram.streamlines._data += shift
         if self._origin == Origin.NIFTI:
             logger.debug('Origin moved to the corner of voxel')
             self._origin = Origin.TRACKVIS
@@ -1,21 +1,33 @@
+from collections import deque
 from copy import deepcopy
+import hashlib
+from itertools import islice
+import json
 import logging
 import os
+import shutil
+import tempfile
 import time
+import warnings
 
 import nibabel as nib
+from nibabel.affines import apply_affine
 from nibabel.streamlines import detect_format
-from nibabel.streamlines.tractogram import Tractogram
+from nibabel.streamlines.tractogram import LazyTractogram, Tractogram
 import numpy as np
 
-from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
+from dipy.io.stateful_tractogram import (LazyStreamlines, Origin, Space,
+                                         StatefulTractogram)
 from dipy.io.vtk import save_vtk_streamlines, load_vtk_streamlines
 from dipy.io.dpy import Dpy
 from dipy.io.utils import (create_tractogram_header,
+                           get_reference_info,
                            is_header_compatible)
+from dipy.tracking.streamline import Streamlines
 
 
-def save_tractogram(sft, filename, bbox_valid_check=True):
+def save_tractogram(sft, filename, bbox_valid_check=True,
+                    dpy_version=u'0.0.1'):
     """ Save the stateful tractogram in any format (trk, tck, vtk, fib, dpy)
 
     Parameters
@@ -27,6 +39,10 @@ def save_tractogram(sft, filename, bbox_valid_check=True):
     bbox_valid_check : bool
         Verification for negative voxel coordinates or values above the
         volume dimensions. Default is True, to enforce valid file.
+    dpy_version : '0.0.1' or '0.0.2', optional
+        Version of the Dpy format written to dpy files. Files of version
+        0.0.2 are written by chunks and indexed, but can't be read by
+        versions of dipy reading only 0.0.1.
 
     Returns
     -------
@@ -52,26 +68,55 @@ def save_tractogram(sft, filename, bbox_valid_check=True):
     sft.to_center()
 
     timer = time.time()
+    streamlines = sft.streamlines
     if extension in ['.trk', '.tck']:
         tractogram_type = detect_format(filename)
         header = create_tractogram_header(tractogram_type,
                                           *sft.space_attributes)
-        new_tractogram = Tractogram(sft.streamlines,
-                                    affine_to_rasmm=np.eye(4))
+        if sft.is_lazy:
+            # Written as they are read from the memory-mapped files
+            data_per_point = {}
+            data_per_streamline = {}
+            if extension == '.trk':
+                data_per_point = dict(
+                    (key, _iter_func(values))
+                    for key, values in sft.data_per_point.items())
+                data_per_streamline = dict(
+                    (key, _iter_func(values))
+                    for key, values in sft.data_per_streamline.items())
+
+            def streamlines_func():
+                for block in _iter_streamline_blocks(streamlines):
+                    for points in block:
+                        yield points
+
+            new_tractogram = LazyTractogram(
+                streamlines_func, data_per_point=data_per_point,
+                data_per_streamline=data_per_streamline,
+                affine_to_rasmm=np.eye(4))
+        else:
+            new_tractogram = Tractogram(streamlines,
+                                        affine_to_rasmm=np.eye(4))
 
-        if extension == '.trk':
-            new_tractogram.data_per_point = sft.data_per_point
-            new_tractogram.data_per_streamline = sft.data_per_streamline
+            if extension == '.trk':
+                new_tractogram.data_per_point = sft.data_per_point
+                new_tractogram.data_per_streamline = sft.data_per_streamline
 
         fileobj = tractogram_type(new_tractogram, header=header)
         nib.streamlines.save(fileobj, filename)
 
     elif extension in ['.vtk', '.fib']:
-        save_vtk_streamlines(sft.streamlines, filename, binary=True)
+        # VTK files are written at once, from streamlines in memory
+        if sft.is_lazy:
+            streamlines = streamlines.copy()
+        save_vtk_streamlines(streamlines, filename, binary=True)
     elif extension in ['.dpy']:
-        dpy_obj = Dpy(filename, mode='w')
-        dpy_obj.write_tracks(sft.streamlines)
-        dpy_obj.close()
+        dpy_obj = Dpy(filename, mode='w', version=dpy_version)
+        try:
+            for block in _iter_streamline_blocks(streamlines):
+                dpy_obj.write_tracks(block)
+        finally:
+            dpy_obj.close()
 
     logging.debug('Save %s with %s streamlines in %s seconds',
                   filename, len(sft), round(time.time() - timer, 3))
@@ -82,9 +127,169 @@ def save_tractogram(sft, filename, bbox_valid_check=True):
     return True
 
 
+def save_tractogram_streaming(streamlines, filename, reference,
+                              space=Space.RASMM, origin=Origin.NIFTI,
+                              data_per_streamline_keys=None,
+                              batch_size=10000, dpy_version=u'0.0.1'):
+    """ Save streamlines (trk, tck, dpy) as they are generated
+
+    Unlike ``save_tractogram``, the streamlines do not have to fit in memory,
+    e.g. the generator of ``LocalTracking`` can be saved directly. The
+    streamlines are moved to the space of the file and written a batch at a
+    time, and the header is updated with the streamline count at the end.
+
+    Parameters
+    ----------
+    streamlines : iterable
+        Streamlines to save, each an ndarray of shape (N, 3). If
+        `data_per_streamline_keys` is given, each element is instead a tuple
+        of a streamline followed by one value per key (e.g. the
+        ``(streamline, seed)`` tuples of ``LocalTracking`` with
+        ``save_seeds=True``).
+    filename : string
+        Filename with valid extension
+    reference : Nifti or Trk filename, Nifti1Image or TrkFile, Nifti1Header or
+        trk.header (dict)
+        Reference that provides the spatial attribute.
+    space : Enum (dipy.io.stateful_tractogram.Space)
+        Current space in which the streamlines are (vox, voxmm or rasmm)
+    origin : Enum (dipy.io.stateful_tractogram.Origin)
+        Current origin in which the streamlines are (center or corner)
+    data_per_streamline_keys : list of str, optional
+        Names of the values following each streamline, only saved in trk
+        files.
+    batch_size : int, optional
+        Number of streamlines moved to the space of the file at once.
+    dpy_version : '0.0.1' or '0.0.2', optional
+        Version of the Dpy format written to dpy files, see
+        ``save_tractogram``.
+
+    Returns
+    -------
+    output : int
+        Number of streamlines saved
+
+    Notes
+    -----
+    Streamlines are saved as they come, without checking the bounding box,
+    see ``save_tractogram`` with ``bbox_valid_check=False``. The vtk and fib
+    formats are supported too, but their streamlines are gathered in memory
+    before saving.
+    """
+    _, extension = os.path.splitext(filename)
+    if extension not in ['.trk', '.tck', '.vtk', '.fib', '.dpy']:
+        raise TypeError('Output filename is not one of the supported format')
+
+    space_attributes = get_reference_info(reference)
+    to_rasmm = _affine_to_rasmm(space, origin, *space_attributes[:3])
+    keys = list(data_per_streamline_keys or [])
+    count = [0]
+
+    def items():
+        iterator = iter(streamlines)
+        while True:
+            batch = list(islice(iterator, batch_size))
+            if not batch:
+                return
+            if keys:
+                batch_data = [dict(zip(keys, element[1:]))
+                              for element in batch]
+                batch = [element[0] for element in batch]
+            else:
+                batch_data = [{}] * len(batch)
+            lengths = [len(points) for points in batch]
+            points = np.concatenate(batch).astype(np.float32)
+            if not np.array_equal(to_rasmm, np.eye(4)):
+                points = apply_affine(to_rasmm, points).astype(np.float32)
+            count[0] += len(batch)
+            yield np.split(points, np.cumsum(lengths)[:-1]), batch_data
+
+    timer = time.time()
+    if extension in ['.trk', '.tck']:
+        tractogram_type = detect_format(filename)
+        header = create_tractogram_header(tractogram_type, *space_attributes)
+        queues = dict((key, deque()) for key in keys)
+
+        def streamlines_func():
+            for batch, batch_data in items():
+                for points, data in zip(batch, batch_data):
+                    for key in keys:
+                        queues[key].append(np.asarray(data[key]))
+                    yield points
+
+        def data_func(key):
+            # Consumed in lockstep with the streamlines when saving
+            def data_gen():
+                while queues[key]:
+                    yield queues[key].popleft()
+            return data_gen
+
+        tractogram = LazyTractogram(
+            streamlines_func,
+            data_per_streamline=dict((key, data_func(key)) for key in keys),
+            affine_to_rasmm=np.eye(4))
+        fileobj = tractogram_type(tractogram, header=header)
+        nib.streamlines.save(fileobj, filename)
+    elif extension in ['.vtk', '.fib']:
+        all_streamlines = Streamlines()
+        for batch, _ in items():
+            all_streamlines.extend(batch)
+        save_vtk_streamlines(all_streamlines, filename, binary=True)
+    else:
+        dpy_obj = Dpy(filename, mode='w', version=dpy_version)
+        try:
+            for batch, _ in items():
+                dpy_obj.write_tracks(Streamlines(batch))
+        finally:
+            dpy_obj.close()
+
+    logging.debug('Save %s with %s streamlines in %s seconds',
+                  filename, count[0], round(time.time() - timer, 3))
+
+    return count[0]
+
+
+def _iter_func(values):
+    """ Function returning a new iterator of `values` when called """
+    def iter_values():
+        return iter(values)
+    return iter_values
+
+
+def _iter_streamline_blocks(streamlines, max_points=2 ** 20):
+    """ Streamlines in memory, a block of about `max_points` points at a
+    time if they are lazy """
+    if not isinstance(streamlines, LazyStreamlines):
+        yield streamlines
+        return
+    for _, lengths, points in streamlines.iter_points(max_points):
+        block = Streamlines()
+        block._data = points
+        block._lengths = np.asarray(lengths, dtype=np.int64)
+        block._offsets = np.concatenate(
+            ([0], np.cumsum(block._lengths)[:-1])).astype(np.int64)
+        yield block
+
+
+def _affine_to_rasmm(space, origin, affine, dimensions, voxel_sizes):
+    """ Affine moving points from a space and origin to rasmm (center) """
+    voxel_sizes = np.asarray(voxel_sizes, dtype=float)
+    if space == Space.VOX:
+        to_vox = np.eye(4)
+    elif space == Space.VOXMM:
+        to_vox = np.diag(np.append(1. / voxel_sizes, 1))
+    else:
+        to_vox = np.linalg.inv(affine)
+    if origin == Origin.TRACKVIS:
+        to_center = np.eye(4)
+        to_center[:3, 3] = -0.5
+        to_vox = np.dot(to_center, to_vox)
+    return np.dot(affine, to_vox)
+
+
 def load_tractogram(filename, reference, to_space=Space.RASMM,
                     to_origin=Origin.NIFTI, bbox_valid_check=True,
-                    trk_header_check=True):
+                    trk_header_check=True, lazy=False, cache_dir=None):
     """ Load the stateful tractogram from any format (trk, tck, vtk, fib, dpy)
 
     Parameters
@@ -108,6 +313,23 @@ def load_tractogram(filename, reference, to_space=Space.RASMM,
     trk_header_check : bool
         Verification that the reference has the same header as the spatial
         attributes as the input tractogram when a Trk is loaded
+    lazy : bool, optional
+        If True, the streamlines are read one at a time and written to raw
+        files in `cache_dir`, which are then memory-mapped (read-only), so
+        that tractograms larger than the memory can be loaded. Changes of
+        space and origin are applied to the points on access, see
+        ``LazyStreamlines``. Data per point is memory-mapped as well. The
+        streamlines of trk, tck and dpy files are read a batch at a time,
+        while vtk and fib files can't be streamed: they are read in memory
+        once, before being written to the cache.
+    cache_dir : str, optional
+        Directory of the memory-mapped files when `lazy` is True. Files
+        cached for the same tractogram (same path, size and modification
+        time) are reused. By default, all the points of the tractogram are
+        rewritten at each load (12 bytes per point) in a temporary
+        directory, removed as soon as the files are mapped. On systems where
+        mapped files can't be removed (Windows), a warning is issued and the
+        directory is left behind.
 
     Returns
     -------
@@ -140,7 +362,10 @@ def load_tractogram(filename, reference, to_space=Space.RASMM,
     timer = time.time()
     data_per_point = None
     data_per_streamline = None
-    if extension in ['.trk', '.tck']:
+    if lazy:
+        streamlines, data_per_point, data_per_streamline = \
+            _load_memmapped(filename, extension, cache_dir)
+    elif extension in ['.trk', '.tck']:
         tractogram_obj = nib.streamlines.load(filename).tractogram
         streamlines = tractogram_obj.streamlines
         if extension == '.trk':
@@ -174,6 +399,181 @@ def load_tractogram(filename, reference, to_space=Space.RASMM,
     return sft
 
 
+def _iter_tractogram_items(filename, extension, batch_size=10000):
+    """ Streamlines (in RASMM), data per point and data per streamline of a
+    tractogram, one streamline at a time, dpy files being read `batch_size`
+    streamlines at a time """
+    if extension in ['.trk', '.tck']:
+        tractogram_obj = nib.streamlines.load(filename,
+                                              lazy_load=True).tractogram
+        dpp_keys = list(tractogram_obj.data_per_point)
+        dps_keys = list(tractogram_obj.data_per_streamline)
+        # Unlike its items, the streamlines of a LazyTractogram are in RASMM
+        for values in zip(tractogram_obj.streamlines,
+                          *([tractogram_obj.data_per_point[key]
+                             for key in dpp_keys] +
+                            [tractogram_obj.data_per_streamline[key]
+                             for key in dps_keys])):
+            yield (values[0],
+                   dict(zip(dpp_keys, values[1:len(dpp_keys) + 1])),
+                   dict(zip(dps_keys, values[len(dpp_keys) + 1:])))
+    elif extension in ['.vtk', '.fib']:
+        # VTK readers load the whole file, it can't be streamed
+        for streamline in load_vtk_streamlines(filename):
+            yield streamline, {}, {}
+    else:
+        dpy_obj = Dpy(filename, mode='r')
+        try:
+            for start in range(0, dpy_obj.track_no, batch_size):
+                for streamline in dpy_obj.read_tracksi(
+                        slice(start, start + batch_size)):
+                    yield streamline, {}, {}
+        finally:
+            dpy_obj.close()
+
+
+def _write_memmap_cache(filename, extension, directory,
+                        buffer_size=2 ** 20):
+    """ Write the points and data of a tractogram to raw files, a buffer of
+    points at a time, and their description to a json file """
+    points_file = open(os.path.join(directory, 'points.dat'), 'wb')
+    dpp_files = {}
+    dpp_buffers = {}
+    dpp_dtypes = {}
+    dps = {}
+    points_buffer = []
+    lengths = []
+    buffered = 0
+
+    def flush():
+        if points_buffer:
+            np.concatenate(points_buffer).astype(np.float32).tofile(
+                points_file)
+            del points_buffer[:]
+        for key, values in dpp_buffers.items():
+            if values:
+                np.concatenate(values).astype(dpp_dtypes[key]).tofile(
+                    dpp_files[key])
+                del values[:]
+
+    try:
+        for points, dpp, data in _iter_tractogram_items(filename, extension):
+            if not lengths:
+                for key, values in dpp.items():
+                    dpp_files[key] = open(
+                        os.path.join(directory, 'dpp_%d.dat' % len(dpp_files)),
+                        'wb')
+                    dpp_buffers[key] = []
+                    dpp_dtypes[key] = np.asarray(values).dtype
+                dps = dict((key, []) for key in data)
+            lengths.append(len(points))
+            points_buffer.append(points)
+            for key, values in dpp.items():
+                dpp_buffers[key].append(values)
+            for key, values in data.items():
+                dps[key].append(values)
+            buffered += len(points)
+            if buffered >= buffer_size:
+                flush()
+                buffered = 0
+        flush()
+    finally:
+        points_file.close()
+        for f in dpp_files.values():
+            f.close()
+
+    np.save(os.path.join(directory, 'lengths.npy'),
+            np.asarray(lengths, dtype=np.int64))
+    for i, (key, values) in enumerate(dps.items()):
+        np.save(os.path.join(directory, 'dps_%d.npy' % i), np.asarray(values))
+
+    description = {'n_points': int(np.sum(lengths)),
+                   'data_per_point': [], 'data_per_streamline': list(dps)}
+    for i, key in enumerate(dpp_files):
+        size = os.path.getsize(os.path.join(directory, 'dpp_%d.dat' % i))
+        description['data_per_point'].append((key, dpp_dtypes[key].str,
+                                              size))
+    with open(os.path.join(directory, 'description.json'), 'w') as f:
+        json.dump(description, f)
+
+
+def _map_memmap_cache(directory):
+    """ LazyStreamlines, data per point and data per streamline mapped from
+    the files written by `_write_memmap_cache` """
+    with open(os.path.join(directory, 'description.json')) as f:
+        description = json.load(f)
+    n_points = description['n_points']
+
+    def map_raw(name, dtype, n_bytes_per_point):
+        if n_points == 0 or n_bytes_per_point == 0:
+            return np.zeros((n_points, n_bytes_per_point // dtype.itemsize),
+                            dtype=dtype)
+        return np.memmap(os.path.join(directory, name), dtype=dtype,
+                         mode='r', shape=(n_points, n_bytes_per_point //
+                                          dtype.itemsize))
+
+    lengths = np.load(os.path.join(directory, 'lengths.npy'))
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+
+    streamlines = LazyStreamlines()
+    streamlines._data = map_raw('points.dat', np.dtype(np.float32), 12)
+    streamlines._offsets = offsets
+    streamlines._lengths = lengths
+
+    data_per_point = {}
+    for i, (key, dtype, size) in enumerate(description['data_per_point']):
+        values = Streamlines()
+        values._data = map_raw('dpp_%d.dat' % i, np.dtype(dtype),
+                               size // max(n_points, 1))
+        values._offsets = offsets
+        values._lengths = lengths
+        data_per_point[key] = values
+
+    data_per_streamline = {}
+    for i, key in enumerate(description['data_per_streamline']):
+        data_per_streamline[key] = np.load(
+            os.path.join(directory, 'dps_%d.npy' % i))
+
+    return streamlines, data_per_point, data_per_streamline
+
+
+def _load_memmapped(filename, extension, cache_dir=None):
+    """ Load a tractogram as memory-mapped files, see `load_tractogram` """
+    if cache_dir is None:
+        directory = tempfile.mkdtemp(prefix='dipy_tractogram_')
+        try:
+            _write_memmap_cache(filename, extension, directory)
+            return _map_memmap_cache(directory)
+        finally:
+            # The mapped files remain readable until they are unmapped, on
+            # the systems that allow to remove them (not on Windows)
+            try:
+                shutil.rmtree(directory)
+            except OSError as e:
+                warnings.warn('The temporary files of the lazy tractogram '
+                              'could not be removed from {0} ({1}). Use '
+                              'cache_dir to reuse them in the next loads.'
+                              .format(directory, e))
+
+    stat = os.stat(filename)
+    signature = repr((os.path.abspath(filename), stat.st_size,
+                      stat.st_mtime_ns))
+    directory = os.path.join(
+        cache_dir, '%s-%s' % (os.path.basename(filename),
+                              hashlib.sha1(signature.encode()).hexdigest()))
+    if not os.path.isfile(os.path.join(directory, 'description.json')):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_directory = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            _write_memmap_cache(filename, extension, tmp_directory)
+            os.replace(tmp_directory, directory)
+        except BaseException:
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+            if not os.path.isdir(directory):
+                raise
+    return _map_memmap_cache(directory)
+
+
 def load_generator(ttype):
     """ Generate a loading function that performs a file extension
     check to restrict the user to a single file format.
@@ -189,7 +589,7 @@ def load_generator(ttype):
     """
     def f_gen(filename, reference, to_space=Space.RASMM,
               to_origin=Origin.NIFTI, bbox_valid_check=True,
-              trk_header_check=True):
+              trk_header_check=True, lazy=False, cache_dir=None):
         _, extension = os.path.splitext(filename)
         if not extension == ttype:
             raise ValueError('This function can only load {} files, for a more'
@@ -199,7 +599,8 @@ def load_generator(ttype):
                               to_space=Space.RASMM,
                               to_origin=to_origin,
                               bbox_valid_check=bbox_valid_check,
-                              trk_header_check=trk_header_check)
+                              trk_header_check=trk_header_check,
+                              lazy=lazy, cache_dir=cache_dir)
         return sft
 
     f_gen.__doc__ = load_tractogram.__doc__.replace(
@@ -33,5 +33,48 @@ def test_dpy():
         npt.assert_array_equal(C, T[5])
 
 
+def test_dpy_v2():
+    rng = np.random.RandomState(0)
+    tracks = [rng.uniform(-100, 100, (rng.randint(1, 20), 3))
+              for _ in range(500)]
+    tracks[3] = tracks[3][:0]
+    with InTemporaryDirectory():
+        for kwargs, decimal in [({}, 4), ({'dtype': 'f2'}, 0),
+                                ({'quantization_step': 0.01,
+                                  'compression': 4}, 2),
+                                ({'compression': 'lzf', 'chunk_size': 10},
+                                 4)]:
+            dpw = Dpy('test.dpy', 'w', version='0.0.2', **kwargs)
+            for track in tracks[:100]:
+                dpw.write_track(track)
+            dpw.write_tracks(Streamlines(tracks[100:]))
+            dpw.close()
+
+            dpr = Dpy('test.dpy', 'r')
+            npt.assert_equal(dpr.version(), u'0.0.2')
+            indices = [3, 250, 0, 499, 250, 42, 100]
+            T = dpr.read_tracksi(indices)
+            npt.assert_equal(len(T), len(indices))
+            for track, i in zip(T, indices):
+                npt.assert_array_almost_equal(track, tracks[i],
+                                              decimal=decimal)
+            T = dpr.read_tracksi(slice(10, 400, 7))
+            for track, i in zip(T, range(10, 400, 7)):
+                npt.assert_array_almost_equal(track, tracks[i],
+                                              decimal=decimal)
+            T = dpr.read_tracks()
+            npt.assert_equal(len(T), len(tracks))
+            npt.assert_array_almost_equal(T[499], tracks[499],
+                                          decimal=decimal)
+            npt.assert_array_almost_equal(dpr.read_track(), tracks[0],
+                                          decimal=decimal)
+            dpr.close()
+
+        dpw = Dpy('test.dpy', 'w', version='0.0.2', quantization_step=0.001)
+        dpw.write_track(tracks[0])
+        npt.assert_raises(ValueError, dpw.close)
+        npt.assert_raises(ValueError, Dpy, 'test.dpy', 'w', version='1.0')
+
+
 if __name__ == '__main__':
     npt.run_module_suite()
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import numpy.testing as npt
+import nibabel as nib
+from nibabel.tmpdirs import TemporaryDirectory
+
+from dipy.io.image import load_nifti, save_nifti, save_nifti_streaming
+
+
+def test_save_nifti_streaming():
+    rng = np.random.RandomState(0)
+    data = rng.rand(5, 6, 7, 3).astype(np.float32)
+    affine = np.diag([2., 2., 2., 1.])
+    with TemporaryDirectory() as tmpdir:
+        for ext in ['.nii', '.nii.gz']:
+            expected_fname = os.path.join(tmpdir, 'expected' + ext)
+            fname = os.path.join(tmpdir, 'streamed' + ext)
+            save_nifti(expected_fname, data, affine)
+            slabs = (data[:, :, z:z + 3, i]
+                     for i in range(data.shape[-1]) for z in range(0, 7, 3))
+            save_nifti_streaming(fname, slabs, data.shape, affine)
+
+            streamed, streamed_affine, img = load_nifti(fname,
+                                                        return_img=True)
+            npt.assert_array_equal(streamed, data)
+            npt.assert_array_equal(streamed_affine, affine)
+            expected_img = nib.load(expected_fname)
+            npt.assert_equal(img.header.binaryblock,
+                             expected_img.header.binaryblock)
+
+        # The dtype of the header is overridden
+        int_data = (data * 1000).astype(np.int16)
+        fname = os.path.join(tmpdir, 'int.nii.gz')
+        save_nifti_streaming(fname, [int_data], data.shape, affine,
+                             hdr=expected_img.header)
+        npt.assert_array_equal(load_nifti(fname)[0], int_data)
+        npt.assert_equal(nib.load(fname).get_data_dtype(), np.int16)
+
+        npt.assert_raises(ValueError, save_nifti_streaming, fname,
+                          [data[..., 0]], data.shape, affine)
+        npt.assert_raises(ValueError, save_nifti_streaming, fname, [],
+                          data.shape, affine)
@@ -1,5 +1,7 @@
 import json
 import os
+import shutil
+import tempfile
 from copy import deepcopy
 
 from nibabel.tmpdirs import InTemporaryDirectory
@@ -873,5 +875,81 @@ def test_create_from_sft():
         raise AssertionError()
 
 
+def test_lazy_loading():
+    for ext in ['trk', 'tck', 'dpy']:
+        filename = filepath_dix['gs.' + ext]
+        for space in Space:
+            for origin in Origin:
+                sft = load_tractogram(filename, filepath_dix['gs.nii'],
+                                      to_space=space, to_origin=origin)
+                lazy_sft = load_tractogram(filename, filepath_dix['gs.nii'],
+                                           to_space=space, to_origin=origin,
+                                           lazy=True)
+                assert_(lazy_sft.is_lazy and not sft.is_lazy)
+                assert_(isinstance(lazy_sft.streamlines._data, np.memmap))
+                assert_allclose(sft.streamlines.get_data(),
+                                lazy_sft.streamlines.get_data(), atol=1e-5)
+                assert_allclose(sft.streamlines[3], lazy_sft.streamlines[3],
+                                atol=1e-5)
+                assert_allclose(sft.compute_bounding_box(),
+                                lazy_sft.compute_bounding_box(), atol=1e-5)
+                assert_allclose(sft[::2].streamlines.get_data(),
+                                lazy_sft[::2].streamlines.get_data(),
+                                atol=1e-5)
+
+    sft = load_tractogram(filepath_dix['gs.trk'], filepath_dix['gs.nii'],
+                          lazy=True)
+    sft.dimensions[2] = 5
+    sft.remove_invalid_streamlines()
+    assert_(sft.is_lazy and len(sft) == 5)
+
+
+def test_lazy_cache_dir():
+    with InTemporaryDirectory():
+        for _ in range(2):
+            sft = load_tractogram(filepath_dix['gs.trk'],
+                                  filepath_dix['gs.nii'], lazy=True,
+                                  cache_dir='cache')
+            assert_(len(os.listdir('cache')) == 1)
+        save_tractogram(sft, 'lazy.trk')
+        lazy_saved = load_tractogram('lazy.trk', filepath_dix['gs.nii'])
+        sft = load_tractogram(filepath_dix['gs.trk'], filepath_dix['gs.nii'])
+        assert_allclose(sft.streamlines.get_data(),
+                        lazy_saved.streamlines.get_data(), atol=1e-5)
+
+
+def test_lazy_cleanup_failure():
+    # The temporary files that can't be removed are reported
+    def failing_rmtree(path, *args, **kwargs):
+        raise PermissionError('mapped files')
+
+    with InTemporaryDirectory() as tmp_dir:
+        rmtree, tempdir = shutil.rmtree, tempfile.tempdir
+        shutil.rmtree, tempfile.tempdir = failing_rmtree, tmp_dir
+        try:
+            sft = npt.assert_warns(UserWarning, load_tractogram,
+                                   filepath_dix['gs.trk'],
+                                   filepath_dix['gs.nii'], lazy=True)
+        finally:
+            shutil.rmtree, tempfile.tempdir = rmtree, tempdir
+        assert_(sft.is_lazy)
+        del sft
+
+
+def test_lazy_saving():
+    sft = load_tractogram(filepath_dix['gs.trk'], filepath_dix['gs.nii'])
+    with InTemporaryDirectory():
+        for ext in ['trk', 'tck', 'dpy']:
+            lazy_sft = load_tractogram(filepath_dix['gs.' + ext],
+                                       filepath_dix['gs.nii'],
+                                       to_space=Space.VOX, lazy=True)
+            save_tractogram(lazy_sft, 'lazy.' + ext)
+            assert_(lazy_sft.is_lazy and lazy_sft.space == Space.VOX)
+            lazy_saved = load_tractogram('lazy.' + ext,
+                                         filepath_dix['gs.nii'])
+            assert_allclose(sft.streamlines.get_data(),
+                            lazy_saved.streamlines.get_data(), atol=1e-5)
+
+
 if __name__ == '__main__':
     npt.run_module_suite()
@@ -3,8 +3,10 @@ import os
 
 from dipy.data import fetch_gold_standard_io
 from dipy.io.streamline import (load_tractogram, save_tractogram,
-                                load_trk, save_trk)
-from dipy.io.stateful_tractogram import Space, StatefulTractogram
+                                save_tractogram_streaming, load_trk,
+                                save_trk)
+from dipy.io.dpy import Dpy
+from dipy.io.stateful_tractogram import Origin, Space, StatefulTractogram
 from dipy.io.utils import create_nifti_header
 from dipy.io.vtk import save_vtk_streamlines, load_vtk_streamlines
 from dipy.tracking.streamline import Streamlines
@@ -152,7 +154,7 @@ streamlines = Streamlines([streamline[[0, 10]], streamline,
                            streamline[::5], streamline[::6]])
 
 
-def io_tractogram(extension):
+def io_tractogram(extension, **kwargs):
     with InTemporaryDirectory():
         fname = 'test.{}'.format(extension)
 
@@ -162,7 +164,7 @@ def io_tractogram(extension):
         nii_header = create_nifti_header(in_affine, in_dimensions,
                                          in_voxel_sizes)
         sft = StatefulTractogram(streamlines, nii_header, space=Space.RASMM)
-        save_tractogram(sft, fname, bbox_valid_check=False)
+        save_tractogram(sft, fname, bbox_valid_check=False, **kwargs)
 
         if extension == 'trk':
             reference = 'same'
@@ -195,6 +197,64 @@ def test_io_vtk():
 
 def test_io_dpy():
     io_tractogram('dpy')
+    io_tractogram('dpy', dpy_version='0.0.2')
+
+    # Version 0.0.1 stays the default, readable by older versions of dipy
+    nii_header = create_nifti_header(np.eye(4), np.array([50, 50, 50]),
+                                     np.array([2, 1.5, 1.5]))
+    sft = StatefulTractogram(streamlines, nii_header, space=Space.RASMM)
+    with InTemporaryDirectory():
+        for dpy_version in [None, '0.0.1', '0.0.2']:
+            kwargs = {'dpy_version': dpy_version} if dpy_version else {}
+            save_tractogram(sft, 'test.dpy', bbox_valid_check=False,
+                            **kwargs)
+            save_tractogram_streaming(iter(streamlines), 'stream.dpy',
+                                      nii_header, **kwargs)
+            for fname in ['test.dpy', 'stream.dpy']:
+                dpy_obj = Dpy(fname, 'r')
+                npt.assert_equal(dpy_obj.version(), dpy_version or '0.0.1')
+                npt.assert_equal(len(dpy_obj.read_tracks()),
+                                 len(streamlines))
+                dpy_obj.close()
+
+
+def test_io_streaming():
+    nii_header = create_nifti_header(np.diag([2, 1.5, 1.5, 1]),
+                                     np.array([50, 50, 50]),
+                                     np.array([2, 1.5, 1.5]))
+    with InTemporaryDirectory():
+        for extension in ['trk', 'tck', 'dpy']:
+            fname = 'test.{}'.format(extension)
+            for space in Space:
+                for origin in Origin:
+                    sft = StatefulTractogram(streamlines, nii_header,
+                                             space=Space.RASMM)
+                    sft.to_space(space)
+                    sft.to_origin(origin)
+                    count = save_tractogram_streaming(
+                        iter(sft.streamlines.copy()), fname, nii_header,
+                        space=space, origin=origin, batch_size=4)
+                    npt.assert_equal(count, len(streamlines))
+
+                    sft = load_tractogram(fname, nii_header,
+                                          bbox_valid_check=False)
+                    npt.assert_equal(len(sft), len(streamlines))
+                    npt.assert_array_almost_equal(sft.streamlines[1],
+                                                  streamline, decimal=4)
+
+            npt.assert_equal(save_tractogram_streaming(iter([]), fname,
+                                                       nii_header), 0)
+            npt.assert_equal(len(load_tractogram(fname, nii_header)), 0)
+
+        seeds = [s[0] for s in streamlines]
+        save_tractogram_streaming(zip(streamlines, seeds), 'seeds.trk',
+                                  nii_header,
+                                  data_per_streamline_keys=['seeds'])
+        sft = load_tractogram('seeds.trk', 'same', bbox_valid_check=False)
+        npt.assert_array_almost_equal(sft.data_per_streamline['seeds'],
+                                      seeds, decimal=4)
+        npt.assert_array_almost_equal(sft.streamlines[1], streamline,
+                                      decimal=4)
 
 
 @pytest.mark.skipif(not have_fury, reason="Requires FURY")
@@ -2,10 +2,13 @@
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
-from dipy.core.gradients import GradientTable
-from dipy.data import read_stanford_labels
+from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
+                                   csdeconv, csdeconv_batch)
+from dipy.core.gradients import GradientTable, gradient_table
+from dipy.data import get_fnames, read_stanford_labels
+from dipy.io.gradients import read_bvals_bvecs
 from dipy.io.image import load_nifti_data
+from dipy.sims.voxel import multi_tensor
 
 
 def num_grad(gtab):
@@ -52,5 +55,34 @@ def bench_csdeconv(center=(50, 40, 40), width=12):
     time = npt.measure(cmd)
     print(msg % (sh_order, num_grad(gtab), time))
 
+
+def bench_csdeconv_batch(n_voxels=2000, sh_order=8):
+    _, fbvals, fbvecs = get_fnames('small_64D')
+    gtab = gradient_table(*read_bvals_bvecs(fbvals, fbvecs))
+    evals = np.array([0.0015, 0.0003, 0.0003])
+    model = ConstrainedSphericalDeconvModel(gtab, (evals, 1.),
+                                            sh_order=sh_order)
+    rng = np.random.RandomState(1234)
+    signals = []
+    for i in range(n_voxels):
+        angles = [(rng.uniform(0, 90), rng.uniform(0, 360)),
+                  (rng.uniform(0, 90), rng.uniform(0, 360))]
+        S, _ = multi_tensor(gtab, np.array([evals, evals]), 100.,
+                            angles=angles, fractions=[50, 50], snr=20)
+        signals.append(S)
+    dwi = np.array(signals)[:, ~gtab.b0s_mask]
+    X, B_reg, P = model._X, model.B_reg, model._P
+
+    print("== Benchmarking CSD of %d voxels, SH order %d ==" %
+          (n_voxels, sh_order))
+    cmd = "for s in dwi: csdeconv(s, X, B_reg, P=P)"
+    print("One voxel at a time :: %g sec" % npt.measure(cmd))
+    cmd = "csdeconv_batch(dwi, X, B_reg, P=P, num_threads=1)"
+    print("Batched, one thread :: %g sec" % npt.measure(cmd))
+    cmd = "csdeconv_batch(dwi, X, B_reg, P=P)"
+    print("Batched, all threads :: %g sec" % npt.measure(cmd))
+
+
 if __name__ == "__main__":
     bench_csdeconv()
+    bench_csdeconv_batch()
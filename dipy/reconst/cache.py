@@ -1,9 +1,37 @@
+from collections import OrderedDict, namedtuple
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from dipy.core.gradients import GradientTable
 from dipy.core.onetime import auto_attr
+from dipy.core.sphere import Sphere
+from dipy.info import __version__
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'currsize', 'nbytes',
+                                     'max_nbytes'])
 
 
 class Cache(object):
     """Cache values based on a key object (such as a sphere or gradient table).
 
+    The cache keeps the most recently used values, within a memory budget of
+    `cache_max_nbytes` bytes counted from the ``nbytes`` of the cached
+    arrays. When storing a value exceeds the budget, the least recently used
+    values are evicted. Set `cache_max_nbytes` to None for an unbounded
+    cache.
+
+    Spheres, gradient tables and arrays used as keys are compared by content,
+    so that two equal spheres share the same cached values.
+
+    The cache can be used by many threads at once, e.g. when a model is
+    fitted with the 'thread' engine of ``multi_voxel_fit``.
+
     Notes
     -----
     This class is meant to be used as a mix-in::
@@ -25,12 +53,34 @@ class Cache(object):
 
     """
 
+    #: Memory budget of the cache in bytes, None for no limit
+    cache_max_nbytes = 512 * 2 ** 20
+
     # We use this method instead of __init__ to construct the cache, so
     # that the class can be used as a mixin, without having to worry about
     # calling the super-class constructor
     @auto_attr
     def _cache(self):
-        return {}
+        return OrderedDict()
+
+    @auto_attr
+    def _cache_stats(self):
+        return {'hits': 0, 'misses': 0, 'nbytes': 0}
+
+    @property
+    def _cache_lock(self):
+        lock = self.__dict__.get('_cache_rlock')
+        if lock is None:
+            # setdefault is atomic, so that threads calling this at the same
+            # time get the same lock
+            lock = self.__dict__.setdefault('_cache_rlock', threading.RLock())
+        return lock
+
+    def __getstate__(self):
+        # Locks can't be pickled, a copy gets its own lock
+        state = self.__dict__.copy()
+        state.pop('_cache_rlock', None)
+        return state
 
     def cache_set(self, tag, key, value):
         """Store a value in the cache.
@@ -63,7 +113,19 @@ class Cache(object):
         True
 
         """
-        self._cache[(tag, key)] = value
+        cache_key = (tag, content_key(key))
+        nbytes = _nbytes(value)
+        with self._cache_lock:
+            self._cache_discard(cache_key)
+            max_nbytes = self.cache_max_nbytes
+            if max_nbytes is not None:
+                if nbytes > max_nbytes:
+                    # The value alone does not fit in the cache
+                    return
+                while self._cache_stats['nbytes'] + nbytes > max_nbytes:
+                    self._cache_discard(next(iter(self._cache)))
+            self._cache[cache_key] = (value, nbytes)
+            self._cache_stats['nbytes'] += nbytes
 
     def cache_get(self, tag, key, default=None):
         """Retrieve a value from the cache.
@@ -84,10 +146,208 @@ class Cache(object):
             `default` if no cached entry is found.
 
         """
-        return self._cache.get((tag, key), default)
+        cache_key = (tag, content_key(key))
+        with self._cache_lock:
+            try:
+                value, _ = self._cache[cache_key]
+            except KeyError:
+                self._cache_stats['misses'] += 1
+                return default
+            self._cache.move_to_end(cache_key)
+            self._cache_stats['hits'] += 1
+        return value
 
     def cache_clear(self):
-        """Clear the cache.
+        """Clear the cache and its statistics.
+
+        """
+        with self._cache_lock:
+            self._cache = OrderedDict()
+            self._cache_stats = {'hits': 0, 'misses': 0, 'nbytes': 0}
+
+    def cache_info(self):
+        """Statistics of the cache.
+
+        Returns
+        -------
+        info : CacheInfo
+            Named tuple with the number of ``hits`` and ``misses`` of
+            `cache_get`, the number of cached values ``currsize``, the memory
+            used by the cached arrays ``nbytes`` and the memory budget
+            ``max_nbytes``.
 
         """
-        self._cache = {}
+        with self._cache_lock:
+            stats = self._cache_stats
+            return CacheInfo(stats['hits'], stats['misses'], len(self._cache),
+                             stats['nbytes'], self.cache_max_nbytes)
+
+    def _cache_discard(self, cache_key):
+        # Called with the lock held
+        entry = self._cache.pop(cache_key, None)
+        if entry is not None:
+            self._cache_stats['nbytes'] -= entry[1]
+
+
+def content_key(key):
+    """Hashable key identifying an object by its content.
+
+    Spheres, gradient tables and arrays are replaced by a digest of the data
+    defining them, tuples are converted item by item and other objects are
+    used as is.
+
+    Parameters
+    ----------
+    key : object
+        Object used to look up cached values.
+
+    Returns
+    -------
+    content_key : object
+        Hashable key equal for objects with equal content.
+
+    """
+    if isinstance(key, Sphere):
+        return (type(key).__name__, _digest(key.vertices))
+    if isinstance(key, GradientTable):
+        return ('GradientTable', _digest(key.gradients), key.b0_threshold,
+                _digest(key.big_delta), _digest(key.small_delta))
+    if isinstance(key, np.ndarray):
+        return ('ndarray', _digest(key))
+    if isinstance(key, tuple):
+        return tuple(content_key(k) for k in key)
+    return key
+
+
+def _digest(arr):
+    """Digest of the shape, type and values of an array"""
+    if arr is None:
+        return None
+    arr = np.asarray(arr)
+    digest = hashlib.sha1(arr.tobytes()).hexdigest()
+    return (arr.shape, arr.dtype.str, digest)
+
+
+def _nbytes(value):
+    """Memory used by the arrays in `value`"""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(_nbytes(v) for v in value)
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return 0
+
+
+class DiskCache(object):
+    """Arrays cached on disk as memory-mapped ``.npy`` files.
+
+    Each array is stored in a file named after its tag and a hash of its key
+    (see :func:`content_key`) and of the DIPY version, so that results of
+    other versions are never reused. Files are written atomically, so many
+    processes can share the same cache directory.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the cached files. It is created if needed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, tag, key):
+        digest = hashlib.sha1(repr((__version__, content_key(key)))
+                              .encode()).hexdigest()
+        return os.path.join(self.cache_dir, '%s-%s.npy' % (tag, digest))
+
+    def get(self, tag, key, default=None):
+        """Memory map the array cached for ``(tag, key)``.
+
+        Returns `default` if there is no such array, or if its file can't be
+        read.
+        """
+        try:
+            return np.load(self._path(tag, key), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return default
+
+    def set(self, tag, key, value):
+        """Store an array in the cache and return it memory-mapped."""
+        path = self._path(tag, key)
+        fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(value))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return np.load(path, mmap_mode='r')
+
+    def clear(self, tag=None):
+        """Remove the cached arrays of `tag`, or all of them if None."""
+        pattern = '*.npy' if tag is None else '%s-*.npy' % tag
+        for path in glob.glob(os.path.join(self.cache_dir, pattern)):
+            os.remove(path)
+
+    def nbytes(self):
+        """Disk space used by the cached arrays."""
+        return sum(os.path.getsize(path) for path in
+                   glob.glob(os.path.join(self.cache_dir, '*.npy')))
+
+
+_disk_cache = None
+
+
+def set_disk_cache_dir(cache_dir):
+    """Set the directory of the on-disk cache of basis matrices.
+
+    The on-disk cache is disabled by default, unless the ``DIPY_CACHE_DIR``
+    environment variable is set.
+
+    Parameters
+    ----------
+    cache_dir : str or None
+        Directory of the cache, None to disable the on-disk cache.
+    """
+    global _disk_cache
+    _disk_cache = None if cache_dir is None else DiskCache(cache_dir)
+
+
+def get_disk_cache():
+    """The current :class:`DiskCache`, None if the disk cache is disabled."""
+    return _disk_cache
+
+
+def disk_cached(tag, key, compute):
+    """Array computed by `compute`, cached on disk if the cache is enabled.
+
+    Parameters
+    ----------
+    tag : str
+        Description of the cached array.
+    key : object
+        Key object used to look up the cached array.
+    compute : callable
+        Function without arguments computing the array on a cache miss.
+
+    Returns
+    -------
+    value : ndarray
+        The array, memory-mapped (read-only) when it comes from the disk
+        cache.
+    """
+    cache = _disk_cache
+    if cache is None:
+        return compute()
+    value = cache.get(tag, key)
+    if value is None:
+        value = cache.set(tag, key, compute())
+    return value
+
+
+if os.environ.get('DIPY_CACHE_DIR'):
+    set_disk_cache_dir(os.environ['DIPY_CACHE_DIR'])
@@ -13,6 +13,7 @@ from dipy.core.ndindex import ndindex
 from dipy.sims.voxel import single_tensor
 
 from dipy.reconst.multi_voxel import multi_voxel_fit
+from dipy.reconst.recspeed import csd_refine
 from dipy.reconst.dti import TensorModel, fractional_anisotropy
 from dipy.reconst.shm import (sph_harm_ind_list, real_sph_harm,
                               sph_harm_lookup, lazy_index, SphHarmFit,
@@ -59,6 +60,9 @@ class AxSymShResponse(object):
 
 class ConstrainedSphericalDeconvModel(SphHarmModel):
 
+    #: Number of voxels deconvolved at once by `csdeconv_batch`
+    batch_size = 10000
+
     def __init__(self, gtab, response, reg_sphere=None, sh_order=8,
                  lambda_=1, tau=0.1, convergence=50):
         r""" Constrained Spherical Deconvolution (CSD) [1]_.
@@ -174,13 +178,25 @@ class ConstrainedSphericalDeconvModel(SphHarmModel):
         self._X = X = self.R.diagonal() * self.B_dwi
         self._P = np.dot(X.T, X)
 
-    @multi_voxel_fit
+    @multi_voxel_fit(batch_fit='_fit_batch')
     def fit(self, data):
         dwi_data = data[self._where_dwi]
         shm_coeff, _ = csdeconv(dwi_data, self._X, self.B_reg, self.tau,
                                 convergence=self.convergence, P=self._P)
         return SphHarmFit(self, shm_coeff, None)
 
+    def _fit_batch(self, data, num_threads=None):
+        """Fit an (N, ...) array of voxels, `batch_size` voxels at a time"""
+        dwi_data = data[:, self._where_dwi]
+        fits = []
+        for start in range(0, dwi_data.shape[0], self.batch_size):
+            shm_coeff, _ = csdeconv_batch(
+                dwi_data[start:start + self.batch_size], self._X,
+                self.B_reg, self.tau, convergence=self.convergence,
+                P=self._P, num_threads=num_threads)
+            fits.extend(SphHarmFit(self, coeff, None) for coeff in shm_coeff)
+        return fits
+
     def predict(self, sh_coeff, gtab=None, S0=1.):
         """Compute a signal prediction given spherical harmonic coefficients
         for the provided GradientTable class instance.
@@ -589,6 +605,97 @@ def csdeconv(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None):
     return fodf_sh, num_it
 
 
+def csdeconv_batch(dwsignal, X, B_reg, tau=0.1, convergence=50, P=None,
+                   num_threads=None):
+    r""" Constrained-regularized spherical deconvolution (CSD) of many voxels
+
+    Version of :func:`csdeconv` deconvolving a block of voxels at once. The
+    unconstrained solution of all the voxels is computed with one Cholesky
+    decomposition. The iterations of the constrained-regularization are then
+    done by a compiled kernel without the GIL, the voxels being shared out
+    among `num_threads` threads. The system of a voxel is updated with the
+    rows of `B_reg` that change between iterations instead of being formed
+    again.
+
+    Parameters
+    ----------
+    dwsignal : array (N, M)
+        Diffusion weighted signals of N voxels to be deconvolved.
+    X : array (M, C)
+        Prediction matrix which estimates diffusion weighted signals from FOD
+        coefficients.
+    B_reg : array (K, C)
+        SH basis matrix which maps FOD coefficients to FOD values on the
+        surface of the sphere. B_reg should be scaled to account for lambda.
+    tau : float
+        Threshold controlling the amplitude below which the corresponding fODF
+        is assumed to be zero (see :func:`csdeconv`).
+    convergence : int
+        Maximum number of iterations to allow the deconvolution to converge.
+    P : ndarray
+        Precomputed ``dot(X.T, X)``.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
+
+    Returns
+    -------
+    fodf_sh : ndarray (N, C)
+         Spherical harmonics coefficients of the constrained-regularized fiber
+         ODF of each voxel.
+    num_it : ndarray (N,)
+         Number of iterations in the constrained-regularization used for
+         convergence in each voxel.
+
+    """
+    mu = 1e-5
+    if P is None:
+        P = np.dot(X.T, X)
+    dwsignal = np.atleast_2d(dwsignal)
+    z = np.dot(dwsignal, X)
+
+    try:
+        cho = la.cho_factor(P, lower=False, check_finite=False)
+    except la.LinAlgError:
+        P = P + mu * np.eye(P.shape[0])
+        cho = la.cho_factor(P, lower=False, check_finite=False)
+    fodf_sh = np.ascontiguousarray(la.cho_solve(cho, z.T,
+                                                check_finite=False).T)
+    num_it = np.zeros(len(fodf_sh), dtype=np.intp)
+
+    # For the first iteration we use a smooth FOD that only uses SH orders up
+    # to 4 (the first 15 coefficients).
+    fodf = np.dot(fodf_sh[:, :15], B_reg[:, :15].T)
+    threshold = B_reg[0, 0] * fodf_sh[:, 0:1] * tau
+    fodf_small = fodf < threshold
+
+    # Where the low-order fodf does not have any values less than threshold,
+    # the full-order fodf is used. Voxels where it still has no values less
+    # than threshold are already done.
+    smooth = ~fodf_small.any(axis=1)
+    if smooth.any():
+        fodf = np.dot(fodf_sh[smooth], B_reg.T)
+        fodf_small[smooth] = fodf < threshold[smooth]
+
+    # The constrained-regularization iterations of each voxel are done by a
+    # compiled kernel, which solves the systems without the GIL
+    small = fodf_small.view(np.uint8)
+    status = csd_refine(fodf_sh, np.ascontiguousarray(z),
+                        np.ascontiguousarray(P, dtype=float),
+                        np.ascontiguousarray(B_reg, dtype=float),
+                        np.ascontiguousarray(threshold[:, 0]), small,
+                        convergence, num_it, num_threads=num_threads)
+    if (status == 2).any():
+        raise la.LinAlgError("leading minor not positive definite in %d "
+                             "voxels" % np.count_nonzero(status == 2))
+    if (status == 1).any():
+        msg = ('maximum number of iterations exceeded - failed to '
+               'converge in %d voxels' % np.count_nonzero(status == 1))
+        warnings.warn(msg)
+
+    return fodf_sh, num_it
+
+
 def odf_deconv(odf_sh, R, B_reg, lambda_=1., tau=0.1, r2_term=False):
     r""" ODF constrained-regularized spherical deconvolution using
     the Sharpening Deconvolution Transform (SDT) [1]_, [2]_.
@@ -201,6 +201,11 @@ class FreeWaterTensorFit(TensorFit):
         """
         TensorFit.__init__(self, model, model_params)
 
+    @classmethod
+    def from_model_params(cls, model, model_params):
+        """Build a fit from an array of free water tensor parameters"""
+        return cls(model, model_params)
+
     @property
     def f(self):
         """ Returns the free water diffusion volume fraction f """
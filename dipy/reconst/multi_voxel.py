@@ -1,17 +1,43 @@
 """Tools to easily make multi voxel models"""
+import functools
+import inspect
+
 import numpy as np
 from numpy.lib.stride_tricks import as_strided
 
 from dipy.core.ndindex import ndindex
 from dipy.reconst.quick_squash import quick_squash as _squash
 from dipy.reconst.base import ReconstFit
+from dipy.utils.parallel import chunk_slices, determine_num_jobs, paramap
 
 
-def multi_voxel_fit(single_voxel_fit):
+def multi_voxel_fit(single_voxel_fit=None, batch_fit=None):
     """Method decorator to turn a single voxel model fit
     definition into a multi voxel model fit definition
+
+    The decorated fit method accepts the additional keyword arguments
+    ``engine``, ``n_jobs`` and ``vox_per_chunk``. When ``engine`` is 'thread'
+    or 'process', the masked voxels are split in chunks of ``vox_per_chunk``
+    voxels that are fitted concurrently by ``n_jobs`` workers (see
+    :func:`dipy.utils.parallel.paramap`). The resulting fit is the same as
+    the one obtained with the default 'serial' engine.
+
+    Models able to fit many voxels at once can give the name of the method
+    doing so as ``batch_fit``, as in
+    ``@multi_voxel_fit(batch_fit='_fit_batch')``. That method takes an
+    (N, ...) array of voxels and returns the list of their N single voxel
+    fits. It is then used on the masked voxels, or on each chunk of them,
+    instead of fitting the voxels one at a time. It also takes a
+    ``num_threads`` keyword argument, always set to 1: the 'serial' engine
+    fits on one thread, and parallel workers do not each start a thread per
+    core.
     """
-    def new_fit(self, data, mask=None):
+    if single_voxel_fit is None:
+        return functools.partial(multi_voxel_fit, batch_fit=batch_fit)
+
+    @functools.wraps(single_voxel_fit)
+    def new_fit(self, data, mask=None, engine='serial', n_jobs=None,
+                vox_per_chunk=None):
         """Fit method for every voxel in data"""
         # If only one voxel just return a normal fit
         if data.ndim == 1:
@@ -27,14 +53,121 @@ def multi_voxel_fit(single_voxel_fit):
             raise ValueError("mask and data shape do not match")
 
         # Fit data where mask is True
-        fit_array = np.empty(data.shape[:-1], dtype=object)
-        for ijk in ndindex(data.shape[:-1]):
-            if mask[ijk]:
-                fit_array[ijk] = single_voxel_fit(self, data[ijk])
-        return MultiVoxelFit(self, fit_array, mask)
+        if engine == 'serial' and batch_fit is not None:
+            return _collect_fits(self, getattr(self, batch_fit)(
+                data[mask], num_threads=1), mask)
+        if engine == 'serial':
+            fits = (single_voxel_fit(self, data[ijk])
+                    for ijk in ndindex(data.shape[:-1]) if mask[ijk])
+            return _collect_fits(self, fits, mask)
+
+        owner = _find_owner(type(self), single_voxel_fit.__name__, new_fit)
+        vox_data = data[mask]
+        n_jobs = determine_num_jobs(n_jobs)
+        chunks = [vox_data[sl] for sl in
+                  chunk_slices(vox_data.shape[0], n_jobs, vox_per_chunk)]
+        chunk_fits = paramap(_fit_voxel_chunk, chunks, engine=engine,
+                             n_jobs=n_jobs,
+                             func_args=[self, owner,
+                                        single_voxel_fit.__name__, batch_fit])
+        fits = (fit for fits in chunk_fits for fit in fits)
+        if engine == 'process':
+            # Fits coming back from other processes hold a copy of the
+            # model, share the original one instead
+            fits = (_reattach_model(fit, self) for fit in fits)
+        return _collect_fits(self, fits, mask)
     return new_fit
 
 
+def _collect_fits(model, fits, mask):
+    """Gather the single voxel fits of the masked voxels in a fit container
+
+    Parameters
+    ----------
+    model : object
+        The model the voxels were fitted with.
+    fits : iterable
+        Single voxel fits of the voxels where `mask` is True, in C order.
+    mask : ndarray
+        Boolean mask of the fitted voxels.
+
+    Returns
+    -------
+    fit : MultiVoxelFit
+        A ``ParamsMultiVoxelFit`` when the fits can be stored as an array of
+        model parameters, a ``MultiVoxelFit`` holding an array of fit
+        objects otherwise.
+    """
+    n_vox = int(np.count_nonzero(mask))
+    fit_class = None
+    params = None
+    fit_list = None
+    for i, fit in enumerate(fits):
+        if i == 0 and _has_params(fit):
+            fit_class = type(fit)
+            fit_params = np.asarray(fit.model_params)
+            params = np.zeros((n_vox,) + fit_params.shape, fit_params.dtype)
+        if params is not None:
+            if type(fit) is fit_class and _has_params(fit):
+                fit_params = np.asarray(fit.model_params)
+                if fit_params.shape == params.shape[1:]:
+                    if not np.can_cast(fit_params.dtype, params.dtype):
+                        params = params.astype(np.result_type(params,
+                                                              fit_params))
+                    params[i] = fit_params
+                    continue
+            # Parameters can't be stacked, fall back to fit objects
+            fit_list = [fit_class.from_model_params(model, p)
+                        for p in params[:i]]
+            params = None
+        if fit_list is None:
+            fit_list = []
+        fit_list.append(fit)
+
+    if params is not None:
+        model_params = np.zeros(mask.shape + params.shape[1:], params.dtype)
+        model_params[mask] = params
+        return ParamsMultiVoxelFit(model, fit_class, model_params, mask)
+
+    fit_array = np.empty(mask.shape, dtype=object)
+    if fit_list:
+        flat_fits = np.empty(len(fit_list), dtype=object)
+        for i, fit in enumerate(fit_list):
+            flat_fits[i] = fit
+        fit_array[mask] = flat_fits
+    return MultiVoxelFit(model, fit_array, mask)
+
+
+def _has_params(fit):
+    """Whether a single voxel fit can be stored as model parameters"""
+    return (hasattr(type(fit), 'from_model_params') and
+            getattr(fit, 'model_params', None) is not None)
+
+
+def _reattach_model(fit, model):
+    if getattr(fit, 'model', None) is not None:
+        fit.model = model
+    return fit
+
+
+def _find_owner(klass, name, method):
+    """Find the class in the MRO of `klass` defining `method` as `name`"""
+    for base in klass.__mro__:
+        if base.__dict__.get(name) is method:
+            return base
+    raise ValueError("%s is not a method of %s" % (name, klass.__name__))
+
+
+def _fit_voxel_chunk(vox_data, model, owner, name, batch_fit=None):
+    """Fit each voxel of a (N, ...) chunk of data with the undecorated
+    single voxel fit method `name` of class `owner`, or with the method
+    `batch_fit` of the model if given"""
+    if batch_fit is not None:
+        return getattr(model, batch_fit)(vox_data, num_threads=1)
+    single_voxel_fit = owner.__dict__[name].__wrapped__
+    return [single_voxel_fit(model, vox) for vox in vox_data]
+
+
 class MultiVoxelFit(ReconstFit):
     """Holds an array of fits and allows access to their attributes and
     methods"""
@@ -99,6 +232,112 @@ class MultiVoxelFit(ReconstFit):
         return result
 
 
+class ParamsMultiVoxelFit(MultiVoxelFit):
+    """Holds the parameters of many single voxel fits in a single array
+
+    Instead of keeping one fit object per voxel, the parameters of all the
+    voxels are stored in one ``mask.shape + params_shape`` array. Single
+    voxel fits are only built when a voxel is indexed, and the attributes
+    and methods of the fits are evaluated on batches of voxels.
+
+    The single voxel fit class must have a ``model_params`` attribute and a
+    ``from_model_params(model, model_params)`` class method building a fit
+    from parameters with any number of leading (voxel) dimensions.
+    """
+    #: Number of voxels evaluated at once by attributes and methods
+    batch_size = 10000
+
+    def __init__(self, model, fit_class, model_params, mask):
+        self.model = model
+        self.fit_class = fit_class
+        self.model_params = model_params
+        self.mask = mask
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    @property
+    def fit_array(self):
+        """Array of single voxel fits, built on every access"""
+        fit_array = np.empty(self.shape, dtype=object)
+        for ijk in zip(*np.nonzero(self.mask)):
+            fit_array[ijk] = self.fit_class.from_model_params(
+                self.model, self.model_params[ijk])
+        return fit_array
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') or attr in ('model', 'fit_class',
+                                             'model_params', 'mask'):
+            raise AttributeError(attr)
+        if inspect.isfunction(inspect.getattr_static(self.fit_class, attr,
+                                                     None)):
+            def batch_method(*args, **kwargs):
+                return self._map_batches(
+                    lambda fit: getattr(fit, attr)(*args, **kwargs))
+            batch_method.__name__ = attr
+            return batch_method
+        return self._map_batches(lambda fit: getattr(fit, attr))
+
+    def __getitem__(self, index):
+        mask = self.mask[index]
+        if (isinstance(index, tuple) and
+                not any(i is Ellipsis for i in index)):
+            params_index = index + (Ellipsis,)
+        else:
+            params_index = index
+        model_params = self.model_params[params_index]
+        if np.ndim(mask) == 0:
+            if mask:
+                return self.fit_class.from_model_params(self.model,
+                                                        model_params)
+            return None
+        return ParamsMultiVoxelFit(self.model, self.fit_class, model_params,
+                                   mask)
+
+    def predict(self, *args, **kwargs):
+        """
+        Predict for the multi-voxel object using the prediction API of the
+        single voxel fits, with S0 provided from an array.
+        """
+        if not hasattr(self.fit_class, 'predict'):
+            msg = "This model does not have prediction implemented yet"
+            raise NotImplementedError(msg)
+        S0 = kwargs.pop('S0', 1.)
+        if np.ndim(S0) == 0:
+            return self._map_batches(
+                lambda fit: fit.predict(*args, S0=S0, **kwargs))
+        S0 = np.asarray(S0)
+        return self._map_batches(
+            lambda fit, idx: fit.predict(*args, S0=S0[idx], **kwargs),
+            with_index=True)
+
+    def _map_batches(self, func, with_index=False):
+        """Evaluate `func` on batches of fits of the masked voxels
+
+        The results are gathered in an array of the shape of the fit, with
+        zeros in the voxels outside the mask.
+        """
+        idx = np.nonzero(self.mask)
+        slices = chunk_slices(len(idx[0]), 1, self.batch_size)
+        result = None
+        for sl in slices or [slice(0, 0)]:
+            batch_idx = tuple(i[sl] for i in idx)
+            batch = self.fit_class.from_model_params(
+                self.model, self.model_params[batch_idx])
+            if with_index:
+                value = np.asarray(func(batch, batch_idx))
+            else:
+                value = np.asarray(func(batch))
+            n_batch = len(batch_idx[0])
+            if value.ndim == 0:
+                value = np.broadcast_to(value, (n_batch,))
+            if result is None:
+                result = np.zeros(self.shape + value.shape[1:], value.dtype)
+            result[batch_idx] = value
+        return result
+
+
 class CallableArray(np.ndarray):
     """An array which can be called like a function"""
     def __call__(self, *args, **kwargs):
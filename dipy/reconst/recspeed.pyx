@@ -10,8 +10,13 @@ cimport cython
 import numpy as np
 cimport numpy as cnp
 
+from cython.parallel import parallel, prange
 from libc.stdlib cimport malloc, free
 from libc.string cimport memcpy
+from scipy.linalg.cython_blas cimport dgemv, dsyrk
+from scipy.linalg.cython_lapack cimport dpotf2, dpotrs
+
+from dipy.utils.omp cimport set_num_threads, restore_default_num_threads
 
 cdef extern from "dpy_math.h" nogil:
     double floor(double x)
@@ -550,3 +555,186 @@ def argmax_from_countarrs(cnp.ndarray vals,
         return np.array([])
     # fancy indexing always produces a copy
     return maxinds[argsort(maxes[:n_maxes])]
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+def csd_refine(double[:, ::1] fodf_sh, double[:, ::1] z, double[:, ::1] P,
+               double[:, ::1] B_reg, double[::1] threshold,
+               cnp.uint8_t[:, ::1] small, int convergence,
+               cnp.npy_intp[::1] num_it, num_threads=None):
+    """Constrained-regularization iterations of the CSD of many voxels
+
+    Solves ``(P + H.T H) f = z`` for each voxel, where H holds the rows of
+    `B_reg` where the fODF is below its threshold, until these rows do not
+    change (see ``dipy.reconst.csdeconv.csdeconv``). The system of a voxel
+    is updated with the rows that change between iterations and solved with
+    a Cholesky decomposition, without the GIL.
+
+    Parameters
+    ----------
+    fodf_sh : array (N, C)
+        Initial SH coefficients of the fODF of the N voxels, updated in
+        place.
+    z : array (N, C)
+        ``X.T s`` for the signal s of each voxel.
+    P : array (C, C)
+        ``X.T X``.
+    B_reg : array (K, C)
+        SH basis matrix of the regularization sphere, scaled by lambda.
+    threshold : array (N,)
+        fODF amplitude below which a point of the sphere is constrained.
+    small : array (N, K)
+        Points of the sphere below threshold for the initial fODF, updated
+        in place. Voxels without any such point are left unchanged.
+    convergence : int
+        Maximum number of iterations.
+    num_it : array (N,)
+        Number of iterations done in each voxel, updated in place.
+    num_threads : int, optional
+        Number of threads. If None (default) then all available threads
+        will be used (all CPU cores).
+
+    Returns
+    -------
+    status : array (N,)
+        0 where the iterations converged, 1 where they did not, and 2 where
+        a system is not positive definite.
+    """
+    cdef:
+        int n_coef = P.shape[0]
+        int n_points = B_reg.shape[0]
+        cnp.npy_intp n_vox = fodf_sh.shape[0]
+        cnp.npy_intp i
+        double *Q
+        double *L
+        double *H
+        double *fodf
+        cnp.uint8_t[::1] status = np.zeros(n_vox, dtype=np.uint8)
+
+    if (z.shape[0] != n_vox or small.shape[0] != n_vox or
+            threshold.shape[0] != n_vox or num_it.shape[0] != n_vox or
+            fodf_sh.shape[1] != n_coef or z.shape[1] != n_coef or
+            B_reg.shape[1] != n_coef or small.shape[1] != n_points):
+        raise ValueError("Inconsistent shapes of the CSD arrays")
+
+    set_num_threads(num_threads)
+    with nogil, parallel():
+        Q = <double *> malloc(n_coef * n_coef * sizeof(double))
+        L = <double *> malloc(n_coef * n_coef * sizeof(double))
+        H = <double *> malloc(n_points * n_coef * sizeof(double))
+        fodf = <double *> malloc(n_points * sizeof(double))
+        for i in prange(n_vox, schedule='dynamic'):
+            status[i] = _csd_refine_voxel(
+                &fodf_sh[i, 0], &z[i, 0], &P[0, 0], &B_reg[0, 0],
+                threshold[i], &small[i, 0], n_coef, n_points, convergence,
+                &num_it[i], Q, L, H, fodf)
+        free(Q)
+        free(L)
+        free(H)
+        free(fodf)
+    if num_threads is not None:
+        restore_default_num_threads()
+    return np.asarray(status)
+
+
+@cython.wraparound(False)
+@cython.boundscheck(False)
+cdef cnp.uint8_t _csd_refine_voxel(double *f, double *z, double *P,
+                                   double *B_reg, double threshold,
+                                   cnp.uint8_t *small, int n_coef,
+                                   int n_points, int convergence,
+                                   cnp.npy_intp *num_it, double *Q, double *L,
+                                   double *H, double *fodf) nogil:
+    """CSD iterations of one voxel, see ``csd_refine``
+
+    The matrices are symmetric, and only their upper triangle is updated
+    and decomposed.
+    """
+    cdef:
+        int k, it, below
+        int n_added, n_removed
+        int one = 1
+        double d_one = 1., d_minus_one = -1., d_zero = 0.
+        char trans = b'T'
+
+    memcpy(Q, P, n_coef * n_coef * sizeof(double))
+    n_added = _gather_rows(B_reg, small, 1, n_coef, n_points, H)
+    if n_added == 0:
+        return 0
+    _add_outer_products(Q, H, n_added, n_coef, d_one)
+
+    for it in range(1, convergence + 1):
+        memcpy(L, Q, n_coef * n_coef * sizeof(double))
+        if not _cholesky_solve(L, z, f, n_coef):
+            return 2
+        num_it[0] = it
+
+        # fodf = B_reg f, B_reg being the transpose of a (C, K) Fortran array
+        dgemv(&trans, &n_coef, &n_points, &d_one, B_reg, &n_coef, f, &one,
+              &d_zero, fodf, &one)
+        # Rows of B_reg added to H are marked with 2, removed ones with 3
+        n_added = 0
+        n_removed = 0
+        for k in range(n_points):
+            below = fodf[k] < threshold
+            if below and not small[k]:
+                small[k] = 2
+                n_added += 1
+            elif not below and small[k]:
+                small[k] = 3
+                n_removed += 1
+        if n_added == 0 and n_removed == 0:
+            return 0
+        if n_added:
+            _gather_rows(B_reg, small, 2, n_coef, n_points, H)
+            _add_outer_products(Q, H, n_added, n_coef, d_one)
+        if n_removed:
+            _gather_rows(B_reg, small, 3, n_coef, n_points, H)
+            _add_outer_products(Q, H, n_removed, n_coef, d_minus_one)
+        for k in range(n_points):
+            small[k] = small[k] == 1 or small[k] == 2
+    return 1
+
+
+cdef int _cholesky_solve(double *A, double *b, double *x, int n) nogil:
+    """Solve ``A x = b`` for a symmetric positive definite (n, n) matrix
+
+    Only the upper triangle of the C order `A` is read, and it is replaced
+    by its Cholesky factor. Return 0 if `A` is not positive definite.
+    """
+    cdef:
+        int info, one = 1
+        char uplo = b'L'
+    # The upper triangle of the C order A is the lower triangle of its
+    # Fortran order transpose. The unblocked decomposition is faster than
+    # dpotrf for such small matrices.
+    dpotf2(&uplo, &n, A, &n, &info)
+    if info != 0:
+        return 0
+    memcpy(x, b, n * sizeof(double))
+    dpotrs(&uplo, &n, &one, A, &n, x, &n, &info)
+    return 1
+
+
+cdef int _gather_rows(double *B, cnp.uint8_t *marks, cnp.uint8_t mark,
+                      int n_cols, int n_rows, double *H) nogil:
+    """Copy the rows of `B` marked with `mark` to `H`, return their number"""
+    cdef int k, n = 0
+    for k in range(n_rows):
+        if marks[k] == mark:
+            memcpy(&H[n * n_cols], &B[k * n_cols], n_cols * sizeof(double))
+            n += 1
+    return n
+
+
+cdef void _add_outer_products(double *Q, double *H, int n_rows, int n_cols,
+                              double alpha) nogil:
+    """Add `alpha` times the outer products of the rows of `H` to `Q`"""
+    cdef:
+        double d_one = 1.
+        char uplo = b'L', trans = b'N'
+    # The rows of H are the columns of a (n_cols, n_rows) Fortran array,
+    # whose lower triangle is the upper triangle of the C order Q
+    dsyrk(&uplo, &trans, &n_cols, &n_rows, &alpha, H, &n_cols, &d_one, Q,
+          &n_cols)
@@ -32,7 +32,7 @@ from numpy.random import randint
 from dipy.reconst.odf import OdfModel, OdfFit
 from dipy.core.geometry import cart2sphere
 from dipy.core.onetime import auto_attr
-from dipy.reconst.cache import Cache
+from dipy.reconst.cache import Cache, disk_cached
 
 
 def _copydoc(obj):
@@ -485,10 +485,8 @@ class SphHarmModel(OdfModel, Cache):
         """
         sampling_matrix = self.cache_get("sampling_matrix", sphere)
         if sampling_matrix is None:
-            sh_order = self.sh_order
-            theta = sphere.theta
-            phi = sphere.phi
-            sampling_matrix, m, n = real_sym_sh_basis(sh_order, theta, phi)
+            sampling_matrix = _sh_basis_matrix(sphere, self.sh_order,
+                                               real_sym_sh_basis)
             self.cache_set("sampling_matrix", sphere, sampling_matrix)
         return sampling_matrix
 
@@ -589,6 +587,20 @@ class SphHarmFit(OdfFit):
 
         return SphHarmFit(self.model, new_coef, new_mask)
 
+    @classmethod
+    def from_model_params(cls, model, model_params):
+        """Build a fit from an array of spherical harmonic coefficients
+
+        This allows multi voxel fits to store the coefficients of all the
+        voxels in one array (see ``dipy.reconst.multi_voxel``).
+        """
+        return cls(model, model_params, None)
+
+    @property
+    def model_params(self):
+        """The coefficients of the fit, as used by ``from_model_params``"""
+        return self._shm_coef
+
     def odf(self, sphere):
         """Samples the odf function on the points of a sphere
 
@@ -895,10 +907,8 @@ def sf_to_sh(sf, sphere, sh_order=4, basis_type=None, smooth=0.0):
 
     if sph_harm_basis is None:
         raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
-
-    L = -n * (n + 1)
-    invB = smooth_pinv(B, np.sqrt(smooth) * L)
+    B = _sh_basis_matrix(sphere, sh_order, sph_harm_basis)
+    invB = _sh_basis_inv_matrix(sphere, sh_order, sph_harm_basis, B, smooth)
     sh = np.dot(sf, invB.T)
 
     return sh
@@ -943,7 +953,7 @@ def sh_to_sf(sh, sphere, sh_order, basis_type=None):
 
     if sph_harm_basis is None:
         raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
+    B = _sh_basis_matrix(sphere, sh_order, sph_harm_basis)
 
     sf = np.dot(sh, B.T)
 
@@ -996,16 +1006,39 @@ def sh_to_sf_matrix(sphere, sh_order, basis_type=None, return_inv=True,
 
     if sph_harm_basis is None:
         raise ValueError("Invalid basis name.")
-    B, m, n = sph_harm_basis(sh_order, sphere.theta, sphere.phi)
+    B = _sh_basis_matrix(sphere, sh_order, sph_harm_basis)
 
     if return_inv:
-        L = -n * (n + 1)
-        invB = smooth_pinv(B, np.sqrt(smooth) * L)
+        invB = _sh_basis_inv_matrix(sphere, sh_order, sph_harm_basis, B,
+                                    smooth)
         return B.T, invB.T
 
     return B.T
 
 
+def _sh_basis_matrix(sphere, sh_order, sph_harm_basis):
+    """SH basis sampled on the vertices of `sphere`.
+
+    The matrix is cached on disk when a cache directory is set (see
+    :func:`dipy.reconst.cache.set_disk_cache_dir`).
+    """
+    def compute():
+        return sph_harm_basis(sh_order, sphere.theta, sphere.phi)[0]
+    return disk_cached('sh_basis', (sphere, sh_order,
+                                    sph_harm_basis.__name__), compute)
+
+
+def _sh_basis_inv_matrix(sphere, sh_order, sph_harm_basis, B, smooth):
+    """Regularized inverse of the SH basis `B` sampled on `sphere`."""
+    def compute():
+        m, n = sph_harm_ind_list(sh_order)
+        L = -n * (n + 1)
+        return smooth_pinv(B, np.sqrt(smooth) * L)
+    return disk_cached('sh_basis_inv', (sphere, sh_order,
+                                        sph_harm_basis.__name__,
+                                        float(smooth)), compute)
+
+
 def calculate_max_order(n_coeffs):
     r"""Calculate the maximal harmonic order, given that you know the
     number of parameters that were estimated.
@@ -1,5 +1,13 @@
-from dipy.reconst.cache import Cache
-from dipy.core.sphere import Sphere
+import os
+import pickle
+import threading
+
+import numpy as np
+from nibabel.tmpdirs import TemporaryDirectory
+
+from dipy.reconst.cache import Cache, DiskCache
+from dipy.core.gradients import gradient_table
+from dipy.core.sphere import Sphere, HemiSphere
 
 from numpy.testing import assert_, assert_equal, run_module_suite
 
@@ -24,5 +32,133 @@ def test_basic_cache():
     assert_(t.cache_get("design_matrix", s) is None)
 
 
+def test_content_keys():
+    t = DummyModel()
+    s1 = Sphere(theta=[0, 1], phi=[0, 2])
+    s2 = Sphere(theta=[0, 1], phi=[0, 2])
+    s3 = Sphere(theta=[0, 1], phi=[0, 3])
+
+    t.cache_set("design_matrix", s1, 1)
+    # Equal spheres share the same entry
+    assert_equal(t.cache_get("design_matrix", s2), 1)
+    assert_(t.cache_get("design_matrix", s3) is None)
+    assert_(t.cache_get("design_matrix", HemiSphere(theta=[0, 1],
+                                                    phi=[0, 2])) is None)
+    t.cache_set("design_matrix", (s2, 0.5), 2)
+    assert_equal(t.cache_get("design_matrix", (s1, 0.5)), 2)
+    assert_(t.cache_get("design_matrix", (s1, 0.4)) is None)
+
+    bvals = np.array([0, 1000, 1000, 1000])
+    bvecs = np.array([[0, 0, 0], [1, 0, 0], [0, 1, 0], [0, 0, 1]])
+    t.cache_set("design_matrix", gradient_table(bvals, bvecs), 3)
+    assert_equal(t.cache_get("design_matrix", gradient_table(bvals, bvecs)),
+                 3)
+    assert_(t.cache_get("design_matrix",
+                        gradient_table(bvals * 2, bvecs)) is None)
+
+    t.cache_set("design_matrix", np.arange(3), 4)
+    assert_equal(t.cache_get("design_matrix", np.arange(3)), 4)
+    assert_(t.cache_get("design_matrix", np.arange(3.)) is None)
+
+
+def test_cache_budget():
+    t = DummyModel()
+    t.cache_max_nbytes = 3000
+    a = np.zeros(100)
+    b = np.zeros(200)
+
+    t.cache_set("matrix", 0, a)
+    t.cache_set("matrix", 1, a)
+    t.cache_set("matrix", 2, a)
+    assert_equal(t.cache_info().nbytes, 2400)
+    assert_equal(t.cache_info().currsize, 3)
+
+    # Overwriting an entry does not count twice
+    t.cache_set("matrix", 2, a)
+    assert_equal(t.cache_info().nbytes, 2400)
+
+    # Least recently used entries are evicted first
+    t.cache_get("matrix", 0)
+    t.cache_set("matrix", 3, b)
+    assert_(t.cache_get("matrix", 1) is None)
+    assert_(t.cache_get("matrix", 2) is None)
+    assert_(t.cache_get("matrix", 0) is a)
+    assert_(t.cache_get("matrix", 3) is b)
+    assert_equal(t.cache_info().nbytes, 2400)
+
+    # Values larger than the budget are not cached
+    t.cache_set("matrix", 4, np.zeros(1000))
+    assert_(t.cache_get("matrix", 4) is None)
+    assert_equal(t.cache_info().currsize, 2)
+
+    info = t.cache_info()
+    assert_equal((info.hits, info.misses), (3, 3))
+    assert_equal(info.max_nbytes, 3000)
+
+    t.cache_clear()
+    assert_equal(t.cache_info(), (0, 0, 0, 0, 3000))
+
+    # No limit
+    t.cache_max_nbytes = None
+    for i in range(10):
+        t.cache_set("matrix", i, b)
+    assert_equal(t.cache_info().nbytes, 16000)
+
+
+def test_cache_threads():
+    t = DummyModel()
+    t.cache_max_nbytes = 10 * 800
+    a = np.zeros(100)
+
+    # Entries are evicted while other threads look them up
+    def use_cache(start):
+        for i in range(start, start + 2000):
+            t.cache_set("matrix", i % 50, a)
+            t.cache_get("matrix", (i + 25) % 50)
+
+    threads = [threading.Thread(target=use_cache, args=(i * 7,))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    info = t.cache_info()
+    assert_equal(info.hits + info.misses, 8000)
+    assert_equal(info.nbytes, info.currsize * 800)
+    assert_(info.nbytes <= t.cache_max_nbytes)
+
+    # Models holding a cache can still be pickled
+    t2 = pickle.loads(pickle.dumps(t))
+    assert_equal(t2.cache_info(), info)
+    assert_(t2._cache_lock is not t._cache_lock)
+
+
+def test_disk_cache():
+    s1 = Sphere(theta=[0, 1], phi=[0, 2])
+    s2 = Sphere(theta=[0, 1], phi=[0, 2])
+    value = np.arange(12.).reshape((3, 4))
+    with TemporaryDirectory() as cache_dir:
+        cache = DiskCache(os.path.join(cache_dir, 'sub'))
+        assert_(cache.get("basis", (s1, 8)) is None)
+        stored = cache.set("basis", (s1, 8), value)
+        assert_equal(stored, value)
+        cached = cache.get("basis", (s2, 8))
+        assert_(isinstance(cached, np.memmap))
+        assert_equal(cached, value)
+        assert_(cache.get("basis", (s2, 6)) is None)
+        assert_(cache.get("other", (s2, 8)) is None)
+
+        # Another cache on the same directory shares the arrays
+        assert_equal(DiskCache(cache.cache_dir).get("basis", (s1, 8)), value)
+
+        cache.set("other", (s1, 8), value)
+        assert_equal(cache.nbytes() > 2 * value.nbytes, True)
+        cache.clear("basis")
+        assert_(cache.get("basis", (s1, 8)) is None)
+        assert_equal(cache.get("other", (s1, 8)), value)
+        cache.clear()
+        assert_equal(os.listdir(cache.cache_dir), [])
+
+
 if __name__ == "__main__":
     run_module_suite()
@@ -13,6 +13,8 @@ from dipy.sims.voxel import (multi_tensor,
 from dipy.core.gradients import gradient_table
 from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    ConstrainedSDTModel,
+                                   csdeconv,
+                                   csdeconv_batch,
                                    forward_sdeconv_mat,
                                    odf_deconv,
                                    odf_sh_to_sharp,
@@ -26,7 +28,7 @@ from dipy.core.sphere import HemiSphere
 from dipy.core.sphere_stats import angular_similarity
 from dipy.reconst.dti import TensorModel, fractional_anisotropy
 from dipy.reconst.shm import (QballModel, sf_to_sh, sh_to_sf,
-                              real_sym_sh_basis, sph_harm_ind_list)
+                              real_sym_sh_basis, sph_harm_ind_list, SphHarmFit)
 from dipy.reconst.shm import lazy_index
 import dipy.reconst.dti as dti
 from dipy.core.sphere import Sphere
@@ -501,6 +503,14 @@ def test_csd_predict_multi():
     pred_multi = csd_fit_multi.predict(S0=S0_multi)
     npt.assert_array_almost_equal(pred_multi, multi_S)
 
+    # Coefficients are stored in one array, fits are built on indexing
+    npt.assert_equal(csd_fit_multi.model_params.shape, (2, 2, 45))
+    voxel_fit = csd_fit_multi[1, 0]
+    assert_(isinstance(voxel_fit, SphHarmFit))
+    npt.assert_array_almost_equal(voxel_fit.shm_coeff,
+                                  csd_fit_multi.shm_coeff[1, 0])
+    npt.assert_array_almost_equal(voxel_fit.predict(S0=S0_multi[1, 0]), S)
+
 
 def test_sphere_scaling_csdmodel():
     """Check that mirroring regularization sphere does not change the result of
@@ -618,5 +628,51 @@ def test_csd_convergence():
     assert_equal(model_w_conv.fit(S).shm_coeff, model_wo_conv.fit(S).shm_coeff)
 
 
+def test_csdeconv_batch():
+    _, fbvals, fbvecs = get_fnames('small_64D')
+    bvals, bvecs = read_bvals_bvecs(fbvals, fbvecs)
+    gtab = gradient_table(bvals, bvecs)
+    evals = np.array([0.0015, 0.0003, 0.0003])
+    csd = ConstrainedSphericalDeconvModel(gtab, (evals, 1.))
+
+    rng = np.random.RandomState(1234)
+    signals = []
+    for i in range(30):
+        angles = [(rng.uniform(0, 90), rng.uniform(0, 360)),
+                  (rng.uniform(0, 90), rng.uniform(0, 360))]
+        S, _ = multi_tensor(gtab, np.array([evals, evals]), 1., angles=angles,
+                            fractions=[50, 50], snr=rng.choice([None, 20]))
+        signals.append(S)
+    signals = np.array(signals)
+    dwi = signals[:, ~gtab.b0s_mask]
+
+    fodf_sh, num_it = csdeconv_batch(dwi, csd._X, csd.B_reg, csd.tau,
+                                     convergence=csd.convergence, P=csd._P)
+    npt.assert_equal(fodf_sh.shape, (30, 45))
+    for i in range(len(dwi)):
+        expected, expected_it = csdeconv(dwi[i], csd._X, csd.B_reg, csd.tau,
+                                         convergence=csd.convergence,
+                                         P=csd._P)
+        npt.assert_array_almost_equal(fodf_sh[i], expected)
+        npt.assert_equal(num_it[i], expected_it)
+
+    # The result does not depend on the number of threads
+    for num_threads in [1, 2]:
+        fodf_sh_t, num_it_t = csdeconv_batch(dwi, csd._X, csd.B_reg, csd.tau,
+                                             convergence=csd.convergence,
+                                             P=csd._P,
+                                             num_threads=num_threads)
+        npt.assert_array_equal(fodf_sh_t, fodf_sh)
+        npt.assert_array_equal(num_it_t, num_it)
+
+    # The model fits blocks of voxels with the batched solver
+    csd.batch_size = 7
+    csd_fit = csd.fit(signals.reshape((5, 6, -1)))
+    npt.assert_array_almost_equal(csd_fit.shm_coeff.reshape((30, -1)),
+                                  fodf_sh)
+    npt.assert_array_almost_equal(csd_fit.shm_coeff[2, 3],
+                                  csd.fit(signals[15]).shm_coeff)
+
+
 if __name__ == '__main__':
     run_module_suite()
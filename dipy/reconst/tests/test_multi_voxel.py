@@ -4,7 +4,8 @@ from functools import reduce
 import numpy as np
 import numpy.testing as npt
 
-from dipy.reconst.multi_voxel import _squash, multi_voxel_fit, CallableArray
+from dipy.reconst.multi_voxel import (_squash, multi_voxel_fit, CallableArray,
+                                     MultiVoxelFit, ParamsMultiVoxelFit)
 from dipy.core.sphere import unit_icosahedron
 
 
@@ -174,3 +175,160 @@ def test_multi_voxel_fit():
     # Test indexing into a fit
     npt.assert_equal(type(fit[0, 0, 0]), SillyFit)
     npt.assert_equal(fit[:2, :2, :2].shape, (2, 2, 2))
+
+
+class _SumModel(object):
+    """Module level model so that it can be sent to worker processes"""
+
+    @multi_voxel_fit
+    def fit(self, data):
+        return _SumFit(self, data.sum())
+
+
+class _SumFit(object):
+
+    def __init__(self, model, total):
+        self.model = model
+        self.total = total
+
+    def odf(self, sphere):
+        return np.ones(len(sphere.vertices)) * self.total
+
+
+def test_multi_voxel_fit_engines():
+    rng = np.random.RandomState(1234)
+    data = rng.rand(4, 5, 3, 16)
+    mask = rng.rand(4, 5, 3) > 0.3
+    model = _SumModel()
+
+    expected = model.fit(data, mask=mask)
+    for engine in ['thread', 'process']:
+        for vox_per_chunk in [None, 1, 7, 1000]:
+            fit = model.fit(data, mask=mask, engine=engine, n_jobs=2,
+                            vox_per_chunk=vox_per_chunk)
+            npt.assert_equal(fit.shape, expected.shape)
+            npt.assert_array_equal(fit.total, expected.total)
+            npt.assert_array_equal(fit.odf(unit_icosahedron),
+                                   expected.odf(unit_icosahedron))
+            npt.assert_(fit.fit_array[~mask].tolist() ==
+                        [None] * (~mask).sum())
+            npt.assert_(fit[mask.nonzero()[0][0], mask.nonzero()[1][0],
+                            mask.nonzero()[2][0]].model is model)
+
+    # Without a mask every voxel is fitted
+    fit = model.fit(data, engine='thread', n_jobs=3)
+    npt.assert_array_almost_equal(fit.total, data.sum(-1))
+
+    npt.assert_raises(ValueError, model.fit, data, mask=mask,
+                      engine='gpu')
+
+
+class _BatchModel(object):
+    """Model fitting many voxels at once, recording its threads"""
+
+    def __init__(self):
+        self.num_threads = []
+
+    @multi_voxel_fit(batch_fit='_fit_batch')
+    def fit(self, data):
+        return _SumFit(self, data.sum())
+
+    def _fit_batch(self, data, num_threads=None):
+        self.num_threads.append(num_threads)
+        return [_SumFit(self, total) for total in data.sum(-1)]
+
+
+def test_multi_voxel_batch_fit():
+    rng = np.random.RandomState(1234)
+    data = rng.rand(4, 5, 3, 16)
+    mask = rng.rand(4, 5, 3) > 0.3
+
+    # Every engine fits each batch of voxels on one thread
+    for engine in ['serial', 'thread']:
+        model = _BatchModel()
+        fit = model.fit(data, mask=mask, engine=engine, n_jobs=2)
+        npt.assert_array_almost_equal(fit.total[mask], data.sum(-1)[mask])
+        npt.assert_(len(model.num_threads) > 0)
+        npt.assert_equal(set(model.num_threads), {1})
+
+
+class _ParamsModel(object):
+
+    @multi_voxel_fit
+    def fit(self, data):
+        return _ParamsFit(self, np.array([data.mean(), data.max()]))
+
+
+class _ParamsFit(object):
+
+    def __init__(self, model, model_params):
+        self.model = model
+        self.model_params = model_params
+
+    @classmethod
+    def from_model_params(cls, model, model_params):
+        return cls(model, model_params)
+
+    @property
+    def mean(self):
+        return self.model_params[..., 0]
+
+    def odf(self, sphere):
+        return self.model_params[..., 1:] * np.ones(len(sphere.vertices))
+
+    def predict(self, S0=1.):
+        return np.asarray(S0)[..., None] * self.model_params
+
+
+def test_params_multi_voxel_fit():
+    rng = np.random.RandomState(42)
+    data = rng.rand(4, 3, 5, 10)
+    mask = rng.rand(4, 3, 5) > 0.4
+    model = _ParamsModel()
+
+    for engine in ['serial', 'thread', 'process']:
+        fit = model.fit(data, mask=mask, engine=engine, n_jobs=2)
+        npt.assert_(isinstance(fit, ParamsMultiVoxelFit))
+        npt.assert_(isinstance(fit, MultiVoxelFit))
+        npt.assert_equal(fit.shape, mask.shape)
+        npt.assert_equal(fit.model_params.shape, mask.shape + (2,))
+
+        mean = np.where(mask, data.mean(-1), 0)
+        npt.assert_array_almost_equal(fit.mean, mean)
+        odf = fit.odf(unit_icosahedron)
+        npt.assert_equal(odf.shape, mask.shape + (12,))
+        npt.assert_array_almost_equal(odf[mask],
+                                      data[mask].max(-1)[:, None] *
+                                      np.ones(12))
+        npt.assert_array_equal(odf[~mask], 0)
+
+        S0 = rng.rand(*mask.shape)
+        pred = fit.predict(S0=S0)
+        npt.assert_array_almost_equal(pred[mask],
+                                      S0[mask][:, None] *
+                                      fit.model_params[mask])
+        npt.assert_array_equal(pred[~mask], 0)
+        npt.assert_array_almost_equal(fit.predict(S0=2.),
+                                      2 * fit.model_params)
+
+    # Results don't depend on the size of the batches
+    fit.batch_size = 3
+    npt.assert_array_almost_equal(fit.mean, mean)
+
+    # Per voxel fits are only built on indexing
+    i, j, k = np.argwhere(mask)[0]
+    voxel = fit[i, j, k]
+    npt.assert_(isinstance(voxel, _ParamsFit))
+    npt.assert_array_almost_equal(voxel.model_params,
+                                  [data[i, j, k].mean(), data[i, j, k].max()])
+    i, j, k = np.argwhere(~mask)[0]
+    npt.assert_(fit[i, j, k] is None)
+    sub = fit[:2, :2]
+    npt.assert_(isinstance(sub, ParamsMultiVoxelFit))
+    npt.assert_array_almost_equal(sub.mean, mean[:2, :2])
+    npt.assert_equal(fit.fit_array.shape, mask.shape)
+    npt.assert_(fit.fit_array[i, j, k] is None)
+
+    # An empty mask gives an empty fit
+    fit = model.fit(data, mask=np.zeros(mask.shape, bool))
+    npt.assert_array_equal(fit.fit_array, None)
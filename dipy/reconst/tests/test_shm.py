@@ -1,5 +1,6 @@
 """Test spherical harmonic models and the tools associated with those models.
 """
+import os
 import warnings
 import numpy as np
 import numpy.linalg as npl
@@ -14,7 +15,9 @@ from dipy.core.gradients import gradient_table
 from dipy.core.interpolation import NearestNeighborInterpolator
 from dipy.sims.voxel import single_tensor
 from dipy.direction.peaks import peak_directions
-from dipy.reconst.shm import sf_to_sh, sh_to_sf
+from dipy.reconst.shm import sf_to_sh, sh_to_sf, sh_to_sf_matrix
+from dipy.reconst.cache import set_disk_cache_dir
+from nibabel.tmpdirs import TemporaryDirectory
 from dipy.sims.voxel import multi_tensor_odf
 from dipy.data import mrtrix_spherical_functions
 from dipy.reconst import odf
@@ -384,6 +387,34 @@ def test_sf_to_sh():
     assert_array_almost_equal(odf2d, odf2d_sf, 2)
 
 
+def test_sh_matrices_disk_cache():
+    sphere = hemi_icosahedron.subdivide(2)
+    odf = np.random.RandomState(0).rand(3, len(sphere.vertices))
+    expected_sh = sf_to_sh(odf, sphere, 8, smooth=0.006)
+    expected_B, expected_invB = sh_to_sf_matrix(sphere, 8, "tournier07")
+
+    with TemporaryDirectory() as cache_dir:
+        set_disk_cache_dir(cache_dir)
+        try:
+            for i in range(2):
+                # The second time, matrices are read from the disk cache
+                assert_array_almost_equal(sf_to_sh(odf, sphere, 8,
+                                                   smooth=0.006),
+                                          expected_sh)
+                B, invB = sh_to_sf_matrix(sphere, 8, "tournier07")
+                assert_array_almost_equal(B, expected_B)
+                assert_array_almost_equal(invB, expected_invB)
+                assert_true(isinstance(B, np.memmap))
+                assert_array_almost_equal(
+                    sh_to_sf(expected_sh, sphere, 8),
+                    np.dot(expected_sh, sh_to_sf_matrix(sphere, 8,
+                                                        return_inv=False)))
+            # one basis matrix and one inverse for each basis
+            assert_equal(len(os.listdir(cache_dir)), 4)
+        finally:
+            set_disk_cache_dir(None)
+
+
 def test_faster_sph_harm():
 
     sh_order = 8
@@ -1,16 +1,19 @@
 import random
 from collections.abc import Iterable
+from itertools import islice
 
 import numpy as np
 
-from dipy.tracking.localtrack import local_tracker, pft_tracker
-from dipy.tracking.stopping_criterion import (AnatomicalStoppingCriterion,
-                                              StreamlineStatus)
-from dipy.tracking import utils
+from dipy.tracking.localtrack import local_tracker_batch, pft_tracker_batch
+from dipy.tracking.stopping_criterion import AnatomicalStoppingCriterion
+from dipy.utils.parallel import determine_num_jobs, paramap
 
 
 class LocalTracking(object):
 
+    #: Number of seeds sent at once to a worker when tracking in parallel
+    seeds_per_chunk = 256
+
     @staticmethod
     def _get_voxel_size(affine):
         """Computes the voxel sizes of an image from the affine.
@@ -31,7 +34,8 @@ class LocalTracking(object):
 
     def __init__(self, direction_getter, stopping_criterion, seeds, affine,
                  step_size, max_cross=None, maxlen=500, fixedstep=True,
-                 return_all=True, random_seed=None, save_seeds=False):
+                 return_all=True, random_seed=None, save_seeds=False,
+                 n_jobs=1, ordered=True):
         """Creates streamlines by using local fiber-tracking.
 
         Parameters
@@ -69,6 +73,22 @@ class LocalTracking(object):
             random.seed).
         save_seeds : bool
             If True, return seeds alongside streamlines
+        n_jobs : int
+            Number of processes tracking seeds in parallel. Each process
+            tracks with its own copy of the direction getter and stopping
+            criterion. If None or 0, all cpus are used, negative values are
+            counted backwards from the number of cpus. Parallel tracking
+            relies on the 'fork' start method of multiprocessing (the default
+            on Linux). By default, seeds are tracked serially.
+        ordered : bool
+            If True, streamlines are returned in the order of the seeds,
+            otherwise they are returned in chunks of seeds as soon as they
+            are tracked. Only used when tracking in parallel.
+
+        Notes
+        -----
+        When `random_seed` is set, each seed is tracked with its own random
+        state, so that the same streamlines are returned for any `n_jobs`.
         """
 
         self.direction_getter = direction_getter
@@ -93,75 +113,69 @@ class LocalTracking(object):
         self.return_all = return_all
         self.random_seed = random_seed
         self.save_seeds = save_seeds
-
-    def _tracker(self, seed, first_step, streamline):
-        return local_tracker(self.direction_getter,
-                             self.stopping_criterion,
-                             seed,
-                             first_step,
-                             self._voxel_size,
-                             streamline,
-                             self.step_size,
-                             self.fixed_stepsize)
+        self.n_jobs = determine_num_jobs(n_jobs)
+        self.ordered = ordered
 
     def __iter__(self):
-        # Make tracks, move them to point space and return
-        track = self._generate_streamlines()
-
-        return utils.transform_tracking_output(track, self.affine,
-                                               save_seeds=self.save_seeds)
+        return self._generate_streamlines()
 
     def _generate_streamlines(self):
         """A streamline generator"""
-
-        # Get inverse transform (lin/offset) for seeds
-        inv_A = np.linalg.inv(self.affine)
-        lin = inv_A[:3, :3]
-        offset = inv_A[:3, 3]
-
-        F = np.empty((self.max_length + 1, 3), dtype=float)
-        B = F.copy()
-        for s in self.seeds:
-            s = np.dot(lin, s) + offset
-            # Set the random seed in numpy and random
-            if self.random_seed is not None:
-                s_random_seed = hash(np.abs((np.sum(s)) + self.random_seed)) \
-                    % (2**32 - 1)
-                random.seed(s_random_seed)
-                np.random.seed(s_random_seed)
-            directions = self.direction_getter.initial_direction(s)
-            if directions.size == 0 and self.return_all:
-                # only the seed position
+        if self.n_jobs == 1:
+            blocks = self._track_blocks(self.seeds)
+        else:
+            chunks = _seed_chunks(self.seeds, self.seeds_per_chunk)
+            blocks = paramap(_track_seed_chunk, chunks, engine='process',
+                             n_jobs=self.n_jobs, ordered=self.ordered,
+                             initializer=_init_tracking_worker,
+                             initargs=(self,))
+        # Each streamline is a view of the points of its block
+        for points, offsets, lengths, seeds in blocks:
+            for start, length, seed in zip(offsets, lengths, seeds):
+                streamline = points[start:start + length]
                 if self.save_seeds:
-                    yield [s], s
+                    yield streamline, seed
                 else:
-                    yield [s]
-            directions = directions[:self.max_cross]
-            for first_step in directions:
-                stepsF, stream_status = self._tracker(s, first_step, F)
-                if not (self.return_all or
-                        stream_status == StreamlineStatus.ENDPOINT or
-                        stream_status == StreamlineStatus.OUTSIDEIMAGE):
-                    continue
-                first_step = -first_step
-                stepsB, stream_status = self._tracker(s, first_step, B)
-                if not (self.return_all or
-                        stream_status == StreamlineStatus.ENDPOINT or
-                        stream_status == StreamlineStatus.OUTSIDEIMAGE):
-                    continue
-                if stepsB == 1:
-                    streamline = F[:stepsF].copy()
-                else:
-                    parts = (B[stepsB - 1:0:-1], F[:stepsF])
-                    streamline = np.concatenate(parts, axis=0)
+                    yield streamline
+
+    def _tracker_batch(self, seeds):
+        return local_tracker_batch(self.direction_getter,
+                                   self.stopping_criterion,
+                                   seeds,
+                                   self._voxel_size,
+                                   self.max_length,
+                                   self.step_size,
+                                   self.fixed_stepsize,
+                                   self.max_cross,
+                                   self.return_all,
+                                   self.random_seed)
+
+    def _track_blocks(self, seeds):
+        """Track streamlines from blocks of seed points, in order
 
-                # move to the next streamline if only the seed position
-                # and not return all
-                if len(streamline) > 1 or self.return_all:
-                    if self.save_seeds:
-                        yield streamline, s
-                    else:
-                        yield streamline
+        Yields the points of the streamlines of each block of
+        `seeds_per_chunk` seeds, in point space, with the offsets and
+        lengths of the streamlines in the points and the seed of each
+        streamline.
+        """
+        inv_A = np.linalg.inv(self.affine)
+        inv_lin = inv_A[:3, :3]
+        inv_offset = inv_A[:3, 3]
+        lin_T = self.affine[:3, :3].T
+        offset = self.affine[:3, 3]
+        for seed_block in _seed_chunks(seeds, self.seeds_per_chunk):
+            # The seeds are moved one at a time, as the random generators
+            # are seeded from their exact position
+            seed_block = np.array([np.dot(inv_lin, s) + inv_offset
+                                   for s in seed_block])
+            points, offsets, lengths, seed_ids = \
+                self._tracker_batch(seed_block)
+            # Streamlines and seeds are moved to point space for the whole
+            # block at once
+            points = np.dot(points, lin_T)
+            points += offset
+            seed_block = np.dot(seed_block[seed_ids], lin_T) + offset
+            yield points, offsets, lengths, seed_block
 
 
 class ParticleFilteringTracking(LocalTracking):
@@ -170,7 +184,8 @@ class ParticleFilteringTracking(LocalTracking):
                  step_size, max_cross=None, maxlen=500,
                  pft_back_tracking_dist=2, pft_front_tracking_dist=1,
                  pft_max_trial=20, particle_count=15, return_all=True,
-                 random_seed=None, save_seeds=False):
+                 random_seed=None, save_seeds=False, n_jobs=1,
+                 ordered=True):
         r"""A streamline generator using the particle filtering tractography
         method [1]_.
 
@@ -221,6 +236,13 @@ class ParticleFilteringTracking(LocalTracking):
             random.seed).
         save_seeds : bool
             If True, return seeds alongside streamlines
+        n_jobs : int
+            Number of processes tracking seeds in parallel (see
+            :class:`LocalTracking`). By default, seeds are tracked serially.
+        ordered : bool
+            If True, streamlines are returned in the order of the seeds,
+            otherwise they are returned in chunks of seeds as soon as they
+            are tracked. Only used when tracking in parallel.
 
 
         References
@@ -248,19 +270,8 @@ class ParticleFilteringTracking(LocalTracking):
         if particle_count <= 0:
             raise ValueError("The particle count must be greater than 0.")
 
-        self.directions = np.empty((maxlen + 1, 3), dtype=float)
-
         self.pft_max_trial = pft_max_trial
         self.particle_count = particle_count
-        self.particle_paths = np.empty((2, self.particle_count,
-                                        pft_max_steps + 1, 3),
-                                       dtype=float)
-        self.particle_weights = np.empty(self.particle_count, dtype=float)
-        self.particle_dirs = np.empty((2, self.particle_count,
-                                       pft_max_steps + 1, 3), dtype=float)
-        self.particle_steps = np.empty((2, self.particle_count), dtype=int)
-        self.particle_stream_statuses = np.empty((2, self.particle_count),
-                                                 dtype=int)
         super(ParticleFilteringTracking, self).__init__(direction_getter,
                                                         stopping_criterion,
                                                         seeds,
@@ -271,23 +282,54 @@ class ParticleFilteringTracking(LocalTracking):
                                                         True,
                                                         return_all,
                                                         random_seed,
-                                                        save_seeds)
-
-    def _tracker(self, seed, first_step, streamline):
-        return pft_tracker(self.direction_getter,
-                           self.stopping_criterion,
-                           seed,
-                           first_step,
-                           self._voxel_size,
-                           streamline,
-                           self.directions,
-                           self.step_size,
-                           self.pft_max_nbr_back_steps,
-                           self.pft_max_nbr_front_steps,
-                           self.pft_max_trial,
-                           self.particle_count,
-                           self.particle_paths,
-                           self.particle_dirs,
-                           self.particle_weights,
-                           self.particle_steps,
-                           self.particle_stream_statuses)
+                                                        save_seeds,
+                                                        n_jobs,
+                                                        ordered)
+
+    def _tracker_batch(self, seeds):
+        return pft_tracker_batch(self.direction_getter,
+                                 self.stopping_criterion,
+                                 seeds,
+                                 self._voxel_size,
+                                 self.max_length,
+                                 self.step_size,
+                                 self.pft_max_nbr_back_steps,
+                                 self.pft_max_nbr_front_steps,
+                                 self.pft_max_trial,
+                                 self.particle_count,
+                                 self.max_cross,
+                                 self.return_all,
+                                 self.random_seed)
+
+
+def _seed_chunks(seeds, seeds_per_chunk):
+    """Split an iterable of seeds in arrays of `seeds_per_chunk` seeds"""
+    seeds = iter(seeds)
+    while True:
+        chunk = list(islice(seeds, seeds_per_chunk))
+        if not chunk:
+            return
+        yield np.asarray(chunk, dtype=float)
+
+
+_worker_tracking = None
+
+
+def _init_tracking_worker(tracking):
+    """Keep the tracking object of the worker process.
+
+    With the fork start method, the tracking object (with its direction
+    getter, stopping criterion and buffers) is inherited by each worker
+    instead of being pickled.
+    """
+    global _worker_tracking
+    _worker_tracking = tracking
+    if tracking.random_seed is None:
+        # Forked workers inherit the same random state, draw a new one
+        random.seed()
+        np.random.seed()
+
+
+def _track_seed_chunk(seeds):
+    # A chunk of seeds is tracked as a single block
+    return next(_worker_tracking._track_blocks(seeds))
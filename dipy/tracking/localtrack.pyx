@@ -1,5 +1,5 @@
 
-from random import random
+from random import random, seed as random_seed_module
 
 cimport cython
 cimport numpy as np
@@ -506,3 +506,265 @@ cdef _pft(np.float_t[:, :] streamline,
         copy_point(&particle_dirs[0, p, s, 0], &directions[streamline_i + s, 0])
     stream_status[0] = <StreamlineStatus> particle_stream_statuses[0, p]
     return streamline_i + particle_steps[0, p]
+
+
+def local_tracker_batch(
+        DirectionGetter dg,
+        StoppingCriterion sc,
+        np.float_t[:, :] seeds,
+        np.float_t[:] voxel_size,
+        int max_length,
+        double step_size,
+        int fixedstep,
+        max_cross=None,
+        int return_all=True,
+        random_seed=None):
+    """Tracks all directions from a block of seeds.
+
+    Streamlines are tracked as in ``LocalTracking`` and written one after the
+    other into a flat array of points, in the layout of ``ArraySequence``.
+
+    The tracking holds the GIL: the direction getters and stopping criteria
+    are extension types that can call Python code, e.g. the ``random``
+    module of the probabilistic direction getters. Seeds are tracked in
+    parallel by processes (see ``LocalTracking``).
+
+    Parameters
+    ----------
+    dg : DirectionGetter
+        Used to choosing tracking directions.
+    sc : StoppingCriterion
+        Used to check the streamline status (e.g. endpoint) along path.
+    seeds : array, float, 2d, (N, 3)
+        Seed points, in voxel coordinates.
+    voxel_size : array, float, 1d, (3,)
+        Size of voxels in the data set.
+    max_length : int
+        Maximum number of steps to track from a seed in each direction.
+    step_size : float
+        Size of tracking steps in mm if ``fixed_step``.
+    fixedstep : bool
+        If true, a fixed step_size is used, otherwise a variable step size is
+        used.
+    max_cross : int or None
+        The maximum number of directions to track from each seed. By default
+        all initial directions are tracked.
+    return_all : bool
+        If true, return all streamlines, otherwise only streamlines reaching
+        end points or exiting the image.
+    random_seed : int or None
+        If not None, the random generators are seeded for each seed from its
+        position and `random_seed`, as in ``LocalTracking``.
+
+    Returns
+    -------
+    points : array, float, 2d, (P, 3)
+        Points of all streamlines, one after the other.
+    offsets : array, int, 1d, (S,)
+        Index of the first point of each streamline in `points`.
+    lengths : array, int, 1d, (S,)
+        Number of points of each streamline.
+    seed_ids : array, int, 1d, (S,)
+        Index of the seed of each streamline.
+    """
+    cdef:
+        np.float_t[:, :, :, :] no_paths = np.empty((0, 0, 0, 0))
+        np.float_t[:] no_weights = np.empty(0)
+        np.int_t[:, :] no_steps = np.empty((0, 0), dtype=int)
+
+    return _tracker_batch(dg, sc, seeds, voxel_size, max_length, step_size,
+                          fixedstep, max_cross, return_all, random_seed,
+                          False, 0, 0, 0, 0, no_paths, no_paths, no_weights,
+                          no_steps, no_steps)
+
+
+def pft_tracker_batch(
+        DirectionGetter dg,
+        AnatomicalStoppingCriterion sc,
+        np.float_t[:, :] seeds,
+        np.float_t[:] voxel_size,
+        int max_length,
+        double step_size,
+        int pft_max_nbr_back_steps,
+        int pft_max_nbr_front_steps,
+        int pft_max_trials,
+        int particle_count,
+        max_cross=None,
+        int return_all=True,
+        random_seed=None):
+    """Tracks all directions from a block of seeds using the particle
+    filtering algorithm.
+
+    Streamlines are tracked as in ``ParticleFilteringTracking`` and written
+    one after the other into a flat array of points, in the layout of
+    ``ArraySequence``. See ``pft_tracker`` and ``local_tracker_batch`` for
+    the description of the parameters and of the returned arrays.
+    """
+    cdef:
+        int pft_max_steps = pft_max_nbr_back_steps + pft_max_nbr_front_steps
+
+    particle_paths = np.empty((2, particle_count, pft_max_steps + 1, 3))
+    particle_dirs = np.empty((2, particle_count, pft_max_steps + 1, 3))
+    particle_weights = np.empty(particle_count)
+    particle_steps = np.empty((2, particle_count), dtype=int)
+    particle_stream_statuses = np.empty((2, particle_count), dtype=int)
+    return _tracker_batch(dg, sc, seeds, voxel_size, max_length, step_size,
+                          True, max_cross, return_all, random_seed, True,
+                          pft_max_nbr_back_steps, pft_max_nbr_front_steps,
+                          pft_max_trials, particle_count, particle_paths,
+                          particle_dirs, particle_weights, particle_steps,
+                          particle_stream_statuses)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _tracker_batch(DirectionGetter dg,
+                    StoppingCriterion sc,
+                    np.float_t[:, :] seeds,
+                    np.float_t[:] voxel_size,
+                    int max_length,
+                    double step_size,
+                    int fixedstep,
+                    max_cross,
+                    int return_all,
+                    random_seed,
+                    int pft,
+                    int pft_max_nbr_back_steps,
+                    int pft_max_nbr_front_steps,
+                    int pft_max_trials,
+                    int particle_count,
+                    np.float_t[:, :, :, :] particle_paths,
+                    np.float_t[:, :, :, :] particle_dirs,
+                    np.float_t[:] particle_weights,
+                    np.int_t[:, :] particle_steps,
+                    np.int_t[:, :] particle_stream_statuses):
+    cdef:
+        Py_ssize_t i, j, k, d, n_dirs, n_points, n_streamlines, capacity
+        Py_ssize_t stepsF, stepsB, length, k2
+        AnatomicalStoppingCriterion pft_sc = None
+        StreamlineStatus stream_status
+        double dir[3]
+        double vs[3]
+        double seed[3]
+        np.float_t[:, :] F, B, directions, out_view
+        const np.float_t[:, :] initial_dirs
+        np.intp_t[:] offsets_view, lengths_view, seed_ids_view
+
+    if seeds.shape[1] != 3 or voxel_size.shape[0] != 3:
+        raise ValueError('Invalid input parameter dimensions.')
+    if pft:
+        if not isinstance(sc, AnatomicalStoppingCriterion):
+            raise ValueError("expecting AnatomicalStoppingCriterion")
+        pft_sc = <AnatomicalStoppingCriterion> sc
+
+    for d in range(3):
+        vs[d] = voxel_size[d]
+    F = np.empty((max_length + 1, 3))
+    B = np.empty((max_length + 1, 3))
+    directions = np.empty((max_length + 1, 3))
+    seed_arr = np.empty(3)
+
+    # The flat buffers grow geometrically as streamlines are added
+    capacity = max(seeds.shape[0] * 8, 1024)
+    out = np.empty((capacity, 3))
+    out_view = out
+    offsets = np.empty(seeds.shape[0] + 16, dtype=np.intp)
+    lengths = np.empty_like(offsets)
+    seed_ids = np.empty_like(offsets)
+    offsets_view = offsets
+    lengths_view = lengths
+    seed_ids_view = seed_ids
+    n_points = 0
+    n_streamlines = 0
+
+    for i in range(seeds.shape[0]):
+        for d in range(3):
+            seed[d] = seeds[i, d]
+            seed_arr[d] = seed[d]
+        if random_seed is not None:
+            s_random_seed = hash(np.abs((np.sum(seed_arr)) + random_seed)) \
+                % (2**32 - 1)
+            random_seed_module(s_random_seed)
+            np.random.seed(s_random_seed)
+        initial_dirs = dg.initial_direction(seed_arr)
+        n_dirs = initial_dirs.shape[0]
+        if max_cross is not None:
+            n_dirs = min(n_dirs, max_cross)
+
+        # Each seed adds at most one streamline per direction, or the seed
+        if n_streamlines + max(n_dirs, 1) > offsets.shape[0]:
+            new_size = 2 * offsets.shape[0] + n_dirs
+            offsets = np.resize(offsets, new_size)
+            lengths = np.resize(lengths, new_size)
+            seed_ids = np.resize(seed_ids, new_size)
+            offsets_view = offsets
+            lengths_view = lengths
+            seed_ids_view = seed_ids
+        if n_points + max(n_dirs, 1) * (2 * max_length + 1) > capacity:
+            capacity = max(2 * capacity,
+                           n_points + max(n_dirs, 1) * (2 * max_length + 1))
+            new_out = np.empty((capacity, 3))
+            new_out[:n_points] = out[:n_points]
+            out = new_out
+            out_view = out
+
+        if initial_dirs.shape[0] == 0 and return_all:
+            # only the seed position
+            copy_point(seed, &out_view[n_points, 0])
+            offsets_view[n_streamlines] = n_points
+            lengths_view[n_streamlines] = 1
+            seed_ids_view[n_streamlines] = i
+            n_points += 1
+            n_streamlines += 1
+
+        for k in range(n_dirs):
+            for d in range(3):
+                dir[d] = initial_dirs[k, d]
+            if pft:
+                stepsF = _pft_tracker(
+                    dg, pft_sc, seed, dir, vs, F, directions, step_size,
+                    &stream_status, pft_max_nbr_back_steps,
+                    pft_max_nbr_front_steps, pft_max_trials, particle_count,
+                    particle_paths, particle_dirs, particle_weights,
+                    particle_steps, particle_stream_statuses)
+            else:
+                stepsF = _local_tracker(dg, sc, seed, dir, vs, F, step_size,
+                                        fixedstep, &stream_status)
+            if not (return_all or stream_status == ENDPOINT or
+                    stream_status == OUTSIDEIMAGE):
+                continue
+            for d in range(3):
+                dir[d] = -initial_dirs[k, d]
+            if pft:
+                stepsB = _pft_tracker(
+                    dg, pft_sc, seed, dir, vs, B, directions, step_size,
+                    &stream_status, pft_max_nbr_back_steps,
+                    pft_max_nbr_front_steps, pft_max_trials, particle_count,
+                    particle_paths, particle_dirs, particle_weights,
+                    particle_steps, particle_stream_statuses)
+            else:
+                stepsB = _local_tracker(dg, sc, seed, dir, vs, B, step_size,
+                                        fixedstep, &stream_status)
+            if not (return_all or stream_status == ENDPOINT or
+                    stream_status == OUTSIDEIMAGE):
+                continue
+
+            # The backward part is reversed, without its copy of the seed
+            length = stepsF + max(stepsB, 1) - 1
+            if length <= 1 and not return_all:
+                continue
+            j = n_points
+            for k2 in range(stepsB - 1, 0, -1):
+                copy_point(&B[k2, 0], &out_view[j, 0])
+                j += 1
+            for k2 in range(stepsF):
+                copy_point(&F[k2, 0], &out_view[j, 0])
+                j += 1
+            offsets_view[n_streamlines] = n_points
+            lengths_view[n_streamlines] = j - n_points
+            seed_ids_view[n_streamlines] = i
+            n_points = j
+            n_streamlines += 1
+
+    return (out[:n_points], offsets[:n_streamlines].copy(),
+            lengths[:n_streamlines].copy(), seed_ids[:n_streamlines].copy())
@@ -14,6 +14,7 @@ from dipy.direction import (BootDirectionGetter,
 from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
 from dipy.tracking.local_tracking import (LocalTracking,
                                           ParticleFilteringTracking)
+from dipy.tracking.localtrack import local_tracker, local_tracker_batch
 from dipy.tracking.streamline import Streamlines
 from dipy.tracking.stopping_criterion import (ActStoppingCriterion,
                                               BinaryStoppingCriterion,
@@ -320,6 +321,111 @@ def test_probabilistic_odf_weighted_tracker():
                                            random_seed=0))._data
     npt.assert_equal(tracking_1, tracking_2)
 
+    # Test that parallel tracking returns the same streamlines, in order
+    parallel_tracking = LocalTracking(dg, sc, seeds, np.eye(4), 0.5,
+                                      random_seed=0, n_jobs=2)
+    parallel_tracking.seeds_per_chunk = 5
+    tracking_3 = Streamlines(parallel_tracking)._data
+    npt.assert_equal(tracking_1, tracking_3)
+
+    # Streamlines returned as they are tracked are the same, in any order
+    parallel_tracking = LocalTracking(dg, sc, seeds, np.eye(4), 0.5,
+                                      random_seed=0, n_jobs=2, ordered=False,
+                                      save_seeds=True)
+    parallel_tracking.seeds_per_chunk = 5
+    serial_tracking = LocalTracking(dg, sc, seeds, np.eye(4), 0.5,
+                                    random_seed=0, save_seeds=True)
+    key = lambda output: tuple(output[1]) + (len(output[0]),)
+    unordered = sorted(parallel_tracking, key=key)
+    expected = sorted(serial_tracking, key=key)
+    npt.assert_equal(len(unordered), len(expected))
+    for (sl, seed), (expected_sl, expected_seed) in zip(unordered, expected):
+        npt.assert_array_equal(sl, expected_sl)
+        npt.assert_array_equal(seed, expected_seed)
+
+
+def test_tracker_batch():
+    """This tests that local_tracker_batch writes the streamlines of a block
+    of seeds in the layout of ArraySequence.
+    """
+    sphere = HemiSphere.from_sphere(unit_octahedron)
+    pmf_lookup = np.array([[0., 0., 1.],
+                           [1., 0., 0.],
+                           [0., 1., 0.],
+                           [.6, .4, 0.]])
+    simple_image = np.array([[0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 3, 2, 2, 2, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 1, 0, 0, 0, 0],
+                             ])
+    simple_image = simple_image[..., None]
+    pmf = pmf_lookup[simple_image]
+    mask = (simple_image > 0).astype(float)
+    sc = ThresholdStoppingCriterion(mask, .5)
+    dg = DeterministicMaximumDirectionGetter.from_pmf(pmf, 90, sphere)
+    seeds = seeds_from_mask(np.ones(mask.shape), np.eye(4), density=2)
+    voxel_size = np.ones(3)
+
+    points, offsets, lengths, seed_ids = local_tracker_batch(
+        dg, sc, seeds, voxel_size, 100, 0.5, True)
+    npt.assert_equal(len(offsets), len(lengths))
+    npt.assert_equal(len(offsets), len(seed_ids))
+    npt.assert_array_equal(offsets[1:], np.cumsum(lengths)[:-1])
+    npt.assert_equal(points.shape, (lengths.sum(), 3))
+
+    # Compare with the streamlines tracked one direction at a time
+    F = np.empty((101, 3))
+    B = np.empty((101, 3))
+    expected = []
+    expected_ids = []
+    for i, s in enumerate(seeds):
+        directions = dg.initial_direction(s)
+        if directions.size == 0:
+            expected.append(s[None])
+            expected_ids.append(i)
+        for first_step in directions:
+            stepsF, _ = local_tracker(dg, sc, s, first_step, voxel_size, F,
+                                      0.5, True)
+            stepsB, _ = local_tracker(dg, sc, s, -first_step, voxel_size, B,
+                                      0.5, True)
+            expected.append(np.concatenate((B[stepsB - 1:0:-1],
+                                            F[:stepsF])))
+            expected_ids.append(i)
+    npt.assert_equal(len(offsets), len(expected))
+    npt.assert_array_equal(seed_ids, expected_ids)
+    for start, length, streamline in zip(offsets, lengths, expected):
+        npt.assert_array_equal(points[start:start + length], streamline)
+
+    # The output feeds Streamlines without copies
+    streamlines = Streamlines()
+    streamlines._data = points
+    streamlines._offsets = offsets
+    streamlines._lengths = lengths
+    npt.assert_(np.shares_memory(streamlines[0], points))
+    npt.assert_array_equal(streamlines[len(expected) - 1], expected[-1])
+
+    # Only the first direction of each seed, only valid streamlines
+    points, offsets, lengths, seed_ids = local_tracker_batch(
+        dg, sc, seeds, voxel_size, 100, 0.5, True, max_cross=1,
+        return_all=False)
+    npt.assert_(np.all(np.bincount(seed_ids) <= 1))
+    npt.assert_(np.all(lengths > 1))
+
+    npt.assert_raises(ValueError, local_tracker_batch, dg, sc,
+                      np.zeros((3, 2)), voxel_size, 100, 0.5, True)
+
+    # LocalTracking yields views of the points of a block, in point space
+    affine = np.diag([2., 2., 2., 1.])
+    tracking = LocalTracking(dg, sc, np.dot(seeds, affine[:3, :3]), affine,
+                             step_size=1.)
+    tracked = list(tracking)
+    npt.assert_equal(len(tracked), len(expected))
+    npt.assert_(tracked[0].base is not None)
+    npt.assert_(tracked[0].base is tracked[-1].base)
+    for streamline, points in zip(tracked, expected):
+        npt.assert_array_almost_equal(streamline, 2 * points)
+
 
 def test_particle_filtering_tractography():
     """This tests that the ParticleFilteringTracking produces
@@ -463,6 +569,14 @@ def test_particle_filtering_tractography():
                                                       random_seed=0))._data
     npt.assert_equal(tracking1, tracking2)
 
+    # Test that parallel tracking returns the same streamlines
+    parallel_tracking = ParticleFilteringTracking(dg, sc, seeds, np.eye(4),
+                                                  step_size, random_seed=0,
+                                                  n_jobs=2)
+    parallel_tracking.seeds_per_chunk = 3
+    tracking3 = Streamlines(parallel_tracking)._data
+    npt.assert_equal(tracking1, tracking3)
+
 
 def test_maximum_deterministic_tracker():
     """This tests that the Maximum Deterministic Direction Getter plays nice
@@ -2,7 +2,7 @@ import warnings
 
 import numpy as np
 from dipy.tracking import metrics
-from dipy.tracking.streamline import transform_streamlines
+from dipy.tracking.streamline import Streamlines, transform_streamlines
 from dipy.tracking.utils import (connectivity_matrix, density_map, length,
                                  ndbincount, reduce_labels, seeds_from_mask,
                                  random_seeds_from_mask, target,
@@ -541,6 +541,69 @@ def test_connectivity_matrix_shape():
     npt.assert_equal(matrix.shape, (3, 3))
 
 
+def test_connectivity_matrix_array_sequence():
+    rng = np.random.RandomState(0)
+    label_volume = rng.randint(0, 5, (8, 8, 8))
+    streamlines = [rng.uniform(0, 7.4, (rng.randint(1, 12), 3))
+                   for _ in range(50)]
+    # Every other streamline, backwards, is not stored contiguously
+    for seq in [Streamlines(streamlines), Streamlines(streamlines)[::-2]]:
+        as_list = list(seq)
+        npt.assert_array_equal(density_map(seq, np.eye(4), (8, 8, 8)),
+                               density_map(as_list, np.eye(4), (8, 8, 8)))
+        for inclusive in [False, True]:
+            for symmetric in [False, True]:
+                matrix, mapping = connectivity_matrix(
+                    seq, np.eye(4), label_volume, inclusive=inclusive,
+                    symmetric=symmetric, return_mapping=True)
+                expected, expected_mapping = connectivity_matrix(
+                    iter(as_list), np.eye(4), label_volume,
+                    inclusive=inclusive, symmetric=symmetric,
+                    return_mapping=True)
+                npt.assert_array_equal(matrix, expected)
+                npt.assert_equal(dict(mapping), dict(expected_mapping))
+
+
+def test_connectivity_matrix_sparse():
+    rng = np.random.RandomState(1)
+    label_volume = rng.randint(0, 6, (8, 8, 8))
+    streamlines = Streamlines([rng.uniform(0, 7.4, (rng.randint(2, 12), 3))
+                               for _ in range(50)])
+    for inclusive in [False, True]:
+        for symmetric in [False, True]:
+            expected, expected_mapping = connectivity_matrix(
+                streamlines, np.eye(4), label_volume, inclusive=inclusive,
+                symmetric=symmetric, return_mapping=True)
+            matrix = connectivity_matrix(
+                streamlines, np.eye(4), label_volume, inclusive=inclusive,
+                symmetric=symmetric, sparse=True)
+            npt.assert_array_equal(matrix.toarray(), expected)
+            matrix, mapping = connectivity_matrix(
+                streamlines, np.eye(4), label_volume, inclusive=inclusive,
+                symmetric=symmetric, return_mapping=True, sparse=True,
+                compact_mapping=True)
+            npt.assert_array_equal(matrix.toarray(), expected)
+            npt.assert_equal(len(mapping), len(expected_mapping))
+            for key, value in expected_mapping.items():
+                assert_true(key in mapping)
+                npt.assert_array_equal(mapping[key], value)
+            npt.assert_equal(mapping.get((6, 6)), None)
+            npt.assert_raises(KeyError, mapping.__getitem__, (6, 6))
+            npt.assert_equal(dict(mapping.to_dict()), dict(expected_mapping))
+
+    # The compact mapping can index the streamlines
+    _, expected_mapping = connectivity_matrix(streamlines, np.eye(4),
+                                              label_volume,
+                                              return_mapping=True)
+    _, mapping = connectivity_matrix(streamlines, np.eye(4), label_volume,
+                                     return_mapping=True,
+                                     mapping_as_streamlines=True,
+                                     compact_mapping=True)
+    for key, indices in expected_mapping.items():
+        npt.assert_array_equal(mapping[key].get_data(),
+                               streamlines[indices].get_data())
+
+
 def test_unique_rows():
     """
     Testing the function unique_coords
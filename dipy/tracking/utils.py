@@ -51,15 +51,16 @@ from functools import wraps
 from warnings import warn
 
 from nibabel.affines import apply_affine
+from scipy.sparse import coo_matrix
 from scipy.spatial.distance import cdist
 from numpy import ravel_multi_index
 
 from dipy.core.geometry import dist_to_corner
 
-from collections import defaultdict, OrderedDict
-from itertools import combinations, groupby
+from collections import defaultdict
 
 import numpy as np
+from nibabel.streamlines import ArraySequence
 from numpy import (asarray, ceil, empty, sqrt)
 from dipy.tracking import metrics
 from dipy.tracking.vox2track import _streamlines_in_mask
@@ -68,6 +69,73 @@ from dipy.tracking.vox2track import _streamlines_in_mask
 from dipy.tracking._utils import (_mapping_to_voxel, _to_voxel_coordinates)
 
 
+def _streamline_point_blocks(streamlines, max_points=2 ** 20):
+    """Points of whole streamlines, a block at a time.
+
+    Streamlines stored in an ArraySequence are read from its flat buffer, any
+    other iterable of streamlines is concatenated a block at a time.
+
+    Parameters
+    ----------
+    streamlines : iterable
+        A sequence of streamlines.
+    max_points : int, optional
+        Approximate number of points per block, a streamline is never split
+        between blocks.
+
+    Returns
+    -------
+    output : generator
+        Generator of tuples (lengths, points) of the number of points of the
+        streamlines of each block, in order, and their points one after the
+        other.
+    """
+    if hasattr(streamlines, 'iter_points'):
+        # Lazy streamlines apply their affine to each block of points
+        for _, lengths, points in streamlines.iter_points(max_points):
+            yield lengths, points
+    elif isinstance(streamlines, ArraySequence):
+        offsets = np.asarray(streamlines._offsets)
+        lengths = np.asarray(streamlines._lengths)
+        if len(lengths) == 0:
+            return
+        ends = np.cumsum(lengths)
+        splits = np.unique(np.searchsorted(ends, np.arange(max_points,
+                                                           ends[-1],
+                                                           max_points)))
+        for start, stop in zip(np.r_[0, splits], np.r_[splits, len(lengths)]):
+            if start == stop:
+                continue
+            offs = offsets[start:stop]
+            lens = lengths[start:stop]
+            if np.all(offs[1:] == offs[:-1] + lens[:-1]):
+                points = streamlines._data[offs[0]:offs[-1] + lens[-1]]
+            else:
+                # Gather the points of streamlines that are not stored one
+                # after the other, e.g. in a view of another sequence
+                starts = np.cumsum(lens) - lens
+                index = np.arange(lens.sum()) + np.repeat(offs - starts, lens)
+                points = streamlines._data[index]
+            yield lens, points
+    else:
+        streamlines = iter(streamlines)
+        while True:
+            block = []
+            n_points = 0
+            for sl in streamlines:
+                sl = np.asarray(sl)
+                block.append(sl)
+                n_points += len(sl)
+                if n_points >= max_points:
+                    break
+            if not block:
+                return
+            yield (np.array([len(sl) for sl in block], dtype=np.intp),
+                   np.concatenate(block))
+            if n_points < max_points:
+                return
+
+
 def density_map(streamlines, affine, vol_dims):
     """Counts the number of unique streamlines that pass through each voxel.
 
@@ -99,21 +167,243 @@ def density_map(streamlines, affine, vol_dims):
     [0,0,2] passes through [0,0,1]. Consider subsegmenting the streamlines when
     the edges of the voxels are smaller than the steps of the streamlines.
 
+    The streamlines are processed a block of points at a time. Streamlines
+    stored in an ArraySequence (``Streamlines``) are read directly from its
+    buffer of points.
+
     """
     lin_T, offset = _mapping_to_voxel(affine)
-    counts = np.zeros(vol_dims, 'int')
-    for sl in streamlines:
-        inds = _to_voxel_coordinates(sl, lin_T, offset)
+    vol_dims = tuple(int(d) for d in vol_dims)
+    n_voxels = int(np.prod(vol_dims))
+    counts = np.zeros(n_voxels, 'int')
+    for lengths, points in _streamline_point_blocks(streamlines):
+        if len(points) == 0:
+            continue
+        inds = _to_voxel_coordinates(points, lin_T, offset)
+        if np.any(inds >= vol_dims):
+            raise IndexError('streamline has points that map outside of the'
+                             ' volume')
+        voxels = ravel_multi_index(inds.T, vol_dims)
+        # Each streamline is counted once per voxel, even if several of its
+        # points lie in that voxel
+        ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+        visits = np.unique(ids * n_voxels + voxels)
+        counts += np.bincount(visits % n_voxels, minlength=n_voxels)
+    return counts.reshape(vol_dims)
+
+
+def _inclusive_edges(labels, lengths, symmetric):
+    """Label pairs connected by streamlines anywhere along their path.
+
+    Parameters
+    ----------
+    labels : ndarray (N,)
+        The label of each point of the streamlines, one after the other.
+    lengths : ndarray (M,)
+        The number of points of each streamline.
+    symmetric : bool
+        If True, each pair of different labels crossed by a streamline is
+        returned once, with the smallest label first. Otherwise, a pair
+        ``(a, b)`` is returned if the streamline leaves `a` and later enters
+        `b`.
+
+    Returns
+    -------
+    start, end, ids : ndarray
+        The labels and the streamline index of each connection, ordered by
+        streamline.
+    """
+    ids = np.repeat(np.arange(len(lengths), dtype=np.int64), lengths)
+    keys = ids * (labels.max() + 1) + labels
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    first = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    last = np.r_[first[1:], len(keys)] - 1
+    # One entry for each label of each streamline, grouped by streamline, with
+    # the first and last point of the streamline in that label
+    u_ids = ids[order[first]]
+    u_labels = labels[order[first]]
+    u_first = order[first]
+    u_last = order[last]
+
+    # Pair each label of a streamline with each of its labels
+    counts = np.bincount(u_ids, minlength=len(lengths))
+    group_starts = np.cumsum(counts) - counts
+    repeats = counts[u_ids]
+    a = np.repeat(np.arange(len(u_ids)), repeats)
+    b = (np.arange(len(a)) - np.repeat(np.cumsum(repeats) - repeats, repeats) +
+         np.repeat(group_starts[u_ids], repeats))
+    if symmetric:
+        keep = u_labels[a] < u_labels[b]
+    else:
+        keep = (u_labels[a] != u_labels[b]) & (u_first[a] < u_last[b])
+    a = a[keep]
+    b = b[keep]
+    return u_labels[a], u_labels[b], u_ids[a]
+
+
+def _connectivity_edges(streamlines, affine, label_volume, inclusive,
+                        symmetric):
+    """Label pairs connected by each streamline.
+
+    See ``connectivity_matrix`` for the parameters.
+
+    Returns
+    -------
+    edges : ndarray (3, N)
+        The start label, end label and index of the streamline of each
+        connection, ordered by streamline.
+    """
+    lin_T, offset = _mapping_to_voxel(affine)
+    edges = []
+    n_streamlines = 0
+    for lengths, points in _streamline_point_blocks(streamlines):
+        if len(points) == 0:
+            n_streamlines += len(lengths)
+            continue
+        inds = _to_voxel_coordinates(points, lin_T, offset)
         i, j, k = inds.T
-        # this takes advantage of the fact that numpy's += operator only
-        # acts once even if there are repeats in inds
-        counts[i, j, k] += 1
-    return counts
+        labels = label_volume[i, j, k].astype(np.int64)
+        if inclusive:
+            start, end, ids = _inclusive_edges(labels, lengths, symmetric)
+        else:
+            # take the first and last point of each streamline
+            ends = np.cumsum(lengths)
+            start = labels[ends - lengths]
+            end = labels[ends - 1]
+            ids = np.arange(len(lengths), dtype=np.int64)
+            if symmetric:
+                start, end = np.minimum(start, end), np.maximum(start, end)
+        edges.append(np.array([start, end, ids + n_streamlines]))
+        n_streamlines += len(lengths)
+    if not edges:
+        return np.empty((3, 0), dtype=np.int64)
+    return np.concatenate(edges, axis=1)
+
+
+class ConnectivityMapping(object):
+    """Streamlines connecting each label pair.
+
+    The indices of the streamlines are grouped by label pair in a single
+    array, like the column indices of a CSR sparse matrix, so that the
+    memory scales with the number of connections instead of the number of
+    labels. It can be used like the ``defaultdict(list)`` mapping returned by
+    ``connectivity_matrix``, except that missing label pairs raise a
+    KeyError.
+
+    Parameters
+    ----------
+    pairs : ndarray (N, 2)
+        The label pairs connected by at least one streamline, in increasing
+        order.
+    offsets : ndarray (N + 1,)
+        ``indices[offsets[n]:offsets[n + 1]]`` are the indices of the
+        streamlines connecting ``pairs[n]``.
+    indices : ndarray
+        The indices of the streamlines, grouped by label pair.
+    streamlines : sequence, optional
+        If given, the mapping returns the streamlines instead of their
+        indices.
+
+    """
+    def __init__(self, pairs, offsets, indices, streamlines=None):
+        self.pairs = np.asarray(pairs).reshape(-1, 2)
+        self.offsets = np.asarray(offsets)
+        self.indices = np.asarray(indices)
+        self.streamlines = streamlines
+        self._n_labels = self.pairs.max() + 1 if len(self.pairs) else 1
+        self._keys = self.pairs[:, 0] * self._n_labels + self.pairs[:, 1]
+
+    @classmethod
+    def from_edges(cls, edges, n_labels, streamlines=None):
+        """Groups the streamlines of each edge by label pair.
+
+        Parameters
+        ----------
+        edges : ndarray (3, N)
+            The start label, end label and streamline index of each
+            connection, ordered by streamline.
+        n_labels : int
+            Number of labels, larger than all labels of `edges`.
+        streamlines : sequence, optional
+            If given, the mapping returns the streamlines instead of their
+            indices.
+
+        Returns
+        -------
+        mapping : ConnectivityMapping
+        """
+        keys = edges[0] * n_labels + edges[1]
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[len(keys) > 0, keys[1:] != keys[:-1]])
+        pairs = np.column_stack(np.divmod(keys[starts], n_labels))
+        offsets = np.r_[starts, len(keys)]
+        return cls(pairs, offsets, edges[2, order], streamlines)
+
+    @property
+    def counts(self):
+        """Number of streamlines connecting each label pair."""
+        return np.diff(self.offsets)
+
+    def _find(self, key):
+        i, j = key
+        if not (0 <= i < self._n_labels and 0 <= j < self._n_labels):
+            return -1
+        n = np.searchsorted(self._keys, i * self._n_labels + j)
+        if n == len(self._keys) or self._keys[n] != i * self._n_labels + j:
+            return -1
+        return n
+
+    def _group(self, n):
+        indices = self.indices[self.offsets[n]:self.offsets[n + 1]]
+        if self.streamlines is None:
+            return indices
+        if isinstance(self.streamlines, ArraySequence):
+            return self.streamlines[indices]
+        return [self.streamlines[i] for i in indices]
+
+    def __len__(self):
+        return len(self.pairs)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __getitem__(self, key):
+        n = self._find(key)
+        if n < 0:
+            raise KeyError(key)
+        return self._group(n)
+
+    def get(self, key, default=None):
+        n = self._find(key)
+        return default if n < 0 else self._group(n)
+
+    def keys(self):
+        return [tuple(pair) for pair in self.pairs.tolist()]
+
+    def values(self):
+        return [self._group(n) for n in range(len(self))]
+
+    def items(self):
+        return list(zip(self.keys(), self.values()))
+
+    def to_dict(self):
+        """Mapping as a ``defaultdict(list)`` of label pairs to lists."""
+        mapping = defaultdict(list)
+        for key, value in self.items():
+            mapping[key] = list(value) if self.streamlines is not None \
+                else value.tolist()
+        return mapping
 
 
 def connectivity_matrix(streamlines, affine, label_volume, inclusive=False,
                         symmetric=True, return_mapping=False,
-                        mapping_as_streamlines=False):
+                        mapping_as_streamlines=False, sparse=False,
+                        compact_mapping=False):
     """Counts the streamlines that start and end at each label pair.
 
     Parameters
@@ -139,18 +429,31 @@ def connectivity_matrix(streamlines, affine, label_volume, inclusive=False,
     mapping_as_streamlines : bool, False by default
         If True voxel indices map to lists of streamline objects. Otherwise
         voxel indices map to lists of integers.
+    sparse : bool, False by default
+        If True, the matrix is returned as a ``scipy.sparse.csr_matrix``,
+        which only stores the label pairs connected by streamlines.
+    compact_mapping : bool, False by default
+        If True, the mapping is a ``ConnectivityMapping``, which stores the
+        streamline indices of all label pairs in a single array instead of
+        a list for each label pair.
 
     Returns
     -------
-    matrix : ndarray
+    matrix : ndarray or csr_matrix
         The number of connection between each pair of regions in
         `label_volume`.
-    mapping : defaultdict(list)
+    mapping : defaultdict(list) or ConnectivityMapping
         ``mapping[i, j]`` returns all the streamlines that connect region `i`
         to region `j`. If `symmetric` is True mapping will only have one key
         for each start end pair such that if ``i < j`` mapping will have key
         ``(i, j)`` but not key ``(j, i)``.
 
+    Notes
+    -----
+    The streamlines are processed a block of points at a time. Streamlines
+    stored in an ArraySequence (``Streamlines``) are read directly from its
+    buffer of points.
+
     """
     # Error checking on label_volume
     kind = label_volume.dtype.kind
@@ -162,89 +465,41 @@ def connectivity_matrix(streamlines, affine, label_volume, inclusive=False,
                          "non-negative label values")
 
     # If streamlines is an iterator
-    if return_mapping and mapping_as_streamlines:
+    if (return_mapping and mapping_as_streamlines and
+            not isinstance(streamlines, ArraySequence)):
         streamlines = list(streamlines)
 
-    if inclusive:
-        # Create ndarray to store streamline connections
-        edges = np.ndarray(shape=(3, 0), dtype=int)
-        lin_T, offset = _mapping_to_voxel(affine)
-        for sl, _ in enumerate(streamlines):
-            # Convert streamline to voxel coordinates
-            entire = _to_voxel_coordinates(streamlines[sl], lin_T, offset)
-            i, j, k = entire.T
-
-            if symmetric:
-                # Create list of all labels streamline passes through
-                entirelabels = list(OrderedDict.fromkeys(label_volume[i, j, k]))
-                # Append all connection combinations with streamline number
-                for comb in combinations(entirelabels, 2):
-                    edges = np.append(edges, [[comb[0]], [comb[1]], [sl]],
-                                      axis=1)
-            else:
-                # Create list of all labels streamline passes through, keeping
-                # order and whether a label was entered multiple times
-                entirelabels = list(groupby(label_volume[i, j, k]))
-                # Append connection combinations along with streamline number,
-                # removing duplicates and connections from a label to itself
-                combs = set(combinations([z[0] for z in entirelabels], 2))
-                for comb in combs:
-                    if comb[0] == comb[1]:
-                        pass
-                    else:
-                        edges = np.append(edges, [[comb[0]], [comb[1]], [sl]],
-                                          axis=1)
-        if symmetric:
-            edges[0:2].sort(0)
-        mx = label_volume.max() + 1
+    edges = _connectivity_edges(streamlines, affine, label_volume, inclusive,
+                                symmetric)
+    mx = int(label_volume.max()) + 1
+    if return_mapping:
+        # The mapping counts the streamlines of each label pair, which are
+        # the entries of the (non symmetrized) sparse matrix
+        mapping = ConnectivityMapping.from_edges(
+            edges, mx, streamlines if mapping_as_streamlines else None)
+        if sparse:
+            matrix = coo_matrix((mapping.counts, mapping.pairs.T),
+                                shape=(mx, mx)).tocsr()
+        else:
+            matrix = ndbincount(mapping.pairs.T, mapping.counts,
+                                shape=(mx, mx)).astype(int)
+    elif sparse:
+        matrix = coo_matrix((np.ones(edges.shape[1], dtype=int), edges[0:2]),
+                            shape=(mx, mx)).tocsr()
+    else:
         matrix = ndbincount(edges[0:2], shape=(mx, mx))
+    if symmetric:
+        matrix = matrix.maximum(matrix.T) if sparse else \
+            np.maximum(matrix, matrix.T)
 
-        if symmetric:
-            matrix = np.maximum(matrix, matrix.T)
-        if return_mapping:
-            mapping = defaultdict(list)
-            for i, (a, b, c) in enumerate(edges.T):
-                mapping[a, b].append(c)
-            # Replace each list of indices with the streamlines they index
-            if mapping_as_streamlines:
-                for key in mapping:
-                    mapping[key] = [streamlines[i] for i in mapping[key]]
+    if return_mapping:
+        if not compact_mapping:
+            mapping = mapping.to_dict()
 
-            return matrix, mapping
+        # Return the mapping matrix and the mapping
+        return matrix, mapping
 
-        return matrix
-    else:
-        # take the first and last point of each streamline
-        endpoints = [sl[0::len(sl)-1] for sl in streamlines]
-
-        # Map the streamlines coordinates to voxel coordinates
-        lin_T, offset = _mapping_to_voxel(affine)
-        endpoints = _to_voxel_coordinates(endpoints, lin_T, offset)
-
-        # get labels for label_volume
-        i, j, k = endpoints.T
-        endlabels = label_volume[i, j, k]
-        if symmetric:
-            endlabels.sort(0)
-        mx = label_volume.max() + 1
-        matrix = ndbincount(endlabels, shape=(mx, mx))
-        if symmetric:
-            matrix = np.maximum(matrix, matrix.T)
-
-        if return_mapping:
-            mapping = defaultdict(list)
-            for i, (a, b) in enumerate(endlabels.T):
-                mapping[a, b].append(i)
-
-            # Replace each list of indices with the streamlines they index
-            if mapping_as_streamlines:
-                for key in mapping:
-                    mapping[key] = [streamlines[i] for i in mapping[key]]
-
-            # Return the mapping matrix and the mapping
-            return matrix, mapping
-
-        return matrix
+    return matrix
 
 
 def ndbincount(x, weights=None, shape=None):
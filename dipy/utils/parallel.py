@@ -0,0 +1,156 @@
+"""Tools to map a function over chunks of work using a pool of workers"""
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from multiprocessing import cpu_count
+
+import numpy as np
+
+
+ENGINES = ('serial', 'thread', 'process')
+
+
+def determine_num_jobs(n_jobs):
+    """Determine the effective number of workers for a pool.
+
+    Parameters
+    ----------
+    n_jobs : int or None
+        Desired number of workers. If None or 0, the number of cpus is
+        used. Negative values are counted backwards from the number of
+        cpus, so that -1 means all cpus, -2 all cpus but one, and so on.
+
+    Returns
+    -------
+    n_jobs : int
+        Number of workers to use, always greater or equal to 1.
+    """
+    if n_jobs is None or n_jobs == 0:
+        return cpu_count()
+    if n_jobs < 0:
+        return max(1, cpu_count() + 1 + n_jobs)
+    return int(n_jobs)
+
+
+def chunk_slices(n_items, n_jobs, chunk_size=None):
+    """Split a range of items into contiguous chunks.
+
+    Parameters
+    ----------
+    n_items : int
+        Number of items to split.
+    n_jobs : int
+        Number of workers the chunks will be distributed to.
+    chunk_size : int, optional
+        Number of items per chunk. By default, the items are split in about
+        four chunks per worker so that the load is balanced when some chunks
+        are slower than others.
+
+    Returns
+    -------
+    slices : list of slice
+        Slices covering ``range(n_items)`` in order.
+    """
+    if chunk_size is None:
+        chunk_size = int(np.ceil(n_items / (4. * n_jobs)))
+    chunk_size = max(1, int(chunk_size))
+    return [slice(start, min(start + chunk_size, n_items))
+            for start in range(0, n_items, chunk_size)]
+
+
+def paramap(func, in_list, engine='serial', n_jobs=None, ordered=True,
+            func_args=None, func_kwargs=None, initializer=None, initargs=()):
+    """Map a function over a list of inputs, possibly in parallel.
+
+    Parameters
+    ----------
+    func : callable
+        Function applied to each element of `in_list`. It must be picklable
+        (i.e. defined at module level) when `engine` is 'process'.
+    in_list : iterable
+        Inputs to `func`. Each element is passed as the first argument. It
+        is consumed lazily, so that only a few inputs per worker are pending
+        at any time.
+    engine : {'serial', 'thread', 'process'}, optional
+        'serial' calls `func` in the current thread, 'thread' uses a pool of
+        threads (useful when `func` releases the GIL) and 'process' uses a
+        pool of processes.
+    n_jobs : int, optional
+        Number of workers. See :func:`determine_num_jobs`.
+    ordered : bool, optional
+        If True (default), results are yielded in the order of `in_list`.
+        Otherwise they are yielded as soon as they are completed.
+    func_args : list, optional
+        Additional positional arguments passed to `func`.
+    func_kwargs : dict, optional
+        Additional keyword arguments passed to `func`.
+    initializer : callable, optional
+        Function called with `initargs` once in each worker before it
+        starts. With the 'fork' start method of multiprocessing (the default
+        on Linux), `initargs` are inherited by the worker processes instead
+        of being pickled.
+    initargs : tuple, optional
+        Arguments of `initializer`.
+
+    Returns
+    -------
+    results : generator
+        Generator of the results of `func` on each element of `in_list`.
+    """
+    if engine not in ENGINES:
+        raise ValueError("engine should be one of %s, got %r" %
+                         (", ".join(ENGINES), engine))
+    func_args = func_args or []
+    func_kwargs = func_kwargs or {}
+    n_jobs = determine_num_jobs(n_jobs)
+
+    if engine == 'serial' or n_jobs == 1:
+        return _serial_map(func, in_list, func_args, func_kwargs,
+                           initializer, initargs)
+    return _pool_map(func, in_list, engine, n_jobs, ordered, func_args,
+                     func_kwargs, initializer, initargs)
+
+
+def _serial_map(func, in_list, func_args, func_kwargs, initializer,
+                initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    for item in in_list:
+        yield func(item, *func_args, **func_kwargs)
+
+
+def _pool_map(func, in_list, engine, n_jobs, ordered, func_args,
+              func_kwargs, initializer, initargs):
+    executor_class = (ThreadPoolExecutor if engine == 'thread'
+                      else ProcessPoolExecutor)
+    # Keep a few inputs per worker in flight, so that workers never wait
+    # while results not yet consumed don't pile up
+    max_pending = 2 * n_jobs
+    in_iter = iter(in_list)
+    with executor_class(max_workers=n_jobs, initializer=initializer,
+                        initargs=initargs) as executor:
+        def submit_next():
+            for item in in_iter:
+                return executor.submit(func, item, *func_args,
+                                       **func_kwargs)
+            return None
+
+        pending = deque()
+        for _ in range(max_pending):
+            future = submit_next()
+            if future is None:
+                break
+            pending.append(future)
+
+        while pending:
+            if ordered:
+                future = pending.popleft()
+            else:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                future = next(f for f in pending if f in done)
+                pending.remove(future)
+            result = future.result()
+            future = submit_next()
+            if future is not None:
+                pending.append(future)
+            yield result
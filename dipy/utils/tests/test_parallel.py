@@ -0,0 +1,65 @@
+import numpy as np
+import numpy.testing as npt
+
+from dipy.utils.parallel import chunk_slices, determine_num_jobs, paramap
+from multiprocessing import cpu_count
+
+
+_offset = 0
+
+
+def _power(x, exponent=2):
+    return x ** exponent
+
+
+def _set_offset(offset):
+    global _offset
+    _offset = offset
+
+
+def _add_offset(x):
+    return x + _offset
+
+
+def test_determine_num_jobs():
+    npt.assert_equal(determine_num_jobs(None), cpu_count())
+    npt.assert_equal(determine_num_jobs(0), cpu_count())
+    npt.assert_equal(determine_num_jobs(3), 3)
+    npt.assert_equal(determine_num_jobs(-1), cpu_count())
+    npt.assert_equal(determine_num_jobs(-cpu_count() - 5), 1)
+
+
+def test_chunk_slices():
+    for n_items, n_jobs, chunk_size in [(10, 2, None), (10, 2, 3),
+                                        (1, 4, None), (0, 4, None),
+                                        (100, 7, 1)]:
+        slices = chunk_slices(n_items, n_jobs, chunk_size)
+        covered = np.concatenate([np.arange(n_items)[sl] for sl in slices]
+                                 + [np.array([], dtype=int)])
+        npt.assert_array_equal(covered, np.arange(n_items))
+        if chunk_size is not None:
+            npt.assert_(all(sl.stop - sl.start <= chunk_size
+                            for sl in slices))
+
+
+def test_paramap():
+    in_list = list(range(20))
+    expected = [x ** 3 for x in in_list]
+    for engine in ['serial', 'thread', 'process']:
+        res = list(paramap(_power, in_list, engine=engine, n_jobs=2,
+                           func_kwargs={'exponent': 3}))
+        npt.assert_array_equal(res, expected)
+        res = list(paramap(_power, in_list, engine=engine, n_jobs=2,
+                           ordered=False, func_args=[3]))
+        npt.assert_array_equal(sorted(res), expected)
+    npt.assert_raises(ValueError, paramap, _power, in_list, engine='gpu')
+
+
+def test_paramap_initializer():
+    # Inputs can be any iterable, consumed lazily
+    for engine in ['serial', 'process']:
+        res = list(paramap(_add_offset, iter(range(10)), engine=engine,
+                           n_jobs=2, initializer=_set_offset,
+                           initargs=(100,)))
+        npt.assert_array_equal(res, np.arange(100, 110))
+        _set_offset(0)
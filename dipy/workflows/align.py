@@ -1,5 +1,6 @@
 
 import logging
+from collections import deque
 import numpy as np
 import nibabel as nib
 
@@ -489,12 +490,88 @@ class ImageRegistrationFlow(Workflow):
                                            affreg, params0, transform,
                                            affine)
 
+    def register_batch(self, static, static_grid2world, movings,
+                       moving_grid2worlds, affreg, params0, transform,
+                       progressive, n_jobs=1):
+        """ Function to register many moving images to the same static image.
+
+        The moving images are first aligned by their center of mass, then
+        registered through each stage (translation, rigid body and full
+        affine). The scale space of the static image is computed once and
+        the registrations run concurrently (see
+        ``AffineRegistration.iter_optimize_batch``).
+
+        Parameters
+        ----------
+        static : 2D or 3D array
+            the image to be used as reference during optimization.
+
+        static_grid2world : array, shape (dim+1, dim+1)
+            the voxel-to-space transformation associated with the static
+            image.
+
+        movings : iterable of 2D or 3D arrays
+            the images to be registered towards `static`. It is consumed
+            lazily, so it can load the images one at a time.
+
+        moving_grid2worlds : iterable of arrays, shape (dim+1, dim+1)
+            the voxel-to-space transformation associated with each moving
+            image.
+
+        affreg : An object of the image registration class.
+
+        params0 : array, shape (n,)
+            parameters from which to start the optimization. If None, the
+            optimization will start at the identity transform. n is the
+            number of parameters of the specified transformation.
+
+        transform : string
+            trans: translation, rigid: rigid body, affine: full affine.
+
+        progressive : boolean
+            Flag to enable or disable the progressive registration.
+
+        n_jobs : int, optional
+            Number of registrations running concurrently. If 0, all
+            available cpus are used (default 1).
+
+        Returns
+        -------
+        results : generator of tuples
+            the moved image, the affine matrix, the optimal parameters and
+            the value of the metric of each moving image, in the order of
+            `movings`, as soon as they are available.
+        """
+        stages = [TranslationTransform3D, RigidTransform3D, AffineTransform3D]
+        last = ['trans', 'rigid', 'affine'].index(transform)
+        if progressive:
+            stages = stages[:last + 1]
+        else:
+            stages = stages[last:last + 1]
+
+        # The moving images are kept until their registration returns, to be
+        # transformed
+        pending = deque()
+
+        def pending_movings():
+            for moving in movings:
+                pending.append(moving)
+                yield moving
+
+        results = affreg.iter_optimize_batch(
+            static, pending_movings(), [stage() for stage in stages],
+            params0, static_grid2world, moving_grid2worlds,
+            starting_affine='mass', ret_metric=True, n_jobs=n_jobs)
+        for affine_map, xopt, fopt in results:
+            moving = pending.popleft()
+            yield affine_map.transform(moving), affine_map.affine, xopt, fopt
+
     def run(self, static_img_files, moving_img_files, transform='affine',
             nbins=32, sampling_prop=None, metric='mi',
             level_iters=[10000, 1000, 100], sigmas=[3.0, 1.0, 0.0],
             factors=[4, 2, 1], progressive=True, save_metric=False,
-            out_dir='', out_moved='moved.nii.gz', out_affine='affine.txt',
-            out_quality='quality_metric.txt'):
+            n_jobs=1, out_dir='', out_moved='moved.nii.gz',
+            out_affine='affine.txt', out_quality='quality_metric.txt'):
         """
         Parameters
         ----------
@@ -544,6 +621,13 @@ class ImageRegistrationFlow(Workflow):
             If true, quality assessment metric are saved in
             'quality_metric.txt' (default 'False').
 
+        n_jobs : int, optional
+            Number of registrations running concurrently. The scale space of
+            each static image is computed once for all its moving images,
+            which are loaded as the registrations need them: a few per job
+            are in memory at once. Each registration uses a share of the
+            threads. If 0, all available cpus are used (default 1).
+
         out_dir : string, optional
             Directory to save the transformed image and the affine matrix
              (default '').
@@ -563,83 +647,78 @@ class ImageRegistrationFlow(Workflow):
 
         io_it = self.get_io_iterator()
         transform = transform.lower()
+        if transform not in ['com', 'trans', 'rigid', 'affine']:
+            raise ValueError('Invalid transformation:'
+                             ' Please see program\'s help'
+                             ' for allowed values of'
+                             ' transformation.')
+        if transform != 'com' and metric != 'mi':
+            raise ValueError("Invalid similarity metric: Please"
+                             " provide a valid metric.")
 
+        # The moving images of the same static image are registered together
+        groups = {}
         for static_img, mov_img, moved_file, affine_matrix_file, \
                 qual_val_file in io_it:
+            groups.setdefault(static_img, []).append(
+                (mov_img, moved_file, affine_matrix_file, qual_val_file))
+
+        for static_img, group in groups.items():
 
             # Load the data from the input files and store into objects.
             static, static_grid2world = load_nifti(static_img)
-            moving, moving_grid2world = load_nifti(mov_img)
 
-            check_dimensions(static, moving)
+            # The moving images are loaded as they are registered, and their
+            # results saved right away
+            def load_movings(group=group, static=static):
+                for mov_img, _, _, _ in group:
+                    moving, moving_grid2world = load_nifti(mov_img)
+                    check_dimensions(static, moving)
+                    yield moving, moving_grid2world
 
             if transform == 'com':
-                moved_image, affine = self.center_of_mass(static,
-                                                          static_grid2world,
-                                                          moving,
-                                                          moving_grid2world)
+                results = (self.center_of_mass(static, static_grid2world,
+                                               moving, moving_grid2world)
+                           for moving, moving_grid2world in load_movings())
             else:
 
                 params0 = None
-                if metric != 'mi':
-                    raise ValueError("Invalid similarity metric: Please"
-                                     " provide a valid metric.")
-                metric = MutualInformationMetric(nbins, sampling_prop)
+                mi_metric = MutualInformationMetric(nbins, sampling_prop)
 
                 """
                 Instantiating the registration class with the configurations.
                 """
 
-                affreg = AffineRegistration(metric=metric,
+                affreg = AffineRegistration(metric=mi_metric,
                                             level_iters=level_iters,
                                             sigmas=sigmas,
                                             factors=factors)
 
-                if transform == 'trans':
-                    moved_image, affine, \
-                        xopt, fopt = self.translate(static,
-                                                    static_grid2world,
-                                                    moving,
-                                                    moving_grid2world,
-                                                    affreg,
-                                                    params0)
-
-                elif transform == 'rigid':
-                    moved_image, affine, \
-                        xopt, fopt = self.rigid(static,
-                                                static_grid2world,
-                                                moving,
-                                                moving_grid2world,
-                                                affreg,
-                                                params0,
-                                                progressive)
-
-                elif transform == 'affine':
-                    moved_image, affine, \
-                        xopt, fopt = self.affine(static,
-                                                 static_grid2world,
-                                                 moving,
-                                                 moving_grid2world,
-                                                 affreg,
-                                                 params0,
-                                                 progressive)
-                else:
-                    raise ValueError('Invalid transformation:'
-                                     ' Please see program\'s help'
-                                     ' for allowed values of'
-                                     ' transformation.')
+                movings = (moving for moving, _ in load_movings())
+                moving_grid2worlds = [nib.load(mov_img).affine
+                                      for mov_img, _, _, _ in group]
+                results = self.register_batch(static, static_grid2world,
+                                              movings, moving_grid2worlds,
+                                              affreg, params0, transform,
+                                              progressive, n_jobs)
+
+            for (_, moved_file, affine_matrix_file, qual_val_file), \
+                    result in zip(group, results):
+                moved_image, affine = result[:2]
 
                 """
                 Saving the moved image file and the affine matrix.
                 """
-                logging.info("Optimal parameters: {0}".format(str(xopt)))
-                logging.info("Similarity metric: {0}".format(str(fopt)))
+                if transform != 'com':
+                    xopt, fopt = result[2:]
+                    logging.info("Optimal parameters: {0}".format(str(xopt)))
+                    logging.info("Similarity metric: {0}".format(str(fopt)))
 
-                if save_metric:
-                    save_qa_metric(qual_val_file, xopt, fopt)
+                    if save_metric:
+                        save_qa_metric(qual_val_file, xopt, fopt)
 
-            save_nifti(moved_file, moved_image, static_grid2world)
-            np.savetxt(affine_matrix_file, affine)
+                save_nifti(moved_file, moved_image, static_grid2world)
+                np.savetxt(affine_matrix_file, affine)
 
 
 class ApplyTransformFlow(Workflow):
@@ -736,7 +815,8 @@ class SynRegistrationFlow(Workflow):
             mopt_inner_iter=0.0, mopt_q_levels=256, mopt_double_gradient=True,
             mopt_step_type='', step_length=0.25,
             ss_sigma_factor=0.2, opt_tol=1e-5, inv_iter=20,
-            inv_tol=1e-3, out_dir='', out_warped='warped_moved.nii.gz',
+            inv_tol=1e-3, n_jobs=1, out_dir='',
+            out_warped='warped_moved.nii.gz',
             out_inv_static='inc_static.nii.gz',
             out_field='displacement_field.nii.gz'):
         """
@@ -830,6 +910,13 @@ class SynRegistrationFlow(Workflow):
             the displacement field inversion algorithm will stop iterating
              when the inversion error falls below this threshold.
 
+        n_jobs : int, optional
+            Number of registrations running concurrently. The scale space of
+             each static image is computed once for all its moving images,
+             which are loaded as the registrations need them: a few per job
+             are in memory at once. Each registration uses a share of the
+             threads. If 0, all available cpus are used (default 1).
+
         out_dir : string, optional
             Directory to save the transformed files (default '').
 
@@ -870,18 +957,37 @@ class SynRegistrationFlow(Workflow):
         mopt_step_type = mopt_step_type or \
             init_param[metric]['mopt_step_type']
 
+        # The moving images of the same static image are registered together
+        groups = {}
         for (static_file, moving_file, owarped_file, oinv_static_file,
              omap_file) in io_it:
+            groups.setdefault(static_file, []).append(
+                (moving_file, owarped_file, omap_file))
 
-            logging.info('Loading static file {0}'.format(static_file))
-            logging.info('Loading moving file {0}'.format(moving_file))
+        for static_file, group in groups.items():
 
             # Loading the image data from the input files into object.
+            logging.info('Loading static file {0}'.format(static_file))
             static_image, static_grid2world = load_nifti(static_file)
-            moving_image, moving_grid2world = load_nifti(moving_file)
 
-            # Sanity check for the input image dimensions.
-            check_dimensions(static_image, moving_image)
+            # The moving images are loaded as they are registered, and kept
+            # until their mapping returns, to be warped
+            pending = deque()
+
+            def load_movings(group=group, static_image=static_image,
+                             pending=pending):
+                for moving_file, _, _ in group:
+                    logging.info('Loading moving file {0}'.format(
+                        moving_file))
+                    moving_image, _ = load_nifti(moving_file)
+
+                    # Sanity check for the input image dimensions.
+                    check_dimensions(static_image, moving_image)
+                    pending.append(moving_image)
+                    yield moving_image
+
+            moving_grid2worlds = [nib.load(moving_file).affine
+                                  for moving_file, _, _ in group]
 
             # Loading the affine matrix.
             prealign = np.loadtxt(prealign_file) if prealign_file else None
@@ -914,15 +1020,21 @@ class SynRegistrationFlow(Workflow):
                 inv_tol=inv_tol
             )
 
-            mapping = sdr.optimize(static_image, moving_image,
-                                   static_grid2world, moving_grid2world,
-                                   prealign)
-
-            mapping_data = np.array([mapping.forward.T, mapping.backward.T]).T
-            warped_moving = mapping.transform(moving_image)
-
-            # Saving
-            logging.info('Saving warped {0}'.format(owarped_file))
-            save_nifti(owarped_file, warped_moving, static_grid2world)
-            logging.info('Saving Diffeomorphic map {0}'.format(omap_file))
-            save_nifti(omap_file, mapping_data, mapping.codomain_world2grid)
+            mappings = sdr.iter_optimize_batch(static_image, load_movings(),
+                                               static_grid2world,
+                                               moving_grid2worlds, prealign,
+                                               n_jobs=n_jobs)
+
+            for (_, owarped_file, omap_file), mapping in zip(group,
+                                                             mappings):
+                moving_image = pending.popleft()
+                mapping_data = np.array([mapping.forward.T,
+                                         mapping.backward.T]).T
+                warped_moving = mapping.transform(moving_image)
+
+                # Saving
+                logging.info('Saving warped {0}'.format(owarped_file))
+                save_nifti(owarped_file, warped_moving, static_grid2world)
+                logging.info('Saving Diffeomorphic map {0}'.format(omap_file))
+                save_nifti(omap_file, mapping_data,
+                           mapping.codomain_world2grid)
@@ -60,7 +60,7 @@ def test_slr_flow():
         save_tractogram(sft, f2_path, bbox_valid_check=False)
 
         slr_flow = SlrWithQbxFlow(force=True)
-        slr_flow.run(f1_path, f2_path)
+        slr_flow.run(f1_path, f2_path, out_dir=out_dir)
 
         out_path = slr_flow.last_generated_outputs['out_moved']
 
@@ -190,6 +190,46 @@ def test_image_registration():
         test_err()
 
 
+def test_image_registration_batch():
+    with TemporaryDirectory() as temp_out_dir:
+
+        static, moving, static_g2w, moving_g2w, smask, mmask, M\
+            = setup_random_transform(transform=regtransforms[('AFFINE', 3)],
+                                     rfactor=0.1)
+
+        save_nifti(pjoin(temp_out_dir, 'b0.nii.gz'), data=static,
+                   affine=static_g2w)
+        save_nifti(pjoin(temp_out_dir, 't1.nii.gz'), data=moving,
+                   affine=moving_g2w)
+        save_nifti(pjoin(temp_out_dir, 't2.nii.gz'),
+                   data=np.roll(moving, 2, axis=0), affine=moving_g2w)
+        save_nifti(pjoin(temp_out_dir, 't3.nii.gz'),
+                   data=np.roll(moving, -2, axis=1), affine=moving_g2w)
+        static_image_file = pjoin(temp_out_dir, 'b0.nii.gz')
+
+        # The moving images are registered together, two at a time, their
+        # results are the same as when they are registered alone
+        for out_dir, moving_files, n_jobs in \
+                [('batch', pjoin(temp_out_dir, 't*.nii.gz'), 2),
+                 ('t1', pjoin(temp_out_dir, 't1.nii.gz'), 1),
+                 ('t2', pjoin(temp_out_dir, 't2.nii.gz'), 1),
+                 ('t3', pjoin(temp_out_dir, 't3.nii.gz'), 1)]:
+            flow = ImageRegistrationFlow(mix_names=True)
+            flow.run(static_image_file, moving_files, transform='rigid',
+                     level_iters=[100, 10, 1], save_metric=True,
+                     n_jobs=n_jobs, out_dir=pjoin(temp_out_dir, out_dir))
+
+        for name in ['t1', 't2', 't3']:
+            prefix = 'b0_{0}__'.format(name)
+            for out_file in ['affine.txt', 'quality_metric.txt']:
+                npt.assert_array_equal(
+                    np.loadtxt(pjoin(temp_out_dir, 'batch',
+                                     prefix + out_file)),
+                    np.loadtxt(pjoin(temp_out_dir, name, prefix + out_file)))
+            assert os.path.exists(pjoin(temp_out_dir, 'batch',
+                                        prefix + 'moved.nii.gz'))
+
+
 def test_apply_transform_error():
     flow = ApplyTransformFlow()
     npt.assert_raises(ValueError, flow.run,
@@ -304,6 +344,19 @@ def test_syn_registration_flow():
         warped_map_path = syn_flow.last_generated_outputs['out_field']
         npt.assert_equal(os.path.isfile(warped_map_path), True)
 
+        # Many moving images registered to the same static image
+        fname_moving2 = pjoin(out_dir, 'tmp_moving2.nii.gz')
+        nib.save(moving_img, fname_moving2)
+        syn_flow = SynRegistrationFlow(mix_names=True)
+        all_args['level_iters'] = [10, 5]
+        syn_flow.run(fname_static, pjoin(out_dir, 'tmp_moving*.nii.gz'),
+                     out_dir=out_dir, n_jobs=2, **all_args)
+        fields = [pjoin(out_dir, 'tmp_static_{0}__displacement_field.nii.gz'
+                        .format(name)) for name in ['tmp_moving',
+                                                    'tmp_moving2']]
+        npt.assert_array_equal(load_nifti_data(fields[0]),
+                               load_nifti_data(fields[1]))
+
 
 if __name__ == "__main__":
     npt.run_module_suite()
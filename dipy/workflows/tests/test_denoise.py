@@ -31,6 +31,10 @@ def test_nlmeans_flow():
         npt.assert_equal(denoised_data.shape, volume.shape)
         npt.assert_array_almost_equal(denoised_affine, affine)
 
+        # Denoising by slabs within a memory budget gives the same result
+        nlmeans_flow.run(data_path, sigma=4, max_memory=1, out_dir=out_dir)
+        npt.assert_array_equal(load_nifti_data(denoised_path), denoised_data)
+
 
 def test_lpca_flow():
     with TemporaryDirectory() as out_dir:
@@ -102,6 +106,11 @@ def test_gibbs_flow():
         assert_true(os.path.isfile(
                 gibbs_flow.last_generated_outputs['out_unring']))
 
+        gibbs_flow._force_overwrite = True
+        gibbs_flow.run(data_path, num_threads=2, out_dir=out_dir)
+        unring_path = gibbs_flow.last_generated_outputs['out_unring']
+        npt.assert_equal(load_nifti_data(unring_path).shape, image4d.shape)
+
 
 if __name__ == '__main__':
     test_gibbs_flow()
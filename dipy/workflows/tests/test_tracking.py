@@ -85,7 +85,8 @@ def test_particle_filtering_traking_workflows():
         # Test tracking
         pf_track_pam = PFTrackingPAMFlow()
         assert_equal(pf_track_pam.get_short_name(), 'track_pft')
-        pf_track_pam.run(pam_path, wm_path, gm_path, csf_path, seeds_path)
+        pf_track_pam.run(pam_path, wm_path, gm_path, csf_path, seeds_path,
+                         out_dir=out_dir)
         tractogram_path = \
             pf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -98,7 +99,8 @@ def test_particle_filtering_traking_workflows():
                          gm_path,
                          csf_path,
                          seeds_path,
-                         save_seeds=True)
+                         save_seeds=True,
+                         out_dir=out_dir)
         tractogram_path = \
             pf_track_pam.last_generated_outputs['out_tractogram']
         assert_true(tractogram_has_seeds(tractogram_path))
@@ -133,7 +135,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         assert_equal(lf_track_pam.get_short_name(), 'track_local')
-        lf_track_pam.run(pam_path, gfa_path, seeds_path)
+        lf_track_pam.run(pam_path, gfa_path, seeds_path, out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -142,7 +144,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, mask_path, seeds_path,
-                         use_binary_mask=True)
+                         use_binary_mask=True, out_dir=out_dir)
 
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
@@ -152,7 +154,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, gfa_path, seeds_path,
-                         tracking_method="eudx")
+                         tracking_method="eudx", out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -161,7 +163,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, gfa_path, seeds_path,
-                         tracking_method="deterministic")
+                         tracking_method="deterministic", out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -170,7 +172,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, gfa_path, seeds_path,
-                         tracking_method="probabilistic")
+                         tracking_method="probabilistic", out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -179,7 +181,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam = LocalFiberTrackingPAMFlow()
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, gfa_path, seeds_path,
-                         tracking_method="closestpeaks")
+                         tracking_method="closestpeaks", out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_false(is_tractogram_empty(tractogram_path))
@@ -189,7 +191,7 @@ def test_local_fiber_tracking_workflow():
         lf_track_pam._force_overwrite = True
         lf_track_pam.run(pam_path, gfa_path, seeds_path,
                          tracking_method="deterministic",
-                         save_seeds=True)
+                         save_seeds=True, out_dir=out_dir)
         tractogram_path = \
             lf_track_pam.last_generated_outputs['out_tractogram']
         assert_true(tractogram_has_seeds(tractogram_path))
@@ -7,8 +7,8 @@ from dipy.direction import (DeterministicMaximumDirectionGetter,
                             ClosestPeakDirectionGetter)
 from dipy.io.image import load_nifti
 from dipy.io.peaks import load_peaks
-from dipy.io.stateful_tractogram import Space, StatefulTractogram
-from dipy.io.streamline import save_tractogram
+from dipy.io.stateful_tractogram import Space
+from dipy.io.streamline import save_tractogram_streaming
 from dipy.tracking import utils
 from dipy.tracking.local_tracking import (LocalTracking,
                                           ParticleFilteringTracking)
@@ -103,16 +103,9 @@ class LocalFiberTrackingPAMFlow(Workflow):
 
         logging.info('LocalTracking initiated')
 
-        if save_seeds:
-            streamlines, seeds = zip(*tracking_result)
-            seeds = {'seeds': seeds}
-        else:
-            streamlines = list(tracking_result)
-            seeds = {}
-
-        sft = StatefulTractogram(streamlines, seeding_path, Space.RASMM,
-                                 data_per_streamline=seeds)
-        save_tractogram(sft, out_tract, bbox_valid_check=False)
+        save_tractogram_streaming(
+            tracking_result, out_tract, seeding_path, Space.RASMM,
+            data_per_streamline_keys=['seeds'] if save_seeds else None)
         logging.info('Saved {0}'.format(out_tract))
 
     def run(self, pam_files, stopping_files, seeding_files,
@@ -315,14 +308,7 @@ class PFTrackingPAMFlow(Workflow):
 
             logging.info('ParticleFilteringTracking initiated')
 
-            if save_seeds:
-                streamlines, seeds = zip(*tracking_result)
-                seeds = {'seeds': seeds}
-            else:
-                streamlines = list(tracking_result)
-                seeds = {}
-
-            sft = StatefulTractogram(streamlines, seeding_path, Space.RASMM,
-                                     data_per_streamline=seeds)
-            save_tractogram(sft, out_tract, bbox_valid_check=False)
+            save_tractogram_streaming(
+                tracking_result, out_tract, seeding_path, Space.RASMM,
+                data_per_streamline_keys=['seeds'] if save_seeds else None)
             logging.info('Saved {0}'.format(out_tract))